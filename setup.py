@@ -32,14 +32,23 @@ setup(
     extras_require={
         'dev': [
             'flake8==6.0.0',
+            'numpy==1.26.4',
+            'orjson==3.8.3',
             'pytest-cov==4.0.0',
             'pytest==7.3.1',
             'python-dotenv==1.0.0'
+        ],
+        'gazetteer': [
+            'numpy==1.26.4'
+        ],
+        'orjson': [
+            'orjson==3.8.3'
         ]
     },
     entry_points={
         'console_scripts': [
-            'windowbox-fetch = windowbox.fetch:main'
+            'windowbox-fetch = windowbox.fetch:main',
+            'windowbox-import = windowbox.importer:main'
         ]
     },
 )
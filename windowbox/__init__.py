@@ -10,6 +10,7 @@ Attributes:
     app: The fully-configured Flask app suitable for WSGI, etc.
 """
 
+import atexit
 import windowbox.blueprints.api as api_bp
 import windowbox.blueprints.site as site_bp
 import windowbox.utils
@@ -20,17 +21,25 @@ from flask_assets import Environment
 from functools import partial
 from pathlib import Path
 from werkzeug.exceptions import NotFound
-from windowbox.clients.exiftool import ExifToolClient
+from windowbox.clients.exiftool import make_client as make_exiftool_client
+from windowbox.clients.gazetteer import GazetteerClient, make_geocoder
 from windowbox.clients.gmapi import GoogleMapsAPIClient
 from windowbox.clients.imap import IMAP_SSLClient
-from windowbox.database import db
-from windowbox.models import import_all_models
+from windowbox.clients.s3 import S3Client
+from windowbox.database import configure_engines, db
+from windowbox.models import configure_storage, import_all_models
+from windowbox.models.attachment import Attachment
+from windowbox.models.derivative import Derivative
+from windowbox.models.geocode import CachedGeocoder
+from windowbox.models.pack import PackStore
+from windowbox.storage import make_backend
 
 __version__ = '3.0.0'
 
 app = Flask(__name__)
 app.config.from_pyfile('configs/base.py')
 app.config.from_envvar('WINDOWBOX_CONFIG')
+app.json = windowbox.utils.FastJSONProvider(app)
 
 for h in app.logger.handlers:
     app.logger.removeHandler(h)  # pragma: nocover
@@ -40,14 +49,50 @@ app.logger.setLevel(app.config['APP_LOG_LEVEL'])
 
 app.attachments_path = Path(app.config['ATTACHMENTS_PATH'])
 app.derivatives_path = Path(app.config['DERIVATIVES_PATH'])
-app.exiftool_client = ExifToolClient(exiftool_bin=app.config['EXIFTOOL_BIN'])
-app.gmapi_client = GoogleMapsAPIClient(api_key=app.config['GOOGLE_MAPS_API_KEY'])
+configure_storage(
+    layout=app.config['STORAGE_LAYOUT'], fallback_layout=app.config['STORAGE_LAYOUT_FALLBACK'],
+    fsync=app.config['STORAGE_FSYNC'])
+app.object_store_client = S3Client(
+    endpoint_url=app.config['STORAGE_S3_ENDPOINT'], bucket=app.config['STORAGE_S3_BUCKET'],
+    access_key=app.config['STORAGE_S3_ACCESS_KEY'], secret_key=app.config['STORAGE_S3_SECRET_KEY'],
+    region=app.config['STORAGE_S3_REGION'], part_size=app.config['STORAGE_S3_PART_BYTES'],
+    pool_size=max(app.config['INGEST_WORKERS'], 10)) if app.config['STORAGE_BACKEND'] != 'local' else None
+for model, prefix in ((Attachment, 'attachments'), (Derivative, 'derivatives')):
+    model.storage_backend = make_backend(
+        name=app.config['STORAGE_BACKEND'], client=app.object_store_client, prefix=f'{prefix}/',
+        public_url=app.config['STORAGE_S3_PUBLIC_URL'], cache_path=Path(app.config['STORAGE_CACHE_PATH']) / prefix,
+        fsync=app.config['STORAGE_FSYNC'])
+# Pack files are local to one machine, so they only suit local storage
+app.derivative_pack_store = PackStore(
+    base_path=app.derivatives_path, max_entry_bytes=app.config['DERIVATIVE_PACK_MAX_BYTES'],
+    max_pack_bytes=app.config['DERIVATIVE_PACK_FILE_BYTES'], fsync=app.config['STORAGE_FSYNC']) if (
+        app.config['DERIVATIVE_PACK_MAX_BYTES'] and app.config['STORAGE_BACKEND'] == 'local') else None
+app.exiftool_client = make_exiftool_client(
+    exiftool_bin=app.config['EXIFTOOL_BIN'], processes=app.config['EXIFTOOL_PROCESSES'],
+    timeout=app.config['EXIFTOOL_TIMEOUT'], tag_filter=app.config['EXIFTOOL_TAG_FILTER'],
+    tags=Attachment.exif_whitelist())
+atexit.register(app.exiftool_client.close)
+geocoders = {
+    'gazetteer': GazetteerClient(
+        path=app.config['GAZETTEER_PATH'], max_distance=app.config['GAZETTEER_MAX_DISTANCE']),
+    'google': GoogleMapsAPIClient(
+        api_key=app.config['GOOGLE_MAPS_API_KEY'], base_url=app.config['GOOGLE_MAPS_BASE_URL'],
+        retries=app.config['GOOGLE_MAPS_RETRIES'], backoff=app.config['GOOGLE_MAPS_BACKOFF'],
+        pool_size=max(app.config['INGEST_WORKERS'], 1))}
+app.gmapi_client = make_geocoder([geocoders[name] for name in app.config['GEOCODER']])
+if app.config['GEOCODE_CACHE_GRID']:
+    app.gmapi_client = CachedGeocoder(
+        client=app.gmapi_client, app=app, grid=app.config['GEOCODE_CACHE_GRID'],
+        ttl=app.config['GEOCODE_CACHE_TTL'])
 app.imap_client = IMAP_SSLClient(
     host=app.config['IMAP_FETCH_HOST'], user=app.config['IMAP_FETCH_USER'],
-    password=app.config['IMAP_FETCH_PASSWORD'])
+    password=app.config['IMAP_FETCH_PASSWORD'], expunge_every=app.config['IMAP_EXPUNGE_EVERY'],
+    batch_size=app.config['IMAP_FETCH_BATCH_SIZE'], batch_bytes=app.config['IMAP_FETCH_BATCH_BYTES'],
+    prefetch=app.config['IMAP_FETCH_PREFETCH'])
 
 import_all_models()
 db.init_app(app)
+configure_engines(app)
 
 Environment(app)
 
@@ -7,16 +7,21 @@ Attributes:
     api_url_for: Wrapper for Flask's url_for() that forces URLs to be external.
 """
 
+import hashlib
 import logging
-from flask import Blueprint, abort, request, url_for
-from functools import partial
+from flask import Blueprint, abort, current_app, request, url_for
+from functools import partial, wraps
 from http import HTTPStatus
 from werkzeug.exceptions import HTTPException
 from windowbox.controllers.attachment import AttachmentController
 from windowbox.controllers.post import PostController
-from .schemas import AttachmentSchemaFull, PostSchema, PostSchemaFull
+from windowbox.database import reset_routing, route_request
+from .cache import ResponseCache
+from .schemas import ArchiveMonthSchema, AttachmentSchemaFull, PostSchema, PostSchemaFull
 
 bp = Blueprint('api', __name__, url_prefix='/api')
+bp.before_request(route_request)
+bp.teardown_request(reset_routing)
 logger = logging.getLogger(__name__)
 
 api_url_for = partial(url_for, _external=True)
@@ -29,6 +34,7 @@ def register(app):
     Args:
         app: Instance of the Flask application.
     """
+    app.api_response_cache = ResponseCache(max_bytes=app.config['API_RESPONSE_CACHE_BYTES'])
     app.register_blueprint(bp)
 
 
@@ -47,10 +53,55 @@ def http_error(exc):
             'details': exc.description}}, exc.code
 
 
-@bp.route('/posts')
-def get_many_posts():
+def conditional(version_func):
     """
-    Handler for returning a list of Posts matching the query arguments.
+    Decorate a view so that it can be validated with an ETag.
+
+    The ETag is a digest of the request URL and a cheap content version, which
+    `version_func` computes from the view's arguments without loading any
+    models. A client that already holds the current version gets a 304 before
+    the view runs at all. Otherwise the serialized body is looked up in the
+    app's ResponseCache under the ETag, and the view only runs on a miss.
+
+    Args:
+        version_func: Callable that accepts the view's keyword arguments and
+            returns a hashable version, or None if the thing being looked up
+            does not exist (in which case the view runs normally).
+
+    Returns:
+        Decorator function.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**kwargs):
+            version = version_func(**kwargs)
+            if version is None:
+                return view(**kwargs)
+
+            etag = hashlib.sha1(repr((request.url, version)).encode()).hexdigest()
+
+            if request.if_none_match.contains(etag):
+                response = current_app.response_class(status=HTTPStatus.NOT_MODIFIED, mimetype='application/json')
+            else:
+                body = current_app.api_response_cache.get(etag)
+                if body is None:
+                    body = current_app.json.response(view(**kwargs)).get_data()
+                    current_app.api_response_cache.put(etag, body)
+                response = current_app.response_class(body, mimetype='application/json')
+
+            response.set_etag(etag)
+            response.cache_control.no_cache = True
+
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def many_posts_response(*, endpoint, url_kwargs=None, **filters):
+    """
+    Build the paginated "many Posts" response shared by list endpoints.
 
     Pagination is achieved by sending ONE of the following:
       - `since`: Only return Posts with IDs higher than this value, in
@@ -61,6 +112,14 @@ def get_many_posts():
 
     Additionally, accepts an optional `limit` argument in the range 1..100 to
     control how many objects to return. If omitted, the site default is used.
+
+    Args:
+        endpoint: Name of the endpoint that `more_url` should point back to.
+        url_kwargs: Optional dict of URL arguments that `endpoint` requires.
+        filters: Any extra keyword arguments for PostController.get_many().
+
+    Returns:
+        Dict suitable for returning from a view function.
     """
     limit = request.args.get('limit')
 
@@ -68,13 +127,14 @@ def get_many_posts():
         posts, has_more, page_mode = PostController.get_many(
             since_id=request.args.get('since'),
             until_id=request.args.get('until'),
-            limit=limit or PostController.API_DEFAULT_LIMIT)
+            limit=limit or PostController.API_DEFAULT_LIMIT,
+            **filters)
     except PostController.InvalidArgument:
         abort(HTTPStatus.UNPROCESSABLE_ENTITY)
 
     more_url = None
     if has_more:
-        more_kwargs = {}
+        more_kwargs = dict(url_kwargs or {})
         if page_mode == PostController.PAGE_MODE.SINCE:
             more_kwargs['since'] = posts[-1].id
         elif page_mode == PostController.PAGE_MODE.UNTIL:
@@ -83,14 +143,49 @@ def get_many_posts():
         if limit is not None:
             more_kwargs['limit'] = limit
 
-        more_url = api_url_for('.get_many_posts', **more_kwargs)
+        more_url = api_url_for(endpoint, **more_kwargs)
 
     return {
         'posts': [PostSchema(p).to_dict() for p in posts],
         'more_url': more_url}
 
 
+@bp.route('/posts')
+@conditional(lambda: PostController.get_content_version())
+def get_many_posts():
+    """
+    Handler for returning a list of Posts matching the query arguments.
+
+    See many_posts_response() for the supported pagination arguments.
+    """
+    return many_posts_response(endpoint='.get_many_posts')
+
+
+@bp.route('/archive')
+def get_archive():
+    """
+    Handler for returning the number of Posts in each month.
+    """
+    return {
+        'months': [ArchiveMonthSchema(m).to_dict() for m in PostController.get_archive_months()]}
+
+
+@bp.route('/archive/<int:year>/<int:month>')
+@conditional(lambda year, month: PostController.get_content_version())
+def get_archive_month(year, month):
+    """
+    Handler for returning a list of Posts created during one month.
+
+    Accepts the same pagination arguments as get_many_posts().
+    """
+    url_kwargs = {'year': year, 'month': month}
+
+    return many_posts_response(
+        endpoint='.get_archive_month', url_kwargs=url_kwargs, **url_kwargs)
+
+
 @bp.route('/posts/<int:post_id>')
+@conditional(PostController.get_post_version)
 def get_post(post_id):
     """
     Handler for individual Post lookups.
@@ -115,6 +210,7 @@ def get_post(post_id):
 
 
 @bp.route('/attachments/<int:attachment_id>')
+@conditional(AttachmentController.get_version)
 def get_attachment(attachment_id):
     """
     Handler for individual Attachment lookups.
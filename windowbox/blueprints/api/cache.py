@@ -0,0 +1,70 @@
+"""
+In-process cache of serialized API response bodies.
+
+Bodies are stored under their ETag, which already covers the request URL and
+the version of the content, so an entry never needs to be invalidated; entries
+for content that has moved on are simply never asked for again, and fall out
+of the cache as newer ones are added.
+"""
+
+import threading
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """
+    Thread-safe, least-recently-used cache of bytes, bounded by total size.
+    """
+
+    def __init__(self, *, max_bytes):
+        """
+        Constructor.
+
+        Args:
+            max_bytes: Total size of the bodies to hold. Bodies larger than
+                this are never stored, so 0 disables the cache.
+        """
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        """
+        Return the number of bodies being held.
+        """
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Return the body stored under `key`, or None if there isn't one.
+        """
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+
+            return body
+
+    def put(self, key, body):
+        """
+        Store `body` under `key`, evicting the least recently used bodies.
+
+        Args:
+            key: Any hashable value, normally an ETag.
+            body: Bytes to store.
+        """
+        if len(body) > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+
+            self._entries[key] = body
+            self.size += len(body)
+
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
@@ -9,16 +9,131 @@ If the day ever comes when POST/PUT/PATCH methods need to be supported and
 validation comes into play, it will be time to put this approach away.
 """
 
-from flask import url_for
-from windowbox.models.attachment import EXIF_CATEGORIES
+from flask import g, request, url_for
+from windowbox.models.attachment import EXIF_CATEGORIES, Attachment
+
+
+class URLTemplates:
+    """
+    Precomputed pieces of the URLs that schemas link to.
+
+    Every url_for() call walks the URL map, and a page of Posts links to each
+    of its Attachments several times. Instead, each URL is built once with a
+    placeholder ID (and dimensions) and split around it; after that, building a
+    URL is only a matter of joining strings. Dimension strings are cached per
+    MIME type for the same reason.
+
+    Attributes:
+        PLACEHOLDER_ID: Integer passed to url_for() in place of real IDs.
+        PLACEHOLDER_DIMENSIONS: String passed to url_for() in place of real
+            dimension strings.
+    """
+
+    PLACEHOLDER_ID = 987654321
+    PLACEHOLDER_DIMENSIONS = 'dimensions'
+
+    def __init__(self):
+        """
+        Constructor. Must be called within a request context.
+        """
+        self.url_root = request.url_root
+        self.post_parts = self.split(url_for('api.get_post', post_id=self.PLACEHOLDER_ID, _external=True))
+        self.attachment_parts = self.split(
+            url_for('api.get_attachment', attachment_id=self.PLACEHOLDER_ID, _external=True))
+
+        derivative_url = url_for(
+            'site.get_attachment_derivative', attachment_id=self.PLACEHOLDER_ID,
+            dimensions=self.PLACEHOLDER_DIMENSIONS, _external=True)
+        head, tail = self.split(derivative_url)
+        self.derivative_parts = (head, *tail.split(self.PLACEHOLDER_DIMENSIONS, 1))
+        self.dimensions = {}
+
+    @classmethod
+    def split(cls, url):
+        """
+        Split a URL around the placeholder ID.
+
+        Returns:
+            Tuple of (prefix, suffix) strings.
+        """
+        prefix, _, suffix = url.partition(str(cls.PLACEHOLDER_ID))
+
+        return prefix, suffix
+
+    def post(self, post_id):
+        """
+        Return the API URL of the Post with ID `post_id`.
+        """
+        prefix, suffix = self.post_parts
+
+        return f'{prefix}{post_id}{suffix}'
+
+    def attachment(self, attachment_id):
+        """
+        Return the API URL of the Attachment with ID `attachment_id`.
+        """
+        prefix, suffix = self.attachment_parts
+
+        return f'{prefix}{attachment_id}{suffix}'
+
+    def derivative(self, attachment, canned_dimensions):
+        """
+        Return the same URL as attachment.derivative_url(canned_dimensions).
+
+        Dimension strings only contain characters that are safe in URLs, so
+        they are used without quoting.
+        """
+        key = (canned_dimensions, attachment.mime_type)
+        dimensions = self.dimensions.get(key)
+        if dimensions is None:
+            dimensions = self.dimensions[key] = Attachment.encode_dimensions(*key)
+
+        head, middle, tail = self.derivative_parts
+
+        return f'{head}{attachment.id}{middle}{dimensions}{tail}'
+
+
+def url_templates():
+    """
+    Return the URLTemplates for the current request, creating them if needed.
+
+    URLs are external, so they depend on the host the request came in on. The
+    templates are kept in `g`, and are rebuilt if that is shared with another
+    request (as in tests) that came in on a different host.
+    """
+    templates = g.get('api_url_templates')
+    if templates is None or templates.url_root != request.url_root:
+        templates = g.api_url_templates = URLTemplates()
+
+    return templates
+
+
+def archive_month_url(m):
+    return url_for('.get_archive_month', year=m.year, month=m.month, _external=True)
 
 
 def attachment_url(a):
-    return url_for('.get_attachment', attachment_id=a.id, _external=True)
+    return url_templates().attachment(a.id)
 
 
 def post_url(p):
-    return url_for('.get_post', post_id=p.id, _external=True)
+    return url_templates().post(p.id)
+
+
+class ArchiveMonthSchema:
+    """
+    Class for serializing an ArchiveMonth to JSON.
+    """
+
+    def __init__(self, archive_month):
+        self.archive_month = archive_month
+
+    def to_dict(self):
+        return {
+            'year': self.archive_month.year,
+            'month': self.archive_month.month,
+            'post_count': self.archive_month.post_count,
+            'posts_url': archive_month_url(self.archive_month)}
 
 
 class AttachmentSchema:
@@ -31,7 +146,7 @@ class AttachmentSchema:
         self.attachment = attachment
 
     def deriv_url(self, dim_name):
-        return self.attachment.derivative_url(dim_name, _external=True)
+        return url_templates().derivative(self.attachment, dim_name)
 
     def to_dict(self):
         return {
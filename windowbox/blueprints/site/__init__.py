@@ -9,18 +9,23 @@ Attributes:
     logger: Logger instance scoped to the current module name.
 """
 
+import io
 import logging
+from datetime import datetime
 from flask import (
-    Blueprint, abort, current_app, make_response, render_template, request, send_file)
+    Blueprint, abort, current_app, make_response, redirect, render_template, request, send_file)
 from flask_assets import Bundle
 from http import HTTPStatus
 from werkzeug.exceptions import HTTPException
 from windowbox.controllers.attachment import AttachmentController
 from windowbox.controllers.post import PostController
+from windowbox.database import reset_routing, route_request
 
 X_ACCEL_REDIRECT_ROOT = '/_derivatives'
 
 bp = Blueprint('site', __name__, template_folder='templates')
+bp.before_request(route_request)
+bp.teardown_request(reset_routing)
 logger = logging.getLogger(__name__)
 
 
@@ -56,6 +61,29 @@ def http_error(exc):
     return render_template('error.html', error_exc=exc), exc.code
 
 
+def next_page_ids(*, posts, has_more, page_mode):
+    """
+    Work out the `since`/`until` values that lead to the next page of Posts.
+
+    Args:
+        posts: List of Posts on the current page.
+        has_more: True if there is another page after this one.
+        page_mode: PostController.PAGE_MODE the current page was fetched with.
+
+    Returns:
+        Tuple of (since_id, until_id); at most one of them will be set.
+    """
+    since_id = None
+    until_id = None
+    if has_more:
+        if page_mode == PostController.PAGE_MODE.SINCE:
+            since_id = posts[-1].id
+        elif page_mode == PostController.PAGE_MODE.UNTIL:
+            until_id = posts[-1].id
+
+    return since_id, until_id
+
+
 @bp.route('/')
 def get_index():
     """
@@ -69,19 +97,43 @@ def get_index():
     except PostController.InvalidArgument:
         abort(HTTPStatus.UNPROCESSABLE_ENTITY)
 
-    since_id = None
-    until_id = None
-    if has_more:
-        if page_mode == PostController.PAGE_MODE.SINCE:
-            since_id = posts[-1].id
-        elif page_mode == PostController.PAGE_MODE.UNTIL:
-            until_id = posts[-1].id
+    since_id, until_id = next_page_ids(posts=posts, has_more=has_more, page_mode=page_mode)
 
     return render_template(
         'index.html', posts=posts, has_more=has_more,
         since_id=since_id, until_id=until_id)
 
 
+@bp.route('/archive')
+def get_archive():
+    """
+    Handler for the archive overview page.
+    """
+    return render_template('archive.html', months=PostController.get_archive_months())
+
+
+@bp.route('/archive/<int:year>/<int:month>')
+def get_archive_month(year, month):
+    """
+    Handler for the list of Posts created during one month.
+    """
+    try:
+        posts, has_more, page_mode = PostController.get_many(
+            since_id=request.args.get('since'),
+            until_id=request.args.get('until'),
+            limit=PostController.SITE_DEFAULT_LIMIT,
+            year=year, month=month)
+    except PostController.InvalidArgument:
+        abort(HTTPStatus.UNPROCESSABLE_ENTITY)
+
+    since_id, until_id = next_page_ids(posts=posts, has_more=has_more, page_mode=page_mode)
+
+    return render_template(
+        'archive_month.html', posts=posts, has_more=has_more,
+        since_id=since_id, until_id=until_id,
+        month_start=datetime(year, month, 1))
+
+
 @bp.route('/post/<int:post_id>')
 def get_post(post_id):
     """
@@ -110,11 +162,27 @@ def get_attachment_derivative(attachment_id, dimensions):
     except AttachmentController.NoResultFound:
         abort(HTTPStatus.NOT_FOUND)
 
-    if current_app.config['USE_X_ACCEL_REDIRECT']:
-        # Rewrite the Derivative's storage path to refer to the nginx alias
-        dv_base = str(derivative.base_path)
-        dv_path = str(derivative.storage_path())
-        redirect_path = f'{X_ACCEL_REDIRECT_ROOT}{dv_path[len(dv_base):]}'
+    packed = derivative.get_packed_data()
+    if packed is not None:
+        # nginx can't be pointed at a slice of a pack file, so always send these
+        logger.debug(f'Sending packed Derivative ID {derivative.id}')
+
+        return send_file(io.BytesIO(packed), mimetype=derivative.mime_type, etag=derivative.storage_name)
+
+    key = derivative.storage_key()
+    hint = derivative.backend.serve_hint(key)
+
+    if isinstance(hint, str):
+        logger.debug(f'Redirecting to Derivative ID {derivative.id} at {hint}')
+
+        return redirect(hint)
+    elif hint is None:
+        logger.debug(f'Streaming Derivative ID {derivative.id} from its backend')
+
+        return send_file(derivative.open_storage_data(), mimetype=derivative.mime_type, etag=derivative.storage_name)
+    elif current_app.config['USE_X_ACCEL_REDIRECT']:
+        # Storage keys are relative to the directory that the nginx alias refers to
+        redirect_path = f'{X_ACCEL_REDIRECT_ROOT}/{key}'
 
         logger.debug(
             f'Sending Derivative ID {derivative.id} with '
@@ -126,7 +194,7 @@ def get_attachment_derivative(attachment_id, dimensions):
     else:
         logger.debug(f'Sending Derivative ID {derivative.id} with send_file()')
 
-        return send_file(derivative.storage_path(), mimetype=derivative.mime_type)
+        return send_file(hint, mimetype=derivative.mime_type)
 
 
 @bp.route('/atom.xml')
@@ -5,7 +5,7 @@ This file defines several custom commands for use with the `flask <COMMAND>`
 utility. Broadly, these scripts can do the following:
 
     * Initialize, fill, and clear the development database.
-    * Run development reports (style checks/unit tests).
+    * Run development reports (style checks/unit tests/benchmarks).
 
 Each script tries to be a courteous command-line citizen, implementing exit
 codes and responding to `flask --help` in useful ways.
@@ -28,15 +28,25 @@ Attributes:
         image in the `flask insert` command.
     CIRCLE_AREA: 4-tuple of (x1, y1, x2, y2) outlining the bounding box for the
         inner circle in the fake image (to visually verify cropping).
+    archive_cli: Click command group for `flask archive <COMMAND>`.
+    bench_cli: Click command group for the `flask bench <COMMAND>` benchmarks.
+    fetch_cli: Click command group for `flask fetch <COMMAND>`.
+    geocode_cli: Click command group for `flask geocode <COMMAND>`.
+    storage_cli: Click command group for `flask storage <COMMAND>`.
 """
 
 import click
 import os
 import shutil
 import sys
+import threading
+import time
+from flask.cli import AppGroup
+from pathlib import Path
 from subprocess import call
 from windowbox import app
 from windowbox.database import db
+from windowbox.synthetic import EXIF_PAYLOADS
 
 DEV_DB_SUFFIX = '/dev.sqlite'
 DEV_CLI_EMAIL_ADDRESS = 'cli@localhost'
@@ -45,6 +55,29 @@ DEV_CLI_USER_AGENT = 'windowbox.cli'
 FAKE_IMAGE_DIMENSIONS = (2000, 1500)
 CIRCLE_AREA = (250, 0, 1750, 1499)
 
+archive_cli = AppGroup('archive', help='Maintain the date archive.')
+app.cli.add_command(archive_cli)
+bench_cli = AppGroup('bench', help='Run development benchmarks.')
+app.cli.add_command(bench_cli)
+fetch_cli = AppGroup('fetch', help='Inspect and reset IMAP fetch checkpoints.')
+app.cli.add_command(fetch_cli)
+geocode_cli = AppGroup('geocode', help='Maintain the reverse geocode cache.')
+app.cli.add_command(geocode_cli)
+storage_cli = AppGroup('storage', help='Maintain the Attachment and Derivative storage files.')
+app.cli.add_command(storage_cli)
+
+
+def require_local_storage():  # pragma: nocover
+    """
+    Refuse to go on unless files are kept on the local filesystem.
+
+    Raises:
+        click.ClickException: STORAGE_BACKEND is not "local".
+    """
+    if app.config['STORAGE_BACKEND'] != 'local':
+        raise click.ClickException(
+            f'This only works on local files; STORAGE_BACKEND is {app.config["STORAGE_BACKEND"]!r}')
+
 
 @app.cli.command('create')
 def cli_create():  # pragma: nocover
@@ -80,22 +113,16 @@ def cli_drop():  # pragma: nocover
     print('Dev database and storage files dropped.')
 
 
-@app.cli.command('insert')
-@click.argument('count', default=1, type=int)
-def cli_insert(count):  # pragma: nocover
+def get_or_create_cli_sender():  # pragma: nocover
     """
-    Generate COUNT Posts with Attachments and all other attributes filled in.
+    Return the Sender used for generated Posts, creating it if necessary.
 
-    If unspecified, COUNT defaults to 1.
+    Returns:
+        Sender instance, added to the current session.
     """
     import sqlalchemy.orm.exc
-    from PIL import Image, ImageDraw
-    from random import randrange
-    from windowbox.models.post import Post
     from windowbox.models.sender import Sender
 
-    print(f'Generating {count} Post(s)...')
-
     try:
         sender = Sender.query.filter_by(email_address=DEV_CLI_EMAIL_ADDRESS).one()
     except sqlalchemy.orm.exc.NoResultFound:
@@ -105,38 +132,449 @@ def cli_insert(count):  # pragma: nocover
         db.session.add(sender)
         print(f'Sender {DEV_CLI_EMAIL_ADDRESS} was created.')
 
-    for _ in range(count):
-        color = (randrange(256), randrange(256), randrange(256))
-        fake_caption = f'#{color[0]:0>2X}{color[1]:0>2X}{color[2]:0>2X}'
-        fake_image = Image.new('RGB', FAKE_IMAGE_DIMENSIONS, color)
-        draw = ImageDraw.Draw(fake_image)
-        draw.ellipse(CIRCLE_AREA, fill=(color[2], color[1], color[0]))
-
-        post = Post(
-            sender=sender,
-            caption=fake_caption,
-            user_agent=DEV_CLI_USER_AGENT)
-        db.session.add(post)
+    return sender
+
+
+def insert_fake_post(*, sender):  # pragma: nocover
+    """
+    Generate and commit one Post with an Attachment and all attributes filled.
+
+    Args:
+        sender: Sender instance that will own the new Post.
+
+    Returns:
+        The new Post instance.
+    """
+    from PIL import Image, ImageDraw
+    from random import randrange
+    from windowbox.models.post import Post
+
+    color = (randrange(256), randrange(256), randrange(256))
+    fake_caption = f'#{color[0]:0>2X}{color[1]:0>2X}{color[2]:0>2X}'
+    fake_image = Image.new('RGB', FAKE_IMAGE_DIMENSIONS, color)
+    draw = ImageDraw.Draw(fake_image)
+    draw.ellipse(CIRCLE_AREA, fill=(color[2], color[1], color[0]))
 
+    post = Post(
+        sender=sender,
+        caption=fake_caption,
+        user_agent=DEV_CLI_USER_AGENT)
+    db.session.add(post)
+
+    attachment = post.new_attachment(mime_type='image/jpeg')
+    db.session.add(attachment)
+    db.session.flush()
+
+    attachment.base_path = app.attachments_path
+    attachment.set_storage_data_from_image(fake_image)
+    attachment.populate_exif(exiftool_client=app.exiftool_client)
+
+    attachment.geo_latitude = attachment.exif['Composite:GPSLatitude.num'] = 36
+    attachment.geo_longitude = attachment.exif['Composite:GPSLongitude.num'] = -78.9
+    attachment.geo_address = 'Command Line, USA'
+
+    db.session.commit()
+
+    return post
+
+
+def insert_synthetic_batch(*, sender_id, specs, images):  # pragma: nocover
+    """
+    Add one batch of synthetic Posts, each with an Attachment, in one commit.
+
+    The Posts and Attachments go out in a single flush, and the EXIF rows are
+    inserted in bulk afterwards. No exiftool process is run; the EXIF data is
+    what exiftool would have reported for the image each spec describes.
+
+    Args:
+        sender_id: ID of the Sender that will own the new Posts.
+        specs: List of SyntheticSpec instances, one per Post.
+        images: List of JPEG bytes in the same order as `specs`, or None to
+            skip writing storage files entirely.
+    """
+    from sqlalchemy import insert
+    from windowbox.models.attachment import AttachmentEXIF
+    from windowbox.models.post import Post
+    from windowbox.synthetic import (
+        FAKE_ADDRESS, FAKE_LATITUDE, FAKE_LONGITUDE, caption_for, exif_data)
+
+    attachments = []
+    for spec in specs:
+        post = Post(sender_id=sender_id, caption=caption_for(spec), user_agent=DEV_CLI_USER_AGENT)
         attachment = post.new_attachment(mime_type='image/jpeg')
-        db.session.add(attachment)
-        db.session.flush()
 
+        if spec.exif_payload != 'none':
+            attachment.orientation = spec.orientation
+        if spec.exif_payload == 'full':
+            attachment.geo_latitude = FAKE_LATITUDE
+            attachment.geo_longitude = FAKE_LONGITUDE
+            attachment.geo_address = FAKE_ADDRESS
+
+        db.session.add(post)
+        attachments.append(attachment)
+
+    db.session.flush()
+
+    db.session.execute(insert(AttachmentEXIF), [
+        {'attachment_id': attachment.id, 'attribute': key, 'value': value}
+        for attachment, spec in zip(attachments, specs)
+        for key, value in exif_data(spec).items()])
+
+    for attachment, data in zip(attachments, images or []):
         attachment.base_path = app.attachments_path
-        attachment.set_storage_data_from_image(fake_image)
-        attachment.populate_exif(exiftool_client=app.exiftool_client)
+        attachment.set_storage_data(data)
+
+    db.session.commit()
+    db.session.expunge_all()
+
+
+def synthetic_batches(*, pool, count, batch_size, **spec_kwargs):  # pragma: nocover
+    """
+    Yield batches of synthetic specs, rendering one batch ahead of the caller.
+
+    While the caller is inserting one batch, the pool is already rendering the
+    images for the next, so at most two batches of images are held in memory.
+
+    Args:
+        pool: multiprocessing Pool to render images with, or None to skip
+            rendering.
+        count: Total number of specs to generate.
+        batch_size: Maximum number of specs per batch.
+        **spec_kwargs: Passed through to make_spec().
+
+    Yields:
+        Tuples of (specs, images), where `images` is None if `pool` is None.
+    """
+    import random
+    from windowbox.synthetic import make_spec, render_image
+
+    def submit(n):
+        specs = [make_spec(rng=random, **spec_kwargs) for _ in range(n)]
+        return specs, pool and pool.map_async(render_image, specs)
+
+    def resolve(batch):
+        specs, result = batch
+        return specs, result and result.get()
+
+    pending = None
+    for start in range(0, count, batch_size):
+        current, pending = pending, submit(min(batch_size, count - start))
+        if current is not None:
+            yield resolve(current)
+
+    if pending is not None:
+        yield resolve(pending)
+
+
+def parse_sizes(ctx, param, value):  # pragma: nocover
+    """
+    Click callback to convert repeated WIDTHxHEIGHT options into tuples.
+    """
+    from windowbox.synthetic import parse_size
+
+    try:
+        return [parse_size(v) for v in value]
+    except ValueError as exc:
+        raise click.BadParameter(str(exc))
+
+
+@app.cli.command('insert')
+@click.argument('count', default=1, type=int)
+@click.option(
+    '--bulk', is_flag=True,
+    help='Render images in parallel and insert Posts in batches, without exiftool.')
+@click.option('--batch-size', default=500, type=click.IntRange(1), help='Bulk: Posts per commit.')
+@click.option(
+    '--workers', default=None, type=click.IntRange(1),
+    help='Bulk: image rendering processes (default: one per CPU).')
+@click.option(
+    '--size', 'sizes', multiple=True, default=['2000x1500'], callback=parse_sizes,
+    help='Bulk: WIDTHxHEIGHT of the images; repeat to mix sizes.')
+@click.option(
+    '--orientation', 'orientations', multiple=True, default=[1], type=click.IntRange(1, 8),
+    help='Bulk: EXIF orientation of the images; repeat to mix orientations.')
+@click.option(
+    '--exif', 'exif_payload', default='full', type=click.Choice(EXIF_PAYLOADS),
+    help='Bulk: how much EXIF data to embed and record.')
+@click.option(
+    '--files/--no-files', default=True,
+    help='Bulk: write storage files (--no-files for database-only benchmarks).')
+def cli_insert(count, bulk, batch_size, workers, sizes, orientations, exif_payload, files):  # pragma: nocover
+    """
+    Generate COUNT Posts with Attachments and all other attributes filled in.
+
+    If unspecified, COUNT defaults to 1. By default each Post is rendered, run
+    through exiftool, and committed on its own. With --bulk, images are
+    rendered by a process pool and Posts are committed in batches, which is
+    much faster for building large load-testing datasets.
+    """
+    import multiprocessing
+
+    print(f'Generating {count} Post(s)...')
+
+    sender = get_or_create_cli_sender()
+
+    if not bulk:
+        for _ in range(count):
+            post = insert_fake_post(sender=sender)
+
+            print(f'Post {post.id}: {post.caption}')
+
+        print('Done.')
+        return
 
-        attachment.geo_latitude = attachment.exif['Composite:GPSLatitude.num'] = 36
-        attachment.geo_longitude = attachment.exif['Composite:GPSLongitude.num'] = -78.9
-        attachment.geo_address = 'Command Line, USA'
+    db.session.commit()
+    sender_id = sender.id
 
-        db.session.commit()
+    pool = multiprocessing.Pool(workers) if files else None
+    started = time.monotonic()
+    done = 0
 
-        print(f'Post {post.id}: {fake_caption}')
+    try:
+        for specs, images in synthetic_batches(
+                pool=pool, count=count, batch_size=batch_size, sizes=sizes,
+                orientations=orientations, exif_payload=exif_payload):
+            insert_synthetic_batch(sender_id=sender_id, specs=specs, images=images)
+            done += len(specs)
+
+            print(f'{done}/{count} Post(s) ({done / (time.monotonic() - started):.1f}/s)')
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
     print('Done.')
 
 
+@archive_cli.command('rebuild')
+def cli_archive_rebuild():  # pragma: nocover
+    """
+    Create the archive table/index if missing, then recount every month.
+
+    This is safe to run against any database, including production. Counts are
+    kept up to date automatically as Posts are created, so this only needs to
+    be run once on databases that predate the archive feature.
+    """
+    from windowbox.models.archive import ArchiveMonth
+    from windowbox.models.post import Post
+
+    ArchiveMonth.__table__.create(bind=db.engine, checkfirst=True)
+    for index in Post.__table__.indexes:
+        index.create(bind=db.engine, checkfirst=True)
+
+    ArchiveMonth.rebuild()
+
+    print('Archive counts rebuilt.')
+
+
+@fetch_cli.command('quarantine')
+def cli_fetch_quarantine():  # pragma: nocover
+    """
+    List the messages that have failed to ingest, and why.
+
+    The checkpoint tables are created first if missing, so this is also the
+    way to add them to a database that predates the feature.
+    """
+    from windowbox.models.checkpoint import FetchCheckpoint, QuarantinedMessage
+
+    FetchCheckpoint.__table__.create(bind=db.engine, checkfirst=True)
+    QuarantinedMessage.__table__.create(bind=db.engine, checkfirst=True)
+
+    for checkpoint in FetchCheckpoint.query.order_by(FetchCheckpoint.mailbox):
+        print(
+            f'{checkpoint.mailbox}: UIDVALIDITY {checkpoint.uid_validity}, '
+            f'last UID {checkpoint.last_uid}, {len(checkpoint.quarantine)} quarantined')
+        for uid, quarantined in sorted(checkpoint.quarantine.items()):
+            print(f'  UID {uid}: {quarantined.attempts} attempt(s), {quarantined.last_error}')
+
+
+@fetch_cli.command('release')
+@click.argument('uids', nargs=-1, type=int)
+def cli_fetch_release(uids):  # pragma: nocover
+    """
+    Let quarantined messages be retried by the next fetch.
+
+    Releases the messages with the given UIDs, or every quarantined message if
+    no UIDs are given. Their failure counts are reset, not removed, so a
+    message that fails again goes straight back into quarantine.
+    """
+    from windowbox.models.checkpoint import QuarantinedMessage
+
+    query = QuarantinedMessage.query
+    if uids:
+        query = query.filter(QuarantinedMessage.uid.in_(uids))
+
+    released = query.update({QuarantinedMessage.attempts: 0}, synchronize_session=False)
+    db.session.commit()
+
+    print(f'Released {released} message(s).')
+
+
+@geocode_cli.command('backfill')
+def cli_geocode_backfill():  # pragma: nocover
+    """
+    Create the geocode cache table if missing, then seed it from Attachments.
+
+    This is safe to run against any database, including production. Cells that
+    are already cached are left alone, so it can be re-run at any time.
+    """
+    from windowbox.models.geocode import GeocodeCache
+
+    GeocodeCache.__table__.create(bind=db.engine, checkfirst=True)
+
+    added = GeocodeCache.backfill(grid=app.config['GEOCODE_CACHE_GRID'])
+
+    print(f'Added {added} cell(s) to the geocode cache.')
+
+
+@geocode_cli.command('stats')
+def cli_geocode_stats():  # pragma: nocover
+    """
+    Show the size of the geocode cache and how often it has been useful.
+    """
+    from windowbox.models.geocode import GeocodeCache
+
+    cells, hits, misses = db.session.query(
+        db.func.count(GeocodeCache.cell),
+        db.func.coalesce(db.func.sum(GeocodeCache.hit_count), 0),
+        db.func.coalesce(db.func.sum(GeocodeCache.miss_count), 0)).one()
+    lookups = hits + misses
+
+    print(f'{cells} cell(s), {hits} hit(s), {misses} miss(es)')
+    if lookups:
+        print(f'Hit rate: {hits / lookups:.1%}')
+
+
+@storage_cli.command('dedupe')
+@click.option('--workers', default=4, type=click.IntRange(1), help='Number of files to hash at once.')
+@click.option('--batch-size', default=100, type=click.IntRange(1), help='Attachments per commit.')
+def cli_storage_dedupe(workers, batch_size):  # pragma: nocover
+    """
+    Move Attachments that predate content addressing to their SHA-256 paths.
+
+    Copies of the same data end up sharing one file, as do their Derivatives.
+    Each batch is committed before its old files are removed, so this can be
+    interrupted and re-run at any time. The sha256 column must already exist;
+    see the README. Only local storage can be deduplicated.
+    """
+    from windowbox.models.attachment import Attachment
+
+    require_local_storage()
+
+    counts = Attachment.deduplicate_storage(
+        attachments_path=app.attachments_path, derivatives_path=app.derivatives_path,
+        workers=workers, batch_size=batch_size)
+
+    print(
+        f'{counts["moved"]} moved, {counts["merged"]} merged with an existing copy, '
+        f'{counts["missing"]} missing.')
+
+
+@storage_cli.command('migrate')
+@click.option(
+    '--from', 'source', default=None, type=int,
+    help='Layout to move files out of (default: STORAGE_LAYOUT_FALLBACK).')
+@click.option('--workers', default=4, type=click.IntRange(1), help='Number of files to move at once.')
+@click.option('--batch-size', default=500, type=click.IntRange(1), help='Rows to load from the database at once.')
+def cli_storage_migrate(source, workers, batch_size):  # pragma: nocover
+    """
+    Move ID-addressed files from an old storage layout to STORAGE_LAYOUT.
+
+    Keep STORAGE_LAYOUT_FALLBACK set to the old layout while this runs, so
+    files that haven't moved yet can still be served; clear it afterwards.
+    Files that are already in place are skipped, so this can be interrupted
+    and re-run at any time. Only local storage can be migrated.
+    """
+    from windowbox.models.attachment import Attachment
+    from windowbox.models.derivative import Derivative
+
+    require_local_storage()
+
+    source = source or app.config['STORAGE_LAYOUT_FALLBACK']
+    target = app.config['STORAGE_LAYOUT']
+    if source is None or source == target:
+        raise click.ClickException(f'Nothing to migrate; give --from a layout other than {target}')
+
+    for model, base_path in ((Attachment, app.attachments_path), (Derivative, app.derivatives_path)):
+        counts = model.migrate_storage_layout(
+            base_path=base_path, source=source, target=target, workers=workers, batch_size=batch_size)
+
+        print(
+            f'{model.__name__}: {counts["moved"]} moved, {counts["already"]} already in layout {target}, '
+            f'{counts["missing"]} missing.')
+
+
+@storage_cli.command('compact')
+@click.option(
+    '--min-live', default=0.5, type=click.FloatRange(0, 1),
+    help='Fraction of a pack that must still be in use for it to be left alone.')
+@click.option(
+    '--min-age', default=3600, type=click.IntRange(0),
+    help='Seconds a pack must go unmodified before it can be rewritten.')
+def cli_storage_compact(min_live, min_age):  # pragma: nocover
+    """
+    Rewrite mostly-unused Derivative pack files to reclaim their space.
+
+    The pack index table is created first if missing, so this is also the way
+    to add it to a database that predates pack files.
+    """
+    from windowbox.models.pack import PackEntry, PackStore
+
+    PackEntry.__table__.create(bind=db.engine, checkfirst=True)
+
+    store = app.derivative_pack_store or PackStore(
+        base_path=app.derivatives_path, max_entry_bytes=0,
+        max_pack_bytes=app.config['DERIVATIVE_PACK_FILE_BYTES'], fsync=app.config['STORAGE_FSYNC'])
+    counts = store.compact(min_live_ratio=min_live, min_age=min_age)
+
+    print(f'{counts["packs"]} pack(s) removed, {counts["entries"]} entries moved, {counts["bytes"]} bytes reclaimed.')
+
+
+@storage_cli.command('sweep')
+@click.option(
+    '--min-age', default=None, type=click.IntRange(0),
+    help='Seconds a temporary file must be untouched (default: STORAGE_SWEEP_MIN_AGE, or an hour).')
+def cli_storage_sweep(min_age):  # pragma: nocover
+    """
+    Remove temporary files that interrupted writes left in the storage paths.
+    """
+    from windowbox.storage import sweep_temp_files
+
+    if min_age is None:
+        min_age = app.config['STORAGE_SWEEP_MIN_AGE'] or 60 * 60
+
+    for base_path in (app.attachments_path, app.derivatives_path):
+        removed = sweep_temp_files(base_path, min_age=min_age)
+
+        print(f'{base_path}: removed {removed} temporary file(s).')
+
+
+@storage_cli.command('trim-cache')
+@click.option(
+    '--max-bytes', default=None, type=click.IntRange(0),
+    help='Size to shrink each cache to (default: STORAGE_CACHE_MAX_BYTES).')
+def cli_storage_trim_cache(max_bytes):  # pragma: nocover
+    """
+    Remove the least recently read files from the local read-through caches.
+
+    Only applies when STORAGE_BACKEND is "cached". Everything removed is still
+    in the object store, and is cached again the next time it is read.
+    """
+    from windowbox.models.attachment import Attachment
+    from windowbox.models.derivative import Derivative
+
+    if app.config['STORAGE_BACKEND'] != 'cached':
+        raise click.ClickException('There is no cache unless STORAGE_BACKEND is "cached"')
+
+    if max_bytes is None:
+        max_bytes = app.config['STORAGE_CACHE_MAX_BYTES']
+
+    for model in (Attachment, Derivative):
+        counts = model.storage_backend.trim(max_bytes)
+
+        print(f'{model.__name__}: removed {counts["files"]} file(s), {counts["bytes"]} bytes.')
+
+
 @app.cli.command('lint')
 def cli_lint():  # pragma: nocover
     """
@@ -161,3 +599,230 @@ def cli_test(pytest_args):  # pragma: nocover
     os.environ['WINDOWBOX_CONFIG'] = 'configs/test.py'
 
     sys.exit(call(['pytest', *pytest_args]))
+
+
+def bench_reader(*, client, image_urls, deadline, tally):  # pragma: nocover
+    """
+    Alternate between index and image requests until `deadline` passes.
+
+    Args:
+        client: Flask test client owned by the calling thread.
+        image_urls: List of Derivative URLs to choose from.
+        deadline: time.monotonic() value at which to stop.
+        tally: Callable that records one result by kind name.
+    """
+    from random import choice
+
+    while time.monotonic() < deadline:
+        if choice([True, False]):
+            kind, res = 'index', client.get('/')
+        else:
+            kind, res = 'image', client.get(choice(image_urls))
+
+        tally(kind if res.status_code == 200 else 'error')
+
+
+def bench_writer(*, stop, tally):  # pragma: nocover
+    """
+    Insert fake Posts, one commit at a time, until `stop` is set.
+
+    Args:
+        stop: threading.Event signaling the benchmark is over.
+        tally: Callable that records one result by kind name.
+    """
+    with app.app_context():
+        sender = get_or_create_cli_sender()
+
+        while not stop.is_set():
+            try:
+                insert_fake_post(sender=sender)
+                tally('insert')
+            except Exception as exc:
+                db.session.rollback()
+                print(f'Insert failed: {exc}')
+                tally('error')
+
+
+@bench_cli.command('concurrency')
+@click.option('--threads', default=4, type=int, help='Number of concurrent reader threads.')
+@click.option('--duration', default=10.0, type=float, help='Seconds to run the benchmark for.')
+@click.option('--ingest/--no-ingest', default=True, help='Insert Posts while the readers run.')
+def cli_bench_concurrency(threads, duration, ingest):  # pragma: nocover
+    """
+    Measure read throughput while an ingest is writing to the database.
+
+    Reader threads alternate between the index page and a random Attachment
+    image, while (optionally) one writer thread inserts fake Posts the same way
+    `flask insert` does. Requires at least one existing Post with an
+    Attachment; run `flask insert` first if the database is empty.
+    """
+    from collections import Counter
+    from windowbox.models.attachment import Attachment
+
+    if not app.config['SQLALCHEMY_DATABASE_URI'].endswith(DEV_DB_SUFFIX):
+        raise EnvironmentError('Refusing to benchmark a non-dev database')
+
+    with app.test_request_context():
+        image_urls = [
+            a.derivative_url(dim) for a in Attachment.query
+            for dim in ('thumbnail', 'thumbnail2x', 'single', 'single2x')]
+    if not image_urls:
+        raise click.ClickException('No Attachments found; run `flask insert` first')
+
+    counts = Counter()
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def tally(kind):
+        with lock:
+            counts[kind] += 1
+
+    print(
+        f'Running {threads} reader thread(s) for {duration} seconds, '
+        f'ingest {"enabled" if ingest else "disabled"}...')
+
+    deadline = time.monotonic() + duration
+    readers = [
+        threading.Thread(target=bench_reader, kwargs={
+            'client': app.test_client(), 'image_urls': image_urls,
+            'deadline': deadline, 'tally': tally})
+        for _ in range(threads)]
+    writers = [
+        threading.Thread(target=bench_writer, kwargs={'stop': stop, 'tally': tally})
+        for _ in range(1 if ingest else 0)]
+
+    started = time.monotonic()
+    for t in readers + writers:
+        t.start()
+    for t in readers:
+        t.join()
+    stop.set()
+    for t in writers:
+        t.join()
+    elapsed = time.monotonic() - started
+
+    counts['read'] = counts['index'] + counts['image']
+    for kind in ('index', 'image', 'read', 'insert'):
+        print(f'{kind:>8}: {counts[kind]:>8} ({counts[kind] / elapsed:.1f}/s)')
+    print(f'{"error":>8}: {counts["error"]:>8}')
+
+
+def bench_url_for(page):  # pragma: nocover
+    """
+    Build every URL a page of Posts links to the way url_for() would.
+
+    Args:
+        page: List of Post instances, with their Attachments loaded.
+    """
+    from flask import url_for
+    from windowbox.blueprints.api.schemas import AttachmentSchema
+
+    for post in page:
+        url_for('api.get_post', post_id=post.id, _external=True)
+        for attachment in post.attachments:
+            url_for('api.get_attachment', attachment_id=attachment.id, _external=True)
+            for kind in AttachmentSchema.THUMBNAIL_KINDS:
+                attachment.derivative_url(kind, _external=True)
+
+
+@bench_cli.command('api-serialize')
+@click.option('--posts', default=100, type=int, help='Number of Posts on the page.')
+@click.option('--rounds', default=50, type=int, help='Number of times to serialize the page.')
+def cli_bench_api_serialize(posts, rounds):  # pragma: nocover
+    """
+    Measure how long one page of Posts takes to serialize for the API.
+
+    The newest Posts are loaded once, then repeatedly turned into the dict that
+    `/api/posts` returns, and encoded with the standard library and (if it is
+    installed) orjson. Building the same URLs with url_for() is timed for
+    comparison. Requires existing Posts; run `flask insert` first if the
+    database is empty.
+    """
+    from flask import g
+    from flask.json.provider import DefaultJSONProvider
+    from windowbox.blueprints.api.schemas import PostSchema
+    from windowbox.models.post import Post
+    from windowbox.utils import FastJSONProvider, orjson
+
+    def timed(func):
+        started = time.perf_counter()
+        for _ in range(rounds):
+            func()
+        return (time.perf_counter() - started) / rounds * 1000
+
+    def to_dict():
+        g.pop('api_url_templates', None)
+        return {'posts': [PostSchema(p).to_dict() for p in page]}
+
+    with app.test_request_context():
+        page = Post.query.order_by(Post.id.desc()).limit(posts).all()
+        if not page:
+            raise click.ClickException('No Posts found; run `flask insert` first')
+        body = to_dict()  # also loads every Post's Attachments
+
+        timings = {
+            'url_for() URLs': timed(lambda: bench_url_for(page)),
+            'to_dict()': timed(to_dict),
+            'json encode': timed(lambda: DefaultJSONProvider(app).dumps(body, separators=(',', ':'))),
+        }
+        if orjson is not None:
+            timings['orjson encode'] = timed(lambda: FastJSONProvider(app).dumps(body, separators=(',', ':')))
+
+    print(f'{len(page)} Post(s), {sum(len(p.attachments) for p in page)} Attachment(s), {rounds} round(s):')
+    for name, ms in timings.items():
+        print(f'{name:>16}: {ms:8.3f} ms/page')
+
+
+@bench_cli.command('geocode-server')
+@click.option('--port', default=8089, type=int, help='Port to listen on.')
+@click.option('--latency', default=0.1, type=float, help='Seconds to wait before each response.')
+def cli_bench_geocode_server(port, latency):  # pragma: nocover
+    """
+    Run a stand-in for the Google Maps geocoding API until interrupted.
+
+    Point `GOOGLE_MAPS_BASE_URL` at the printed URL to run windowbox-fetch or
+    windowbox-import without touching the real API. Every lookup succeeds
+    with the same address after a fixed delay.
+    """
+    from windowbox.standins import GeocodeStandIn
+
+    server = GeocodeStandIn(port=port, latency=latency)
+
+    print(f'Geocode stand-in listening on {server.base_url} ({latency}s latency)')
+
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+    print(f'Answered {len(server.requests)} request(s).')
+
+
+@bench_cli.command('object-store-server')
+@click.option('--port', default=8090, type=int, help='Port to listen on.')
+@click.option('--latency', default=0.0, type=float, help='Seconds to wait before each response.')
+@click.argument('directory', type=click.Path(file_okay=False, path_type=Path))
+def cli_bench_object_store_server(port, latency, directory):  # pragma: nocover
+    """
+    Run a stand-in S3-compatible object store until interrupted.
+
+    Objects are kept as plain files under DIRECTORY, one subdirectory per
+    bucket. Point `STORAGE_S3_ENDPOINT` at the printed URL (with any bucket
+    name and keys) to try the "s3" or "cached" storage backends locally.
+    """
+    from windowbox.standins import ObjectStoreStandIn
+
+    server = ObjectStoreStandIn(directory=directory, port=port, latency=latency)
+
+    print(f'Object store stand-in listening on {server.base_url}, storing in {directory}')
+
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+    print(f'Answered {len(server.requests)} request(s).')
@@ -1,18 +1,36 @@
 """
 Wrapper client for the ExifTool binary.
 
+Two clients are provided. ExifToolClient runs a fresh exiftool process for
+every file, which is simple but pays Perl's startup cost each time.
+StayOpenExifToolClient keeps one or more exiftool processes running in
+`-stay_open` mode and feeds them files one at a time over stdin.
+
 Attributes:
     DISCARD_PATTERNS: List of compiled regex patterns which are used to weed out
         unwanted EXIF data from ever being returned by this client.
+    DISCARD_MATCHER: Single compiled regex equivalent to all of the
+        DISCARD_PATTERNS, so output can be filtered in one pass.
+    EXCLUDE_TAGS: List of exiftool tag names (wildcards allowed) that match
+        the DISCARD_PATTERNS, so exiftool can skip them in the first place.
     FLATTEN_SEPARATOR: The character(s) to insert between key levels of a dict
         that has been run through flatten_dict().
+    READ_ARGS: List of exiftool options used when reading a file's metadata.
+    TAG_FILTERS: Tuple of the tag filter names that clients understand. "none"
+        reads every tag, including binary data, and discards the unwanted
+        ones afterwards. "exclude" asks exiftool to skip the unwanted tags and
+        binary data. "whitelist" asks exiftool for a specific list of tags.
     logger: Logger instance scoped to the current module name.
 """
 
 import json
 import logging
+import os
+import queue
 import re
+import select
 import subprocess
+import time
 
 DISCARD_PATTERNS = [
     re.compile(r'Thumbnail'),
@@ -25,7 +43,20 @@ DISCARD_PATTERNS = [
     re.compile(r'^File:FilePermissions$'),
     re.compile(r'^File:MIMEType$'),
     re.compile(r'^SourceFile$')]
+DISCARD_MATCHER = re.compile('|'.join(f'(?:{p.pattern})' for p in DISCARD_PATTERNS))
+EXCLUDE_TAGS = [
+    '*Thumbnail*',
+    'ExifTool:all',
+    'File:Directory',
+    'File:FileAccessDate',
+    'File:FileInodeChangeDate',
+    'File:FileModifyDate',
+    'File:FileName',
+    'File:FilePermissions',
+    'File:MIMEType']
 FLATTEN_SEPARATOR = '.'
+READ_ARGS = ['-groupNames', '-json', '-long']
+TAG_FILTERS = ('none', 'exclude', 'whitelist')
 
 logger = logging.getLogger(__name__)
 
@@ -78,6 +109,54 @@ def flatten_dict(src_dict, *, _prefix=''):
     return dest_dict
 
 
+def make_client(*, exiftool_bin, processes, timeout, tag_filter='none', tags=()):
+    """
+    Return the ExifTool client appropriate for the given settings.
+
+    Args:
+        exiftool_bin: Full path a suitable exiftool binary.
+        processes: Number of long-lived exiftool processes to keep. If zero,
+            a one-shot client is returned instead.
+        timeout: Seconds to wait for a long-lived process to read one file.
+        tag_filter: One of the names in TAG_FILTERS.
+        tags: List of tag names to read when `tag_filter` is "whitelist".
+
+    Returns:
+        Instance of ExifToolClient or StayOpenExifToolClient.
+    """
+    if processes > 0:
+        return StayOpenExifToolClient(
+            exiftool_bin=exiftool_bin, processes=processes, timeout=timeout,
+            tag_filter=tag_filter, tags=tags)
+
+    return ExifToolClient(exiftool_bin=exiftool_bin, tag_filter=tag_filter, tags=tags)
+
+
+def make_read_args(*, tag_filter, tags=()):
+    """
+    Build the exiftool options for reading a file with the given tag filter.
+
+    Args:
+        tag_filter: One of the names in TAG_FILTERS.
+        tags: List of "Group:Item" tag names to read when `tag_filter` is
+            "whitelist". Ignored otherwise.
+
+    Returns:
+        List of exiftool options, not including the binary or file name.
+
+    Raises:
+        ValueError: The tag filter is not known, or a whitelist is empty.
+    """
+    if tag_filter == 'none':
+        return ['-binary', *READ_ARGS]
+    elif tag_filter == 'exclude':
+        return [*READ_ARGS, *(f'--{tag}' for tag in EXCLUDE_TAGS)]
+    elif tag_filter == 'whitelist' and tags:
+        return [*READ_ARGS, *(f'-{tag}' for tag in tags)]
+
+    raise ValueError(f'Cannot use tag filter {tag_filter!r} with tags {tags!r}')
+
+
 class ExifToolClient:
     """
     Provides a simplified interface to run ExifTool and get output as a dict.
@@ -89,14 +168,17 @@ class ExifToolClient:
     metadata...) and no scrubbing/anonymization is performed.
     """
 
-    def __init__(self, *, exiftool_bin):
+    def __init__(self, *, exiftool_bin, tag_filter='none', tags=()):
         """
         Constructor.
 
         Args:
             exiftool_bin: Full path a suitable exiftool binary.
+            tag_filter: One of the names in TAG_FILTERS.
+            tags: List of tag names to read when `tag_filter` is "whitelist".
         """
         self.exiftool_bin = exiftool_bin
+        self.read_args = make_read_args(tag_filter=tag_filter, tags=tags)
 
     def read_file(self, filename):
         """
@@ -111,17 +193,236 @@ class ExifToolClient:
             "Group:Item" format, and the values are themselves dicts with
             different structures depending on the underlying data.
         """
-        args = [
-            self.exiftool_bin, '-binary', '-groupNames', '-json', '-long',
-            str(filename)]
+        exif_json = self.execute([*self.read_args, str(filename)])
+        exif_data = json.loads(exif_json)[0]
+
+        return flatten_dict({k: v for k, v in exif_data.items() if not DISCARD_MATCHER.search(k)})
+
+    def execute(self, args):
+        """
+        Run exiftool once with `args` and return everything it wrote to stdout.
+
+        Args:
+            args: List of command-line arguments, not including the binary.
+
+        Returns:
+            Bytes of output.
+
+        Raises:
+            subprocess.CalledProcessError: exiftool exited unsuccessfully.
+        """
+        args = [self.exiftool_bin, *args]
 
         logger.debug(f'Executing {" ".join(args)}...')
         exif_json = subprocess.check_output(args)
         logger.debug(f'...got {len(exif_json)} bytes')
 
-        exif_data = json.loads(exif_json)[0]
+        return exif_json
+
+    def close(self):
+        """
+        Release any resources held by the client. One-shot clients hold none.
+        """
+
+
+class ExifToolProcess:
+    """
+    One exiftool process running in `-stay_open` mode.
+
+    Arguments are written to the process's stdin one per line, followed by an
+    `-executeNUM` line. exiftool then writes its output for that command,
+    followed by a `{readyNUM}` line, to stdout. This class is not thread-safe;
+    StayOpenExifToolClient makes sure each instance has one user at a time.
+
+    Attributes:
+        CLOSE_TIMEOUT: Seconds to wait for a clean exit before killing.
+    """
+
+    CLOSE_TIMEOUT = 5
+
+    class Crashed(Exception):
+        """
+        The process exited or closed its pipes in the middle of a command.
+        """
+
+    def __init__(self, *, exiftool_bin):
+        """
+        Constructor. Starts the process.
+
+        Args:
+            exiftool_bin: Full path a suitable exiftool binary.
+        """
+        self.pid = os.getpid()
+        self.sequence = 0
+        self.popen = subprocess.Popen(
+            [exiftool_bin, '-stay_open', 'True', '-@', '-'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=0)
+
+        logger.debug(f'Started exiftool process {self.popen.pid}')
+
+    @property
+    def is_usable(self):
+        """
+        Can this process accept another command?
+
+        A process inherited from a parent across fork() is not usable, since
+        the parent may still be talking to it over the same pipes.
+
+        Returns:
+            Boolean True if the process is running and belongs to this PID.
+        """
+        return self.pid == os.getpid() and self.popen.poll() is None
+
+    def execute(self, args, *, timeout):
+        """
+        Run one command and return everything it wrote to stdout.
+
+        Args:
+            args: List of command-line arguments for this command.
+            timeout: Seconds to wait for the command to finish.
+
+        Returns:
+            Bytes of output, not including the ready marker.
+
+        Raises:
+            ExifToolProcess.Crashed: The process went away mid-command.
+            subprocess.TimeoutExpired: The command did not finish in time.
+        """
+        self.sequence += 1
+        marker = f'{{ready{self.sequence}}}\n'.encode()
+        payload = '\n'.join([*args, f'-execute{self.sequence}', '']).encode()
+
+        try:
+            self.popen.stdin.write(payload)
+        except BrokenPipeError:
+            raise self.Crashed(f'exiftool process {self.popen.pid} is gone')
+
+        fd = self.popen.stdout.fileno()
+        deadline = time.monotonic() + timeout
+        output = bytearray()
+
+        while not output.endswith(marker):
+            readable, _, _ = select.select([fd], [], [], max(deadline - time.monotonic(), 0))
+            if not readable:
+                raise subprocess.TimeoutExpired(args, timeout, output=bytes(output))
+
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                raise self.Crashed(f'exiftool process {self.popen.pid} closed its output')
+            output += chunk
+
+        return bytes(output[:-len(marker)])
+
+    def close(self):
+        """
+        Ask the process to exit, killing it if it does not do so promptly.
+        """
+        if self.pid != os.getpid():
+            return
+
+        try:
+            self.popen.stdin.write(b'-stay_open\nFalse\n')
+            self.popen.stdin.close()
+            self.popen.wait(timeout=self.CLOSE_TIMEOUT)
+        except (OSError, subprocess.TimeoutExpired):
+            self.popen.kill()
+            self.popen.wait()
+
+        self.popen.stdout.close()
+
+        logger.debug(f'Stopped exiftool process {self.popen.pid}')
+
+
+class StayOpenExifToolClient(ExifToolClient):
+    """
+    ExifTool client that reuses long-lived exiftool processes.
 
-        for pattern in DISCARD_PATTERNS:
-            exif_data = {k: v for k, v in exif_data.items() if not pattern.search(k)}
+    Up to `processes` exiftool instances are started on demand and shared by
+    all threads; a caller that finds them all busy waits its turn. A process
+    that crashes is replaced and the command is retried once. A process that
+    times out is killed and replaced on the next call. Each process belongs to
+    the OS process that started it, so a client inherited across fork() (e.g.
+    by a prefork web server) starts its own fresh processes.
+    """
+
+    def __init__(self, *, exiftool_bin, processes=1, timeout=30, tag_filter='none', tags=()):
+        """
+        Constructor.
+
+        Args:
+            exiftool_bin: Full path a suitable exiftool binary.
+            processes: Maximum number of exiftool processes to run at once.
+            timeout: Seconds to wait for exiftool to read one file.
+            tag_filter: One of the names in TAG_FILTERS.
+            tags: List of tag names to read when `tag_filter` is "whitelist".
+        """
+        super().__init__(exiftool_bin=exiftool_bin, tag_filter=tag_filter, tags=tags)
+
+        self.processes = processes
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        for _ in range(processes):
+            self._idle.put(None)
+
+    def execute(self, args):
+        """
+        Run one command on an idle exiftool process and return its stdout.
+
+        Args:
+            args: List of command-line arguments, not including the binary.
+
+        Returns:
+            Bytes of output.
+
+        Raises:
+            subprocess.CalledProcessError: exiftool produced no output (e.g.
+                the file did not exist), or it crashed twice in a row.
+            subprocess.TimeoutExpired: exiftool did not finish in time.
+        """
+        process = self._idle.get()
+
+        try:
+            for attempt in (1, 2):
+                if process is None or not process.is_usable:
+                    process = ExifToolProcess(exiftool_bin=self.exiftool_bin)
+
+                try:
+                    exif_json = process.execute(args, timeout=self.timeout)
+                    break
+                except ExifToolProcess.Crashed as exc:
+                    logger.warning(f'{exc} (attempt {attempt})')
+                    process.close()
+                    process = None
+                except subprocess.TimeoutExpired:
+                    logger.warning(f'exiftool process {process.popen.pid} timed out; killing it')
+                    process.popen.kill()
+                    process.popen.wait()
+                    process.close()
+                    process = None
+                    raise
+            else:
+                raise subprocess.CalledProcessError(-1, [self.exiftool_bin, *args])
+        finally:
+            self._idle.put(process)
+
+        if not exif_json.strip():
+            raise subprocess.CalledProcessError(1, [self.exiftool_bin, *args], output=exif_json)
+
+        logger.debug(f'...got {len(exif_json)} bytes')
+
+        return exif_json
+
+    def close(self):
+        """
+        Shut down every exiftool process this client has started.
+
+        The client remains usable afterwards; new processes will be started as
+        they are needed.
+        """
+        for _ in range(self.processes):
+            process = self._idle.get()
+            if process is not None:
+                process.close()
 
-        return flatten_dict(exif_data)
+        for _ in range(self.processes):
+            self._idle.put(None)
@@ -0,0 +1,328 @@
+"""
+Offline reverse geocoder backed by a local gazetteer.
+
+The gazetteer is a GeoNames "cities" dump (e.g. cities15000.txt from
+https://download.geonames.org/export/dump/), optionally accompanied by the
+admin1CodesASCII.txt and countryInfo.txt files from the same place, which
+provide the full names of regions and countries. Without them, the codes from
+the cities file are used as-is.
+
+NumPy is required to use the gazetteer. It is an optional dependency, which
+can be installed with the `gazetteer` extra.
+
+Attributes:
+    ADMIN1_FILE: Name of the GeoNames file that maps region codes to names.
+    COUNTRY_FILE: Name of the GeoNames file that maps country codes to names.
+    EARTH_RADIUS_KM: Mean radius of the Earth, in kilometers.
+    LEAF_SIZE: Largest number of places in one k-d tree leaf. Leaves are
+        searched in one vectorized pass, so this trades tree depth against
+        wasted comparisons.
+    logger: Logger instance scoped to the current module name.
+"""
+
+import csv
+import logging
+import math
+import threading
+from pathlib import Path
+
+try:
+    import numpy
+except ImportError:  # pragma: nocover
+    numpy = None
+
+ADMIN1_FILE = 'admin1CodesASCII.txt'
+COUNTRY_FILE = 'countryInfo.txt'
+EARTH_RADIUS_KM = 6371.0088
+LEAF_SIZE = 16
+
+logger = logging.getLogger(__name__)
+
+
+class GazetteerError(Exception):
+    """
+    Base exception class for any error that occurs within this client code.
+    """
+    pass
+
+
+def to_xyz(latitude, longitude):
+    """
+    Convert a latitude/longitude pair into a point on the unit sphere.
+
+    Straight-line distances between these points increase with great-circle
+    distance, and (unlike raw degrees) don't break down at the poles or the
+    antimeridian.
+
+    Args:
+        latitude: Number or NumPy array in the range -90 to 90.
+        longitude: Number or NumPy array in the range -180 to 180.
+
+    Returns:
+        NumPy array of (x, y, z) along its last axis.
+    """
+    lat = numpy.radians(latitude)
+    lng = numpy.radians(longitude)
+
+    return numpy.stack([
+        numpy.cos(lat) * numpy.cos(lng), numpy.cos(lat) * numpy.sin(lng), numpy.sin(lat)], axis=-1)
+
+
+def read_names(path, *, key_column, name_column):
+    """
+    Read a tab-separated GeoNames code-to-name file, if it exists.
+
+    Args:
+        path: A pathlib Path object referring to the file.
+        key_column: Index of the column holding the code.
+        name_column: Index of the column holding the name.
+
+    Returns:
+        Dict mapping codes to names, empty if the file does not exist.
+    """
+    if not path.is_file():
+        logger.debug(f'{path} not found; using codes instead of names')
+        return {}
+
+    with path.open(encoding='utf-8', newline='') as fp:
+        return {
+            row[key_column]: row[name_column]
+            for row in csv.reader(fp, delimiter='\t', quoting=csv.QUOTE_NONE)
+            if row and not row[0].startswith('#')}
+
+
+class KDTree:
+    """
+    Static 3-dimensional k-d tree for nearest-neighbor lookups.
+
+    The tree is implicit: building it only reorders an index array so that each
+    node's median sits in the middle of its range, with everything before it on
+    one side of the split and everything after it on the other. Small ranges
+    are left unsorted as leaves and scanned all at once.
+    """
+
+    def __init__(self, points):
+        """
+        Constructor.
+
+        Args:
+            points: NumPy array of shape (n, 3).
+        """
+        self.points = points
+        self.order = numpy.arange(len(points))
+        self.build(0, len(points), 0)
+
+    def build(self, lo, hi, axis):
+        """
+        Arrange the index range [lo, hi) into a subtree split on `axis`.
+        """
+        while hi - lo > LEAF_SIZE:
+            mid = (lo + hi) // 2
+            segment = self.order[lo:hi]
+            self.order[lo:hi] = segment[numpy.argpartition(self.points[segment, axis], mid - lo)]
+
+            self.build(lo, mid, (axis + 1) % 3)
+            lo, axis = mid + 1, (axis + 1) % 3
+
+    def nearest(self, point):
+        """
+        Find the point closest to `point`.
+
+        Args:
+            point: NumPy array of shape (3,).
+
+        Returns:
+            Tuple of (index into `points`, squared distance).
+        """
+        best_index, best_distance = -1, math.inf
+        stack = [(0, len(self.points), 0, 0.0)]
+
+        while stack:
+            lo, hi, axis, bound = stack.pop()
+            if bound >= best_distance:
+                continue
+
+            if hi - lo <= LEAF_SIZE:
+                indexes = self.order[lo:hi]
+                distances = ((self.points[indexes] - point) ** 2).sum(axis=1)
+                i = int(distances.argmin())
+                if distances[i] < best_distance:
+                    best_index, best_distance = int(indexes[i]), float(distances[i])
+                continue
+
+            mid = (lo + hi) // 2
+            index = self.order[mid]
+            distance = float(((self.points[index] - point) ** 2).sum())
+            if distance < best_distance:
+                best_index, best_distance = int(index), distance
+
+            offset = float(point[axis] - self.points[index, axis])
+            near, far = ((lo, mid), (mid + 1, hi)) if offset < 0 else ((mid + 1, hi), (lo, mid))
+            next_axis = (axis + 1) % 3
+            stack.append((*far, next_axis, offset * offset))
+            stack.append((*near, next_axis, 0.0))
+
+        return best_index, best_distance
+
+
+class GazetteerClient:
+    """
+    Reverse geocoder that finds the nearest populated place in a gazetteer.
+
+    This has the same latlng_to_address() method as GoogleMapsAPIClient, so it
+    can be used anywhere that one is. The gazetteer is loaded the first time
+    it's needed, and is shared by every thread after that.
+    """
+
+    def __init__(self, *, path, max_distance=50):
+        """
+        Constructor.
+
+        Args:
+            path: A pathlib Path object (or string) referring to the GeoNames
+                cities file. The region and country files are looked for in
+                the same directory.
+            max_distance: Distance in kilometers beyond which the nearest place
+                is too far away to describe a point, or None for no limit.
+        """
+        self.path = Path(path)
+        self.max_distance = max_distance
+        self.lock = threading.Lock()
+        self.tree = None
+        self.addresses = None
+
+    def load(self):
+        """
+        Read the gazetteer into memory and index it, if not already done.
+
+        Raises:
+            GazetteerError: NumPy is not installed, or the cities file could
+                not be read.
+        """
+        with self.lock:
+            if self.tree is not None:
+                return
+
+            if numpy is None:  # pragma: nocover
+                raise GazetteerError('NumPy is required; install the windowbox[gazetteer] extra')
+
+            regions = read_names(self.path.with_name(ADMIN1_FILE), key_column=0, name_column=1)
+            countries = read_names(self.path.with_name(COUNTRY_FILE), key_column=0, name_column=4)
+
+            coordinates, addresses = [], []
+            try:
+                with self.path.open(encoding='utf-8', newline='') as fp:
+                    for row in csv.reader(fp, delimiter='\t', quoting=csv.QUOTE_NONE):
+                        name, latitude, longitude, country, admin1 = row[1], row[4], row[5], row[8], row[10]
+                        coordinates.append((float(latitude), float(longitude)))
+                        addresses.append(self.format_address(
+                            name, regions.get(f'{country}.{admin1}', admin1),
+                            countries.get(country, country)))
+            except (OSError, IndexError, ValueError) as exc:
+                raise GazetteerError(f'could not read {self.path}: {exc}')
+
+            if not coordinates:
+                raise GazetteerError(f'{self.path} contains no places')
+
+            coordinates = numpy.array(coordinates)
+            self.addresses = addresses
+            self.tree = KDTree(to_xyz(coordinates[:, 0], coordinates[:, 1]))
+
+            logger.info(f'Loaded {len(addresses)} place(s) from {self.path}')
+
+    @staticmethod
+    def format_address(*parts):
+        """
+        Join the non-empty, non-repeated parts of an address with commas.
+
+        Returns:
+            String like "Durham, North Carolina, United States".
+        """
+        unique = []
+        for part in parts:
+            if part and part not in unique:
+                unique.append(part)
+
+        return ', '.join(unique)
+
+    def latlng_to_address(self, *, latitude, longitude):
+        """
+        Convert a latitude/longitude pair into a formatted address.
+
+        Args:
+            latitude: Number in the range -90 (south) to 90 (north).
+            longitude: Number in the range -180 (west) to 180 (east).
+
+        Returns:
+            String naming the nearest place, its region, and its country, or
+            None if no place is within `max_distance`.
+
+        Raises:
+            GazetteerError: The gazetteer could not be loaded.
+        """
+        self.load()
+
+        index, chord_squared = self.tree.nearest(to_xyz(float(latitude), float(longitude)))
+        distance = 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(chord_squared) / 2))
+
+        if self.max_distance is not None and distance > self.max_distance:
+            logger.debug(f'Nearest place is {distance:.1f} km away; too far')
+            return None
+
+        return self.addresses[index]
+
+
+class FallbackGeocoder:
+    """
+    Reverse geocoder that tries a list of other geocoders in order.
+
+    The first one to answer without raising wins, so a None address (nothing
+    there) is final. Errors are only raised if every geocoder fails.
+    """
+
+    def __init__(self, geocoders):
+        """
+        Constructor.
+
+        Args:
+            geocoders: List of objects with a latlng_to_address() method.
+        """
+        self.geocoders = geocoders
+
+    def latlng_to_address(self, *, latitude, longitude):
+        """
+        Convert a latitude/longitude pair into a formatted address.
+
+        Args:
+            latitude: Number in the range -90 (south) to 90 (north).
+            longitude: Number in the range -180 (west) to 180 (east).
+
+        Returns:
+            The first address successfully returned by a geocoder.
+
+        Raises:
+            Exception: Whatever the last geocoder raised, if they all failed.
+        """
+        for geocoder in self.geocoders[:-1]:
+            try:
+                return geocoder.latlng_to_address(latitude=latitude, longitude=longitude)
+            except Exception as exc:
+                logger.warning(f'{type(geocoder).__name__} failed ({exc}); falling back')
+
+        return self.geocoders[-1].latlng_to_address(latitude=latitude, longitude=longitude)
+
+
+def make_geocoder(geocoders):
+    """
+    Return a single geocoder that uses each of `geocoders` in turn.
+
+    Args:
+        geocoders: Non-empty list of objects with a latlng_to_address() method.
+
+    Returns:
+        The only geocoder if there is one, otherwise a FallbackGeocoder.
+    """
+    if len(geocoders) == 1:
+        return geocoders[0]
+
+    return FallbackGeocoder(geocoders)
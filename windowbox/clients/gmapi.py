@@ -6,7 +6,11 @@ Attributes:
 """
 
 import logging
+import os
+import random
 import requests
+import time
+from requests.adapters import HTTPAdapter
 
 logger = logging.getLogger(__name__)
 
@@ -18,17 +22,37 @@ class GMAPIClientError(Exception):
     pass
 
 
+class GMAPIRetryableError(GMAPIClientError):
+    """
+    A lookup failed in a way that might succeed if it is tried again later.
+    """
+    pass
+
+
 class GoogleMapsAPIClient:
     """
     Google Maps API Client.
 
+    Requests go through one requests Session, so connections to the API server
+    are kept alive and reused between lookups instead of paying for a new TCP
+    and TLS handshake each time. Lookups that fail in a transient way (server
+    errors, dropped connections, and rate limiting) are retried a few times,
+    waiting a random amount of time up to an exponentially-growing limit
+    between attempts so that concurrent callers don't retry in lockstep.
+
     Attributes:
-        GEOCODE_URL: URL/endpoint to use in geocode lookups.
+        BASE_URL: Default scheme and host of the API server.
+        GEOCODE_PATH: Path of the endpoint to use in geocode lookups.
+        RETRY_STATUSES: API `status` values that are worth retrying.
     """
 
-    GEOCODE_URL = 'https://maps.googleapis.com/maps/api/geocode/json'
+    BASE_URL = 'https://maps.googleapis.com'
+    GEOCODE_PATH = '/maps/api/geocode/json'
+    RETRY_STATUSES = frozenset(['OVER_QUERY_LIMIT', 'UNKNOWN_ERROR'])
 
-    def __init__(self, *, api_key, timeout=10):
+    def __init__(
+            self, *, api_key, timeout=10, base_url=None, retries=3, backoff=0.5, max_backoff=8,
+            pool_size=10):
         """
         Constructor.
 
@@ -36,9 +60,93 @@ class GoogleMapsAPIClient:
             api_key: Key to authenticate with when communicating with Google.
             timeout: Optional number of seconds to wait for a response from the
                 API server before giving up.
+            base_url: Optional scheme and host of the API server, for pointing
+                the client at a stand-in. Defaults to BASE_URL.
+            retries: Number of times to retry a lookup after a transient
+                failure before giving up.
+            backoff: Upper limit, in seconds, of the wait before the first
+                retry. The limit doubles for each retry after that.
+            max_backoff: Largest upper limit, in seconds, of any one wait.
+            pool_size: Number of keep-alive connections to hold open, which
+                should be at least the number of threads doing lookups.
         """
         self.api_key = api_key
         self.timeout = timeout
+        self.base_url = (base_url or self.BASE_URL).rstrip('/')
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.pool_size = pool_size
+        self._session = None
+        self._pid = None
+
+    @property
+    def session(self):
+        """
+        Return the requests Session to send lookups through.
+
+        A Session's pooled connections must never be shared with a forked
+        child, so each process creates its own the first time it asks.
+
+        Returns:
+            requests Session instance.
+        """
+        if self._session is None or self._pid != os.getpid():
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+            self._session = requests.Session()
+            self._session.mount('http://', adapter)
+            self._session.mount('https://', adapter)
+            self._pid = os.getpid()
+
+        return self._session
+
+    def backoff_delay(self, attempt):
+        """
+        Choose how long to wait before a retry.
+
+        Args:
+            attempt: Number of the retry about to be made, starting from 1.
+
+        Returns:
+            Number of seconds to wait.
+        """
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+    def get_geocode(self, params):
+        """
+        Make one request to the geocode endpoint.
+
+        Args:
+            params: Dict of query string parameters, not including the key.
+
+        Returns:
+            The decoded JSON response.
+
+        Raises:
+            GMAPIRetryableError: The request failed in a transient way.
+            requests.HTTPError: The server rejected the request outright.
+        """
+        logger.debug(f'GET {self.base_url}{self.GEOCODE_PATH}?<redacted>...')
+
+        try:
+            response = self.session.get(
+                f'{self.base_url}{self.GEOCODE_PATH}', params={'key': self.api_key, **params},
+                timeout=self.timeout)
+        except (requests.ConnectionError, requests.Timeout) as exc:
+            raise GMAPIRetryableError(f'request failed: {exc}')
+
+        if response.status_code >= 500:
+            raise GMAPIRetryableError(f'got server error: HTTP {response.status_code}')
+
+        response.raise_for_status()
+        response_data = response.json()
+
+        logger.debug(f'...status is {response_data["status"]}')
+
+        if response_data['status'] in self.RETRY_STATUSES:
+            raise GMAPIRetryableError(f'got retryable status: {response_data["status"]}')
+
+        return response_data
 
     def latlng_to_address(self, *, latitude, longitude):
         """
@@ -60,18 +168,22 @@ class GoogleMapsAPIClient:
         Raises:
             GMAPIClientError: The response from the API server was either not
                 successful or did not contain enough information to locate the
-                address.
+                address. GMAPIRetryableError if it was still failing after
+                every retry.
         """
-        logger.debug(f'GET {self.GEOCODE_URL}?<redacted>...')
-
-        response = requests.get(
-            self.GEOCODE_URL,
-            params={'key': self.api_key, 'latlng': f'{latitude},{longitude}'},
-            timeout=self.timeout)
-        response.raise_for_status()
-        response_data = response.json()
-
-        logger.debug(f'...status is {response_data["status"]}')
+        attempt = 0
+        while True:
+            try:
+                response_data = self.get_geocode({'latlng': f'{latitude},{longitude}'})
+                break
+            except GMAPIRetryableError as exc:
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+
+                delay = self.backoff_delay(attempt)
+                logger.warning(f'Geocode lookup failed ({exc}); retrying in {delay:.2f}s')
+                time.sleep(delay)
 
         # It's not an error if Google has zero results. (e.g. photo taken in an
         # airplane in the middle of the Pacific Ocean)
@@ -1,27 +1,54 @@
 """
 IMAP4 client to fetch (and optionally delete) email messages in a sane way.
 
-There are two components to this client: The IMAP_SSLClient, which connects to
-an IMAP mailbox and iterates over all the messages found within it; and the
+There are three components to this client: The IMAP_SSLClient, which connects
+to an IMAP mailbox and iterates over all the messages found within it; the
 IMAPMessage, which represents a single email message within the mailbox and
-provides methods to extract metadata, text, and attachments from it.
+provides methods to extract metadata, text, and attachments from it; and the
+ExpungeBatch, which lets deleted messages be expunged together rather than one
+at a time.
 
 Attributes:
     UID_EXTRACTOR: Compiled regex used to locate a UID in an IMAP response.
+    SIZE_EXTRACTOR: Compiled regex used to locate a message size in an IMAP
+        response.
+    DATE_EXTRACTOR: Compiled regex used to locate the (possibly folded) value
+        of the Date header in a block of raw message headers.
+    STOP_CHECK_INTERVAL: Maximum number of seconds that idle() waits between
+        checks of its `stop` event.
+    BASE64_CHUNK_CHARS: Number of encoded characters that write_part()
+        decodes at a time.
+    BASE64_JUNK: Compiled regex matching characters that are not part of the
+        base64 alphabet (line breaks, mostly).
     logger: Logger instance scoped to the current module name.
 """
 
+import binascii
 import email
 import email.policy
 import email.utils
 import imaplib
 import logging
 import re
+import select
 import ssl
-from collections import defaultdict
+import tempfile
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
 from operator import itemgetter
+from pathlib import Path
+from windowbox.metrics import NULL_METRICS
 
-UID_EXTRACTOR = re.compile(rb'UID\s+(\d+)\s+')
+UID_EXTRACTOR = re.compile(rb'UID\s+(\d+)\b')
+SIZE_EXTRACTOR = re.compile(rb'RFC822\.SIZE\s+(\d+)')
+DATE_EXTRACTOR = re.compile(rb'^Date:[ \t]*(.*(?:\r?\n[ \t].*)*)', re.IGNORECASE | re.MULTILINE)
+STOP_CHECK_INTERVAL = 1
+BASE64_CHUNK_CHARS = 256 * 1024
+BASE64_JUNK = re.compile(r'[^A-Za-z0-9+/]')
 
 logger = logging.getLogger(__name__)
 
@@ -56,6 +83,196 @@ def check_restype(restype, exc_message):
         raise IMAPClientError(exc_message)
 
 
+def refresh_capabilities(connection):
+    """
+    Ask the server for its capabilities again and store them on `connection`.
+
+    imaplib only reads the capability list once, when it first connects, but
+    some servers (Gmail among them) advertise extensions like UIDPLUS only to
+    clients that have logged in. Call this after LOGIN so that later decisions
+    are based on what the authenticated session actually supports.
+
+    Args:
+        connection: An imaplib IMAP4 connection instance. Its `capabilities`
+            attribute is replaced.
+
+    Raises:
+        IMAPClientError: The CAPABILITY command failed.
+    """
+    restype, [data] = connection.capability()
+    check_restype(restype, 'failed to execute CAPABILITY')
+    connection.capabilities = tuple(data.decode().upper().split())
+
+
+def read_uid_validity(connection):
+    """
+    Return the UIDVALIDITY that the server reported for the selected mailbox.
+
+    Args:
+        connection: An imaplib IMAP4 connection that has just SELECTed a
+            mailbox.
+
+    Returns:
+        Integer UIDVALIDITY, or None if the server did not report one.
+    """
+    _, [uid_validity] = connection.response('UIDVALIDITY')
+
+    try:
+        return int(uid_validity)
+    except (TypeError, ValueError):
+        logger.warning(f'Server reported unusable UIDVALIDITY {uid_validity!r}')
+        return None
+
+
+def idle(connection, *, timeout, stop=None):
+    """
+    Send IDLE on `connection` and wait until the server reports new mail.
+
+    imaplib (before Python 3.14) has no IDLE support, so this drives the
+    command by hand: send IDLE, wait for the continuation, wait up to
+    `timeout` seconds for an untagged response, then send DONE and read up to
+    the tagged completion. The wait uses select() on the socket rather than a
+    socket timeout, since a timed-out read leaves imaplib's file object
+    unusable.
+
+    Args:
+        connection: An imaplib IMAP4 connection instance (not wrapped).
+        timeout: Seconds to wait. Servers may drop connections that idle for
+            more than 29 minutes, so this should be comfortably less.
+        stop: Optional threading.Event that ends the wait early when set. It
+            is checked about once per STOP_CHECK_INTERVAL.
+
+    Returns:
+        Boolean True if the server reported new messages (EXISTS) during the
+        wait, False if the wait timed out or ended for some other reason.
+
+    Raises:
+        IMAPClientError: The server refused or failed the IDLE command.
+    """
+    tag = connection._new_tag()
+    connection.send(tag + b' IDLE\r\n')
+
+    line = connection._get_line()
+    if not line.startswith(b'+'):
+        raise IMAPClientError(f'server refused IDLE: {line!r}')
+
+    logger.debug(f'Idling for up to {timeout} seconds')
+    deadline = time.monotonic() + timeout
+    ready = connection.sock.pending() > 0
+    while not ready and not (stop is not None and stop.is_set()):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        ready = bool(select.select([connection.sock], [], [], min(remaining, STOP_CHECK_INTERVAL))[0])
+
+    got_mail = False
+    if ready:
+        line = connection._get_line()
+        logger.debug(f'Woke from IDLE with {line!r}')
+        got_mail = line.endswith(b'EXISTS')
+
+    connection.send(b'DONE\r\n')
+
+    while not line.startswith(tag):
+        line = connection._get_line()
+        got_mail = got_mail or line.endswith(b'EXISTS')
+
+    if not line.startswith(tag + b' OK'):
+        raise IMAPClientError(f'IDLE failed: {line!r}')
+
+    return got_mail
+
+
+class SerializedConnection:
+    """
+    Wraps an IMAP4 connection so that multiple threads can take turns using it.
+
+    Every method call on the wrapper holds a lock for its duration, so a
+    command issued by one thread never interleaves with another thread's
+    command on the wire. Non-callable attributes are passed through as-is.
+    """
+
+    def __init__(self, connection):
+        """
+        Constructor.
+
+        Args:
+            connection: An imaplib IMAP4 connection instance.
+        """
+        self.connection = connection
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        """
+        Return the named attribute of the connection, wrapped in the lock.
+        """
+        attr = getattr(self.connection, name)
+        if not callable(attr):
+            return attr
+
+        def locked(*args, **kwargs):
+            with self.lock:
+                return attr(*args, **kwargs)
+
+        return locked
+
+
+class ExpungeBatch:
+    """
+    Collects the UIDs of messages flagged as deleted and expunges them together.
+
+    Each EXPUNGE is a slow round trip (particularly on Gmail) and may renumber
+    the messages in the mailbox, so it pays to do as few of them as possible.
+    If the server supports UIDPLUS, only the UIDs added to this batch are
+    expunged; otherwise a plain EXPUNGE removes every message flagged deleted.
+    """
+
+    def __init__(self, *, imap_connection, size, metrics=NULL_METRICS):
+        """
+        Constructor.
+
+        Args:
+            imap_connection: A reference to the IMAP4 connection to the mailbox.
+            size: Expunge automatically once this many UIDs are pending.
+            metrics: RunMetrics to time each EXPUNGE in.
+        """
+        self.imap_connection = imap_connection
+        self.size = size
+        self.metrics = metrics
+        self.pending = []
+
+    def add(self, uid):
+        """
+        Add the UID of a message that has been flagged as deleted.
+
+        Args:
+            uid: The IMAP4 UID of the deleted message.
+        """
+        self.pending.append(uid)
+
+        if len(self.pending) >= self.size:
+            self.expunge()
+
+    def expunge(self):
+        """
+        Expunge every pending UID from the mailbox, if there are any.
+        """
+        if not self.pending:
+            return
+
+        with self.metrics.timed('imap_expunge'):
+            if 'UIDPLUS' in self.imap_connection.capabilities:
+                message_set = b','.join(self.pending)
+                logger.debug(f'Expunging UIDs {message_set.decode()}')
+                restype, _ = self.imap_connection.uid('EXPUNGE', message_set)
+            else:
+                logger.debug(f'Expunging ({len(self.pending)} deleted)')
+                restype, _ = self.imap_connection.expunge()
+        check_restype(restype, 'failed to EXPUNGE')
+
+        self.pending.clear()
+
+
 class IMAP_SSLClient:
     """
     IMAP4 (SSL) email client.
@@ -65,11 +282,29 @@ class IMAP_SSLClient:
             constructor if unspecified. Set to the standard IMAP4 SSL port.
         DEFAULT_MAILBOX: Value to be used for the `mailbox` attribute of the
             yield_messages() method if unspecified. Set to "INBOX".
+        DEFAULT_EXPUNGE_EVERY: Value to be used for the `expunge_every`
+            attribute of the constructor if unspecified.
+        DEFAULT_BATCH_SIZE: Value to be used for the `batch_size` attribute of
+            the constructor if unspecified.
+        DEFAULT_BATCH_BYTES: Value to be used for the `batch_bytes` attribute
+            of the constructor if unspecified.
+        DEFAULT_PREFETCH: Value to be used for the `prefetch` attribute of the
+            constructor if unspecified.
+        DEFAULT_POLL_INTERVAL: Value to be used for the `poll_interval`
+            attribute of wait_for_mail() if unspecified.
     """
     DEFAULT_PORT = imaplib.IMAP4_SSL_PORT
     DEFAULT_MAILBOX = 'INBOX'
+    DEFAULT_EXPUNGE_EVERY = 50
+    DEFAULT_BATCH_SIZE = 20
+    DEFAULT_BATCH_BYTES = 32 * 1024 * 1024
+    DEFAULT_PREFETCH = 1
+    DEFAULT_POLL_INTERVAL = 60
 
-    def __init__(self, *, host, port=DEFAULT_PORT, user, password):
+    def __init__(
+            self, *, host, port=DEFAULT_PORT, user, password,
+            expunge_every=DEFAULT_EXPUNGE_EVERY, batch_size=DEFAULT_BATCH_SIZE,
+            batch_bytes=DEFAULT_BATCH_BYTES, prefetch=DEFAULT_PREFETCH):
         """
         Constructor.
 
@@ -79,14 +314,63 @@ class IMAP_SSLClient:
                 uses the default.
             user: The user name or email address to send with the LOGIN command.
             password: The password to send with the LOGIN command.
+            expunge_every: Number of deleted messages to accumulate before
+                sending an EXPUNGE. Whatever is left over is expunged once the
+                caller stops iterating over yield_messages().
+            batch_size: Maximum number of full messages to request in a single
+                FETCH command.
+            batch_bytes: Maximum combined size of the messages requested in a
+                single FETCH command. A message larger than this is fetched on
+                its own.
+            prefetch: Number of batches to fetch in the background while the
+                caller is processing the current one. Peak memory use is about
+                (prefetch + 1) * batch_bytes. If zero, each batch is fetched
+                only after the caller is done with the previous one.
         """
         self.host = host
         self.port = port
         self.user = user
         self.password = password
+        self.expunge_every = expunge_every
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.prefetch = prefetch
 
     @staticmethod
-    def date_uid_map(data):
+    def message_date(chunk):
+        """
+        Find the date of one message in a FETCH response chunk.
+
+        The Date header is preferred, since it's when the message was written.
+        It's found with a regex rather than a full header parse, which matters
+        when there are thousands of messages to sort. If the message has no
+        usable Date header, the server's INTERNALDATE is used instead, when the
+        response includes it.
+
+        Args:
+            chunk: Tuple of (response line, header bytes) from a FETCH command.
+
+        Returns:
+            Timezone-aware datetime, or None if no date could be found.
+        """
+        match = DATE_EXTRACTOR.search(chunk[1] or b'')
+        if match is not None:
+            try:
+                date = email.utils.parsedate_to_datetime(b' '.join(match.group(1).split()).decode('latin-1'))
+            except (TypeError, ValueError):
+                date = None
+
+            if date is not None:
+                return date if date.tzinfo is not None else date.replace(tzinfo=timezone.utc)
+
+        internal = imaplib.Internaldate2tuple(chunk[0])
+        if internal is not None:
+            return datetime.fromtimestamp(time.mktime(internal), timezone.utc)
+
+        return None
+
+    @classmethod
+    def date_uid_map(cls, data):
         """
         Parse IMAP response data and yield date/UID tuples.
 
@@ -102,14 +386,14 @@ class IMAP_SSLClient:
 
         Args:
             data: Raw response data from an IMAP FETCH command. Only needs to
-                include the headers, but could optionally contain complete
-                messages.
+                include the Date header and/or INTERNALDATE, but could
+                optionally contain complete messages.
 
         Yields:
             Tuple of (date, uid) for each message encountered in the input.
 
         Raises:
-            IMAPClientError: If the UID value could not be extracted.
+            IMAPClientError: If the UID or date could not be extracted.
         """
         for chunk in data:
             # Messages are terminated with a `)` byte that we can skip
@@ -123,27 +407,275 @@ class IMAP_SSLClient:
                 raise IMAPClientError('could not find a UID')
             uid = match.group(1)
 
-            # Parse the headers and extract the date from the second part
-            msg = email.message_from_bytes(chunk[1], policy=email.policy.SMTP)
-            if msg['date'] is None:
+            date = cls.message_date(chunk)
+            if date is None:
                 logger.debug(f'Could not find a date header in UID {str(uid)}')
                 raise IMAPClientError('could not find a date header')
-            date = email.utils.parsedate_to_datetime(msg['date'])
 
             yield (date, uid)
 
-    def yield_messages(self, *, mailbox=DEFAULT_MAILBOX):
+    @staticmethod
+    def message_set(uids):
+        """
+        Describe a collection of UIDs as compactly as IMAP allows.
+
+        Args:
+            uids: Iterable of integer UIDs, in any order.
+
+        Returns:
+            String like "1:3,7,9:12".
+        """
+        ranges = []
+
+        for uid in sorted(set(uids)):
+            if ranges and ranges[-1][1] == uid - 1:
+                ranges[-1][1] = uid
+            else:
+                ranges.append([uid, uid])
+
+        return ','.join(str(lo) if lo == hi else f'{lo}:{hi}' for lo, hi in ranges)
+
+    @staticmethod
+    def uid_size_map(data):
+        """
+        Parse IMAP response data and yield UID/size tuples.
+
+        Args:
+            data: Raw response data from an IMAP FETCH command that requested
+                the RFC822.SIZE of each message.
+
+        Yields:
+            Tuple of (uid, size) for each message encountered in the input. If
+            the server did not report a size, it is given as zero.
+        """
+        for chunk in data:
+            # Without a literal (e.g. only the size was requested), each
+            # message is a plain bytes line rather than a tuple
+            line = chunk[0] if isinstance(chunk, tuple) else chunk
+            if not isinstance(line, bytes):
+                continue
+
+            match = UID_EXTRACTOR.search(line)
+            size = SIZE_EXTRACTOR.search(line)
+            if match is None or (size is None and line is chunk):
+                continue
+
+            yield (match.group(1), int(size.group(1)) if size else 0)
+
+    @staticmethod
+    def plan_batches(*, uids, sizes, batch_size, batch_bytes):
+        """
+        Split an ordered list of UIDs into batches for fetching.
+
+        Each batch holds at most `batch_size` UIDs whose `sizes` add up to no
+        more than `batch_bytes`, except that a single UID that is too large on
+        its own gets a batch to itself. The order of `uids` is preserved.
+
+        Args:
+            uids: List of UIDs, in the order they should be processed.
+            sizes: Mapping of UIDs to message sizes in bytes. Missing UIDs are
+                assumed to be zero-sized.
+            batch_size: Maximum number of UIDs in each batch.
+            batch_bytes: Maximum combined message size of each batch.
+
+        Returns:
+            List of lists of UIDs.
+        """
+        batches = []
+        batch, batch_total = [], 0
+
+        for uid in uids:
+            size = sizes.get(uid, 0)
+
+            if batch and (len(batch) >= batch_size or batch_total + size > batch_bytes):
+                batches.append(batch)
+                batch, batch_total = [], 0
+
+            batch.append(uid)
+            batch_total += size
+
+        if batch:
+            batches.append(batch)
+
+        return batches
+
+    @staticmethod
+    def message_data_by_uid(data):
+        """
+        Parse full-message FETCH response data into per-UID pieces.
+
+        Most servers put the UID before the message literal, but the order of
+        FETCH response items is not guaranteed, and some put it in the chunk
+        that closes the literal instead. Both placements are handled.
+
+        Args:
+            data: Raw response data from an IMAP FETCH command that requested
+                complete messages.
+
+        Returns:
+            Dict mapping each UID found to data suitable for the IMAPMessage
+            constructor.
+        """
+        data_by_uid = {}
+        unclaimed = None
+
+        for chunk in data:
+            if isinstance(chunk, tuple):
+                match = UID_EXTRACTOR.search(chunk[0])
+                if match is not None:
+                    data_by_uid[match.group(1)] = [chunk]
+                unclaimed = None if match else chunk
+                continue
+
+            if unclaimed is not None:
+                match = UID_EXTRACTOR.search(chunk)
+                if match is not None:
+                    data_by_uid[match.group(1)] = [unclaimed]
+                unclaimed = None
+
+        return data_by_uid
+
+    @classmethod
+    def fetch_batch(cls, imap_connection, uids):
+        """
+        Fetch the full content of several messages in one FETCH command.
+
+        If the response doesn't account for a UID, that message is requested
+        again on its own before giving up on it.
+
+        Args:
+            imap_connection: A reference to the IMAP4 connection to the mailbox.
+            uids: List of UIDs to fetch.
+
+        Returns:
+            List of (uid, data) tuples in the same order as `uids`, where each
+            `data` is suitable for the IMAPMessage constructor. UIDs that the
+            server did not return (e.g. because the message was deleted in the
+            meantime) are skipped.
+
+        Raises:
+            IMAPClientError: A FETCH command failed.
+        """
+        message_set = b','.join(uids)
+        logger.debug(f'Fetching messages UIDs {message_set.decode()}')
+        restype, resdata = imap_connection.uid('FETCH', message_set, '(RFC822)')
+        check_restype(restype, f'failed to execute FETCH UIDs {message_set.decode()} (full)')
+        data_by_uid = cls.message_data_by_uid(resdata)
+
+        for uid in uids:
+            if uid in data_by_uid or len(uids) == 1:
+                continue
+
+            logger.debug(f'Batch response lacked UID {int(uid)}; fetching it alone')
+            restype, resdata = imap_connection.uid('FETCH', uid, '(RFC822)')
+            check_restype(restype, f'failed to execute FETCH UIDs {uid.decode()} (full)')
+            data_by_uid.update(cls.message_data_by_uid(resdata))
+
+        for uid in uids:
+            if uid not in data_by_uid:
+                logger.warning(f'Server did not return message UID {int(uid)}; skipping')
+
+        return [(uid, data_by_uid[uid]) for uid in uids if uid in data_by_uid]
+
+    @contextmanager
+    def connect(self, *, mailbox=DEFAULT_MAILBOX, metrics=NULL_METRICS):
+        """
+        Open an IMAP connection, log in, and select `mailbox`.
+
+        Args:
+            mailbox: The name of the mailbox to use. If unspecified, uses the
+                default.
+            metrics: RunMetrics to time connecting, logging in, and selecting
+                in.
+
+        Yields:
+            SerializedConnection wrapping the authenticated IMAP4 connection.
+            Its `mailbox` attribute names the user, host, and mailbox, and its
+            `uid_validity` attribute holds the mailbox's UIDVALIDITY (or None
+            if the server didn't report it). The connection is logged out when
+            the context exits.
+
+        Raises:
+            IMAPClientError: Either LOGIN or SELECT failed.
+        """
+        with metrics.timed('imap_connect'):
+            connection = imaplib.IMAP4_SSL(
+                host=self.host, port=self.port, ssl_context=ssl.create_default_context())
+
+        with connection as raw_ic:
+            ic = SerializedConnection(raw_ic)
+
+            logger.debug(f'Logging in as {self.user}')
+            with metrics.timed('imap_login'):
+                restype, _ = ic.login(user=self.user, password=self.password)
+                check_restype(restype, f'failed to LOGIN as {self.user}')
+                refresh_capabilities(raw_ic)
+
+            logger.debug(f'Selecting mailbox {mailbox}')
+            with metrics.timed('imap_select'):
+                restype, _ = ic.select(mailbox=mailbox)
+            check_restype(restype, f'failed to SELECT mailbox {mailbox}')
+            ic.mailbox = f'{self.user}@{self.host}/{mailbox}'
+            ic.uid_validity = read_uid_validity(raw_ic)
+
+            yield ic
+
+    def wait_for_mail(self, connection, *, timeout, poll_interval=DEFAULT_POLL_INTERVAL, stop=None):
+        """
+        Block until new mail might have arrived in the selected mailbox.
+
+        Uses IMAP IDLE if the server supports it. Otherwise, sleeps for
+        `poll_interval` seconds and then sends a NOOP, which both keeps the
+        connection alive and gives the server a chance to report new mail.
+
+        Args:
+            connection: SerializedConnection, as yielded by connect().
+            timeout: Maximum number of seconds to IDLE for.
+            poll_interval: Seconds to sleep between NOOPs when IDLE is not
+                available.
+            stop: Optional threading.Event that ends the wait early when set.
+
+        Raises:
+            IMAPClientError: The IDLE or NOOP command failed.
+        """
+        if 'IDLE' in connection.capabilities:
+            with connection.lock:
+                idle(connection.connection, timeout=timeout, stop=stop)
+            return
+
+        if stop is not None:
+            stop.wait(poll_interval)
+        else:
+            time.sleep(poll_interval)
+        restype, _ = connection.noop()
+        check_restype(restype, 'failed to execute NOOP')
+
+    def yield_messages(
+            self, *, mailbox=DEFAULT_MAILBOX, connection=None, min_uid=1, retry_uids=(), metrics=NULL_METRICS):
         """
         Open up an IMAP mailbox and iterate over all messages found within.
 
         Messages do not need to be in an "unread" state to be found here; any
         message in the mailbox, regardless of age or read state, is considered.
         In order to prevent the same messages from being found again, they must
-        be physically moved into a different mailbox or deleted.
+        be physically moved into a different mailbox or deleted. Deleted
+        messages are expunged in batches, and finally when iteration stops for
+        any reason.
+
+        Full messages are fetched several at a time (see `batch_size` and
+        `batch_bytes`), and up to `prefetch` batches are fetched by a background
+        thread while the caller works on the current one. The background thread
+        and the caller share the IMAP connection through a lock.
 
         Args:
             mailbox: The name of the mailbox to use. If unspecified, uses the
-                default.
+                default. Ignored if `connection` is provided.
+            connection: Optional SerializedConnection, as yielded by connect(),
+                to reuse. If None, a new connection is opened and closed.
+            min_uid: Only consider messages with a UID of at least this value...
+            retry_uids: ...or one of these (lower) UIDs.
+            metrics: RunMetrics to time each IMAP command (and the parsing of
+                each message) in.
 
         Yields:
            For each message discovered within the mailbox.
@@ -153,48 +685,192 @@ class IMAP_SSLClient:
                 yield. Some callers may prefer this condition to be expressed as
                 an empty generator, but Windowbox likes this behavior.
         """
-        with imaplib.IMAP4_SSL(
-                host=self.host, port=self.port,
-                ssl_context=ssl.create_default_context()) as ic:
-            logger.debug(f'Logging in as {self.user}')
-            restype, _ = ic.login(user=self.user, password=self.password)
-            check_restype(restype, f'failed to LOGIN as {self.user}')
+        if connection is None:
+            with self.connect(mailbox=mailbox, metrics=metrics) as ic:
+                yield from self.yield_messages(
+                    connection=ic, min_uid=min_uid, retry_uids=retry_uids, metrics=metrics)
+            return
 
-            logger.debug(f'Selecting mailbox {mailbox}')
-            restype, _ = ic.select(mailbox=mailbox)
-            check_restype(restype, f'failed to SELECT mailbox {mailbox}')
+        ic = connection
+
+        uids, sizes = self.dated_uids(ic, min_uid=min_uid, retry_uids=retry_uids, metrics=metrics)
+
+        # Group all UIDs, in date order from oldest to newest, into batches.
+        batches = iter(self.plan_batches(
+            uids=uids, sizes=sizes, batch_size=self.batch_size, batch_bytes=self.batch_bytes))
+
+        yield from self._yield_batches(ic=ic, batches=batches, metrics=metrics)
+
+    def dated_uids(self, ic, *, min_uid=1, retry_uids=(), metrics=NULL_METRICS):
+        """
+        List the UIDs in the mailbox from oldest to newest, with their sizes.
+
+        If the server supports SORT, it does the work and only the sizes need to
+        be fetched. Otherwise the Date header (and INTERNALDATE, in case there
+        is no Date header) is fetched for exactly the UIDs that SEARCH found,
+        and the sorting happens here.
+
+        Args:
+            ic: IMAP4 connection (or SerializedConnection) with a mailbox
+                selected.
+            min_uid: Only consider messages with a UID of at least this value...
+            retry_uids: ...or one of these (lower) UIDs.
+            metrics: RunMetrics to time the SEARCH/SORT and FETCH in.
+
+        Returns:
+            Tuple of (uids, sizes), where `uids` is a list of UIDs in date
+            order and `sizes` maps UIDs to message sizes in bytes.
+
+        Raises:
+            NoMessages: There are no messages to consider.
+            IMAPClientError: A SEARCH, SORT, or FETCH command failed.
+        """
+        # Query for *all* message UIDs in the selected mailbox (or all from
+        # `min_uid` up). Note that "n:*" always matches the highest UID, even
+        # if it's below n.
+        logger.debug(f'Getting UID list from {min_uid}')
+        criteria = 'ALL' if min_uid <= 1 else f'UID {min_uid}:*'
+        retry_uids = set(retry_uids)
+        if retry_uids and min_uid > 1:
+            criteria = f'UID {self.message_set(retry_uids)},{min_uid}:*'
+        can_sort = 'SORT' in ic.capabilities
+
+        with metrics.timed('imap_search'):
+            if can_sort:
+                restype, [uids] = ic.uid('SORT', '(DATE)', 'UTF-8', criteria)
+                check_restype(restype, 'failed to execute SORT')
+            else:
+                restype, [uids] = ic.uid('SEARCH', criteria)
+                check_restype(restype, 'failed to execute SEARCH')
+        uids = [
+            uid for uid in map(int, filter(None, (uids or b'').split(b' ')))
+            if uid >= min_uid or uid in retry_uids]
+
+        # In the event that the mailbox is empty, there will be no UIDs and
+        # nothing more to do.
+        if not uids:
+            logger.debug('No messages in this mailbox')
+            raise NoMessages
+
+        # Fetch the sizes (and, if needed, dates) of exactly those messages.
+        message_set = self.message_set(uids)
+        items = '(RFC822.SIZE)' if can_sort else '(RFC822.SIZE INTERNALDATE BODY.PEEK[HEADER.FIELDS (DATE)])'
+        logger.debug(f'Fetching {items} for UIDs {message_set}')
+        with metrics.timed('imap_headers'):
+            restype, resdata = ic.uid('FETCH', message_set, items)
+        check_restype(restype, f'failed to execute FETCH UIDs {message_set} (peek)')
+        sizes = dict(self.uid_size_map(data=resdata))
+
+        if can_sort:
+            return [str(uid).encode() for uid in uids], sizes
+
+        return [uid for _, uid in sorted(self.date_uid_map(data=resdata), key=itemgetter(0))], sizes
+
+    def _yield_batches(self, *, ic, batches, metrics=NULL_METRICS):
+        """
+        Fetch `batches` in the background and yield their messages in order.
 
-            # First, query for *all* message UIDs in the selected mailbox.
-            # Interpret the response as a list of integers.
-            logger.debug('Getting UID list')
-            restype, [uids] = ic.uid('SEARCH', 'ALL')
-            check_restype(restype, 'failed to execute SEARCH')
-            uids = [*map(int, filter(None, uids.split(b' ')))]
-
-            # In the event that the mailbox is empty, there will be no UIDs and
-            # nothing more to do.
-            if not uids:
-                logger.debug('No messages in this mailbox')
-                raise NoMessages
-
-            # Fetch a range of message headers, from the smallest UID to the
-            # largest UID. Build a structure that links each UID to the `Date`
-            # header on the message it refers to.
-            message_set = f'{min(uids)}:{max(uids)}'
-            logger.debug(f'Fetching headers in UID range {message_set}')
-            restype, resdata = ic.uid('FETCH', message_set, '(BODY.PEEK[HEADER])')
-            check_restype(restype, f'failed to execute FETCH UIDs {message_set} (peek)')
-            uids_dated = self.date_uid_map(data=resdata)
-
-            # Iterate over all UIDs in date order, oldest to newest.
-            for _, uid in sorted(uids_dated, key=itemgetter(0)):
-                # Fetch the full message content, wrap it in an IMAPMessage and
-                # yield it to the caller.
-                logger.debug(f'Fetching message UID {int(uid)}')
-                restype, resdata = ic.uid('FETCH', uid, '(RFC822)')
-                check_restype(restype, f'failed to execute FETCH UID {int(uid)} (full)')
-
-                yield IMAPMessage(data=resdata, imap_connection=ic, uid=uid)
+        Args:
+            ic: SerializedConnection wrapping the IMAP4 connection.
+            batches: Iterator of lists of UIDs, as built by plan_batches().
+            metrics: RunMetrics to time each batch FETCH in, and to pass on to
+                the messages and the expunge batch.
+
+        Yields:
+            IMAPMessage for each message in each batch.
+        """
+        expunge_batch = ExpungeBatch(imap_connection=ic, size=self.expunge_every, metrics=metrics)
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='imap-fetch')
+        pending = deque()
+
+        def fetch(batch):
+            with metrics.timed('imap_body'):
+                return self.fetch_batch(ic, batch)
+
+        def fill(limit):
+            while len(pending) < limit:
+                batch = next(batches, None)
+                if batch is None:
+                    break
+                pending.append(executor.submit(fetch, batch))
+
+        try:
+            fill(max(1, self.prefetch))
+
+            while pending:
+                fetched = pending.popleft().result()
+                fill(self.prefetch)
+
+                for uid, data in fetched:
+                    # Wrap the full message content in an IMAPMessage and
+                    # yield it to the caller.
+                    yield IMAPMessage(
+                        data=data, imap_connection=ic, uid=uid, expunge_batch=expunge_batch,
+                        metrics=metrics)
+
+                # Let go of this batch before (possibly) starting the next one
+                del fetched
+                fill(1)
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+            expunge_batch.expunge()
+
+
+def part_content(part):
+    """
+    Decode the content of a single (non-multipart) message part.
+
+    Args:
+        part: An email.message.EmailMessage leaf part.
+
+    Returns:
+        The content as bytes, or as a string with normalized newlines if the
+        part is text.
+    """
+    content = part.get_content()
+    if isinstance(content, str):
+        while '\r\n' in content:
+            content = content.replace('\r\n', '\n')
+
+    return content
+
+
+def write_part(part, fp):
+    """
+    Decode the content of a single message part into a binary file.
+
+    Base64 content (which is how practically every attachment is sent) is
+    decoded a BASE64_CHUNK_CHARS slice at a time, so a decoded copy of the
+    whole part never has to be held in memory. Anything else is decoded in one
+    go by the email package. Characters outside the base64 alphabet are
+    skipped, so badly-wrapped data still decodes; the email package would
+    instead give up and return the encoded text.
+
+    Args:
+        part: An email.message.EmailMessage leaf part.
+        fp: File object, opened for binary writing, to write the content to.
+    """
+    if part.get('content-transfer-encoding', '').strip().lower() != 'base64':
+        fp.write(part.get_payload(decode=True))
+        return
+
+    encoded = part.get_payload()
+    leftover = ''
+
+    for start in range(0, len(encoded), BASE64_CHUNK_CHARS):
+        chars = leftover + BASE64_JUNK.sub('', encoded[start:start + BASE64_CHUNK_CHARS])
+        usable = len(chars) - len(chars) % 4
+        fp.write(binascii.a2b_base64(chars[:usable]))
+        leftover = chars[usable:]
+
+    # Whatever is left is the final partial quantum, which should have been
+    # padded. Like the email package, tolerate the padding being missing, and
+    # drop a lone character that can't encode anything.
+    if len(leftover) > 1:
+        fp.write(binascii.a2b_base64(leftover + '=' * (-len(leftover) % 4)))
 
 
 class IMAPMessage:
@@ -232,7 +908,7 @@ class IMAPMessage:
       Windowbox doesn't need to preserve that for its purposes.
     """
 
-    def __init__(self, *, data, imap_connection, uid):
+    def __init__(self, *, data, imap_connection, uid, expunge_batch=None, metrics=NULL_METRICS):
         """
         Constructor.
 
@@ -240,36 +916,54 @@ class IMAPMessage:
             data: Raw response data from an IMAP FETCH command.
             imap_connection: A reference to the IMAP4 connection to the mailbox.
             uid: The IMAP4 UID of the current email message.
+            expunge_batch: Optional ExpungeBatch that delete() should add this
+                message to. If None, delete() expunges immediately.
+            metrics: RunMetrics to count the message's size and time its
+                parsing (and later deletion) in.
         """
 
         # Handle ugly IMAP FETCH structure and parse into an email object. This
         # should only be given single messages; the list unpack doesn't fail
         # when used correctly.
         [data] = (chunk[1] for chunk in data if isinstance(chunk, tuple))
-        msg = email.message_from_bytes(data, policy=email.policy.SMTP)
+        metrics.count('body_bytes', len(data))
+        with metrics.timed('mime_parse'):
+            msg = email.message_from_bytes(data, policy=email.policy.SMTP)
 
+        self.metrics = metrics
         self.imap_connection = imap_connection
         self.uid = uid
+        self.expunge_batch = expunge_batch
         self.date = email.utils.parsedate_to_datetime(msg['date'])
         self.from_name, self.from_address = email.utils.parseaddr(msg['from'])
         self.message_id = msg['message-id']
         self.x_mailer = msg['x-mailer']
-        self.parts_by_type = defaultdict(list)
+        self.mime_parts = defaultdict(list)
 
+        # Parts are only sorted by type here. Their content is decoded later,
+        # and only for the types somebody asks for.
         for part in msg.walk():
             # Only want to process parts that do not contain sub-parts
             if part.is_multipart():
                 continue
 
-            # Read content and, if it's text, normalize newlines.
-            content = part.get_content()
-            if isinstance(content, str):
-                while '\r\n' in content:
-                    content = content.replace('\r\n', '\n')
-
-            # Store this content part
             mime_type = part.get_content_type()
-            self.parts_by_type[mime_type].append(content)
+            self.mime_parts[mime_type].append(part)
+
+    @property
+    def parts_by_type(self):
+        """
+        Get the decoded content of every part of the message, grouped by type.
+
+        This decodes everything, so prefer yield_parts() or write_parts() for
+        the types that are actually needed.
+
+        Returns:
+            Dict mapping MIME-types to lists of decoded content.
+        """
+        return {
+            mime_type: [part_content(part) for part in parts]
+            for mime_type, parts in self.mime_parts.items()}
 
     @property
     def part_types(self):
@@ -279,7 +973,7 @@ class IMAPMessage:
         Returns:
             All MIME-types present in this message, in no meaningful order.
         """
-        return set(self.parts_by_type)
+        return set(self.mime_parts)
 
     @property
     def text_plain(self):
@@ -289,7 +983,7 @@ class IMAPMessage:
         Returns:
             Text content, or an empty string if none is present.
         """
-        return ''.join(self.parts_by_type['text/plain'])
+        return ''.join(self.yield_parts('text/plain'))
 
     def delete(self):
         """
@@ -298,14 +992,21 @@ class IMAPMessage:
         In Gmail terms, this moves the message out of the Inbox and into All
         Mail. (It would require another flag operation to then move it to Trash,
         which would somewhat limit portability.) After the flagging is done, the
-        mailbox is automatically EXPUNGE'd.
+        message is handed to the expunge batch, or if there is no batch, the
+        mailbox is immediately EXPUNGE'd.
         """
         logger.debug(f'Setting delete flag on UID {int(self.uid)}')
-        restype, _ = self.imap_connection.uid('STORE', self.uid, '+FLAGS', '\\Deleted')
+        with self.metrics.timed('imap_delete'):
+            restype, _ = self.imap_connection.uid('STORE', self.uid, '+FLAGS', '\\Deleted')
         check_restype(restype, f'failed to flag UID {int(self.uid)} as deleted')
 
+        if self.expunge_batch is not None:
+            self.expunge_batch.add(self.uid)
+            return
+
         logger.debug('Expunging')
-        restype, _ = self.imap_connection.expunge()
+        with self.metrics.timed('imap_expunge'):
+            restype, _ = self.imap_connection.expunge()
         check_restype(restype, 'failed to EXPUNGE')
 
     def yield_parts(self, mime_type):
@@ -316,4 +1017,35 @@ class IMAPMessage:
             Once per part. There may be zero, one, or many parts for a given
             MIME-type.
         """
-        yield from self.parts_by_type[mime_type]
+        for part in self.mime_parts.get(mime_type, []):
+            yield part_content(part)
+
+    def write_parts(self, mime_type, *, directory):
+        """
+        Decode each part of the specified `mime_type` into its own new file.
+
+        Files are created with unique names inside `directory`, which should be
+        on the same filesystem as their eventual home so that they can be moved
+        into place cheaply. The caller is responsible for moving or removing
+        every file that is yielded.
+
+        Args:
+            mime_type: MIME-type of the parts to write.
+            directory: A pathlib Path object referring to an existing directory
+                to create the files in.
+
+        Yields:
+            A pathlib Path object for each part, after its file is complete.
+        """
+        for part in self.mime_parts.get(mime_type, []):
+            with tempfile.NamedTemporaryFile(
+                    dir=directory, prefix='.incoming-', delete=False) as fp:
+                path = Path(fp.name)
+                try:
+                    write_part(part, fp)
+                except Exception:
+                    fp.close()
+                    path.unlink()
+                    raise
+
+            yield path
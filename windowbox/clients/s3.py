@@ -0,0 +1,334 @@
+"""
+Bare-bones client for S3-compatible object stores.
+
+Only the handful of operations that storage backends need are implemented:
+putting, getting, inspecting and deleting single objects, plus multipart
+uploads for large files. Requests are signed with AWS Signature Version 4 and
+use path-style addressing (`<endpoint>/<bucket>/<key>`), which AWS, MinIO,
+Ceph, and most other S3-compatible servers all accept.
+
+Attributes:
+    ALGORITHM: Name of the signing algorithm, as it appears in requests.
+    SIGNED_HEADERS: Names of the headers included in every signature.
+    UNSIGNED_PAYLOAD: Payload hash value that leaves request bodies unsigned,
+        so that uploads can be streamed without reading them twice.
+    XML_NAMESPACE: Namespace of the S3 API's XML documents.
+    logger: Logger instance scoped to the current module name.
+"""
+
+import hashlib
+import hmac
+import logging
+import os
+import requests
+import xml.etree.ElementTree as ElementTree
+from datetime import datetime, timezone
+from requests.adapters import HTTPAdapter
+from urllib.parse import quote, urlsplit
+
+ALGORITHM = 'AWS4-HMAC-SHA256'
+SIGNED_HEADERS = ('host', 'x-amz-content-sha256', 'x-amz-date')
+UNSIGNED_PAYLOAD = 'UNSIGNED-PAYLOAD'
+XML_NAMESPACE = 'http://s3.amazonaws.com/doc/2006-03-01/'
+
+logger = logging.getLogger(__name__)
+
+
+class S3ClientError(Exception):
+    """
+    Base exception class for any error that occurs within this client code.
+    """
+    pass
+
+
+class S3NotFoundError(S3ClientError):
+    """
+    The requested object does not exist.
+    """
+    pass
+
+
+def canonical_query(query):
+    """
+    Encode a query string the way Signature Version 4 expects.
+
+    Args:
+        query: Dict mapping names to string values. A value of "" leaves just
+            the name, as in "?uploads".
+
+    Returns:
+        String with the names in sorted order and no leading "?".
+    """
+    return '&'.join(
+        f'{quote(name, safe="~")}={quote(value, safe="~")}' for name, value in sorted(query.items()))
+
+
+def signature(*, method, path, query, headers, secret_key, region, amz_date):
+    """
+    Compute the Signature Version 4 signature of one request.
+
+    This is used to sign requests, and by the object store stand-in to check
+    them.
+
+    Args:
+        method: HTTP method, like "PUT".
+        path: Already-encoded path part of the URL.
+        query: Dict of query string parameters; see canonical_query().
+        headers: Mapping that holds (at least) each of `SIGNED_HEADERS`.
+        secret_key: Secret access key to sign with.
+        region: Region name that is part of the credential scope.
+        amz_date: Timestamp of the request, in "YYYYMMDDTHHMMSSZ" format.
+
+    Returns:
+        Lowercase hexadecimal signature string.
+    """
+    canonical_headers = ''.join(f'{name}:{headers[name].strip()}\n' for name in SIGNED_HEADERS)
+    canonical_request = '\n'.join([
+        method, path, canonical_query(query), canonical_headers, ';'.join(SIGNED_HEADERS),
+        headers['x-amz-content-sha256']])
+    scope = f'{amz_date[:8]}/{region}/s3/aws4_request'
+    string_to_sign = '\n'.join([
+        ALGORITHM, amz_date, scope, hashlib.sha256(canonical_request.encode()).hexdigest()])
+
+    key = f'AWS4{secret_key}'.encode()
+    for part in (amz_date[:8], region, 's3', 'aws4_request'):
+        key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+
+    return hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+
+
+def xml_text(content, name):
+    """
+    Find the text of the first element called `name` in an S3 XML document.
+
+    Error documents usually have no namespace while the others do, so only the
+    local part of each element's name is compared.
+
+    Returns:
+        String, or None if there is no such element.
+    """
+    for element in ElementTree.fromstring(content).iter():
+        if element.tag.rpartition('}')[2] == name:
+            return element.text
+
+    return None
+
+
+class S3Client:
+    """
+    S3-compatible object store client for a single bucket.
+
+    Requests go through one requests Session per process, so connections to
+    the server are kept alive and reused. Files larger than `part_size` are
+    uploaded in parts, one part in memory at a time, and an upload that fails
+    partway through is aborted so that the server can discard its parts.
+    """
+
+    def __init__(
+            self, *, endpoint_url, bucket, access_key, secret_key, region='us-east-1', timeout=30,
+            part_size=8 * 1024 * 1024, pool_size=10):
+        """
+        Constructor.
+
+        Args:
+            endpoint_url: Scheme and host (and port, if needed) of the server.
+            bucket: Name of the bucket that every object is kept in.
+            access_key: Access key ID to authenticate with.
+            secret_key: Secret access key to authenticate with.
+            region: Region the bucket is in. Servers that don't have regions
+                generally expect "us-east-1".
+            timeout: Number of seconds to wait for the server to respond.
+            part_size: Size, in bytes, of each part of a multipart upload. S3
+                requires at least 5 MiB for every part except the last.
+            pool_size: Number of keep-alive connections to hold open, which
+                should be at least the number of threads using the client.
+        """
+        self.endpoint_url = endpoint_url.rstrip('/')
+        self.host = urlsplit(self.endpoint_url).netloc
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.timeout = timeout
+        self.part_size = part_size
+        self.pool_size = pool_size
+        self._session = None
+        self._pid = None
+
+    @property
+    def session(self):
+        """
+        Return the requests Session to send requests through.
+
+        A Session's pooled connections must never be shared with a forked
+        child, so each process creates its own the first time it asks.
+
+        Returns:
+            requests Session instance.
+        """
+        if self._session is None or self._pid != os.getpid():
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+            self._session = requests.Session()
+            self._session.mount('http://', adapter)
+            self._session.mount('https://', adapter)
+            self._pid = os.getpid()
+
+        return self._session
+
+    def request(self, method, key, *, query=None, data=None, stream=False):
+        """
+        Send one signed request about the object called `key`.
+
+        Args:
+            method: HTTP method, like "GET".
+            key: Name of the object within the bucket.
+            query: Optional dict of query string parameters.
+            data: Optional request body, as bytes or a file object.
+            stream: If True, the response body is left unread.
+
+        Returns:
+            requests Response instance with a 2xx status.
+
+        Raises:
+            S3NotFoundError: The object (or the upload) does not exist.
+            S3ClientError: The request failed for any other reason.
+        """
+        query = query or {}
+        path = quote(f'/{self.bucket}/{key}', safe='/~')
+        amz_date = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+        headers = {'host': self.host, 'x-amz-content-sha256': UNSIGNED_PAYLOAD, 'x-amz-date': amz_date}
+        sig = signature(
+            method=method, path=path, query=query, headers=headers, secret_key=self.secret_key,
+            region=self.region, amz_date=amz_date)
+        headers['Authorization'] = (
+            f'{ALGORITHM} Credential={self.access_key}/{amz_date[:8]}/{self.region}/s3/aws4_request, '
+            f'SignedHeaders={";".join(SIGNED_HEADERS)}, Signature={sig}')
+        del headers['host']
+
+        url = f'{self.endpoint_url}{path}'
+        if query:
+            url = f'{url}?{canonical_query(query)}'
+
+        logger.debug(f'{method} {url}')
+
+        try:
+            response = self.session.request(
+                method, url, data=data, headers=headers, stream=stream, timeout=self.timeout)
+        except requests.RequestException as exc:
+            raise S3ClientError(f'{method} {key} failed: {exc}')
+
+        if response.status_code == 404:
+            response.close()
+            raise S3NotFoundError(f'{key} not found')
+
+        if response.status_code >= 300:
+            code = None if stream or not response.content else xml_text(response.content, 'Code')
+            response.close()
+            raise S3ClientError(f'{method} {key} failed: HTTP {response.status_code} {code or ""}'.rstrip())
+
+        return response
+
+    def put_object(self, key, data):
+        """
+        Store `data` as the object called `key`, replacing any that exists.
+
+        Args:
+            key: Name of the object.
+            data: Bytes, or a file object open for reading in binary mode.
+        """
+        self.request('PUT', key, data=data)
+
+    def upload_file(self, key, path):
+        """
+        Store the file at `path` as the object called `key`.
+
+        Files up to `part_size` are sent with a single PUT; larger ones go up
+        in parts.
+
+        Args:
+            key: Name of the object.
+            path: A pathlib Path object referring to the file.
+        """
+        if path.stat().st_size <= self.part_size:
+            with path.open('rb') as fp:
+                self.put_object(key, fp)
+        else:
+            self.upload_multipart(key, path)
+
+    def upload_multipart(self, key, path):
+        """
+        Store the file at `path` as the object called `key`, in parts.
+
+        Args:
+            key: Name of the object.
+            path: A pathlib Path object referring to the file.
+
+        Raises:
+            S3ClientError: Any part failed, or the server refused to put them
+                together. The upload is aborted before this is raised.
+        """
+        upload_id = xml_text(self.request('POST', key, query={'uploads': ''}).content, 'UploadId')
+        parts = []
+
+        try:
+            with path.open('rb') as fp:
+                while chunk := fp.read(self.part_size):
+                    response = self.request(
+                        'PUT', key, query={'partNumber': str(len(parts) + 1), 'uploadId': upload_id}, data=chunk)
+                    parts.append(response.headers['ETag'])
+
+            document = ''.join(
+                f'<Part><PartNumber>{number}</PartNumber><ETag>{etag}</ETag></Part>'
+                for number, etag in enumerate(parts, start=1))
+            response = self.request(
+                'POST', key, query={'uploadId': upload_id},
+                data=f'<CompleteMultipartUpload>{document}</CompleteMultipartUpload>'.encode())
+
+            # A failure to complete can arrive with a 200 status once the
+            # server has started sending its response
+            error = xml_text(response.content, 'Code')
+            if error:
+                raise S3ClientError(f'completing upload of {key} failed: {error}')
+        except BaseException:
+            try:
+                self.request('DELETE', key, query={'uploadId': upload_id})
+            except S3ClientError as exc:
+                logger.warning(f'Could not abort upload {upload_id} of {key}: {exc}')
+            raise
+
+        logger.debug(f'Uploaded {key} in {len(parts)} part(s)')
+
+    def get_object(self, key):
+        """
+        Start downloading the object called `key`.
+
+        Returns:
+            requests Response instance whose body has not been read yet. The
+            caller should read it through `raw` and close it.
+
+        Raises:
+            S3NotFoundError: The object does not exist.
+        """
+        response = self.request('GET', key, stream=True)
+        response.raw.decode_content = True
+
+        return response
+
+    def head_object(self, key):
+        """
+        Look up the headers of the object called `key`.
+
+        Returns:
+            Case-insensitive dict of response headers, or None if the object
+            does not exist.
+        """
+        try:
+            return self.request('HEAD', key).headers
+        except S3NotFoundError:
+            return None
+
+    def delete_object(self, key):
+        """
+        Delete the object called `key`. Deleting a missing object succeeds.
+        """
+        self.request('DELETE', key)
@@ -35,19 +35,68 @@ LIBSASS_STYLE = 'compressed'
 """
 Flask-SQLAlchemy
 """
+SQLALCHEMY_BINDS = {}
 SQLALCHEMY_DATABASE_URI = ''
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
 """
 Windowbox app-specific
 """
+API_RESPONSE_CACHE_BYTES = 16 * 1024 * 1024  # serialized API bodies kept in memory per process; 0 disables
 APP_LOG_FORMATTER = logging.Formatter('[%(asctime)s] %(name)s %(levelname)s: %(message)s')
 APP_LOG_LEVEL = logging.INFO
 ATTACHMENTS_PATH = str(varpath / 'attachments')
+DATABASE_READ_BINDS = []  # keys in SQLALCHEMY_BINDS to use as read replicas for GET requests
 DERIVATIVES_PATH = str(varpath / 'derivatives')
+DERIVATIVE_PACK_FILE_BYTES = 256 * 1024 * 1024  # pack files are sealed and a new one started at this size
+DERIVATIVE_PACK_MAX_BYTES = 64 * 1024  # rendered Derivatives up to this size go into pack files; 0 disables
 EXIFTOOL_BIN = '/usr/bin/exiftool'
+EXIFTOOL_PROCESSES = 1  # long-lived `-stay_open` processes; 0 runs a new exiftool per file
+EXIFTOOL_TAG_FILTER = 'exclude'  # 'none', 'exclude' (skip junk and binary data), or 'whitelist'
+EXIFTOOL_TIMEOUT = 30
+GAZETTEER_MAX_DISTANCE = 50  # km; points farther than this from any gazetteer place have no address
+GAZETTEER_PATH = str(varpath / 'gazetteer' / 'cities15000.txt')  # GeoNames dump; see clients/gazetteer.py
+GEOCODER = ['google']  # reverse geocoders to try in order: 'google' and/or 'gazetteer'
+GEOCODE_CACHE_GRID = 0.001  # degrees (~110 m) per geocode cache cell; 0 disables the cache
+GEOCODE_CACHE_TTL = 180 * 24 * 60 * 60  # seconds before a cached address is looked up again; 0 never
 GOOGLE_MAPS_API_KEY = ''
+GOOGLE_MAPS_BACKOFF = 0.5  # longest wait (seconds) before the first retry; doubles for each one after
+GOOGLE_MAPS_BASE_URL = 'https://maps.googleapis.com'  # or a stand-in, e.g. `flask bench geocode-server`
+GOOGLE_MAPS_RETRIES = 3  # retries after server errors, dropped connections, or OVER_QUERY_LIMIT
+IMAP_EXPUNGE_EVERY = 50  # deleted messages to accumulate before each EXPUNGE
+IMAP_FETCH_BATCH_BYTES = 32 * 1024 * 1024  # full messages are fetched in batches of this size...
+IMAP_FETCH_BATCH_SIZE = 20  # ...or this many messages, whichever is smaller
 IMAP_FETCH_HOST = ''
+IMAP_FETCH_MAX_ATTEMPTS = 3  # failed ingests of one message before it stays quarantined
 IMAP_FETCH_USER = ''
 IMAP_FETCH_PASSWORD = ''
+IMAP_FETCH_PREFETCH = 1  # batches to fetch in the background while one is processed
+IMAP_IDLE_TIMEOUT = 300  # `windowbox-fetch --daemon` re-issues IDLE this often (seconds)
+IMAP_POLL_INTERVAL = 60  # ...or sends NOOP this often if the server has no IDLE
+IMAP_RECONNECT_MAX_BACKOFF = 300  # longest wait (seconds) between reconnect attempts
+IMPORT_BATCH_SIZE = 100  # messages `windowbox-import` commits at a time
+IMPORT_WORKERS = 4  # processes `windowbox-import` decodes messages and runs exiftool in
+INGEST_METRICS_TEXTFILE = ''  # Prometheus textfile-collector path (*.prom) for fetch metrics; '' disables
+INGEST_WORKERS = 4  # attachments of one message to write/exiftool/geocode at once; 1 disables threads
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,  # negative values are KiB, not pages
+    'busy_timeout': 5000}
+STORAGE_BACKEND = 'local'  # 'local', 's3' (S3-compatible object store), or 'cached' (s3 behind a local cache)
+STORAGE_CACHE_MAX_BYTES = 50 * 1024 * 1024 * 1024  # `flask storage trim-cache` shrinks the 'cached' cache to this
+STORAGE_CACHE_PATH = str(varpath / 'cache')  # local (ideally SSD) directory for the 'cached' backend's copies
+STORAGE_CONTENT_ADDRESSED = True  # store new Attachments by SHA-256, sharing files (and Derivatives) between copies
+STORAGE_FSYNC = 'file'  # 'none', 'file' (flush each file before renaming it into place), or 'full' (and its dir)
+STORAGE_LAYOUT = 2  # ID-addressed file layout: 1 = leading decimal digits, 2 = hashed over 256x256 dirs
+STORAGE_LAYOUT_FALLBACK = 1  # layout to also read from until `flask storage migrate` is done; then None
+STORAGE_S3_ACCESS_KEY = ''
+STORAGE_S3_BUCKET = ''
+STORAGE_S3_ENDPOINT = ''  # e.g. 'https://s3.us-east-1.amazonaws.com', or `flask bench object-store-server`
+STORAGE_S3_PART_BYTES = 8 * 1024 * 1024  # larger files are uploaded in parts of this size (S3 minimum: 5 MiB)
+STORAGE_S3_PUBLIC_URL = ''  # bucket URL browsers can read (public bucket or CDN); '' streams through the app
+STORAGE_S3_REGION = 'us-east-1'
+STORAGE_S3_SECRET_KEY = ''
+STORAGE_SWEEP_MIN_AGE = 60 * 60  # seconds before fetch/import startup removes a leftover temp file; None skips
 USE_X_ACCEL_REDIRECT = False
@@ -7,6 +7,8 @@ all values defined in base.py.
 
 from windowbox.configs.base import varpath
 
+DERIVATIVE_PACK_MAX_BYTES = 0  # tests that want packs make their own PackStore
+SQLALCHEMY_BINDS = {'replica': 'sqlite:///' + str(varpath / 'test-replica.sqlite')}
 SQLALCHEMY_DATABASE_URI = 'sqlite:///' + str(varpath / 'test.sqlite')
 TESTING = True
 
@@ -10,10 +10,11 @@ Attributes:
 
 import logging
 import re
+import sqlalchemy.exc
 import sqlalchemy.orm.exc
 from flask import current_app
 from windowbox.controllers import BaseController
-from windowbox.database import db
+from windowbox.database import db, use_primary
 from windowbox.models.attachment import Attachment, Dimensions
 from windowbox.models.derivative import Derivative
 
@@ -59,6 +60,31 @@ class AttachmentController(BaseController):
             for part_data in message.yield_parts(mime_type):
                 yield mime_type, part_data
 
+    @staticmethod
+    def message_to_files(message, *, directory):
+        """
+        Decode the usable Attachment parts of an IMAP message into files.
+
+        This is the streaming counterpart of message_to_data(). Parts of other
+        types are never decoded at all.
+
+        Args:
+            message: An message instance as returned by the IMAP client.
+            directory: A pathlib Path object referring to the directory to
+                create the files in. It is created if it does not exist.
+
+        Yields:
+            Tuple of (mime_type, path) for each usable message part
+            encountered in the provided message. The caller is responsible for
+            moving or removing each file.
+        """
+        known_types = set(Attachment.KNOWN_EXTENSIONS)
+        directory.mkdir(parents=True, exist_ok=True)
+
+        for mime_type in sorted(known_types.intersection(message.part_types)):
+            for path in message.write_parts(mime_type, directory=directory):
+                yield mime_type, path
+
     @classmethod
     def get_by_id(cls, attachment_id):
         """
@@ -78,6 +104,20 @@ class AttachmentController(BaseController):
         except sqlalchemy.orm.exc.NoResultFound as exc:
             raise cls.NoResultFound from exc
 
+    @staticmethod
+    def get_version(attachment_id):
+        """
+        Return a cheap stamp that changes whenever one Attachment's response could.
+
+        Args:
+            attachment_id: The primary key of an Attachment.
+
+        Returns:
+            The Attachment's `updated_utc`, or None if it does not exist.
+        """
+        return db.session.execute(
+            db.select(Attachment.updated_utc).where(Attachment.id == attachment_id)).scalar_one_or_none()
+
     @staticmethod
     def decode_dimensions(dim_str):
         """
@@ -172,12 +212,17 @@ class AttachmentController(BaseController):
         attachments_path = current_app.attachments_path
         derivatives_path = current_app.derivatives_path
 
+        # A lagging replica could claim this Derivative doesn't exist yet
+        use_primary()
+
+        query = Derivative.query.filter_by(
+            attachment=attachment,
+            width=dim_tuple.width,
+            height=dim_tuple.height,
+            allow_crop=dim_tuple.allow_crop)
+
         try:
-            derivative = Derivative.query.filter_by(
-                attachment=attachment,
-                width=dim_tuple.width,
-                height=dim_tuple.height,
-                allow_crop=dim_tuple.allow_crop).one()
+            derivative = query.one()
         except sqlalchemy.orm.exc.NoResultFound:
             logger.debug(
                 f'Creating {dim_tuple.width}x{dim_tuple.height},{dim_tuple.allow_crop} '
@@ -188,10 +233,18 @@ class AttachmentController(BaseController):
                 height=dim_tuple.height,
                 allow_crop=dim_tuple.allow_crop)
             db.session.add(derivative)
-            db.session.commit()
+
+            try:
+                db.session.commit()
+            except sqlalchemy.exc.IntegrityError:
+                # A concurrent request created the same Derivative first
+                logger.debug('Lost Derivative creation race; using the existing one')
+                db.session.rollback()
+                derivative = query.one()
 
         attachment.base_path = attachments_path
         derivative.base_path = derivatives_path
+        derivative.pack_store = current_app.derivative_pack_store
 
         derivative.ensure_storage_data()
 
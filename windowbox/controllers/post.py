@@ -14,6 +14,9 @@ import sqlalchemy.orm.exc
 from collections import namedtuple
 from datetime import datetime, timezone
 from windowbox.controllers import BaseController
+from windowbox.database import db
+from windowbox.models.archive import ArchiveMonth
+from windowbox.models.attachment import Attachment
 from windowbox.models.post import Post
 from windowbox.models.sender import Sender
 
@@ -48,6 +51,12 @@ class PostController(BaseController):
         """
         pass
 
+    class DuplicateMessage(BaseController.ControllerError):
+        """
+        Indicates a message that has already been made into a Post.
+        """
+        pass
+
     @enum.unique
     class PAGE_MODE(enum.Enum):
         """
@@ -71,6 +80,10 @@ class PostController(BaseController):
         the database. If this is not the case, this method will raise without
         creating a new Post. This is to avoid blithely publishing spam messages.
 
+        If a Post already exists with the message's Message-ID, this method will
+        also raise. This happens when a previous run committed the Post but did
+        not get as far as deleting the message from the mailbox.
+
         Args:
             message: An message instance as returned by the IMAP client.
 
@@ -79,16 +92,22 @@ class PostController(BaseController):
 
         Raises:
             UnknownSender: The message is from an unknown address.
+            DuplicateMessage: The message has already been made into a Post.
         """
         try:
             sender = Sender.query.filter_by(email_address=message.from_address).one()
         except sqlalchemy.orm.exc.NoResultFound as exc:
             raise cls.UnknownSender from exc
 
+        message_id = message.message_id.strip() if message.message_id else None
+        if message_id is not None and Post.query.filter_by(message_id=message_id).count() > 0:
+            raise cls.DuplicateMessage
+
         post = Post(
             sender=sender,
             created_utc=message.date,
-            user_agent=message.x_mailer)
+            user_agent=message.x_mailer,
+            message_id=message_id)
         post.set_stripped_caption(message.text_plain)
 
         return post
@@ -160,7 +179,34 @@ class PostController(BaseController):
             'limit': limit}
 
     @classmethod
-    def get_many(cls, *, since_id=None, until_id=None, limit=None):
+    def month_bounds(cls, *, year, month):
+        """
+        Return the UTC datetime range covered by one calendar month.
+
+        Args:
+            year: Integer year.
+            month: Integer month, 1 through 12.
+
+        Returns:
+            Tuple of (start, end) timezone-aware datetimes, where `start` is
+            inclusive and `end` is exclusive.
+
+        Raises:
+            InvalidArgument: The year or month was out of range.
+        """
+        if not (datetime.min.year <= year < datetime.max.year) or not (1 <= month <= 12):
+            raise cls.InvalidArgument
+
+        start = datetime(year, month, 1, tzinfo=timezone.utc)
+        if month == 12:
+            end = start.replace(year=year + 1, month=1)
+        else:
+            end = start.replace(month=month + 1)
+
+        return start, end
+
+    @classmethod
+    def get_many(cls, *, since_id=None, until_id=None, limit=None, year=None, month=None):
         """
         Return several Post models matching the filter criteria.
 
@@ -176,22 +222,35 @@ class PostController(BaseController):
         is a default value if unspecified; if all items are desired, explicitly
         set this to None.
 
+        If `year` and `month` are both set, only Posts created during that
+        calendar month (in UTC) are considered. Pagination within the month
+        works the same as it does everywhere else.
+
         Args:
             since_id: If set, switches the order to newest-first and skips any
                 Posts with an equal or smaller ID.
             until_id: If set, skips any Posts with an equal or larger ID.
             limit: If set to an integer, sets the maximum number of items that
                 can be returned. If None, there is no limit.
+            year: If set along with `month`, restricts results to one month.
+            month: If set along with `year`, restricts results to one month.
 
         Returns:
             ManyPostSet tuple with the matching Post instances and the
             pagination flags.
+
+        Raises:
+            InvalidArgument: One of the provided values was not usable.
         """
         args = cls.parse_query_args(
             since_id=since_id, until_id=until_id, limit=limit)
 
         q = Post.query
 
+        if year is not None and month is not None:
+            start, end = cls.month_bounds(year=year, month=month)
+            q = q.filter(Post.created_utc >= start, Post.created_utc < end)
+
         if args['since_id'] is not None:
             q = q.order_by(Post.id.asc()).filter(Post.id > args['since_id'])
             page_mode = cls.PAGE_MODE.SINCE
@@ -214,6 +273,58 @@ class PostController(BaseController):
 
         return ManyPostSet(posts=posts, has_more=has_more, page_mode=page_mode)
 
+    @staticmethod
+    def get_content_version():
+        """
+        Return a cheap stamp that changes whenever any list of Posts could.
+
+        Both parts are read from the ends of indexes; no rows are loaded.
+
+        Returns:
+            Tuple of (highest Post ID, newest Attachment `updated_utc`), either
+            of which is None if there are no rows yet.
+        """
+        return tuple(db.session.execute(db.select(
+            db.select(db.func.max(Post.id)).scalar_subquery(),
+            db.select(db.func.max(Attachment.updated_utc)).scalar_subquery())).one())
+
+    @staticmethod
+    def get_post_version(post_id):
+        """
+        Return a cheap stamp that changes whenever one Post's response could.
+
+        A Post's response links to its newer neighbor, so the highest Post ID
+        is part of this too.
+
+        Args:
+            post_id: The primary key of a Post.
+
+        Returns:
+            Tuple of (Post ID, highest Post ID, newest `updated_utc` of this
+            Post's Attachments), or None if the Post does not exist.
+        """
+        row = db.session.execute(db.select(
+            Post.id,
+            db.select(db.func.max(Post.id)).scalar_subquery(),
+            db.select(db.func.max(Attachment.updated_utc)).where(
+                Attachment.post_id == post_id).scalar_subquery()).where(Post.id == post_id)).one_or_none()
+
+        return None if row is None else tuple(row)
+
+    @staticmethod
+    def get_archive_months():
+        """
+        Return every month that has at least one Post, newest first.
+
+        These come from the precomputed ArchiveMonth counts; the Post table
+        itself is not aggregated.
+
+        Returns:
+            List of ArchiveMonth instances.
+        """
+        return ArchiveMonth.query.filter(ArchiveMonth.post_count > 0).order_by(
+            ArchiveMonth.year.desc(), ArchiveMonth.month.desc()).all()
+
     @staticmethod
     def get_lastmod_datetime():
         """
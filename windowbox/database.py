@@ -1,16 +1,204 @@
 """
-Database connection and custom column types.
+Database connection, session routing, and custom column types.
 
 Attributes:
+    PINNED_KEY: Key in the session's `info` dict that, once truthy, forces every
+        statement (including reads) to the primary engine.
+    REPLICA_KEY: Key in the session's `info` dict that holds the bind key of the
+        replica chosen for reads, or None if reads should use the primary.
+    SAFE_METHODS: HTTP methods that are eligible to read from a replica.
+    UPSERT_DIALECTS: Mapping of SQLAlchemy dialect names to the dialect-specific
+        insert() constructs that support an "upsert" clause.
     db: The global Flask-SQLAlchemy database object for the rest of the app and
         its models.
+    logger: Logger instance scoped to the current module name.
 """
 
+import logging
+import random
 from datetime import timezone
+from flask import current_app, request
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.dialects import mysql, postgresql, sqlite
 from sqlalchemy.dialects.mysql import DATETIME
+from sqlalchemy.sql import Select
 
-db = SQLAlchemy()
+PINNED_KEY = 'windowbox_pinned'
+REPLICA_KEY = 'windowbox_replica'
+SAFE_METHODS = frozenset(['GET', 'HEAD'])
+UPSERT_DIALECTS = {
+    'mysql': mysql.insert,
+    'postgresql': postgresql.insert,
+    'sqlite': sqlite.insert}
+
+logger = logging.getLogger(__name__)
+
+
+class RoutingSession(Session):
+    """
+    Session that can send reads to a read replica and writes to the primary.
+
+    Routing only happens once use_replica() has chosen a replica for this
+    session. Even then, only SELECT statements outside of a flush are eligible.
+    The first time anything else passes through -- a flush, a bulk UPDATE or
+    DELETE, a raw connection request -- the session becomes pinned to the
+    primary for the rest of its life. That gives read-your-writes consistency
+    for the remainder of the request without having to reason about replica
+    lag.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        """
+        Pick the engine that should execute `clause`.
+
+        Args:
+            Same as flask_sqlalchemy.session.Session.get_bind().
+
+        Returns:
+            The chosen replica Engine if the statement is a read and the session
+            is not pinned, otherwise whatever the parent implementation decides.
+        """
+        replica = self.info.get(REPLICA_KEY)
+
+        if bind is None and replica is not None and not self.info.get(PINNED_KEY):
+            if isinstance(clause, Select) and not self._flushing:
+                return self._db.engines[replica]
+
+            logger.debug('Session wrote to the primary; pinning reads there too')
+            self.info[PINNED_KEY] = True
+
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+
+def use_replica():
+    """
+    Allow the current session to read from one of the configured replicas.
+
+    A single replica is chosen at random from the `DATABASE_READ_BINDS` config
+    value and used for the remainder of the session, so a request never sees
+    two replicas at different points of replication. If no replicas are
+    configured, this is a no-op and everything keeps using the primary.
+    """
+    binds = current_app.config['DATABASE_READ_BINDS']
+
+    if binds and db.session.info.get(REPLICA_KEY) is None:
+        db.session.info[REPLICA_KEY] = random.choice(binds)
+
+
+def use_primary():
+    """
+    Pin the current session to the primary for reads and writes alike.
+
+    This should be called before any read whose result decides whether or not
+    to write, where a stale answer from a lagging replica would do harm.
+    """
+    db.session.info[PINNED_KEY] = True
+
+
+def reset_routing(exc=None):
+    """
+    Return the current session to its default (primary-only) routing.
+
+    Args:
+        exc: Ignored; accepted so this can be used as a teardown handler.
+    """
+    db.session.info.pop(REPLICA_KEY, None)
+    db.session.info.pop(PINNED_KEY, None)
+
+
+def route_request():
+    """
+    Allow safe (read-only by HTTP semantics) requests to use a replica.
+
+    Intended to be registered as a `before_request` handler on blueprints,
+    paired with reset_routing() as a `teardown_request` handler.
+    """
+    if request.method in SAFE_METHODS:
+        use_replica()
+
+
+def apply_sqlite_pragmas(engine, pragmas):
+    """
+    Run a set of PRAGMA statements on every new connection made by `engine`.
+
+    SQLite forgets most of these settings when a connection closes, so they
+    are applied through the engine's "connect" event rather than once at
+    startup. The `journal_mode` pragma is skipped for read-only (`mode=ro`)
+    connections since changing it requires write access to the database; the
+    writer is responsible for putting the file into WAL mode.
+
+    Args:
+        engine: SQLAlchemy Engine using the sqlite dialect.
+        pragmas: Mapping of pragma names to the values they should be set to.
+    """
+    if engine.url.query.get('mode') == 'ro':
+        pragmas = {k: v for k, v in pragmas.items() if k != 'journal_mode'}
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+        cursor.close()
+
+
+def configure_engines(app):
+    """
+    Apply Windowbox-specific tuning to every engine the app has configured.
+
+    Currently this only affects SQLite engines, which receive the connection
+    profile in the `SQLITE_PRAGMAS` config value. Must be called after
+    db.init_app() so the engines exist, but before any connections are made.
+
+    Args:
+        app: Instance of the Flask application.
+    """
+    with app.app_context():
+        for bind_key, engine in db.engines.items():
+            if engine.dialect.name == 'sqlite' and app.config['SQLITE_PRAGMAS']:
+                logger.debug(f'Applying SQLite pragmas to bind {bind_key}')
+                apply_sqlite_pragmas(engine, app.config['SQLITE_PRAGMAS'])
+
+
+def upsert(connection, table, *, values, update):
+    """
+    Insert a row, or update the existing row with the same primary key.
+
+    Where the dialect supports it, this is a single atomic statement. Anywhere
+    else it falls back to an UPDATE followed by an INSERT if nothing matched,
+    which two concurrent callers could race on.
+
+    Args:
+        connection: SQLAlchemy Connection to execute statements on.
+        table: SQLAlchemy Table to insert into.
+        values: Mapping of column names to the values of the new row, which
+            must include every primary key column.
+        update: Mapping of column names to the values (or SQL expressions in
+            terms of the existing row) to set if the row already exists.
+    """
+    dialect_insert = UPSERT_DIALECTS.get(connection.dialect.name)
+
+    if dialect_insert is not None:
+        stmt = dialect_insert(table).values(**values)
+        if connection.dialect.name == 'mysql':
+            stmt = stmt.on_duplicate_key_update(**update)
+        else:
+            stmt = stmt.on_conflict_do_update(index_elements=list(table.primary_key), set_=update)
+        connection.execute(stmt)
+        return
+
+    result = connection.execute(
+        table.update()
+        .where(*(column == values[column.name] for column in table.primary_key))
+        .values(**update))
+
+    if result.rowcount == 0:
+        connection.execute(table.insert().values(**values))
 
 
 class UTCDateTime(db.TypeDecorator):
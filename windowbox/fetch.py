@@ -9,51 +9,243 @@ It can also be run directly from a suitable Python interpreter:
 
     WINDOWBOX_CONFIG=configs/some.py python windowbox/fetch.py
 
+By default the mailbox is checked once and the script exits, which suits cron.
+With `--daemon`, the script instead stays connected and waits for new mail to
+arrive (using IMAP IDLE where the server supports it), reconnecting with
+exponential backoff whenever the connection or an ingest fails:
+
+    WINDOWBOX_CONFIG=configs/some.py windowbox-fetch --daemon
+
 This script scrapes the IMAP mailbox specified in the config file, considers
 each message it finds within, and passes suitable ones on to be ingested as
 Posts and Attachments. Unsuitable messages are not ingested. All messages, once
-considered, are deleted from the mailbox.
+considered, are deleted from the mailbox. Deletions are expunged in batches, so
+a crash can leave already-ingested messages in the mailbox; these are recognized
+by their Message-ID on the next run and deleted without making a second Post.
+
+Progress through the mailbox is checkpointed in the database, keyed on the
+mailbox's UIDVALIDITY, so each run only searches for UIDs above the highest one
+a previous run finished with. A message that fails to ingest is quarantined
+rather than stopping the run; it is retried on later runs until it has failed
+IMAP_FETCH_MAX_ATTEMPTS times, and is then left in the mailbox until it is
+released with `flask fetch release`.
+
+Every run reports how long each stage of the ingest took, and how many
+messages, Attachments, and bytes went through it, as a line of JSON in the log.
+If INGEST_METRICS_TEXTFILE is set, the same figures are also written there for
+the Prometheus node_exporter textfile collector.
 
 Attributes:
+    TRANSIENT_ERRORS: Exception classes that say nothing about the message
+        being ingested (a dropped connection, an unreachable database, object
+        store, or geocoder). These abort the run instead of quarantining the message.
     logger: Logger instance scoped to the current module name.
 """
 
+import argparse
+import imaplib
 import logging
+import signal
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import partial
+from sqlalchemy.exc import OperationalError
 from windowbox import app
-from windowbox.clients.imap import NoMessages
+from windowbox.clients.gmapi import GMAPIRetryableError
+from windowbox.clients.imap import IMAPClientError, NoMessages
+from windowbox.clients.s3 import S3ClientError
 from windowbox.controllers.attachment import AttachmentController
 from windowbox.controllers.post import PostController
 from windowbox.database import db
+from windowbox.metrics import NULL_METRICS, RunMetrics
+from windowbox.models import hash_file
+from windowbox.models.attachment import Attachment
+from windowbox.models.checkpoint import FetchCheckpoint
+from windowbox.storage import sweep_temp_files
+
+TRANSIENT_ERRORS = (
+    GMAPIRetryableError, IMAPClientError, S3ClientError, imaplib.IMAP4.error, OSError, OperationalError)
 
 logger = logging.getLogger(__name__)
 
 
-def main():
+def main(argv=None):
     """
     Main entrypoint for the windowbox-fetch console script.
 
+    Args:
+        argv: List of command-line arguments. If None, uses sys.argv.
+
     Returns:
         0, unless something raises an uncaught exception.
     """
+    parser = argparse.ArgumentParser(description='Fetch new Posts from the IMAP mailbox.')
+    parser.add_argument(
+        '--daemon', action='store_true',
+        help='stay connected and process new mail as it arrives, until stopped')
+    args = parser.parse_args(argv)
+
     logger.info('Starting windowbox-fetch')
 
+    if app.config['STORAGE_SWEEP_MIN_AGE'] is not None:
+        for base_path in (app.attachments_path, app.derivatives_path):
+            sweep_temp_files(base_path, min_age=app.config['STORAGE_SWEEP_MIN_AGE'])
+
+    clients = {
+        'attachments_path': app.attachments_path,
+        'content_addressed': app.config['STORAGE_CONTENT_ADDRESSED'],
+        'exiftool_client': app.exiftool_client,
+        'gmapi_client': app.gmapi_client,
+        'imap_client': app.imap_client,
+        'ingest_workers': app.config['INGEST_WORKERS'],
+        'max_attempts': app.config['IMAP_FETCH_MAX_ATTEMPTS'],
+        'metrics_textfile': app.config['INGEST_METRICS_TEXTFILE']}
+
     with app.app_context():
-        run_fetch(
-            attachments_path=app.attachments_path,
-            exiftool_client=app.exiftool_client,
-            gmapi_client=app.gmapi_client,
-            imap_client=app.imap_client)
+        if args.daemon:
+            stop = threading.Event()
+            signal.signal(signal.SIGTERM, lambda *_: stop.set())
+
+            run_daemon(
+                **clients, stop=stop,
+                idle_timeout=app.config['IMAP_IDLE_TIMEOUT'],
+                poll_interval=app.config['IMAP_POLL_INTERVAL'],
+                max_backoff=app.config['IMAP_RECONNECT_MAX_BACKOFF'])
+        else:
+            run_checkpointed_fetch(**clients)
 
     logger.info('windowbox-fetch completed without error')
 
     return 0
 
 
-def run_fetch(*, attachments_path, exiftool_client, gmapi_client, imap_client):
+def run_daemon(
+        *, attachments_path, exiftool_client, gmapi_client, imap_client, stop, idle_timeout,
+        poll_interval, max_backoff, ingest_workers=1, max_attempts=3, metrics_textfile=None,
+        content_addressed=False):
+    """
+    Keep one IMAP connection open and ingest new messages as they arrive.
+
+    Each new message is processed by run_fetch(), exactly as in a one-shot run,
+    and the mailbox's checkpoint is advanced after every pass. If anything goes
+    wrong, the connection is dropped and reopened after a delay that doubles
+    with each consecutive failure, and the next connection picks up from the
+    last checkpoint.
+
+    Args:
+        attachments_path: A pathlib Path object that points to the root
+            directory where storage data for Attachments should be saved.
+        exiftool_client: Instance of ExifToolClient configured to read EXIF
+            metadata from files.
+        gmapi_client: Instance of GoogleMapsAPIClient configured with a valid
+            Google Maps API key.
+        imap_client: Instance of IMAP_SSLClient configured with the desired
+            email authentication and mailbox values.
+        stop: threading.Event; the daemon returns once it is set. Messages
+            already found by the current pass over the mailbox are finished
+            first.
+        idle_timeout: Maximum seconds to wait in each IMAP IDLE.
+        poll_interval: Seconds between NOOP polls on servers without IDLE.
+        max_backoff: Maximum seconds to wait before reconnecting.
+        ingest_workers: Passed through to run_fetch().
+        max_attempts: Passed through to run_fetch().
+        metrics_textfile: Passed through to run_fetch(). Each pass over the
+            mailbox is reported separately, and the first pass on each
+            connection includes the time it took to connect.
+        content_addressed: Passed through to run_fetch().
+    """
+    backoff = 1
+
+    while not stop.is_set():
+        try:
+            metrics = RunMetrics()
+            with imap_client.connect(metrics=metrics) as connection:
+                logger.info('Connected; waiting for new messages')
+                checkpoint = FetchCheckpoint.load(
+                    mailbox=connection.mailbox, uid_validity=connection.uid_validity)
+
+                while not stop.is_set():
+                    run_fetch(
+                        attachments_path=attachments_path, exiftool_client=exiftool_client,
+                        gmapi_client=gmapi_client, imap_client=imap_client,
+                        connection=connection, checkpoint=checkpoint, ingest_workers=ingest_workers,
+                        max_attempts=max_attempts, metrics=metrics, metrics_textfile=metrics_textfile,
+                        content_addressed=content_addressed)
+                    metrics = None
+                    backoff = 1
+
+                    imap_client.wait_for_mail(
+                        connection, timeout=idle_timeout, poll_interval=poll_interval, stop=stop)
+        except Exception:
+            db.session.rollback()
+            logger.exception(f'Fetch failed; reconnecting in {backoff} seconds')
+            stop.wait(backoff)
+            backoff = min(backoff * 2, max_backoff)
+
+
+def run_checkpointed_fetch(*, imap_client, **kwargs):
+    """
+    Connect, load the mailbox's checkpoint, and run_fetch() from there.
+
+    Args:
+        imap_client: Instance of IMAP_SSLClient configured with the desired
+            email authentication and mailbox values.
+        **kwargs: Passed through to run_fetch().
+
+    Returns:
+        Whatever run_fetch() returns.
+    """
+    metrics = RunMetrics()
+
+    with imap_client.connect(metrics=metrics) as connection:
+        checkpoint = FetchCheckpoint.load(mailbox=connection.mailbox, uid_validity=connection.uid_validity)
+
+        return run_fetch(
+            imap_client=imap_client, connection=connection, checkpoint=checkpoint, metrics=metrics, **kwargs)
+
+
+def message_to_post_or_delete(message, *, metrics=NULL_METRICS):
+    """
+    Build a Post from `message`, or delete the message if it cannot be posted.
+
+    Args:
+        message: An message instance as returned by the IMAP client.
+        metrics: RunMetrics to time the sender and duplicate lookups in.
+
+    Returns:
+        Fresh Post instance, or None if the message was deleted instead.
+    """
+    try:
+        with metrics.timed('post_lookup'):
+            return PostController.message_to_post(message)
+    except PostController.UnknownSender:
+        logger.warning(
+            f'Unknown sender {message.from_name} <{message.from_address}>; '
+            'deleting message')
+    except PostController.DuplicateMessage:
+        logger.info(f'Message ID {message.message_id} was already posted; deleting message')
+
+    message.delete()
+
+    return None
+
+
+def run_fetch(
+        *, attachments_path, exiftool_client, gmapi_client, imap_client, connection=None,
+        min_uid=1, ingest_workers=1, checkpoint=None, max_attempts=3, metrics=None,
+        metrics_textfile=None, content_addressed=False):
     """
     Actual fetch-and-create function.
 
+    Without a `checkpoint`, the first message that fails to ingest stops the
+    run. With one, the search starts after the checkpoint's last UID (also
+    including any quarantined messages that are due for a retry), failing
+    messages are quarantined instead, and the checkpoint is advanced and
+    committed once every message has been considered.
+
+    The run's metrics are emitted when it ends, whether or not it succeeded.
+
     Args:
         attachments_path: A pathlib Path object that points to the root
             directory where storage data for Attachments should be saved.
@@ -63,47 +255,283 @@ def run_fetch(*, attachments_path, exiftool_client, gmapi_client, imap_client):
             Google Maps API key.
         imap_client: Instance of IMAP_SSLClient configured with the desired
             email authentication and mailbox values.
+        connection: Optional open IMAP connection to reuse, as yielded by the
+            IMAP client's connect() method.
+        min_uid: Only consider messages with a UID of at least this value.
+        ingest_workers: Number of a message's Attachments to process at once.
+            If 1, they are processed one at a time without any extra threads.
+        checkpoint: Optional FetchCheckpoint for the mailbox being fetched.
+        max_attempts: Number of failed attempts after which a quarantined
+            message is no longer retried.
+        metrics: Optional RunMetrics that the run should add to, e.g. because
+            it already holds the time taken to connect. If None, the run
+            starts its own.
+        metrics_textfile: Optional path to write the run's metrics to, in the
+            Prometheus text format.
+        content_addressed: If True, new Attachments are stored by the SHA-256
+            of their data, sharing files with identical Attachments.
+
+    Returns:
+        The UID to pass as `min_uid` next time to consider only newer messages.
     """
+    if metrics is None:
+        metrics = RunMetrics()
+
     try:
-        messages = imap_client.yield_messages()
+        return fetch_messages(
+            attachments_path=attachments_path, exiftool_client=exiftool_client,
+            gmapi_client=gmapi_client, imap_client=imap_client, connection=connection,
+            min_uid=min_uid, ingest_workers=ingest_workers, checkpoint=checkpoint,
+            max_attempts=max_attempts, metrics=metrics, content_addressed=content_addressed)
+    finally:
+        metrics.emit(textfile=metrics_textfile)
+
+
+def fetch_messages(
+        *, attachments_path, exiftool_client, gmapi_client, imap_client, connection, min_uid,
+        ingest_workers, checkpoint, max_attempts, metrics, content_addressed):
+    """
+    Do the work of run_fetch(), which takes the same arguments.
+
+    Returns:
+        The UID to pass as `min_uid` next time to consider only newer messages.
+    """
+    retry_uids = []
+    if checkpoint is not None:
+        min_uid = max(min_uid, checkpoint.next_uid)
+        retry_uids = checkpoint.retry_uids(max_attempts=max_attempts)
+
+    next_uid = min_uid
+    executor = None
+    if ingest_workers > 1:
+        executor = ThreadPoolExecutor(max_workers=ingest_workers, thread_name_prefix='ingest')
+
+    ingest = partial(
+        ingest_message, attachments_path=attachments_path, exiftool_client=exiftool_client,
+        gmapi_client=gmapi_client, executor=executor, metrics=metrics, content_addressed=content_addressed)
+    if checkpoint is not None:
+        ingest = partial(
+            ingest_or_quarantine, ingest=ingest, checkpoint=checkpoint, max_attempts=max_attempts,
+            metrics=metrics)
+
+    seen = set()
+    try:
+        for message in imap_client.yield_messages(
+                connection=connection, min_uid=min_uid, retry_uids=retry_uids, metrics=metrics):
+            metrics.count('messages')
+            seen.add(int(message.uid))
+            next_uid = max(next_uid, int(message.uid) + 1)
+            ingest(message)
     except NoMessages:
         logger.info('There are no messages')
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    if checkpoint is not None:
+        # Quarantined messages that no longer turn up were deleted by someone
+        for uid in set(retry_uids) - seen:
+            checkpoint.record_success(uid)
+        checkpoint.advance(next_uid - 1)
+        with metrics.timed('db_commit'):
+            db.session.commit()
+
+    return next_uid
+
+
+def ingest_or_quarantine(message, *, ingest, checkpoint, max_attempts, metrics=NULL_METRICS):
+    """
+    Ingest one message, quarantining it in `checkpoint` if that fails.
+
+    Args:
+        message: An message instance as returned by the IMAP client.
+        ingest: Callable that takes `message` and ingests it.
+        checkpoint: FetchCheckpoint for the mailbox being fetched.
+        max_attempts: Number of failed attempts after which the message is no
+            longer retried.
+        metrics: RunMetrics to count quarantined messages in.
+
+    Raises:
+        Exception: Any of TRANSIENT_ERRORS, which are not the message's fault.
+    """
+    uid = int(message.uid)
+
+    try:
+        ingest(message)
+    except TRANSIENT_ERRORS:
+        raise
+    except Exception as exc:
+        db.session.rollback()
+        metrics.count('messages_quarantined')
+        attempts = checkpoint.record_failure(uid, exc)
+        db.session.commit()
+
+        if attempts >= max_attempts:
+            logger.exception(f'Message UID {uid} failed {attempts} time(s); giving up until it is released')
+        else:
+            logger.exception(f'Message UID {uid} failed {attempts} time(s); will retry on a later run')
         return
 
-    for message in messages:
-        logger.info(
-            f'Processing message UID {int(message.uid)}, ID {message.message_id}')
+    if uid in checkpoint.quarantine:
+        checkpoint.record_success(uid)
+        db.session.commit()
 
-        try:
-            post = PostController.message_to_post(message)
-        except PostController.UnknownSender:
-            logger.warning(
-                f'Unknown sender {message.from_name} <{message.from_address}>; '
-                'deleting message')
-            message.delete()
-            continue
 
-        db.session.add(post)
+def ingest_message(
+        message, *, attachments_path, exiftool_client, gmapi_client, executor=None, metrics=NULL_METRICS,
+        content_addressed=False):
+    """
+    Create a Post and Attachments from one message, then delete the message.
 
-        for mime_type, data in AttachmentController.message_to_data(message):
+    Each Attachment part is first decoded into a temporary file inside
+    `attachments_path`, without holding the decoded data in memory, and is
+    moved into storage once the Attachment has an ID. The slow part of each
+    Attachment (running exiftool, looking up its address, and storing its
+    file) involves no database access, so when an `executor` is provided
+    those steps run for all of the message's Attachments at once. The Post is
+    committed only after every Attachment has finished, so Posts are still
+    committed one at a time in message order.
+
+    Content-addressed Attachments are hashed as soon as they are decoded. If
+    identical data is already stored, the decoded copy is simply discarded.
+
+    Args:
+        message: An message instance as returned by the IMAP client.
+        attachments_path: A pathlib Path object that points to the root
+            directory where storage data for Attachments should be saved.
+        exiftool_client: Instance of ExifToolClient configured to read EXIF
+            metadata from files.
+        gmapi_client: Instance of GoogleMapsAPIClient configured with a valid
+            Google Maps API key.
+        executor: Optional concurrent.futures Executor to process Attachments
+            with. If None, they are processed one after another.
+        metrics: RunMetrics to time each stage of the ingest in.
+        content_addressed: If True, store Attachments by their SHA-256.
+    """
+    logger.info(
+        f'Processing message UID {int(message.uid)}, ID {message.message_id}')
+
+    post = message_to_post_or_delete(message, metrics=metrics)
+    if post is None:
+        metrics.count('messages_skipped')
+        return
+
+    db.session.add(post)
+
+    attachments, sources = [], []
+    try:
+        for mime_type, source in metrics.timed_iter(
+                'storage_write', AttachmentController.message_to_files(message, directory=attachments_path)):
             logger.debug(f'Got attachment type {mime_type}')
+            sources.append(source)
+            metrics.count('attachments')
+            metrics.count('attachment_bytes', source.stat().st_size)
 
             attachment = post.new_attachment(mime_type=mime_type)
+            attachment.base_path = attachments_path
+            if content_addressed:
+                with metrics.timed('storage_hash'):
+                    attachment.sha256 = hash_file(source)
             db.session.add(attachment)
+            attachments.append(attachment)
+
+        # IDs (and so storage paths) are assigned here
+        with metrics.timed('db_flush'):
             db.session.flush()
 
-            try:
-                attachment.base_path = attachments_path
-                attachment.set_storage_data(data)
-                attachment.populate_exif(exiftool_client=exiftool_client)
-                attachment.populate_geo(gmapi_client=gmapi_client)
-            except Exception:
-                # Avoids runaway disk usage due to persistent gmapi failures
-                attachment.delete_storage_data()
-                raise
+        results = run_jobs([
+            partial(
+                read_attachment_metadata, source=source, store=attachment.move_into_storage,
+                exiftool_client=exiftool_client, gmapi_client=gmapi_client, metrics=metrics)
+            for attachment, source in zip(attachments, sources)], executor=executor)
+    except Exception:
+        # Avoids runaway disk usage due to persistent gmapi failures
+        discard_files(attachments=attachments, sources=sources)
+        raise
 
+    for attachment, (exif, geo) in zip(attachments, results):
+        attachment.set_exif(exif)
+        attachment.geo_latitude, attachment.geo_longitude, attachment.geo_address = geo
+
+    with metrics.timed('db_commit'):
         db.session.commit()
-        message.delete()
+    metrics.count('posts')
+    message.delete()
+
+
+def discard_files(*, attachments, sources):
+    """
+    Remove every file that an unsuccessful ingest_message() left behind.
+
+    Args:
+        attachments: List of Attachment instances. Those with IDs have their
+            storage data deleted.
+        sources: List of pathlib Path objects referring to decoded message
+            parts that may not have been moved into storage yet.
+    """
+    for source in sources:
+        source.unlink(missing_ok=True)
+
+    for attachment in attachments:
+        if attachment.id is not None:
+            attachment.delete_storage_data()
+
+
+def read_attachment_metadata(*, source, store, exiftool_client, gmapi_client, metrics=NULL_METRICS):
+    """
+    Read one Attachment's EXIF and location, then move its data into storage.
+
+    The data is read from the decoded file, so that storage backends that are
+    not on the local disk never have to hand it back. Nothing here touches the
+    database, so it is safe to run in a worker thread.
+
+    Args:
+        source: A pathlib Path object referring to the decoded Attachment data.
+        store: Callable that takes `source` and moves it into storage, like an
+            Attachment's move_into_storage() method.
+        exiftool_client: Instance of ExifToolClient configured to read EXIF
+            metadata from files.
+        gmapi_client: Instance of GoogleMapsAPIClient configured with a valid
+            Google Maps API key.
+        metrics: RunMetrics to time each step in.
+
+    Returns:
+        Tuple of (exif, geo), where `exif` is suitable for Attachment.set_exif()
+        and `geo` is the (latitude, longitude, address) tuple returned by
+        Attachment.read_geo().
+    """
+    with metrics.timed('exiftool'):
+        exif = exiftool_client.read_file(source)
+    with metrics.timed('geocode'):
+        geo = Attachment.read_geo(exif, gmapi_client=gmapi_client)
+    with metrics.timed('storage_move'):
+        store(source)
+
+    return exif, geo
+
+
+def run_jobs(jobs, *, executor=None):
+    """
+    Call each of `jobs` and return their results in order.
+
+    Unlike Executor.map(), this waits for every job to finish before raising
+    the first exception, so that nothing is still running during cleanup.
+
+    Args:
+        jobs: List of callables that take no arguments.
+        executor: Optional concurrent.futures Executor to run the jobs with. If
+            None, they are run one after another, stopping at the first error.
+
+    Returns:
+        List of the jobs' return values.
+    """
+    if executor is None:
+        return [job() for job in jobs]
+
+    futures = [executor.submit(job) for job in jobs]
+    wait(futures)
+
+    return [future.result() for future in futures]
 
 
 if __name__ == '__main__':  # pragma: nocover
@@ -0,0 +1,496 @@
+"""
+Windowbox offline import script.
+
+This should usually be called via the console script defined in setup.py:
+
+    WINDOWBOX_CONFIG=configs/some.py windowbox-import /path/to/Maildir
+    WINDOWBOX_CONFIG=configs/some.py windowbox-import /path/to/archive.mbox
+
+This reads every message in a local Maildir or mbox archive and ingests suitable
+ones as Posts and Attachments through the same controller logic that
+windowbox-fetch uses. Messages are read in archive key order (the order they
+appear in an mbox file, or Maildir file name order, which usually follows
+delivery time) rather than by their Date headers, so that the checkpoint can
+record progress as a single key. Unlike windowbox-fetch, nothing is ever
+deleted from the source; messages from unknown senders and messages that were
+already posted are simply skipped.
+
+Decoding each message, writing its Attachment parts, and reading their EXIF
+data and location happen in a pool of worker processes. The main process only
+does the database work, committing one batch of messages at a time. After each
+commit, the key of the last message in the batch is saved to a checkpoint file
+so that an interrupted import can pick up where it left off.
+
+Attributes:
+    ImportedMessage: namedtuple holding everything that the Post controller
+        needs from a decoded message (the same attributes an IMAPMessage has),
+        plus the list of its `attachments`.
+    ImportedAttachment: namedtuple describing one decoded Attachment part: its
+        `mime_type`, the `path` of the temporary file holding its data, the
+        `sha256` digest of that data, its `exif` dict, and its `geo` (latitude,
+        longitude, address) tuple.
+    MAILBOX_FORMATS: Mapping of format names to the stdlib mailbox classes that
+        read them.
+    worker_context: Dict holding the open mailbox and clients used by
+        decode_message(). It is filled in by init_worker() in each process.
+    logger: Logger instance scoped to the current module name.
+"""
+
+import argparse
+import json
+import logging
+import mailbox
+import multiprocessing
+import sys
+from collections import Counter, namedtuple
+from contextlib import contextmanager
+from functools import partial
+from pathlib import Path
+from windowbox import app
+from windowbox.clients.imap import IMAPMessage
+from windowbox.controllers.attachment import AttachmentController
+from windowbox.controllers.post import PostController
+from windowbox.database import db
+from windowbox.models import hash_file
+from windowbox.models.attachment import Attachment
+from windowbox.storage import sweep_temp_files
+
+ImportedMessage = namedtuple('ImportedMessage', [
+    'uid', 'date', 'from_name', 'from_address', 'message_id', 'x_mailer', 'text_plain',
+    'attachments'])
+ImportedAttachment = namedtuple('ImportedAttachment', ['mime_type', 'path', 'sha256', 'exif', 'geo'])
+
+MAILBOX_FORMATS = {
+    'maildir': mailbox.Maildir,
+    'mbox': mailbox.mbox}
+
+worker_context = {}
+
+logger = logging.getLogger(__name__)
+
+
+def main(argv=None):
+    """
+    Main entrypoint for the windowbox-import console script.
+
+    Args:
+        argv: List of command-line arguments. If None, uses sys.argv.
+
+    Returns:
+        0, unless something raises an uncaught exception.
+    """
+    parser = argparse.ArgumentParser(description='Import Posts from a Maildir or mbox archive.')
+    parser.add_argument('source', type=Path, help='path to the Maildir directory or mbox file')
+    parser.add_argument(
+        '--format', choices=sorted(MAILBOX_FORMATS),
+        help='archive format (default: maildir for directories, mbox for files)')
+    parser.add_argument(
+        '--batch-size', type=int, default=app.config['IMPORT_BATCH_SIZE'],
+        help='number of messages to commit at a time')
+    parser.add_argument(
+        '--workers', type=int, default=app.config['IMPORT_WORKERS'],
+        help='number of worker processes; 0 does everything in this process')
+    parser.add_argument(
+        '--dry-run', action='store_true',
+        help='go through the motions, but roll back instead of committing')
+    parser.add_argument(
+        '--checkpoint', type=Path,
+        help='file to record progress in (default: SOURCE.windowbox-import.json)')
+    parser.add_argument(
+        '--restart', action='store_true', help='ignore any saved progress and start over')
+    args = parser.parse_args(argv)
+
+    checkpoint = args.checkpoint or Path(f'{args.source}.windowbox-import.json')
+    if args.restart:
+        checkpoint.unlink(missing_ok=True)
+
+    logger.info(f'Starting windowbox-import of {args.source}')
+
+    if app.config['STORAGE_SWEEP_MIN_AGE'] is not None:
+        for base_path in (app.attachments_path, app.derivatives_path):
+            sweep_temp_files(base_path, min_age=app.config['STORAGE_SWEEP_MIN_AGE'])
+
+    with app.app_context():
+        run_import(
+            source=args.source, fmt=args.format, attachments_path=app.attachments_path,
+            exiftool_client=app.exiftool_client, gmapi_client=app.gmapi_client,
+            workers=args.workers, batch_size=args.batch_size, dry_run=args.dry_run,
+            checkpoint=None if args.dry_run else checkpoint,
+            content_addressed=app.config['STORAGE_CONTENT_ADDRESSED'])
+
+    logger.info('windowbox-import completed without error')
+
+    return 0
+
+
+def open_mailbox(source, fmt=None):
+    """
+    Open a local mail archive for reading.
+
+    Args:
+        source: A pathlib Path object referring to the archive.
+        fmt: One of the names in MAILBOX_FORMATS. If None, directories are
+            read as Maildir and files as mbox.
+
+    Returns:
+        A mailbox.Mailbox instance.
+    """
+    if fmt is None:
+        fmt = 'maildir' if source.is_dir() else 'mbox'
+
+    return MAILBOX_FORMATS[fmt](source, create=False)
+
+
+def read_checkpoint(checkpoint, *, source):
+    """
+    Return the key of the last message committed by a previous import.
+
+    Args:
+        checkpoint: A pathlib Path object referring to the checkpoint file.
+        source: A pathlib Path object referring to the archive being imported.
+
+    Returns:
+        The mailbox key of the last committed message, or None if there is no
+        usable checkpoint for `source`.
+    """
+    try:
+        state = json.loads(checkpoint.read_text())
+    except FileNotFoundError:
+        return None
+
+    if state['source'] != str(source):
+        logger.warning(f'Checkpoint {checkpoint} is for {state["source"]}; ignoring it')
+        return None
+
+    return state['last_key']
+
+
+def write_checkpoint(checkpoint, *, source, last_key):
+    """
+    Record the key of the last message that has been committed.
+
+    The file is replaced atomically, so a crash never leaves it half-written.
+
+    Args:
+        checkpoint: A pathlib Path object referring to the checkpoint file.
+        source: A pathlib Path object referring to the archive being imported.
+        last_key: The mailbox key of the last committed message.
+    """
+    temp = checkpoint.with_name(f'{checkpoint.name}.tmp')
+    temp.write_text(json.dumps({'source': str(source), 'last_key': last_key}))
+    temp.replace(checkpoint)
+
+
+def init_worker(*, source, fmt, attachments_path, exiftool_client, gmapi_client):
+    """
+    Prepare the current process to run decode_message().
+
+    Args:
+        source: A pathlib Path object referring to the archive.
+        fmt: Archive format, as accepted by open_mailbox().
+        attachments_path: A pathlib Path object that points to the root
+            directory where storage data for Attachments should be saved.
+        exiftool_client: Instance of ExifToolClient configured to read EXIF
+            metadata from files.
+        gmapi_client: Instance of GoogleMapsAPIClient configured with a valid
+            Google Maps API key.
+    """
+    worker_context.update(
+        mailbox=open_mailbox(source, fmt), attachments_path=attachments_path,
+        exiftool_client=exiftool_client, gmapi_client=gmapi_client)
+
+
+@contextmanager
+def worker_map(*, workers, **init_kwargs):
+    """
+    Provide a map() function that runs decode_message() in worker processes.
+
+    Args:
+        workers: Number of worker processes. If 0, everything runs in the
+            current process instead.
+        **init_kwargs: Passed through to init_worker().
+
+    Yields:
+        A function like the built-in map() that yields results in input order.
+    """
+    initializer = partial(init_worker, **init_kwargs)
+
+    if workers < 1:
+        initializer()
+        yield map
+        return
+
+    with multiprocessing.Pool(processes=workers, initializer=initializer) as pool:
+        yield pool.imap
+
+
+def decode_message(key):
+    """
+    Decode one archived message and prepare its Attachment data.
+
+    This runs in a worker process, so it deals only in plain values and never
+    touches the database session (a CachedGeocoder makes its own connections).
+    Each usable part is written to a temporary file in the attachments path,
+    and it is hashed and its EXIF data and location are read.
+
+    Args:
+        key: The mailbox key of the message to decode.
+
+    Returns:
+        Tuple of (key, message, error). On success, `message` is an
+        ImportedMessage and `error` is None. If the message could not be
+        decoded, `message` is None and `error` describes the problem.
+    """
+    try:
+        raw = worker_context['mailbox'].get_bytes(key)
+        message = IMAPMessage(data=[(b'', raw)], imap_connection=None, uid=key)
+
+        return key, ImportedMessage(
+            uid=key, date=message.date, from_name=message.from_name,
+            from_address=message.from_address, message_id=message.message_id,
+            x_mailer=message.x_mailer, text_plain=message.text_plain,
+            attachments=decode_attachments(message)), None
+    except Exception as exc:
+        return key, None, f'{type(exc).__name__}: {exc}'
+
+
+def decode_attachments(message):
+    """
+    Write out the Attachment parts of `message` and read their metadata.
+
+    Args:
+        message: An IMAPMessage instance.
+
+    Returns:
+        List of ImportedAttachment instances. If anything fails, every file
+        written so far is removed before the exception propagates.
+    """
+    exiftool_client = worker_context['exiftool_client']
+    gmapi_client = worker_context['gmapi_client']
+    paths = []
+
+    try:
+        for mime_type, path in AttachmentController.message_to_files(
+                message, directory=worker_context['attachments_path']):
+            paths.append((mime_type, path))
+
+        attachments = []
+        for mime_type, path in paths:
+            exif = exiftool_client.read_file(path)
+            geo = Attachment.read_geo(exif, gmapi_client=gmapi_client)
+            attachments.append(ImportedAttachment(
+                mime_type=mime_type, path=path, sha256=hash_file(path), exif=exif, geo=geo))
+    except Exception:
+        for _, path in paths:
+            path.unlink(missing_ok=True)
+        raise
+
+    return attachments
+
+
+def import_message(imported, *, attachments_path, dry_run, written, content_addressed=False):
+    """
+    Add a Post and its Attachments for one decoded message to the session.
+
+    Args:
+        imported: ImportedMessage instance from decode_message().
+        attachments_path: A pathlib Path object that points to the root
+            directory where storage data for Attachments should be saved.
+        dry_run: If True, the decoded files are removed instead of being moved
+            into storage.
+        written: List to append every file this creates to, so that the
+            caller can remove them if the batch is not committed; see
+            remove_files().
+        content_addressed: If True, Attachments are stored by their SHA-256,
+            and data that is already stored is not stored again.
+
+    Returns:
+        String describing the outcome: "imported", "unknown_sender", or
+        "duplicate".
+    """
+    written.extend(a.path for a in imported.attachments)
+
+    try:
+        post = PostController.message_to_post(imported)
+    except PostController.UnknownSender:
+        logger.info(f'Skipping message {imported.uid} from unknown sender {imported.from_address}')
+        outcome = 'unknown_sender'
+    except PostController.DuplicateMessage:
+        logger.info(f'Skipping message {imported.uid}; ID {imported.message_id} was already posted')
+        outcome = 'duplicate'
+    else:
+        outcome = 'imported'
+
+    if outcome != 'imported':
+        for decoded in imported.attachments:
+            decoded.path.unlink()
+        return outcome
+
+    db.session.add(post)
+    attachments = [post.new_attachment(mime_type=a.mime_type) for a in imported.attachments]
+    db.session.add_all(attachments)
+    db.session.flush()
+
+    for attachment, decoded in zip(attachments, imported.attachments):
+        attachment.base_path = attachments_path
+        if content_addressed:
+            attachment.sha256 = decoded.sha256
+        attachment.set_exif(decoded.exif)
+        attachment.geo_latitude, attachment.geo_longitude, attachment.geo_address = decoded.geo
+
+        if not dry_run:
+            store_attachment(attachment, decoded.path, written=written)
+
+    return outcome
+
+
+def store_attachment(attachment, source, *, written):
+    """
+    Move a decoded file into an Attachment's storage.
+
+    If the Attachment is content-addressed and its data is already stored, the
+    decoded file is removed instead, and the stored copy is left as it is.
+
+    Args:
+        attachment: Attachment instance, with its base_path set.
+        source: A pathlib Path object referring to the decoded file.
+        written: List to append the (backend, key) pair of the storage data
+            to, if this created it.
+    """
+    if attachment.move_into_storage(source):
+        written.append((attachment.backend, attachment.storage_key()))
+
+
+def run_import(
+        *, source, fmt=None, attachments_path, exiftool_client, gmapi_client, workers,
+        batch_size, dry_run=False, checkpoint=None, content_addressed=False):
+    """
+    Actual import function.
+
+    Args:
+        source: A pathlib Path object referring to the archive to import.
+        fmt: Archive format, as accepted by open_mailbox().
+        attachments_path: A pathlib Path object that points to the root
+            directory where storage data for Attachments should be saved.
+        exiftool_client: Instance of ExifToolClient configured to read EXIF
+            metadata from files.
+        gmapi_client: Instance of GoogleMapsAPIClient configured with a valid
+            Google Maps API key.
+        workers: Number of worker processes to decode messages with. If 0,
+            everything runs in the current process.
+        batch_size: Number of messages to process per commit.
+        dry_run: If True, every batch is rolled back instead of committed, and
+            no files are left behind.
+        checkpoint: Optional pathlib Path object referring to the checkpoint
+            file. If given, messages up to the one it records are skipped, and
+            it is updated after each commit.
+        content_addressed: Passed through to import_message().
+
+    Returns:
+        Counter of message outcomes: "imported", "unknown_sender",
+        "duplicate", and "failed".
+    """
+    keys = sorted(open_mailbox(source, fmt).keys())
+
+    last_key = read_checkpoint(checkpoint, source=source) if checkpoint else None
+    if last_key is not None:
+        logger.info(f'Resuming after message {last_key}')
+        keys = [key for key in keys if key > last_key]
+
+    with worker_map(
+            workers=workers, source=source, fmt=fmt, attachments_path=attachments_path,
+            exiftool_client=exiftool_client, gmapi_client=gmapi_client) as mapper:
+        return import_results(
+            mapper(decode_message, keys), total=len(keys), source=source,
+            attachments_path=attachments_path, batch_size=batch_size, dry_run=dry_run,
+            checkpoint=checkpoint, content_addressed=content_addressed)
+
+
+def import_results(
+        results, *, total, source, attachments_path, batch_size, dry_run, checkpoint, content_addressed=False):
+    """
+    Add the decoded messages in `results` to the database in batches.
+
+    Args:
+        results: Iterable of decode_message() return values, in key order.
+        total: Number of items in `results`.
+        source: A pathlib Path object referring to the archive being imported.
+        attachments_path: A pathlib Path object that points to the root
+            directory where storage data for Attachments should be saved.
+        batch_size: Number of messages to process per commit.
+        dry_run: If True, every batch is rolled back instead of committed.
+        checkpoint: Optional pathlib Path object referring to the checkpoint
+            file to update after each commit.
+        content_addressed: Passed through to import_message().
+
+    Returns:
+        Counter of message outcomes, as described in run_import().
+    """
+    counts = Counter()
+    written = []
+
+    try:
+        for n, (key, imported, error) in enumerate(results, 1):
+            if imported is None:
+                logger.warning(f'Could not decode message {key}: {error}')
+                counts['failed'] += 1
+            else:
+                counts[import_message(
+                    imported, attachments_path=attachments_path, dry_run=dry_run,
+                    written=written, content_addressed=content_addressed)] += 1
+
+            if n % batch_size == 0 or n == total:
+                finish_batch(
+                    written=written, dry_run=dry_run, checkpoint=checkpoint, source=source,
+                    last_key=key)
+                logger.info(f'Finished batch ending at message {key}: {dict(counts)}')
+    except BaseException:
+        db.session.rollback()
+        remove_files(written)
+        raise
+
+    return counts
+
+
+def finish_batch(*, written, dry_run, checkpoint, source, last_key):
+    """
+    Commit (or, in a dry run, roll back) the current batch of messages.
+
+    Args:
+        written: List of the files created for this batch; see remove_files().
+            It is emptied, and in a dry run the files are removed.
+        dry_run: If True, roll back instead of committing.
+        checkpoint: Optional pathlib Path object referring to the checkpoint
+            file to update after committing.
+        source: A pathlib Path object referring to the archive being imported.
+        last_key: The mailbox key of the last message in the batch.
+    """
+    if dry_run:
+        db.session.rollback()
+        remove_files(written)
+    else:
+        db.session.commit()
+        if checkpoint:
+            write_checkpoint(checkpoint, source=source, last_key=last_key)
+
+    written.clear()
+
+
+def remove_files(files):
+    """
+    Remove each of `files`, ignoring any that no longer exist.
+
+    Args:
+        files: Iterable of local pathlib Path objects and (StorageBackend,
+            key) pairs.
+    """
+    for file in files:
+        if isinstance(file, tuple):
+            backend, key = file
+            backend.delete(key)
+        else:
+            file.unlink(missing_ok=True)
+
+
+if __name__ == '__main__':  # pragma: nocover
+    sys.exit(main())
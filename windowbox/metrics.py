@@ -0,0 +1,244 @@
+"""
+Timings and counters for one ingest run.
+
+A RunMetrics instance is handed down through windowbox-fetch and the IMAP
+client, and each stage of the ingest adds to it: time spent is accumulated per
+named stage (along with how many times the stage ran), and everything else is
+a plain named counter. At the end of the run the totals are reported as JSON,
+and optionally written out in the Prometheus text exposition format for the
+node_exporter textfile collector to pick up.
+
+Stages that run in worker threads add up their own time, so the stage totals
+can be larger than the wall-clock time of the run.
+
+Attributes:
+    NULL_METRICS: Shared NullMetrics instance, for code that is called without
+        a RunMetrics to report to.
+    PROMETHEUS_PREFIX: Prefix for every metric name in the textfile.
+    logger: Logger instance scoped to the current module name.
+"""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+
+PROMETHEUS_PREFIX = 'windowbox_fetch'
+
+logger = logging.getLogger(__name__)
+
+
+class RunMetrics:
+    """
+    Thread-safe accumulator of per-stage timings and named counters.
+    """
+
+    def __init__(self):
+        """
+        Constructor. The run's wall-clock time starts now.
+        """
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.started_unix = time.time()
+        self.stage_calls = Counter()
+        self.stage_seconds = Counter()
+        self.counters = Counter()
+
+    @contextmanager
+    def timed(self, stage):
+        """
+        Add the time spent inside a `with` block to `stage`.
+
+        The time is recorded even if the block raises.
+
+        Args:
+            stage: Name of the stage, like "imap_search".
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def timed_iter(self, stage, iterable):
+        """
+        Yield from `iterable`, adding the time taken to produce each item.
+
+        This suits generators that do their work lazily, as each item is
+        asked for. Time spent by the caller between items is not counted.
+
+        Args:
+            stage: Name of the stage.
+            iterable: Any iterable.
+
+        Yields:
+            Each item of `iterable`.
+        """
+        iterator = iter(iterable)
+
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add_time(stage, time.perf_counter() - start)
+
+            yield item
+
+    def add_time(self, stage, seconds):
+        """
+        Record one run of `stage` that took `seconds`.
+
+        Args:
+            stage: Name of the stage.
+            seconds: Duration of this run of the stage.
+        """
+        with self.lock:
+            self.stage_calls[stage] += 1
+            self.stage_seconds[stage] += seconds
+
+    def count(self, name, n=1):
+        """
+        Add `n` to the counter called `name`.
+
+        Args:
+            name: Name of the counter, like "messages".
+            n: Amount to add.
+        """
+        with self.lock:
+            self.counters[name] += n
+
+    def report(self):
+        """
+        Summarize everything recorded so far.
+
+        Returns:
+            Dict with the run's `elapsed_seconds`, its `counters`, and its
+            `stages`, each of which has a `calls` count and total `seconds`.
+        """
+        with self.lock:
+            return {
+                'elapsed_seconds': round(time.perf_counter() - self.started, 6),
+                'counters': dict(sorted(self.counters.items())),
+                'stages': {
+                    stage: {'calls': self.stage_calls[stage], 'seconds': round(self.stage_seconds[stage], 6)}
+                    for stage in sorted(self.stage_calls)}}
+
+    def to_json(self):
+        """
+        Return report() as a single line of JSON.
+        """
+        return json.dumps(self.report(), sort_keys=True)
+
+    def to_prometheus(self):
+        """
+        Return report() in the Prometheus text exposition format.
+
+        Every value describes the last run only, so all of them are gauges.
+
+        Returns:
+            String ending in a newline.
+        """
+        report = self.report()
+        lines = []
+
+        def family(name, help_text, samples):
+            lines.append(f'# HELP {PROMETHEUS_PREFIX}_{name} {help_text}')
+            lines.append(f'# TYPE {PROMETHEUS_PREFIX}_{name} gauge')
+            lines.extend(f'{PROMETHEUS_PREFIX}_{name}{labels} {value}' for labels, value in samples)
+
+        family(
+            'stage_seconds', 'Seconds spent in each stage of the last run.',
+            [(f'{{stage="{stage}"}}', s['seconds']) for stage, s in report['stages'].items()])
+        family(
+            'stage_calls', 'Number of times each stage ran in the last run.',
+            [(f'{{stage="{stage}"}}', s['calls']) for stage, s in report['stages'].items()])
+        family(
+            'items', 'Things counted during the last run.',
+            [(f'{{name="{name}"}}', value) for name, value in report['counters'].items()])
+        family('elapsed_seconds', 'Wall-clock duration of the last run.', [('', report['elapsed_seconds'])])
+        family('last_run_timestamp_seconds', 'Unix time the last run started.', [('', self.started_unix)])
+
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        """
+        Atomically replace `path` with to_prometheus().
+
+        The file is written under a temporary name in the same directory and
+        then renamed, so the collector never sees it half-written.
+
+        Args:
+            path: A pathlib Path object (or string) ending in ".prom".
+        """
+        path = Path(path)
+        fd, temp_name = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.')
+
+        try:
+            with os.fdopen(fd, 'w') as fp:
+                fp.write(self.to_prometheus())
+            os.chmod(temp_name, 0o644)
+            os.replace(temp_name, path)
+        except BaseException:
+            os.unlink(temp_name)
+            raise
+
+    def emit(self, *, textfile=None):
+        """
+        Log the report as JSON, and write it to `textfile` if one is given.
+
+        A textfile that can't be written is logged, not raised; losing the
+        metrics should never fail the run they describe.
+
+        Args:
+            textfile: Optional path for write_textfile().
+        """
+        logger.info(f'Run metrics: {self.to_json()}')
+
+        if not textfile:
+            return
+
+        try:
+            self.write_textfile(textfile)
+        except OSError as exc:
+            logger.warning(f'Could not write metrics to {textfile}: {exc}')
+
+
+class NullMetrics(RunMetrics):
+    """
+    RunMetrics that throws everything away.
+    """
+
+    @contextmanager
+    def timed(self, stage):
+        """
+        Run the `with` block without timing it.
+        """
+        yield
+
+    def timed_iter(self, stage, iterable):
+        """
+        Yield from `iterable` without timing it.
+        """
+        yield from iterable
+
+    def add_time(self, stage, seconds):
+        """
+        Do nothing.
+        """
+        pass
+
+    def count(self, name, n=1):
+        """
+        Do nothing.
+        """
+        pass
+
+
+NULL_METRICS = NullMetrics()
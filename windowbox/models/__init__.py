@@ -1,21 +1,149 @@
 """
 Model utility functions and mixins.
+
+Attributes:
+    HASH_CHUNK_BYTES: Amount of a file to read at a time while hashing it.
+    STORAGE_LAYOUTS: Mapping of layout version numbers to the functions that
+        choose the two directory names an ID-addressed file is stored under.
+    logger: Logger instance scoped to the current module name.
 """
 
+import hashlib
+import io
+import logging
 import mimetypes
+import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
+from windowbox.storage import FSYNC_POLICIES, LocalBackend
+
+HASH_CHUNK_BYTES = 1024 * 1024
+
+logger = logging.getLogger(__name__)
 
 
 def import_all_models():
     """
     Import all of the defined model modules so SQLAlchemy is aware of them.
     """
+    import windowbox.models.archive  # noqa: F401
     import windowbox.models.attachment  # noqa: F401
+    import windowbox.models.checkpoint  # noqa: F401
     import windowbox.models.derivative  # noqa: F401
+    import windowbox.models.geocode  # noqa: F401
+    import windowbox.models.pack  # noqa: F401
     import windowbox.models.post  # noqa: F401
     import windowbox.models.sender  # noqa: F401
 
 
+def hash_file(path):
+    """
+    Compute the SHA-256 digest of a file's content.
+
+    Args:
+        path: A pathlib Path object referring to the file.
+
+    Returns:
+        Lowercase hex digest string.
+    """
+    digest = hashlib.sha256()
+
+    with path.open('rb') as fp:
+        while chunk := fp.read(HASH_CHUNK_BYTES):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def decimal_shards(name):
+    """
+    Layout 1: Use the first two decimal digits of the ID as directory names.
+
+    IDs with fewer than three digits are padded with zeros on the left. Leading
+    digits are far from uniform, so some directories get many more files than
+    others.
+
+    Args:
+        name: The ID, as a string.
+
+    Returns:
+        Tuple of two directory names, like ('1', '2') for ID 1234.
+    """
+    if len(name) <= 1:
+        return '0', '0'
+    elif len(name) == 2:
+        return '0', name[0]
+
+    return name[0], name[1]
+
+
+def hashed_shards(name):
+    """
+    Layout 2: Spread IDs evenly over 256 x 256 directories by hashing them.
+
+    Args:
+        name: The ID, as a string.
+
+    Returns:
+        Tuple of two two-digit hex directory names, like ('5e', '0c').
+    """
+    digest = hashlib.blake2b(name.encode(), digest_size=2).digest()
+
+    return f'{digest[0]:02x}', f'{digest[1]:02x}'
+
+
+STORAGE_LAYOUTS = {
+    1: decimal_shards,
+    2: hashed_shards}
+
+
+def configure_storage(*, layout, fallback_layout=None, fsync='file'):
+    """
+    Set the storage layout and fsync policy of every FilesystemMixin class.
+
+    Args:
+        layout: Version number of the layout files are written in.
+        fallback_layout: Version number of a layout that files are also looked
+            for in when they are read, or None. This is meant for the time
+            between changing `layout` and finishing migrate_storage_layout().
+        fsync: One of the `FSYNC_POLICIES`.
+
+    Raises:
+        ValueError: One of the layouts is not defined in `STORAGE_LAYOUTS`, or
+            the fsync policy is unknown.
+    """
+    for version in (layout, fallback_layout):
+        if version is not None and version not in STORAGE_LAYOUTS:
+            raise ValueError(f'Unknown storage layout: {version}')
+
+    if fsync not in FSYNC_POLICIES:
+        raise ValueError(f'Unknown fsync policy: {fsync}')
+
+    FilesystemMixin.storage_layout = layout
+    FilesystemMixin.fallback_layout = None if fallback_layout == layout else fallback_layout
+    FilesystemMixin.fsync_policy = fsync
+
+
+def link_if_absent(source, destination):
+    """
+    Hardlink `source` to `destination`, unless `destination` already exists.
+
+    Args:
+        source: A pathlib Path object referring to an existing file.
+        destination: A pathlib Path object on the same filesystem.
+
+    Returns:
+        True if the link was made, False if `destination` was already there.
+    """
+    try:
+        os.link(source, destination)
+    except FileExistsError:
+        return False
+
+    return True
+
+
 class FilesystemMixin:
     """
     Adds filesystem storage capabilities to any model class.
@@ -24,6 +152,25 @@ class FilesystemMixin:
       - base_path
       - id
       - mime_type (optional; influences file extensions on disk)
+      - content_key (optional; see below)
+
+    An instance whose `content_key` is None is stored under a path derived from
+    its `id`. Otherwise it is content-addressed: it is stored under a path
+    derived from the key alone, which it shares with every other instance that
+    has the same key. Such files are only deleted along with the last instance
+    that uses them, which classes decide by implementing storage_is_shared().
+
+    Storage data is kept by a storage backend (see windowbox.storage) under a
+    key made from the same directory and file names. Classes that set
+    `storage_backend` use it; otherwise each instance gets a LocalBackend at
+    its own `base_path`, which writes every file atomically and flushes it as
+    `fsync_policy` says. Methods that deal in storage_path() (like
+    migrate_storage_layout()) only make sense for local storage.
+
+    ID-addressed paths are arranged by `storage_layout`, one of the versions in
+    `STORAGE_LAYOUTS`. While files are being moved from one layout to another,
+    `fallback_layout` names the old one, and reads that can't find a file in
+    the new layout look for it there instead.
 
     Attributes:
         FALLBACK_EXTENSION: If a fixed extension is not defined, and the MIME
@@ -34,10 +181,18 @@ class FilesystemMixin:
         IMAGE_SAVE_OPTIONS: Mapping of MIME-types to dictionaries, each one
             defining the options to pass to the Image.save() method when writing
             that type of image file.
+        CONTENT_DIRECTORY: Name of the directory within `base_path` that holds
+            content-addressed files.
         base_path: A pathlib Path object which refers to the root directory
             where all storage data should be located. Within this root, a two-
             level nested directory structure is used to keep the number of
             directory entries manageable.
+        storage_layout: Version number of the layout that files are written in.
+        fallback_layout: Version number of the layout that files are also read
+            from, or None.
+        fsync_policy: One of the `FSYNC_POLICIES`.
+        storage_backend: StorageBackend instance shared by every instance of
+            the class, or None to use local storage at `base_path`.
     """
 
     FALLBACK_EXTENSION = '.dat'
@@ -52,18 +207,40 @@ class FilesystemMixin:
             'subsampling': '4:4:4'},
         'image/png': {
             'optimize': True}}
+    CONTENT_DIRECTORY = 'sha256'
 
     base_path = None
+    content_key = None
+    storage_layout = 1
+    fallback_layout = None
+    fsync_policy = 'file'
+    storage_backend = None
+
+    @property
+    def backend(self):
+        """
+        Return the storage backend that holds this instance's data.
+
+        Returns:
+            StorageBackend instance.
+        """
+        if self.storage_backend is not None:
+            return self.storage_backend
+
+        if self.base_path is None:
+            raise RuntimeError('base_path should not be None')
+
+        return LocalBackend(self.base_path, fsync=self.fsync_policy)
 
     @property
     def has_storage_data(self):
         """
-        Does this instance currently have data stored on the filesystem?
+        Does this instance currently have data stored in its backend?
 
         Returns:
-            Boolean True if a file exists at the storage path for this instance.
+            Boolean True if data exists under the storage key for this instance.
         """
-        return self.storage_path().is_file()
+        return self.backend.exists(self.storage_key())
 
     @property
     def storage_data_size_bytes(self):
@@ -71,23 +248,54 @@ class FilesystemMixin:
         How much space does the storage data for this instance use?
 
         Returns:
-            File size in bytes.
+            Size in bytes.
+        """
+        return self.backend.size(self.storage_key())
+
+    def storage_key(self, *, layout=None):
         """
-        return self.storage_path().stat().st_size
+        Use the current state of the model to make a unique storage key.
+
+        This is the storage path relative to `base_path`, and has the same
+        requirements. Without an explicit `layout`, data that only exists in
+        the `fallback_layout` is found there.
+
+        Args:
+            layout: Version number of the layout to use for an ID-addressed
+                key, instead of `storage_layout`.
 
-    def storage_path(self, *, create_parents=False):
+        Returns:
+            String like "5e/0c/1234.jpg".
+        """
+        key = self.layout_key(layout or self.storage_layout)
+
+        if layout is None and self.fallback_layout is not None:
+            fallback = self.layout_key(self.fallback_layout)
+            if fallback != key and not self.backend.exists(key) and self.backend.exists(fallback):
+                return fallback
+
+        return key
+
+    def storage_path(self, *, create_parents=False, layout=None):
         """
         Use the current state of the model to make a unique filesystem name.
 
         In all cases, uses `base_path` as the topmost directory. Note that for
-        this to work correctly, the model instance must have its `id` and
-        `mime_type` attributes set. For a newly-created instance with an auto-
-        incrementing `id`, this usually requires the DB flush() method.
+        this to work correctly, the model instance must have its `id` (or its
+        `content_key`) and `mime_type` attributes set. For a newly-created
+        instance with an auto-incrementing `id`, this usually requires the DB
+        flush() method.
+
+        When reading (that is, without `create_parents` or an explicit
+        `layout`), a file that only exists in the `fallback_layout` is found
+        there.
 
         Args:
             create_parents: If True, try to create all necessary parent
                 directories before returning. This should be enabled during
                 calls that intend to write to the path, and False during read.
+            layout: Version number of the layout to use for an ID-addressed
+                path, instead of `storage_layout`.
 
         Returns:
             Complete base path plus the unique directory/file names that
@@ -97,65 +305,273 @@ class FilesystemMixin:
         if self.base_path is None:
             raise RuntimeError('base_path should not be None')
 
-        if self.id is None:
-            raise RuntimeError('id should not be None')
+        path = self.base_path / self.layout_key(layout or self.storage_layout)
+
+        if create_parents:
+            path.parent.mkdir(parents=True, exist_ok=True)
+        elif layout is None and self.fallback_layout is not None and not path.exists():
+            fallback = self.base_path / self.layout_key(self.fallback_layout)
+            if fallback.exists():
+                return fallback
 
-        id_str = str(self.id)
+        return path
+
+    def layout_key(self, layout):
+        """
+        Build the storage key for this instance in one particular layout.
+
+        Content-addressed keys are the same in every layout.
+
+        Args:
+            layout: Version number of the layout.
 
-        if len(id_str) <= 1:
-            d1, d2 = '0', '0'
-        elif len(id_str) == 2:
-            d1, d2 = '0', id_str[0]
+        Returns:
+            String key.
+        """
+        key = self.content_key
+
+        if key is not None:
+            directories = (self.CONTENT_DIRECTORY, key[0:2], key[2:4])
+        elif self.id is None:
+            raise RuntimeError('id should not be None')
         else:
-            d1, d2 = id_str[0], id_str[1]
+            directories = STORAGE_LAYOUTS[layout](str(self.id))
 
-        prefix = self.base_path / d1 / d2
-        if create_parents:
-            prefix.mkdir(parents=True, exist_ok=True)
+        return '/'.join((*directories, self.storage_name))
 
-        extension = (
+    @property
+    def storage_extension(self):
+        """
+        Return the file extension that suits this instance's `mime_type`.
+
+        Returns:
+            String like ".jpg".
+        """
+        return (
             self.KNOWN_EXTENSIONS.get(self.mime_type)
             or mimetypes.guess_extension(self.mime_type)
             or self.FALLBACK_EXTENSION)
 
-        return prefix / f'{id_str}{extension}'
+    @property
+    def storage_name(self):
+        """
+        Return the file name of the storage data, without any directories.
+
+        This is unique among all instances of the class that don't share their
+        storage data, in every layout.
+
+        Returns:
+            String like "1234.jpg".
+        """
+        return f'{self.content_key or self.id}{self.storage_extension}'
+
+    def storage_writer(self):
+        """
+        Open a temporary file that replaces the storage data once it's written.
+
+        If the `with` block raises, the storage data is left untouched.
+
+        Returns:
+            Context manager that yields a file object open for writing in
+            binary mode.
+        """
+        return self.backend.writer(self.layout_key(self.storage_layout))
+
+    def move_into_storage(self, source):
+        """
+        Move an already-written file into storage.
+
+        If this instance is content-addressed and its data is already stored,
+        `source` is removed instead, and the stored copy is left as it is.
+
+        This only reads attributes that are already loaded, never the
+        database, so it is safe to call from a worker thread.
+
+        Args:
+            source: A pathlib Path object referring to the file. For local
+                storage it is renamed if it is on the same filesystem as
+                `base_path`, and copied otherwise.
+
+        Returns:
+            Boolean True if `source` became the storage data.
+        """
+        key = self.layout_key(self.storage_layout)
+
+        if self.content_key is not None and self.backend.exists(key):
+            source.unlink()
+            return False
+
+        self.backend.put(key, source)
+
+        return True
+
+    def open_storage_data(self):
+        """
+        Open the storage data for reading.
+
+        Returns:
+            Binary file object, which the caller should close.
+        """
+        return self.backend.open(self.storage_key())
+
+    def storage_local_file(self):
+        """
+        Make the storage data available as a local file.
+
+        Returns:
+            Context manager that yields a pathlib Path object, which is only
+            valid inside the `with` block.
+        """
+        return self.backend.local_file(self.storage_key())
 
     def set_storage_data(self, data):
         """
-        Convenience method to write to the storage path.
+        Convenience method to write the storage data.
+
+        Args:
+            data: Data to write (bytes, in binary mode). The data will be
+                created if it doesn't exist, or atomically replaced if it does
+                exist.
+        """
+        with self.storage_writer() as fp:
+            fp.write(data)
+
+    def image_to_bytes(self, image):
+        """
+        Encode a PIL Image the same way set_storage_data_from_image() would.
 
         Args:
-            data: Data to write (bytes, in binary mode) to the storage path. The
-                file will be created if it doesn't exist, or silently
-                overwritten if it does exist.
+            image: Instance of a PIL Image.
+
+        Returns:
+            Bytes of the encoded image.
         """
-        self.storage_path(create_parents=True).write_bytes(data)
+        save_options = self.IMAGE_SAVE_OPTIONS.get(self.mime_type, {})
+        buffer = io.BytesIO()
+
+        image.save(fp=buffer, format=Image.registered_extensions()[self.storage_extension], **save_options)
+
+        return buffer.getvalue()
 
     def set_storage_data_from_image(self, image):
         """
-        Write the contents of a PIL Image to the storage path.
+        Write the contents of a PIL Image as the storage data.
 
         Args:
             image: Instance of a PIL Image.
         """
         save_options = self.IMAGE_SAVE_OPTIONS.get(self.mime_type, {})
 
-        image.save(fp=self.storage_path(create_parents=True), **save_options)
+        with self.storage_writer() as fp:
+            image.save(fp=fp, format=Image.registered_extensions()[self.storage_extension], **save_options)
 
     def get_storage_data_as_image(self):
         """
-        Return the current storage path data as a PIL Image.
+        Return the current storage data as a PIL Image.
 
         The caller should know whether or not the underlying data is appropriate
-        for reading as an image. No effort is made here to validate that.
+        for reading as an image. No effort is made here to validate that. The
+        image is loaded before the data is closed.
+
+        Returns:
+            PIL Image object representing the storage data.
+        """
+        with self.open_storage_data() as fp:
+            image = Image.open(fp)
+            image.load()
+
+        return image
+
+    def storage_is_shared(self):
+        """
+        Is the storage data for this instance also used by another instance?
+
+        Only content-addressed instances can share storage data. This default
+        implementation assumes that nothing does.
 
         Returns:
-            PIL Image object representing the storage path data.
+            Boolean True if the storage data must be kept for someone else.
         """
-        return Image.open(self.storage_path())
+        return False
 
     def delete_storage_data(self):
         """
-        Remove the file represented by the storage path, if it exists.
+        Remove the storage data, if it exists.
+
+        Content-addressed data is left alone while another instance still uses
+        it.
+        """
+        if self.content_key is not None and self.storage_is_shared():
+            return
+
+        self.backend.delete(self.storage_key())
+
+    @classmethod
+    def id_addressed_query(cls):
         """
-        self.storage_path().unlink(missing_ok=True)
+        Return a query for the instances that are stored by ID.
+
+        Classes whose instances can be content-addressed should override this
+        to leave those out.
+
+        Returns:
+            SQLAlchemy Query.
+        """
+        return cls.query
+
+    @classmethod
+    def migrate_storage_layout(cls, *, base_path, source, target, workers=4, batch_size=500):
+        """
+        Move every ID-addressed file of this class from one layout to another.
+
+        Each file is hardlinked into the `target` layout before its `source`
+        path is removed, so a reader that falls back to `source` always finds
+        it in one place or the other. Files already in `target` are left alone,
+        so an interrupted run can simply be started again. Nothing in the
+        database changes.
+
+        Args:
+            base_path: A pathlib Path object that points to the root directory
+                where storage data for this class is saved.
+            source: Version number of the layout to move files out of.
+            target: Version number of the layout to move files into.
+            workers: Number of files to move at once.
+            batch_size: Number of instances to load from the database at once.
+
+        Returns:
+            Counter with the number of files that were `moved`, that were
+            `already` in the target layout, and that were `missing` from both.
+        """
+        counts = Counter()
+        last_id = 0
+
+        def move(instance):
+            old_path = instance.storage_path(layout=source)
+            new_path = instance.storage_path(layout=target, create_parents=True)
+
+            try:
+                linked = link_if_absent(old_path, new_path)
+            except FileNotFoundError:
+                return 'already' if new_path.exists() else 'missing'
+
+            old_path.unlink()
+
+            return 'moved' if linked else 'already'
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='migrate') as executor:
+            while True:
+                batch = (
+                    cls.id_addressed_query().filter(cls.id > last_id)
+                    .order_by(cls.id).limit(batch_size).all())
+                if not batch:
+                    break
+                last_id = batch[-1].id
+
+                for instance in batch:
+                    instance.base_path = base_path
+
+                counts.update(executor.map(move, batch))
+
+                logger.info(f'Migrated {cls.__name__} storage up to ID {last_id}: {dict(counts)}')
+
+        return counts
@@ -0,0 +1,110 @@
+"""
+Archive month model.
+
+Attributes:
+    logger: Logger instance scoped to the current module name.
+"""
+
+import calendar
+import logging
+from datetime import timezone
+from sqlalchemy import event, extract, func
+from windowbox.database import db, upsert
+from windowbox.models.post import Post
+
+logger = logging.getLogger(__name__)
+
+
+class ArchiveMonth(db.Model):
+    """
+    Archive month model.
+
+    Each ArchiveMonth holds the number of Posts whose `created_utc` falls within
+    one calendar month (in UTC). The counts are adjusted whenever a Post is
+    inserted or deleted, so that the archive overview never has to aggregate
+    the entire Post table. If the counts ever drift (e.g. rows were changed by
+    hand), rebuild() will recompute everything from scratch.
+    """
+
+    __tablename__ = 'archive_month'
+    year = db.Column(db.Integer, nullable=False, primary_key=True, autoincrement=False)
+    month = db.Column(db.Integer, nullable=False, primary_key=True, autoincrement=False)
+    post_count = db.Column(db.Integer, nullable=False, default=0)
+
+    @property
+    def month_name(self):
+        """
+        Return the full English name of this instance's month.
+
+        Returns:
+            String like "January".
+        """
+        return calendar.month_name[self.month]
+
+    @classmethod
+    def adjust(cls, *, connection, created_utc, delta):
+        """
+        Add `delta` to the count for the month containing `created_utc`.
+
+        This is written against the Core table rather than the ORM so that it
+        can be called from within a flush, where the Session is off-limits.
+
+        Args:
+            connection: SQLAlchemy Connection to execute statements on.
+            created_utc: Datetime of the Post being counted, in any timezone.
+            delta: Integer amount to add to the month's count (may be negative).
+        """
+        table = cls.__table__
+
+        # Naive datetimes are understood to be UTC, same as UTCDateTime does
+        if created_utc.tzinfo is not None:
+            created_utc = created_utc.astimezone(timezone.utc)
+        year, month = created_utc.year, created_utc.month
+
+        # The first Post of a month needs its row created. Two transactions
+        # could both be doing that at once, so it must happen atomically with
+        # the increment, or one of them would fail on the primary key.
+        if delta > 0:
+            upsert(
+                connection, table, values={'year': year, 'month': month, 'post_count': delta},
+                update={'post_count': table.c.post_count + delta})
+        else:
+            connection.execute(
+                table.update()
+                .where(table.c.year == year, table.c.month == month)
+                .values(post_count=table.c.post_count + delta))
+
+    @classmethod
+    def rebuild(cls):
+        """
+        Throw away all month counts and recompute them from the Post table.
+
+        This is a full-table aggregate and should only be needed once, when
+        the archive is first set up on an existing database.
+        """
+        year = extract('year', Post.created_utc)
+        month = extract('month', Post.created_utc)
+        rows = db.session.query(year, month, func.count(Post.id)).group_by(year, month).all()
+
+        cls.query.delete()
+        db.session.add_all(
+            cls(year=int(y), month=int(m), post_count=c) for y, m, c in rows)
+        db.session.commit()
+
+        logger.info(f'Rebuilt archive counts for {len(rows)} month(s)')
+
+
+@event.listens_for(Post, 'after_insert')
+def post_after_insert(mapper, connection, target):
+    """
+    Count a newly-inserted Post in its archive month.
+    """
+    ArchiveMonth.adjust(connection=connection, created_utc=target.created_utc, delta=1)
+
+
+@event.listens_for(Post, 'after_delete')
+def post_after_delete(mapper, connection, target):
+    """
+    Stop counting a deleted Post in its archive month.
+    """
+    ArchiveMonth.adjust(connection=connection, created_utc=target.created_utc, delta=-1)
@@ -12,15 +12,20 @@ Attributes:
         slightly more manageable way; it defines the display order in contexts
         where display order matters; and in some cases it specifies a succession
         of fields names that should be tried in order until data is located.
+    EXIF_REQUIRED_ATTRIBUTES: EXIF attributes that are never displayed, but
+        that populate_exif() and populate_geo() need in order to work.
     logger: Logger instance scoped to the current module name.
 """
 
 import logging
-from collections import namedtuple
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.orm.collections import column_mapped_collection
 from windowbox.database import db
-from windowbox.models import FilesystemMixin
+from windowbox.models import FilesystemMixin, hash_file, link_if_absent
+from windowbox.models.pack import PackEntry
 from windowbox.models.post import Post
 
 Dimensions = namedtuple('Dimensions', ['width', 'height', 'allow_crop'])
@@ -90,6 +95,10 @@ EXIF_CATEGORIES = {
         ['EXIF:LensMake'],
         ['EXIF:LensModel'],
         ['EXIF:LensInfo']]}
+EXIF_REQUIRED_ATTRIBUTES = [
+    'EXIF:Orientation',
+    'Composite:GPSLatitude',
+    'Composite:GPSLongitude']
 
 logger = logging.getLogger(__name__)
 
@@ -125,10 +134,15 @@ class Attachment(db.Model, FilesystemMixin):
     Attachment model.
 
     An Attachment is analogous to a single attachment of an email message. Each
-    Attachment belongs to one Post and references data in one file.
+    Attachment belongs to one Post and references data in one file. If the
+    Attachment has a `sha256` digest, that file is content-addressed and may
+    be shared with other Attachments that have identical content. The
+    `updated_utc` stamp moves forward whenever the row or its EXIF data
+    changes, so API responses can be validated without loading anything.
 
     Attributes:
         MIME_TYPE_LENGTH: The maximum size of the mime_type column.
+        SHA256_LENGTH: The size of the sha256 column (a hex digest).
         GEO_ADDRESS_LENGTH: The maximum size of the geo_address column.
         CROP_FLAG_ALLOW: Character to use in Derivative URLs to indicate the
             client is willing to receive a cropped version of the original
@@ -143,6 +157,7 @@ class Attachment(db.Model, FilesystemMixin):
     """
 
     MIME_TYPE_LENGTH = 255
+    SHA256_LENGTH = 64
     GEO_ADDRESS_LENGTH = 255
     CROP_FLAG_ALLOW = 'x'
     CROP_FLAG_DISALLOW = '~'
@@ -159,10 +174,14 @@ class Attachment(db.Model, FilesystemMixin):
         db.Integer, db.ForeignKey('post.id', ondelete='CASCADE'),
         nullable=False, index=True)
     mime_type = db.Column(db.Unicode(length=MIME_TYPE_LENGTH), nullable=False)
+    sha256 = db.Column(db.Unicode(length=SHA256_LENGTH), nullable=True, index=True)
     orientation = db.Column(db.Integer, nullable=True)
     geo_latitude = db.Column(db.DECIMAL(11, 8), nullable=True)
     geo_longitude = db.Column(db.DECIMAL(11, 8), nullable=True)
     geo_address = db.Column(db.Unicode(length=GEO_ADDRESS_LENGTH), nullable=True)
+    updated_utc = db.Column(
+        db.UTCDateTime, nullable=False, index=True, default=lambda: datetime.now(timezone.utc),
+        onupdate=lambda: datetime.now(timezone.utc), server_default=db.func.now(6))
 
     post = db.relationship(Post, backref=db.backref('attachments', cascade='all, delete-orphan'))
 
@@ -171,6 +190,149 @@ class Attachment(db.Model, FilesystemMixin):
     exif = association_proxy(
         '_exif_data', 'value', creator=lambda a, v: AttachmentEXIF(attribute=a, value=v))
 
+    @property
+    def content_key(self):
+        """
+        Return the key that content-addressed storage paths are built from.
+
+        Returns:
+            The `sha256` digest, or None if this Attachment is stored by ID.
+        """
+        return self.sha256
+
+    def storage_is_shared(self):
+        """
+        Does another Attachment have the same content (and so the same file)?
+
+        Returns:
+            Boolean True if another Attachment row has the same digest.
+        """
+        with db.session.no_autoflush:
+            other = db.session.query(Attachment.id).filter(
+                Attachment.sha256 == self.sha256, Attachment.id != self.id).first()
+
+        return other is not None
+
+    @classmethod
+    def id_addressed_query(cls):
+        """
+        Return a query for the Attachments that are stored by ID.
+
+        Returns:
+            SQLAlchemy Query of Attachments that have no `sha256`.
+        """
+        return cls.query.filter(cls.sha256.is_(None))
+
+    @classmethod
+    def deduplicate_storage(cls, *, attachments_path, derivatives_path, workers=4, batch_size=100):
+        """
+        Move every ID-addressed Attachment (and its Derivatives) to content paths.
+
+        Files are hashed `workers` at a time. Each one is hardlinked to its
+        content path, unless a file with identical content is already there,
+        and the old file is only removed once the new digest is committed. The
+        site can keep serving throughout, and an interrupted run can simply be
+        started again. Attachments whose files are missing are left as-is.
+
+        Args:
+            attachments_path: A pathlib Path object that points to the root
+                directory where storage data for Attachments is saved.
+            derivatives_path: A pathlib Path object that points to the root
+                directory where storage data for Derivatives is saved.
+            workers: Number of files to hash at once.
+            batch_size: Number of Attachments to commit at a time.
+
+        Returns:
+            Counter with the number of Attachments that were `moved`, that
+            were `merged` into an existing identical file, and whose files
+            were `missing`.
+        """
+        counts = Counter()
+        last_id = 0
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='dedupe') as executor:
+            while True:
+                batch = (
+                    cls.id_addressed_query().filter(cls.id > last_id)
+                    .order_by(cls.id).limit(batch_size).all())
+                if not batch:
+                    break
+                last_id = batch[-1].id
+
+                for attachment in batch:
+                    attachment.base_path = attachments_path
+                    for derivative in attachment.derivatives:
+                        derivative.base_path = derivatives_path
+
+                old_paths = [attachment.storage_path() for attachment in batch]
+                digests = executor.map(lambda path: hash_file(path) if path.is_file() else None, old_paths)
+
+                obsolete = []
+                for attachment, old_path, digest in zip(batch, old_paths, digests):
+                    if digest is None:
+                        logger.warning(f'Attachment ID {attachment.id} has no file at {old_path}')
+                        counts['missing'] += 1
+                        continue
+
+                    obsolete.extend(attachment.move_to_content_path(digest, old_path=old_path, counts=counts))
+
+                db.session.commit()
+
+                for path in obsolete:
+                    path.unlink(missing_ok=True)
+
+                logger.info(f'Deduplicated Attachments up to ID {last_id}: {dict(counts)}')
+
+        return counts
+
+    def move_to_content_path(self, digest, *, old_path, counts):
+        """
+        Set `sha256`, and link this Attachment's files to their content paths.
+
+        Packed Derivatives are renamed to their new storage names instead. The
+        caller must commit the change before removing the old files.
+
+        Args:
+            digest: SHA-256 hex digest of the Attachment's data.
+            old_path: The Attachment's ID-addressed storage path.
+            counts: Counter to add 1 to, under `moved` or `merged`.
+
+        Returns:
+            List of pathlib Path objects of the files that are no longer needed.
+        """
+        old_derivative_names = [derivative.storage_name for derivative in self.derivatives]
+        old_derivative_paths = [derivative.storage_path() for derivative in self.derivatives]
+
+        self.sha256 = digest
+        new_path = self.storage_path(create_parents=True)
+        counts['moved' if link_if_absent(old_path, new_path) else 'merged'] += 1
+
+        for derivative, old_name, old_derivative_path in zip(
+                self.derivatives, old_derivative_names, old_derivative_paths):
+            PackEntry.rename(old_name, derivative.storage_name)
+            if old_derivative_path.is_file():
+                link_if_absent(old_derivative_path, derivative.storage_path(create_parents=True))
+
+        return [old_path, *old_derivative_paths]
+
+    @staticmethod
+    def exif_whitelist():
+        """
+        Return every EXIF attribute this model is able to use.
+
+        This is the union of all the display candidates in `EXIF_CATEGORIES`
+        and the `EXIF_REQUIRED_ATTRIBUTES`, suitable for telling exiftool which
+        tags to read.
+
+        Returns:
+            List of unique "Group:Item" attribute names.
+        """
+        candidates = (
+            candidate for category_data in EXIF_CATEGORIES.values()
+            for field_candidates in category_data for candidate in field_candidates)
+
+        return list(dict.fromkeys([*candidates, *EXIF_REQUIRED_ATTRIBUTES]))
+
     def new_derivative(self, **kwargs):
         """
         Create a fresh Derivative instance connected to this Attachment.
@@ -196,9 +358,23 @@ class Attachment(db.Model, FilesystemMixin):
             exiftool_client: Instance of ExifToolClient configured to read EXIF
                 metadata from files.
         """
-        self.exif = exiftool_client.read_file(self.storage_path())
+        with self.storage_local_file() as path:
+            self.set_exif(exiftool_client.read_file(path))
+
+    def set_exif(self, exif):
+        """
+        Replace the EXIF dictionary, and the orientation that is derived from it.
+
+        Args:
+            exif: Flattened EXIF dict, as returned by ExifToolClient.read_file().
+        """
+        self.exif = exif
         self.orientation = self.exif.get('EXIF:Orientation.num')
 
+        # EXIF rows live in their own table, so replacing them alone would not
+        # count as an update of this row
+        self.updated_utc = datetime.now(timezone.utc)
+
     def populate_geo(self, *, gmapi_client):
         """
         Populate the `geo_*` attributes from the current EXIF data.
@@ -211,20 +387,35 @@ class Attachment(db.Model, FilesystemMixin):
             gmapi_client: Instance of GoogleMapsAPIClient configured with a
                 valid Google Maps API key.
         """
-        self.geo_latitude = None
-        self.geo_longitude = None
-        self.geo_address = None
+        self.geo_latitude, self.geo_longitude, self.geo_address = self.read_geo(
+            self.exif, gmapi_client=gmapi_client)
+
+    @staticmethod
+    def read_geo(exif, *, gmapi_client):
+        """
+        Look up the location described by the GPS coordinates in `exif`.
+
+        This touches no model state, so it is safe to call from any thread.
+
+        Args:
+            exif: Flattened EXIF dict, as returned by ExifToolClient.read_file().
+            gmapi_client: Instance of GoogleMapsAPIClient configured with a
+                valid Google Maps API key.
+
+        Returns:
+            Tuple of (latitude, longitude, address) suitable for the `geo_*`
+            attributes. All three are None if `exif` has no GPS information.
+        """
+        latitude = exif.get('Composite:GPSLatitude.num')
+        longitude = exif.get('Composite:GPSLongitude.num')
 
-        latitude = self.exif.get('Composite:GPSLatitude.num')
-        longitude = self.exif.get('Composite:GPSLongitude.num')
+        if latitude is None or longitude is None:
+            return None, None, None
 
-        if latitude is not None and longitude is not None:
-            logger.debug(f'Attachment ID {self.id} has geo coordinates; parsing')
+        logger.debug('EXIF has geo coordinates; parsing')
+        address = gmapi_client.latlng_to_address(latitude=latitude, longitude=longitude)
 
-            self.geo_latitude = float(latitude)
-            self.geo_longitude = float(longitude)
-            self.geo_address = gmapi_client.latlng_to_address(
-                latitude=latitude, longitude=longitude)
+        return float(latitude), float(longitude), address
 
     def to_url_kwargs(self, canned_dimensions):
         """
@@ -242,21 +433,37 @@ class Attachment(db.Model, FilesystemMixin):
             Dict of arguments that identify this Attachment as well as the
             identifying information for one of its Derivatives.
         """
-        dim_tuple = self.CANNED_DIMENSIONS_MAP[canned_dimensions]
+        return {
+            'attachment_id': self.id,
+            'dimensions': self.encode_dimensions(canned_dimensions, self.mime_type)}
+
+    @classmethod
+    def encode_dimensions(cls, canned_dimensions, mime_type):
+        """
+        Build the dimensions string that identifies one Derivative in URLs.
 
-        extension = self.KNOWN_EXTENSIONS.get(self.mime_type)
+        This depends only on its arguments, so callers that build many URLs
+        can reuse the result for every Attachment with the same MIME type.
+
+        Args:
+            canned_dimensions: String containing one of the dimensions names
+                from `CANNED_DIMENSIONS_MAP`.
+            mime_type: MIME type of the Attachment, which picks the extension.
+
+        Returns:
+            String like "300x300.png" or "full.jpg".
+        """
+        dim_tuple = cls.CANNED_DIMENSIONS_MAP[canned_dimensions]
+
+        extension = cls.KNOWN_EXTENSIONS.get(mime_type)
 
         if any([dim_tuple.width, dim_tuple.height, dim_tuple.allow_crop]):
             width = dim_tuple.width or ''
             height = dim_tuple.height or ''
-            crop_flag = self.CROP_FLAG_ALLOW if dim_tuple.allow_crop else self.CROP_FLAG_DISALLOW
-            dimensions = f'{width}{crop_flag}{height}{extension}'
-        else:
-            dimensions = f'full{extension}'
+            crop_flag = cls.CROP_FLAG_ALLOW if dim_tuple.allow_crop else cls.CROP_FLAG_DISALLOW
+            return f'{width}{crop_flag}{height}{extension}'
 
-        return {
-            'attachment_id': self.id,
-            'dimensions': dimensions}
+        return f'full{extension}'
 
     def derivative_url(self, canned_dimensions, **kwargs):
         """
@@ -0,0 +1,159 @@
+"""
+Fetch checkpoint and quarantine models.
+
+Attributes:
+    logger: Logger instance scoped to the current module name.
+"""
+
+import logging
+from sqlalchemy.orm import attribute_keyed_dict
+from windowbox.database import db
+
+logger = logging.getLogger(__name__)
+
+
+class QuarantinedMessage(db.Model):
+    """
+    Quarantined message model.
+
+    A QuarantinedMessage records one message that could not be ingested. It is
+    retried on later fetch runs until it has failed too many times, after which
+    it is left alone in the mailbox until someone releases it.
+
+    Attributes:
+        ERROR_LENGTH: The maximum size of the last_error column.
+    """
+
+    __tablename__ = 'fetch_quarantine'
+
+    ERROR_LENGTH = 1024
+
+    mailbox = db.Column(
+        db.Unicode(length=255), db.ForeignKey('fetch_checkpoint.mailbox', ondelete='CASCADE'),
+        nullable=False, primary_key=True)
+    uid = db.Column(db.BigInteger, nullable=False, primary_key=True, autoincrement=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.Unicode(length=ERROR_LENGTH), nullable=True)
+    updated_utc = db.Column(
+        db.UTCDateTime, nullable=False, server_default=db.func.now(6), onupdate=db.func.now(6))
+
+
+class FetchCheckpoint(db.Model):
+    """
+    Fetch checkpoint model.
+
+    There is one FetchCheckpoint per mailbox. It remembers the highest UID that
+    a completed fetch run has seen, so the next run only needs to search for
+    higher ones, along with the messages below that UID which failed and are
+    in quarantine. Everything is only meaningful for one UIDVALIDITY of the
+    mailbox; if the server ever changes it, the UIDs have all been reassigned
+    and the checkpoint starts over.
+
+    Attributes:
+        MAILBOX_LENGTH: The maximum size of the mailbox column.
+    """
+
+    __tablename__ = 'fetch_checkpoint'
+
+    MAILBOX_LENGTH = 255
+
+    mailbox = db.Column(db.Unicode(length=MAILBOX_LENGTH), nullable=False, primary_key=True)
+    uid_validity = db.Column(db.BigInteger, nullable=True)
+    last_uid = db.Column(db.BigInteger, nullable=False, default=0)
+    updated_utc = db.Column(
+        db.UTCDateTime, nullable=False, server_default=db.func.now(6), onupdate=db.func.now(6))
+
+    quarantine = db.relationship(
+        QuarantinedMessage, cascade='all, delete-orphan',
+        collection_class=attribute_keyed_dict('uid'))
+
+    @classmethod
+    def load(cls, *, mailbox, uid_validity):
+        """
+        Return the checkpoint for `mailbox`, creating or resetting it as needed.
+
+        Args:
+            mailbox: String that uniquely identifies the mailbox.
+            uid_validity: The mailbox's current UIDVALIDITY value, or None if
+                the server did not report one (which always starts over).
+
+        Returns:
+            FetchCheckpoint instance, committed to the database.
+        """
+        checkpoint = db.session.get(cls, mailbox)
+
+        if checkpoint is None:
+            checkpoint = cls(mailbox=mailbox, uid_validity=uid_validity, last_uid=0)
+            db.session.add(checkpoint)
+        elif checkpoint.uid_validity != uid_validity or uid_validity is None:
+            logger.warning(
+                f'UIDVALIDITY of {mailbox} changed from {checkpoint.uid_validity} to '
+                f'{uid_validity}; starting over')
+            checkpoint.uid_validity = uid_validity
+            checkpoint.last_uid = 0
+            checkpoint.quarantine.clear()
+
+        db.session.commit()
+
+        return checkpoint
+
+    @property
+    def next_uid(self):
+        """
+        Return the lowest UID that no completed fetch run has seen yet.
+
+        Returns:
+            Integer UID.
+        """
+        return self.last_uid + 1
+
+    def retry_uids(self, *, max_attempts):
+        """
+        List the quarantined UIDs that should be tried again.
+
+        Args:
+            max_attempts: Number of failed attempts after which a message is
+                no longer retried.
+
+        Returns:
+            Sorted list of integer UIDs.
+        """
+        return sorted(uid for uid, q in self.quarantine.items() if q.attempts < max_attempts)
+
+    def record_failure(self, uid, error):
+        """
+        Put a message in quarantine, or count another failure if it is there.
+
+        Args:
+            uid: Integer UID of the message that failed.
+            error: The exception that it failed with.
+
+        Returns:
+            The message's total number of failed attempts.
+        """
+        if uid not in self.quarantine:
+            self.quarantine[uid] = QuarantinedMessage(uid=uid, attempts=0)
+
+        quarantined = self.quarantine[uid]
+        quarantined.attempts += 1
+        quarantined.last_error = f'{type(error).__name__}: {error}'[:QuarantinedMessage.ERROR_LENGTH]
+
+        return quarantined.attempts
+
+    def record_success(self, uid):
+        """
+        Release a message from quarantine, if it was there.
+
+        Args:
+            uid: Integer UID of the message that was ingested.
+        """
+        self.quarantine.pop(uid, None)
+
+    def advance(self, uid):
+        """
+        Note that a fetch run has seen every message up to `uid`.
+
+        Args:
+            uid: Highest integer UID the run found.
+        """
+        self.last_uid = max(self.last_uid, uid)
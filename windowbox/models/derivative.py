@@ -5,11 +5,14 @@ Attributes:
     logger: Logger instance scoped to the current module name.
 """
 
+import hashlib
 import logging
 from PIL.Image import Resampling, Transform, Transpose
+from sqlalchemy.orm import contains_eager
 from windowbox.database import db
 from windowbox.models import FilesystemMixin
 from windowbox.models.attachment import Attachment
+from windowbox.models.pack import PackError
 
 logger = logging.getLogger(__name__)
 
@@ -80,10 +83,17 @@ class Derivative(db.Model, FilesystemMixin):
     Derivative model.
 
     A Derivative is an altered copy of an Attachment, generally with a different
-    size, crop, or image format.
+    size, crop, or image format. The Derivatives of content-addressed
+    Attachments are content-addressed too, keyed on everything that goes into
+    building them, so identical Attachments share one file per size.
+
+    If `pack_store` is set, Derivatives small enough for it are stored in its
+    pack files (under their storage_name) rather than in files of their own.
 
     Attributes:
         MIME_TYPE_LENGTH: The maximum size of the mime_type column.
+        pack_store: PackStore instance, or None to store every Derivative in a
+            file of its own.
     """
 
     MIME_TYPE_LENGTH = Attachment.MIME_TYPE_LENGTH
@@ -105,17 +115,152 @@ class Derivative(db.Model, FilesystemMixin):
     attachment = db.relationship(
         Attachment, backref=db.backref('derivatives', cascade='all, delete-orphan'))
 
+    pack_store = None
+
+    @property
+    def content_key(self):
+        """
+        Return the key that content-addressed storage paths are built from.
+
+        Returns:
+            SHA-256 hex digest of the Attachment's digest and orientation and
+            this Derivative's dimensions and type, or None if the Attachment
+            is stored by ID.
+        """
+        digest = self.attachment.sha256
+        if digest is None:
+            return None
+
+        spec = (
+            f'{digest}:{self.attachment.orientation}:{self.width}:{self.height}:'
+            f'{self.allow_crop}:{self.mime_type}')
+
+        return hashlib.sha256(spec.encode()).hexdigest()
+
+    def storage_is_shared(self):
+        """
+        Is there another Derivative with the same content (and so the same file)?
+
+        Returns:
+            Boolean True if another Derivative is built the same way from an
+            Attachment with the same digest and orientation.
+        """
+        with db.session.no_autoflush:
+            other = db.session.query(Derivative.id).join(Derivative.attachment).filter(
+                Attachment.sha256 == self.attachment.sha256,
+                Attachment.orientation == self.attachment.orientation,
+                Derivative.width == self.width,
+                Derivative.height == self.height,
+                Derivative.allow_crop == self.allow_crop,
+                Derivative.mime_type == self.mime_type,
+                Derivative.id != self.id).first()
+
+        return other is not None
+
+    @classmethod
+    def id_addressed_query(cls):
+        """
+        Return a query for the Derivatives that are stored by ID.
+
+        Returns:
+            SQLAlchemy Query of Derivatives (with their Attachments loaded) whose
+            Attachments have no `sha256`.
+        """
+        return (
+            cls.query.join(cls.attachment).filter(Attachment.sha256.is_(None))
+            .options(contains_eager(cls.attachment)))
+
+    @property
+    def pack_entry(self):
+        """
+        Return the PackEntry that holds this Derivative's storage data.
+
+        Returns:
+            PackEntry instance, or None if there is no pack store or this
+            Derivative isn't in it.
+        """
+        if self.pack_store is None:
+            return None
+
+        return self.pack_store.entry(self.storage_name)
+
+    @property
+    def has_storage_data(self):
+        """
+        Does this instance currently have data in a pack or in its backend?
+        """
+        return self.pack_entry is not None or super().has_storage_data
+
+    @property
+    def storage_data_size_bytes(self):
+        """
+        How much space does the storage data for this instance use?
+        """
+        entry = self.pack_entry
+        if entry is not None:
+            return entry.length
+
+        return super().storage_data_size_bytes
+
+    def get_packed_data(self):
+        """
+        Read this Derivative's storage data out of the pack store.
+
+        If the entry points at a pack that is missing or too short (say, after
+        a crash), it is discarded and the data is generated again, so one bad
+        entry can't break this Derivative for good.
+
+        Returns:
+            Bytes, or None if it is not in a pack.
+        """
+        if self.pack_store is None:
+            return None
+
+        try:
+            return self.pack_store.get(self.storage_name)
+        except (FileNotFoundError, PackError) as exc:
+            logger.warning(f'Regenerating Derivative ID {self.id}; its pack entry is unreadable: {exc}')
+
+        self.pack_store.discard(self.storage_name)
+        self.ensure_storage_data()
+
+        return self.pack_store.get(self.storage_name)
+
+    def delete_storage_data(self):
+        """
+        Remove this Derivative's storage data, whether it is packed or not.
+
+        A packed entry is discarded (which the caller must commit), leaving its
+        bytes for compaction to reclaim. Shared data is left alone.
+        """
+        entry = self.pack_entry
+
+        if entry is None:
+            super().delete_storage_data()
+        elif self.content_key is None or not self.storage_is_shared():
+            db.session.delete(entry)
+
     def ensure_storage_data(self):
         """
         Build the storage path data if it doesn't already exist.
 
-        If the data already exists, this method is a no-op.
+        If the data already exists, this method is a no-op. New data that the
+        pack store accepts goes into a pack instead of a file.
         """
         if not self.has_storage_data:
             logger.debug(f'Generating storage data for Derivative ID {self.id}')
 
             image = self.to_image()
-            self.set_storage_data_from_image(image)
+
+            if self.pack_store is None:
+                self.set_storage_data_from_image(image)
+                return
+
+            data = self.image_to_bytes(image)
+            if self.pack_store.accepts(len(data)):
+                self.pack_store.put(self.storage_name, data)
+            else:
+                self.set_storage_data(data)
 
     def to_image(self):
         """
@@ -0,0 +1,189 @@
+"""
+Reverse geocode cache model.
+
+Attributes:
+    logger: Logger instance scoped to the current module name.
+"""
+
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import select
+from windowbox.database import db, upsert
+from windowbox.models.attachment import Attachment
+
+logger = logging.getLogger(__name__)
+
+
+class GeocodeCache(db.Model):
+    """
+    Reverse geocode cache model.
+
+    Each GeocodeCache row remembers the address that was found for one cell of
+    a latitude/longitude grid. The addresses kept for Attachments are only
+    "approximate" ones, so every photo taken within the same cell can share a
+    single lookup. A None address is cached too, since "nothing here" is just
+    as valid an answer and costs just as much to ask for.
+
+    Attributes:
+        CELL_LENGTH: The maximum size of the cell column.
+        ADDRESS_LENGTH: The maximum size of the address column.
+    """
+
+    __tablename__ = 'geocode_cache'
+
+    CELL_LENGTH = 64
+    ADDRESS_LENGTH = Attachment.GEO_ADDRESS_LENGTH
+
+    cell = db.Column(db.Unicode(length=CELL_LENGTH), nullable=False, primary_key=True)
+    address = db.Column(db.Unicode(length=ADDRESS_LENGTH), nullable=True)
+    updated_utc = db.Column(db.UTCDateTime, nullable=False)
+    hit_count = db.Column(db.Integer, nullable=False, default=0)
+    miss_count = db.Column(db.Integer, nullable=False, default=0)
+
+    @staticmethod
+    def cell_for(*, latitude, longitude, grid):
+        """
+        Name the grid cell that a latitude/longitude pair falls into.
+
+        The grid size is part of the name, so changing it simply starts a new
+        set of cells instead of reusing ones that were measured differently.
+
+        Args:
+            latitude: Number in the range -90 (south) to 90 (north).
+            longitude: Number in the range -180 (west) to 180 (east).
+            grid: Size of each cell, in degrees.
+
+        Returns:
+            String like "0.001:36000:-78900".
+        """
+        return f'{grid}:{round(float(latitude) / grid)}:{round(float(longitude) / grid)}'
+
+    @classmethod
+    def backfill(cls, *, grid):
+        """
+        Seed the cache with the addresses already stored on Attachments.
+
+        When several Attachments fall into the same cell, the most recent one
+        wins. Cells that are already cached are left alone.
+
+        Args:
+            grid: Size of each cell, in degrees.
+
+        Returns:
+            Number of cells that were added to the cache.
+        """
+        known = set(db.session.scalars(select(cls.cell)))
+        rows = (
+            db.session.query(Attachment.geo_latitude, Attachment.geo_longitude, Attachment.geo_address)
+            .filter(
+                Attachment.geo_latitude.is_not(None), Attachment.geo_longitude.is_not(None),
+                Attachment.geo_address.is_not(None))
+            .order_by(Attachment.id.desc()))
+
+        now = datetime.now(timezone.utc)
+        added = []
+        for latitude, longitude, address in rows:
+            cell = cls.cell_for(latitude=latitude, longitude=longitude, grid=grid)
+            if cell not in known:
+                known.add(cell)
+                added.append(cls(cell=cell, address=address, updated_utc=now))
+
+        db.session.add_all(added)
+        db.session.commit()
+
+        logger.info(f'Backfilled {len(added)} geocode cache cell(s)')
+
+        return len(added)
+
+
+class CachedGeocoder:
+    """
+    Reverse geocoder that consults the GeocodeCache before asking a client.
+
+    This has the same latlng_to_address() method as GoogleMapsAPIClient, so it
+    can be used anywhere that one is. The cache is read and written on short-
+    lived connections of its own rather than through the Session, which keeps
+    it usable from ingest worker threads and import worker processes.
+    """
+
+    def __init__(self, *, client, app, grid, ttl):
+        """
+        Constructor.
+
+        Args:
+            client: Instance of GoogleMapsAPIClient (or anything else with a
+                latlng_to_address() method) to use on cache misses.
+            app: Flask application whose database holds the cache.
+            grid: Size of each cache cell, in degrees.
+            ttl: Number of seconds a cached address remains usable, or 0 to
+                keep them forever.
+        """
+        self.client = client
+        self.app = app
+        self.grid = grid
+        self.ttl = ttl
+        self._engine = None
+        self._pid = None
+
+    @property
+    def engine(self):
+        """
+        Return the database engine, safe for use in the current process.
+
+        Connections pooled by a parent process must never be used by a forked
+        child, so the pool is discarded (without closing the parent's
+        connections) the first time a new process asks for it.
+
+        Returns:
+            SQLAlchemy Engine for the app's primary database.
+        """
+        if self._engine is None:
+            with self.app.app_context():
+                self._engine = db.engine
+        elif self._pid != os.getpid():
+            self._engine.dispose(close=False)
+
+        self._pid = os.getpid()
+
+        return self._engine
+
+    def latlng_to_address(self, *, latitude, longitude):
+        """
+        Convert a latitude/longitude pair into a formatted address.
+
+        Args:
+            latitude: Number in the range -90 (south) to 90 (north).
+            longitude: Number in the range -180 (west) to 180 (east).
+
+        Returns:
+            String representation of the address at the specified point, or None
+            if there is no reasonable representation of the point.
+
+        Raises:
+            GMAPIClientError: The client's lookup failed on a cache miss. Failed
+                lookups are not cached, so the next call will try again.
+        """
+        table = GeocodeCache.__table__
+        cell = GeocodeCache.cell_for(latitude=latitude, longitude=longitude, grid=self.grid)
+        now = datetime.now(timezone.utc)
+
+        with self.engine.begin() as connection:
+            row = connection.execute(
+                select(table.c.address, table.c.updated_utc).where(table.c.cell == cell)).first()
+
+            if row is not None and (not self.ttl or now - row.updated_utc < timedelta(seconds=self.ttl)):
+                connection.execute(
+                    table.update().where(table.c.cell == cell).values(hit_count=table.c.hit_count + 1))
+                logger.debug(f'Geocode cache hit for cell {cell}')
+                return row.address
+
+        logger.debug(f'Geocode cache miss for cell {cell}')
+        address = self.client.latlng_to_address(latitude=latitude, longitude=longitude)
+
+        values = {'cell': cell, 'address': address, 'updated_utc': now, 'hit_count': 0, 'miss_count': 1}
+        update = {'address': address, 'updated_utc': now, 'miss_count': table.c.miss_count + 1}
+        with self.engine.begin() as connection:
+            upsert(connection, table, values=values, update=update)
+
+        return address
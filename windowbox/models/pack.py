@@ -0,0 +1,341 @@
+"""
+Pack-file storage for small files.
+
+Thumbnails and other small Derivatives are appended, one after another, to a
+few large pack files instead of each getting a file of its own. A PackEntry row
+records where each one went. Pack files are only ever appended to, so nothing
+is reclaimed when an entry is discarded or replaced; compaction copies the
+live entries out of mostly-dead packs and removes them.
+
+Pack files are numbered, and only the highest-numbered pack is written to.
+Once another pack has been started after it, a pack is sealed and only
+compaction touches it again. A process can append to a pack just before it is
+sealed and commit the entry a moment later, so compaction leaves recently
+modified packs alone.
+
+Attributes:
+    PACK_DIRECTORY: Name of the directory within `base_path` that holds packs.
+    logger: Logger instance scoped to the current module name.
+"""
+
+import fcntl
+import logging
+import os
+import time
+from collections import Counter
+from sqlalchemy.exc import IntegrityError
+from windowbox.database import db
+from windowbox.storage import fsync_path
+
+PACK_DIRECTORY = 'packs'
+
+logger = logging.getLogger(__name__)
+
+
+class PackError(Exception):
+    """
+    Raised when a pack file does not hold what its index says it does.
+    """
+    pass
+
+
+class PackEntry(db.Model):
+    """
+    Pack entry model.
+
+    Each PackEntry locates the data stored under one name: the number of the
+    pack file it is in, and the byte range within that file.
+
+    Attributes:
+        NAME_LENGTH: The maximum size of the name column.
+    """
+
+    __tablename__ = 'pack_entry'
+
+    NAME_LENGTH = 255
+
+    name = db.Column(db.Unicode(length=NAME_LENGTH), nullable=False, primary_key=True)
+    pack = db.Column(db.Integer, nullable=False, index=True)
+    offset = db.Column(db.BigInteger, nullable=False)
+    length = db.Column(db.Integer, nullable=False)
+
+    @classmethod
+    def rename(cls, old_name, new_name):
+        """
+        Move the entry stored under `old_name` so it's stored under `new_name`.
+
+        If `new_name` already has an entry, that one is kept and the old entry
+        is simply dropped. The caller must commit the change.
+
+        Args:
+            old_name: Name the entry is stored under now.
+            new_name: Name to store it under instead.
+        """
+        entry = db.session.get(cls, old_name)
+        if entry is None:
+            return
+
+        if db.session.get(cls, new_name) is None:
+            db.session.add(cls(name=new_name, pack=entry.pack, offset=entry.offset, length=entry.length))
+        db.session.delete(entry)
+
+
+class PackStore:
+    """
+    Append-only store of small files, indexed by name in the database.
+    """
+
+    def __init__(self, *, base_path, max_entry_bytes, max_pack_bytes, fsync='file'):
+        """
+        Constructor.
+
+        Args:
+            base_path: A pathlib Path object; packs are kept in a directory
+                named `PACK_DIRECTORY` inside it.
+            max_entry_bytes: Largest piece of data that accepts() will take.
+            max_pack_bytes: Size at which a pack file is sealed and a new one
+                is started.
+            fsync: One of the `FSYNC_POLICIES` of windowbox.storage. Unless it
+                is "none", every append is flushed before its entry is
+                committed; "full" also flushes the directory when a new pack
+                is started.
+        """
+        self.directory = base_path / PACK_DIRECTORY
+        self.max_entry_bytes = max_entry_bytes
+        self.max_pack_bytes = max_pack_bytes
+        self.fsync = fsync
+        self.current = None
+
+    def path(self, pack):
+        """
+        Return the path of the pack file numbered `pack`.
+        """
+        return self.directory / f'{pack:06d}.pack'
+
+    def packs(self):
+        """
+        List the pack files that exist.
+
+        Returns:
+            Sorted list of integer pack numbers.
+        """
+        return sorted(int(path.stem) for path in self.directory.glob('*.pack'))
+
+    def start(self, pack):
+        """
+        Create the pack file numbered `pack`, unless it already exists.
+        """
+        self.path(pack).touch()
+
+        if self.fsync == 'full':
+            fsync_path(self.directory)
+
+    def accepts(self, length):
+        """
+        Is `length` bytes small enough to go into a pack?
+        """
+        return length <= self.max_entry_bytes
+
+    def current_pack(self):
+        """
+        Return the number of the pack being appended to, creating the first.
+        """
+        if self.current is None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            self.current = max(self.packs(), default=1)
+            self.start(self.current)
+
+        return self.current
+
+    def append(self, data):
+        """
+        Append `data` to the current pack.
+
+        Appends are serialized between processes with an exclusive lock on the
+        pack file. If the pack is full, or another process has moved on to a
+        newer pack, this moves on too.
+
+        Args:
+            data: Bytes to store.
+
+        Returns:
+            Tuple of (pack number, offset) where the data begins.
+        """
+        while True:
+            pack = self.current_pack()
+
+            try:
+                fd = os.open(self.path(pack), os.O_WRONLY | os.O_APPEND)
+            except FileNotFoundError:
+                self.current = None
+                continue
+
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                offset = os.lseek(fd, 0, os.SEEK_END)
+
+                if self.path(pack + 1).exists() or (offset and offset + len(data) > self.max_pack_bytes):
+                    self.start(pack + 1)
+                    self.current = pack + 1
+                    continue
+
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(fd, view):]
+
+                if self.fsync != 'none':
+                    os.fsync(fd)
+
+                return pack, offset
+            finally:
+                os.close(fd)
+
+    def read(self, entry):
+        """
+        Read the data an entry refers to.
+
+        Args:
+            entry: PackEntry instance.
+
+        Returns:
+            Bytes.
+
+        Raises:
+            FileNotFoundError: The pack no longer exists.
+            PackError: The pack is shorter than the entry says.
+        """
+        fd = os.open(self.path(entry.pack), os.O_RDONLY)
+
+        try:
+            data = os.pread(fd, entry.length, entry.offset)
+        finally:
+            os.close(fd)
+
+        if len(data) != entry.length:
+            raise PackError(f'{self.path(entry.pack)} is truncated; expected {entry.length} bytes of {entry.name}')
+
+        return data
+
+    def entry(self, name):
+        """
+        Look up the entry stored under `name`.
+
+        Returns:
+            PackEntry instance, or None if nothing is stored under that name.
+        """
+        return db.session.get(PackEntry, name)
+
+    def discard(self, name):
+        """
+        Forget whatever is stored under `name`, and commit.
+
+        The data itself is left for compaction to reclaim.
+        """
+        PackEntry.query.filter_by(name=name).delete()
+        db.session.commit()
+
+    def get(self, name):
+        """
+        Read the data stored under `name`.
+
+        If compaction moves the entry between looking it up and reading it,
+        the entry is looked up again.
+
+        Returns:
+            Bytes, or None if nothing is stored under that name.
+        """
+        entry = self.entry(name)
+        if entry is None:
+            return None
+
+        try:
+            return self.read(entry)
+        except FileNotFoundError:
+            db.session.refresh(entry)
+            return self.read(entry)
+
+    def put(self, name, data):
+        """
+        Store `data` under `name`, and commit its entry.
+
+        If another process stores the same name first, its entry is kept and
+        this copy is left for compaction to reclaim.
+
+        Args:
+            name: Unique string name, like a Derivative's storage_name.
+            data: Bytes to store.
+        """
+        pack, offset = self.append(data)
+
+        db.session.merge(PackEntry(name=name, pack=pack, offset=offset, length=len(data)))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            logger.debug(f'Lost pack entry race for {name}; using the existing one')
+            db.session.rollback()
+
+    def entries_in(self, pack):
+        """
+        List the entries that refer to the pack numbered `pack`.
+
+        Returns:
+            List of PackEntry instances, in the order they appear in the pack.
+        """
+        return PackEntry.query.filter_by(pack=pack).order_by(PackEntry.offset).all()
+
+    def compact(self, *, min_live_ratio=0.5, min_age=3600):
+        """
+        Reclaim the space used by data that no entry refers to anymore.
+
+        Sealed packs with less than `min_live_ratio` of their bytes still in
+        use have their live entries copied to the current pack, and are then
+        removed. A reader that looked an entry up just before it moved finds
+        it again through get().
+
+        Packs modified within the last `min_age` seconds are skipped, since an
+        entry for data that was just appended to one may not be committed yet.
+        Entries that are committed while a pack is being compacted anyway are
+        moved along with the rest before the pack is removed.
+
+        Args:
+            min_live_ratio: Fraction of a pack that must be in use for it to
+                be left alone.
+            min_age: Age in seconds.
+
+        Returns:
+            Counter with the number of `packs` removed, `entries` moved, and
+            `bytes` reclaimed.
+        """
+        counts = Counter()
+        cutoff = time.time() - min_age
+
+        for pack in self.packs()[:-1]:
+            path = self.path(pack)
+            stat = path.stat()
+            entries = self.entries_in(pack)
+            live = sum(entry.length for entry in entries)
+
+            if stat.st_mtime > cutoff or (entries and live >= stat.st_size * min_live_ratio):
+                continue
+
+            moved = 0
+            while True:
+                for entry in entries:
+                    entry.pack, entry.offset = self.append(self.read(entry))
+                db.session.commit()
+                moved += len(entries)
+
+                # Pick up any entries that were committed after the listing
+                entries = self.entries_in(pack)
+                if not entries:
+                    break
+
+            path.unlink()
+
+            counts['packs'] += 1
+            counts['entries'] += moved
+            counts['bytes'] += stat.st_size - live
+
+            logger.info(f'Compacted pack {pack}: moved {moved} entries, reclaimed {stat.st_size - live} bytes')
+
+        return counts
@@ -9,6 +9,7 @@ Attributes:
 """
 
 import re
+from datetime import datetime, timezone
 from windowbox.database import db
 from windowbox.models.sender import Sender
 
@@ -32,17 +33,22 @@ class Post(db.Model):
 
     Attributes:
         USER_AGENT_LENGTH: The maximum size of the user_agent column.
+        MESSAGE_ID_LENGTH: The maximum size of the message_id column.
     """
 
     USER_AGENT_LENGTH = 255
+    MESSAGE_ID_LENGTH = 255
 
     id = db.Column(db.Integer, nullable=False, autoincrement=True, primary_key=True)
     sender_id = db.Column(
         db.Integer, db.ForeignKey('sender.id', ondelete='CASCADE'),
         nullable=False, index=True)
-    created_utc = db.Column(db.UTCDateTime, nullable=False, server_default=db.func.now(6))
+    created_utc = db.Column(
+        db.UTCDateTime, nullable=False, index=True, default=lambda: datetime.now(timezone.utc),
+        server_default=db.func.now(6))
     caption = db.Column(db.UnicodeText, nullable=False)
     user_agent = db.Column(db.Unicode(length=USER_AGENT_LENGTH), nullable=True)
+    message_id = db.Column(db.Unicode(length=MESSAGE_ID_LENGTH), nullable=True, unique=True)
     is_barked = db.Column(db.Boolean, nullable=False, default=False)
 
     sender = db.relationship(Sender, backref=db.backref('posts', cascade='all, delete-orphan'))
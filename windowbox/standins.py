@@ -0,0 +1,469 @@
+"""
+Local stand-ins for the external services Windowbox talks to.
+
+These are small, dependency-free HTTP servers that answer just enough of each
+service's API to exercise the real clients over real sockets. The tests use
+them in place of the real services, and `flask bench geocode-server` (or
+`object-store-server`) runs one in the foreground so that the app can be tried
+out without touching (or paying for) the real thing. Each server can add a
+fixed delay to every response, to approximate the latency of the real service.
+
+Attributes:
+    GEOCODE_PATH: Path that the geocode stand-in answers on.
+    GEOCODE_ADDRESS: Formatted address that the geocode stand-in returns when
+        it has no canned responses left.
+    UPLOADS_DIRECTORY: Name of the directory where the object store stand-in
+        keeps the parts of unfinished multipart uploads. It can't be mistaken
+        for a bucket, since bucket names never start with a dot.
+    logger: Logger instance scoped to the current module name.
+"""
+
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+import uuid
+import xml.etree.ElementTree as ElementTree
+from abc import ABC, abstractmethod
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+from windowbox.clients.s3 import XML_NAMESPACE, signature
+
+GEOCODE_PATH = '/maps/api/geocode/json'
+GEOCODE_ADDRESS = 'Stand-In, NC, USA'
+UPLOADS_DIRECTORY = '.uploads'
+
+logger = logging.getLogger(__name__)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Request handler that defers to the StandInServer that owns it.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        """
+        Count each new connection before any requests are read from it.
+        """
+        super().setup()
+
+        with self.server.standin.lock:
+            self.server.standin.connections += 1
+
+    def answer(self, method):
+        """
+        Answer one request with whatever the stand-in decides.
+
+        Args:
+            method: HTTP method of the request.
+        """
+        standin = self.server.standin
+        url = urlsplit(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+        if standin.latency:
+            time.sleep(standin.latency)
+
+        status, headers, data = standin.handle(
+            method, url.path, parse_qs(url.query, keep_blank_values=True), self.headers, body)
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if 'Content-Length' not in headers:
+            self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if method != 'HEAD':
+            self.wfile.write(data)
+
+    def do_GET(self):
+        """
+        Answer one GET request.
+        """
+        self.answer('GET')
+
+    def do_HEAD(self):
+        """
+        Answer one HEAD request.
+        """
+        self.answer('HEAD')
+
+    def do_PUT(self):
+        """
+        Answer one PUT request.
+        """
+        self.answer('PUT')
+
+    def do_POST(self):
+        """
+        Answer one POST request.
+        """
+        self.answer('POST')
+
+    def do_DELETE(self):
+        """
+        Answer one DELETE request.
+        """
+        self.answer('DELETE')
+
+    def log_message(self, format, *args):
+        """
+        Send the access log to the module logger instead of stderr.
+        """
+        logger.debug(format % args)
+
+
+class StandInServer(ABC):
+    """
+    Threaded HTTP server on the loopback interface.
+
+    Subclasses implement handle(), or extend JSONStandInServer if they only
+    need GET requests and JSON responses. The server runs in a daemon thread
+    between start() and stop(), or for the duration of a `with` block.
+
+    Attributes:
+        connections: Number of client connections accepted so far.
+        requests: List of (path, query) tuples for every request received, in
+            order. `query` is a dict of lists as returned by parse_qs().
+    """
+
+    def __init__(self, *, host='127.0.0.1', port=0, latency=0):
+        """
+        Constructor.
+
+        Args:
+            host: Address to listen on.
+            port: Port to listen on. If 0, a free port is chosen.
+            latency: Number of seconds to wait before answering each request.
+        """
+        self.latency = latency
+        self.connections = 0
+        self.requests = []
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), StandInHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.standin = self
+        self.thread = None
+
+    @property
+    def base_url(self):
+        """
+        Return the URL to point a client at, with no trailing slash.
+
+        Returns:
+            String like "http://127.0.0.1:54321".
+        """
+        host, port = self.httpd.server_address[:2]
+
+        return f'http://{host}:{port}'
+
+    def start(self):
+        """
+        Start answering requests in a background thread.
+        """
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop answering requests and release the listening socket.
+        """
+        self.httpd.shutdown()
+        self.thread.join()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        """
+        Start the server when entering a `with` block.
+        """
+        self.start()
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """
+        Stop the server when leaving a `with` block.
+        """
+        self.stop()
+
+    @abstractmethod
+    def handle(self, method, path, query, headers, body):
+        """
+        Decide how to answer a request of any kind.
+
+        Args:
+            method: HTTP method of the request.
+            path: Path part of the requested URL, still percent-encoded.
+            query: Dict of lists holding the parsed query string.
+            headers: Mapping of request headers.
+            body: Bytes of the request body.
+
+        Returns:
+            Tuple of (HTTP status code, dict of response headers, body bytes).
+        """
+
+
+class JSONStandInServer(StandInServer):
+    """
+    Stand-in server that answers GET requests with JSON, and nothing else.
+
+    Subclasses implement respond().
+    """
+
+    def handle(self, method, path, query, headers, body):
+        """
+        Answer GET requests with the JSON from respond(), and refuse the rest.
+        """
+        if method != 'GET':
+            return 405, {}, b''
+
+        status, data = self.respond(path, query)
+
+        return status, {'Content-Type': 'application/json'}, json.dumps(data).encode()
+
+    @abstractmethod
+    def respond(self, path, query):
+        """
+        Decide how to answer a GET request.
+
+        Args:
+            path: Path part of the requested URL.
+            query: Dict of lists holding the parsed query string.
+
+        Returns:
+            Tuple of (HTTP status code, JSON-serializable body).
+        """
+
+
+class GeocodeStandIn(JSONStandInServer):
+    """
+    Stand-in for the Google Maps reverse geocoding API.
+
+    Canned responses are replayed in order, one per request. Once they run out,
+    every request is answered with a successful lookup whose only "approximate"
+    result is `address`.
+    """
+
+    def __init__(self, *, responses=(), address=GEOCODE_ADDRESS, **kwargs):
+        """
+        Constructor.
+
+        Args:
+            responses: Iterable of (HTTP status code, JSON body) tuples to
+                replay, in order.
+            address: Formatted address to answer with once `responses` is
+                exhausted.
+            **kwargs: Passed through to StandInServer.
+        """
+        super().__init__(**kwargs)
+
+        self.responses = deque(responses)
+        self.address = address
+
+    def respond(self, path, query):
+        """
+        Answer one geocode request.
+
+        Args:
+            path: Path part of the requested URL.
+            query: Dict of lists holding the parsed query string.
+
+        Returns:
+            Tuple of (HTTP status code, JSON-serializable body).
+        """
+        with self.lock:
+            self.requests.append((path, query))
+
+            if path != GEOCODE_PATH:
+                return 404, {}
+
+            if self.responses:
+                return self.responses.popleft()
+
+        return 200, {
+            'status': 'OK',
+            'results': [
+                {'formatted_address': 'Too Specific', 'geometry': {'location_type': 'ROOFTOP'}},
+                {'formatted_address': self.address, 'geometry': {'location_type': 'APPROXIMATE'}}]}
+
+
+class ObjectStoreStandIn(StandInServer):
+    """
+    Stand-in for an S3-compatible object store, backed by a local directory.
+
+    Each object is kept as a plain file at `<directory>/<bucket>/<key>`, so
+    tests can look at (or tamper with) what was stored. Just enough of the API
+    is answered for S3Client: single-object PUT, GET, HEAD and DELETE, and
+    multipart uploads. If a `secret_key` is given, every request must carry a
+    valid Signature Version 4 Authorization header.
+
+    Attributes:
+        AUTHORIZATION: Pattern that picks the access key, date, region, and
+            signature out of an Authorization header.
+        requests: List of (method, path, query) tuples for every request
+            received, in order.
+    """
+
+    AUTHORIZATION = re.compile(r'Credential=([^/]+)/(\d{8})/([^/]+)/s3/aws4_request, .*Signature=([0-9a-f]+)')
+
+    def __init__(self, *, directory, access_key=None, secret_key=None, **kwargs):
+        """
+        Constructor.
+
+        Args:
+            directory: A pathlib Path object referring to the directory to
+                keep buckets in. It is created if needed.
+            access_key: Access key ID that requests must be signed with.
+            secret_key: Secret access key that requests must be signed with,
+                or None to accept any request.
+            **kwargs: Passed through to StandInServer.
+        """
+        super().__init__(**kwargs)
+
+        self.directory = directory
+        self.access_key = access_key
+        self.secret_key = secret_key
+        (directory / UPLOADS_DIRECTORY).mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def error(status, code):
+        """
+        Build an S3-style error response.
+
+        Returns:
+            Tuple suitable for returning from handle().
+        """
+        return status, {'Content-Type': 'application/xml'}, f'<Error><Code>{code}</Code></Error>'.encode()
+
+    @staticmethod
+    def document(name, **values):
+        """
+        Build an S3-style XML response named `name`, holding `values`.
+
+        Returns:
+            Tuple suitable for returning from handle().
+        """
+        fields = ''.join(f'<{key}>{value}</{key}>' for key, value in values.items())
+        data = f'<{name} xmlns="{XML_NAMESPACE}">{fields}</{name}>'.encode()
+
+        return 200, {'Content-Type': 'application/xml'}, data
+
+    def authorized(self, method, path, query, headers):
+        """
+        Check the request's signature, if this stand-in requires one.
+
+        Returns:
+            Boolean True if the request may proceed.
+        """
+        if self.secret_key is None:
+            return True
+
+        match = self.AUTHORIZATION.search(headers.get('Authorization', ''))
+        if match is None or match[1] != self.access_key:
+            return False
+
+        expected = signature(
+            method=method, path=path, query=query,
+            headers={name.lower(): value for name, value in headers.items()},
+            secret_key=self.secret_key, region=match[3], amz_date=headers['x-amz-date'])
+
+        return match[4] == expected
+
+    def handle(self, method, path, query, headers, body):
+        """
+        Answer one object store request.
+
+        Returns:
+            Tuple of (HTTP status code, dict of response headers, body bytes).
+        """
+        query = {name: values[0] for name, values in query.items()}
+
+        with self.lock:
+            self.requests.append((method, path, query))
+
+        if not self.authorized(method, path, query, headers):
+            return self.error(403, 'SignatureDoesNotMatch')
+
+        bucket, _, key = unquote(path).lstrip('/').partition('/')
+        if not bucket or not key or '..' in key.split('/'):
+            return self.error(400, 'InvalidRequest')
+
+        if 'uploadId' in query or 'uploads' in query:
+            return self.handle_upload(method, bucket, key, query, body)
+
+        path = self.directory / bucket / key
+
+        if method == 'PUT':
+            self.write(path, body)
+            return 200, {'ETag': f'"{hashlib.md5(body).hexdigest()}"'}, b''
+        elif method == 'DELETE':
+            path.unlink(missing_ok=True)
+            return 204, {}, b''
+        elif not path.is_file():
+            return self.error(404, 'NoSuchKey')
+        elif method == 'HEAD':
+            return 200, {'Content-Length': str(path.stat().st_size)}, b''
+
+        return 200, {'Content-Type': 'application/octet-stream'}, path.read_bytes()
+
+    def handle_upload(self, method, bucket, key, query, body):
+        """
+        Answer one request that is part of a multipart upload.
+
+        Returns:
+            Tuple of (HTTP status code, dict of response headers, body bytes).
+        """
+        if method == 'POST' and 'uploads' in query:
+            upload_id = uuid.uuid4().hex
+            (self.directory / UPLOADS_DIRECTORY / upload_id).mkdir()
+            return self.document('InitiateMultipartUploadResult', Bucket=bucket, Key=key, UploadId=upload_id)
+
+        upload = self.directory / UPLOADS_DIRECTORY / query['uploadId']
+        if not upload.is_dir():
+            return self.error(404, 'NoSuchUpload')
+
+        if method == 'PUT':
+            (upload / query['partNumber']).write_bytes(body)
+            return 200, {'ETag': f'"{hashlib.md5(body).hexdigest()}"'}, b''
+        elif method == 'DELETE':
+            self.remove_upload(upload)
+            return 204, {}, b''
+
+        parts = [
+            (part.findtext('PartNumber'), part.findtext('ETag'))
+            for part in ElementTree.fromstring(body).iter('Part')]
+        data = []
+        for number, etag in parts:
+            part = upload / number
+            if not part.is_file() or etag != f'"{hashlib.md5(part.read_bytes()).hexdigest()}"':
+                return self.document('Error', Code='InvalidPart')
+            data.append(part.read_bytes())
+
+        self.write(self.directory / bucket / key, b''.join(data))
+        self.remove_upload(upload)
+
+        return self.document('CompleteMultipartUploadResult', Bucket=bucket, Key=key)
+
+    @staticmethod
+    def write(path, data):
+        """
+        Replace the file at `path` with `data`, creating directories as needed.
+        """
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_name(f'.{path.name}.{uuid.uuid4().hex}')
+        temp_path.write_bytes(data)
+        temp_path.replace(path)
+
+    @staticmethod
+    def remove_upload(upload):
+        """
+        Remove an upload's directory and every part in it.
+        """
+        for part in upload.iterdir():
+            part.unlink()
+        upload.rmdir()
@@ -0,0 +1,581 @@
+"""
+Storage backends for Attachment and Derivative data.
+
+A backend keeps files under string keys like "sha256/ab/cd/abcd...ef.jpg", and
+knows how to put, open, check, measure, and delete them. It can also suggest
+how the web app should serve a file: straight from a local path (optionally
+through nginx), by redirecting to a URL, or by streaming it from the backend.
+
+LocalBackend keeps files on the local filesystem, and is what models use when
+no other backend is configured. ObjectStoreBackend keeps them in a bucket of
+an S3-compatible object store, so that several web nodes can share the same
+files. CachedBackend puts a LocalBackend in front of an ObjectStoreBackend as
+a read-through cache.
+
+Attributes:
+    BACKENDS: Names of the backends that make_backend() can build.
+    FSYNC_POLICIES: The ways local files can be flushed to disk: "none" only
+        renames them into place, "file" flushes each file before renaming it,
+        and "full" also flushes the directory afterwards.
+    STORAGE_FILE_MODE: Permissions given to local files written here.
+    TEMP_PREFIX: Name prefix of the temporary files that data is written to
+        before being renamed into place.
+    TEMP_PREFIXES: Name prefixes of every kind of temporary file that can be
+        left behind in the storage directories, for sweep_temp_files().
+    logger: Logger instance scoped to the current module name.
+"""
+
+import errno
+import logging
+import os
+import shutil
+import tempfile
+import time
+from abc import ABC, abstractmethod
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from urllib.parse import quote
+from windowbox.clients.s3 import S3NotFoundError
+
+BACKENDS = ('local', 's3', 'cached')
+FSYNC_POLICIES = ('none', 'file', 'full')
+STORAGE_FILE_MODE = 0o644
+TEMP_PREFIX = '.tmp-'
+TEMP_PREFIXES = (TEMP_PREFIX, '.incoming-')
+
+logger = logging.getLogger(__name__)
+
+
+def fsync_path(path):
+    """
+    Flush a file or directory to disk.
+
+    Args:
+        path: A pathlib Path object (or string).
+    """
+    fd = os.open(path, os.O_RDONLY)
+
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def install_file(source, path, *, fsync):
+    """
+    Atomically rename a finished file to `path`, flushing it as asked.
+
+    The file is given `STORAGE_FILE_MODE` first. Temporary files are created
+    readable only by their owner, which would keep the web server (or nginx)
+    from serving them.
+
+    Args:
+        source: A pathlib Path object referring to the finished file, on the
+            same filesystem as `path`.
+        path: A pathlib Path object referring to the file to replace.
+        fsync: One of the `FSYNC_POLICIES`.
+    """
+    os.chmod(source, STORAGE_FILE_MODE)
+
+    if fsync != 'none':
+        fsync_path(source)
+
+    os.replace(source, path)
+
+    if fsync == 'full':
+        fsync_path(path.parent)
+
+
+def sweep_temp_files(base_path, *, min_age):
+    """
+    Remove the temporary files that interrupted writes left behind.
+
+    Only files named with one of the `TEMP_PREFIXES` are considered, and only
+    once they have gone unmodified for `min_age` seconds, so that writes which
+    are still in progress are not disturbed.
+
+    Args:
+        base_path: A pathlib Path object referring to the directory to search,
+            along with everything beneath it.
+        min_age: Age in seconds.
+
+    Returns:
+        Number of files removed.
+    """
+    cutoff = time.time() - min_age
+    removed = 0
+
+    for directory, _, names in os.walk(base_path):
+        for name in names:
+            if not name.startswith(TEMP_PREFIXES):
+                continue
+
+            path = Path(directory, name)
+            try:
+                if path.stat().st_mtime < cutoff:
+                    path.unlink()
+                    removed += 1
+            except FileNotFoundError:
+                pass
+
+    if removed:
+        logger.info(f'Removed {removed} abandoned temporary file(s) from {base_path}')
+
+    return removed
+
+
+class StorageBackend(ABC):
+    """
+    Interface that every storage backend implements.
+
+    Keys are relative, slash-separated names. Reading a key that has no data
+    raises FileNotFoundError, whatever the backend.
+    """
+
+    @abstractmethod
+    def put(self, key, source):
+        """
+        Store a finished local file under `key`, replacing any data there.
+
+        Args:
+            key: String key.
+            source: A pathlib Path object referring to the file. It is moved or
+                removed; either way, it is gone afterwards.
+        """
+
+    @contextmanager
+    def writer(self, key):
+        """
+        Open a temporary file that is stored under `key` once it's written.
+
+        If the `with` block raises, nothing is stored. This default writes to
+        the system's temporary directory and hands the result to put().
+
+        Args:
+            key: String key.
+
+        Yields:
+            File object open for writing in binary mode.
+        """
+        fd, temp_name = tempfile.mkstemp(prefix=TEMP_PREFIX)
+        temp_path = Path(temp_name)
+
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                yield fp
+            self.put(key, temp_path)
+        finally:
+            temp_path.unlink(missing_ok=True)
+
+    @abstractmethod
+    def open(self, key):
+        """
+        Open the data stored under `key` for reading.
+
+        Returns:
+            Binary file object, which the caller should close. It is not
+            necessarily seekable.
+        """
+
+    @abstractmethod
+    def exists(self, key):
+        """
+        Is there data stored under `key`?
+        """
+
+    @abstractmethod
+    def size(self, key):
+        """
+        Return the size, in bytes, of the data stored under `key`.
+        """
+
+    @abstractmethod
+    def delete(self, key):
+        """
+        Remove the data stored under `key`, if there is any.
+        """
+
+    @abstractmethod
+    def serve_hint(self, key):
+        """
+        Suggest the cheapest way to send the data under `key` to a browser.
+
+        Returns:
+            A pathlib Path object if the data is in a local file, a string URL
+            to redirect to, or None if it should be streamed through open().
+        """
+
+    @contextmanager
+    def local_file(self, key):
+        """
+        Make the data under `key` available as a local file, for tools that
+        can only read from a path.
+
+        This default downloads a temporary copy, which is removed afterwards.
+
+        Yields:
+            A pathlib Path object.
+        """
+        fd, temp_name = tempfile.mkstemp(prefix=TEMP_PREFIX, suffix=Path(key).suffix)
+
+        try:
+            with os.fdopen(fd, 'wb') as fp, self.open(key) as stream:
+                shutil.copyfileobj(stream, fp)
+            yield Path(temp_name)
+        finally:
+            os.unlink(temp_name)
+
+
+class LocalBackend(StorageBackend):
+    """
+    Storage backend that keeps each key in a file beneath `base_path`.
+
+    Files are always written to a temporary file in the same directory and
+    renamed into place, so readers see either the old file or the whole new
+    one, and a crash can't leave a truncated file behind.
+    """
+
+    def __init__(self, base_path, *, fsync='file'):
+        """
+        Constructor.
+
+        Args:
+            base_path: A pathlib Path object referring to the root directory.
+            fsync: One of the `FSYNC_POLICIES`, for how hard data is pushed to
+                disk before and after it is renamed into place.
+        """
+        self.base_path = base_path
+        self.fsync = fsync
+
+    def path(self, key, *, create_parents=False):
+        """
+        Return the path of the file that holds `key`.
+
+        Args:
+            key: String key.
+            create_parents: If True, create the directories above the file.
+
+        Returns:
+            A pathlib Path object.
+        """
+        path = self.base_path / key
+
+        if create_parents:
+            path.parent.mkdir(parents=True, exist_ok=True)
+
+        return path
+
+    def put(self, key, source):
+        """
+        Rename `source` into place.
+
+        If `source` is on another filesystem (like a tmpfs temporary
+        directory, or a cache on its own disk), it can't simply be renamed, so
+        it is copied through writer() and then removed.
+        """
+        try:
+            install_file(source, self.path(key, create_parents=True), fsync=self.fsync)
+        except OSError as exc:
+            if exc.errno != errno.EXDEV:
+                raise
+
+            with source.open('rb') as src, self.writer(key) as fp:
+                shutil.copyfileobj(src, fp)
+            source.unlink()
+
+    @contextmanager
+    def writer(self, key):
+        """
+        Open a temporary file beside the one for `key`, and rename it over
+        that file once it's written.
+        """
+        path = self.path(key, create_parents=True)
+        fd, temp_name = tempfile.mkstemp(dir=path.parent, prefix=TEMP_PREFIX)
+        temp_path = Path(temp_name)
+
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                yield fp
+            install_file(temp_path, path, fsync=self.fsync)
+        except BaseException:
+            temp_path.unlink(missing_ok=True)
+            raise
+
+    def open(self, key):
+        """
+        Open the file for `key`.
+        """
+        return self.path(key).open('rb')
+
+    def exists(self, key):
+        """
+        Is there a file for `key`?
+        """
+        return self.path(key).is_file()
+
+    def size(self, key):
+        """
+        Return the size of the file for `key`.
+        """
+        return self.path(key).stat().st_size
+
+    def delete(self, key):
+        """
+        Remove the file for `key`, if there is one.
+        """
+        self.path(key).unlink(missing_ok=True)
+
+    def serve_hint(self, key):
+        """
+        Return the path of the file for `key`.
+        """
+        return self.path(key)
+
+    @contextmanager
+    def local_file(self, key):
+        """
+        Yield the path of the file for `key`, without copying it.
+        """
+        yield self.path(key)
+
+
+class ObjectStoreBackend(StorageBackend):
+    """
+    Storage backend that keeps each key in an object of an S3-compatible store.
+    """
+
+    def __init__(self, *, client, prefix='', public_url=None):
+        """
+        Constructor.
+
+        Args:
+            client: S3Client instance for the bucket to use.
+            prefix: String prepended to every key to make its object name, so
+                that several backends can share one bucket.
+            public_url: Optional URL at which the bucket's objects can be read
+                without signing (a public bucket, or a CDN in front of it). If
+                set, browsers are redirected there instead of having the data
+                streamed to them.
+        """
+        self.client = client
+        self.prefix = prefix
+        self.public_url = public_url.rstrip('/') if public_url else None
+
+    def upload(self, key, source):
+        """
+        Copy the local file `source` to the object for `key`, leaving it there.
+        """
+        self.client.upload_file(f'{self.prefix}{key}', source)
+
+    def put(self, key, source):
+        """
+        Upload `source`, then remove it.
+        """
+        self.upload(key, source)
+        source.unlink()
+
+    def open(self, key):
+        """
+        Start downloading the object for `key`.
+        """
+        try:
+            return self.client.get_object(f'{self.prefix}{key}').raw
+        except S3NotFoundError:
+            raise FileNotFoundError(key)
+
+    def exists(self, key):
+        """
+        Is there an object for `key`?
+        """
+        return self.client.head_object(f'{self.prefix}{key}') is not None
+
+    def size(self, key):
+        """
+        Return the size of the object for `key`.
+        """
+        headers = self.client.head_object(f'{self.prefix}{key}')
+        if headers is None:
+            raise FileNotFoundError(key)
+
+        return int(headers['Content-Length'])
+
+    def delete(self, key):
+        """
+        Delete the object for `key`.
+        """
+        self.client.delete_object(f'{self.prefix}{key}')
+
+    def serve_hint(self, key):
+        """
+        Return the public URL of the object for `key`, if there is one.
+        """
+        if self.public_url is None:
+            return None
+
+        return f'{self.public_url}/{quote(self.prefix + key)}'
+
+
+class CachedBackend(StorageBackend):
+    """
+    Storage backend that reads through a local cache in front of another.
+
+    Data is written to `origin` first, then kept in `cache`. Data that is read
+    is copied into `cache` if it isn't there already, and every read after that
+    is served from the local copy. Nothing is ever evicted automatically;
+    trim() does that, oldest-accessed first.
+    """
+
+    def __init__(self, *, origin, cache):
+        """
+        Constructor.
+
+        Args:
+            origin: ObjectStoreBackend (or anything with an upload() method)
+                that holds the authoritative copy of everything.
+            cache: LocalBackend on a fast local disk.
+        """
+        self.origin = origin
+        self.cache = cache
+
+    def fill(self, key):
+        """
+        Copy the data for `key` into the cache, unless it's already there.
+
+        Raises:
+            FileNotFoundError: The origin has no data under `key`.
+        """
+        if self.cache.exists(key):
+            return
+
+        with self.origin.open(key) as stream, self.cache.writer(key) as fp:
+            shutil.copyfileobj(stream, fp)
+
+        logger.debug(f'Cached {key}')
+
+    def put(self, key, source):
+        """
+        Upload `source` to the origin, then move it into the cache.
+        """
+        self.origin.upload(key, source)
+        self.cache.put(key, source)
+
+    def open(self, key):
+        """
+        Open the cached copy of `key`, filling the cache first if needed.
+        """
+        self.fill(key)
+
+        return self.cache.open(key)
+
+    def exists(self, key):
+        """
+        Is there data for `key` in the cache or the origin?
+        """
+        return self.cache.exists(key) or self.origin.exists(key)
+
+    def size(self, key):
+        """
+        Return the size of the data for `key`, from the cache if possible.
+        """
+        if self.cache.exists(key):
+            return self.cache.size(key)
+
+        return self.origin.size(key)
+
+    def delete(self, key):
+        """
+        Remove the data for `key` from the origin, then from the cache.
+        """
+        self.origin.delete(key)
+        self.cache.delete(key)
+
+    def serve_hint(self, key):
+        """
+        Return the path of the cached copy of `key`, filling the cache first.
+        """
+        self.fill(key)
+
+        return self.cache.serve_hint(key)
+
+    @contextmanager
+    def local_file(self, key):
+        """
+        Yield the path of the cached copy of `key`, filling the cache first.
+        """
+        self.fill(key)
+
+        with self.cache.local_file(key) as path:
+            yield path
+
+    def trim(self, max_bytes):
+        """
+        Remove cached files, least recently accessed first, until the cache
+        uses no more than `max_bytes`.
+
+        Access times are only as fresh as the filesystem keeps them (with the
+        usual `relatime` mount option, about once a day), which is plenty to
+        tell a busy file from a forgotten one.
+
+        Args:
+            max_bytes: Size to trim the cache down to.
+
+        Returns:
+            Counter with the number of `files` and `bytes` removed.
+        """
+        entries = []
+        for directory, _, names in os.walk(self.cache.base_path):
+            for name in names:
+                if not name.startswith(TEMP_PREFIXES):
+                    stat = os.stat(os.path.join(directory, name))
+                    entries.append((stat.st_atime, stat.st_size, os.path.join(directory, name)))
+
+        counts = Counter()
+        total = sum(size for _, size, _ in entries)
+
+        for _, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+
+            Path(path).unlink(missing_ok=True)
+            total -= size
+            counts['files'] += 1
+            counts['bytes'] += size
+
+        logger.info(f'Trimmed {counts["files"]} file(s), {counts["bytes"]} bytes from {self.cache.base_path}')
+
+        return counts
+
+
+def make_backend(*, name, client=None, prefix='', public_url=None, cache_path=None, fsync='file'):
+    """
+    Build the storage backend that the configuration asks for.
+
+    Args:
+        name: One of the `BACKENDS`.
+        client: S3Client instance, for every backend but "local".
+        prefix: Object name prefix for the ObjectStoreBackend.
+        public_url: Public URL of the bucket, for the ObjectStoreBackend.
+        cache_path: A pathlib Path object referring to the cache directory, for
+            the "cached" backend.
+        fsync: One of the `FSYNC_POLICIES`, for the cache.
+
+    Returns:
+        StorageBackend instance, or None for "local", which models take to mean
+        a LocalBackend at each instance's own `base_path`.
+
+    Raises:
+        ValueError: `name` is not one of the `BACKENDS`.
+    """
+    if name not in BACKENDS:
+        raise ValueError(f'Unknown storage backend: {name}')
+
+    if name == 'local':
+        return None
+
+    origin = ObjectStoreBackend(client=client, prefix=prefix, public_url=public_url)
+
+    if name == 's3':
+        return origin
+
+    return CachedBackend(origin=origin, cache=LocalBackend(cache_path, fsync=fsync))
@@ -0,0 +1,242 @@
+"""
+Synthetic Post data for development and load testing.
+
+Everything here is deterministic given a SyntheticSpec, and image rendering is
+a plain module-level function so that it can be farmed out to a process pool.
+The EXIF dicts produced here mimic the flattened output of ExifToolClient for
+the tags that render_image() embeds, so bulk-generated Attachments look the
+same to the rest of the app as ones that went through exiftool.
+
+Attributes:
+    SyntheticSpec: namedtuple describing one synthetic Post: its RGB `color`,
+        `size` as a (width, height) tuple, EXIF `orientation` number, and the
+        name of its `exif_payload`.
+    EXIF_PAYLOADS: Tuple of accepted EXIF payload names, from least to most
+        detailed. "none" embeds no EXIF at all, "basic" adds the orientation and
+        camera identification, and "full" adds exposure settings and GPS.
+    ORIENTATION_NAMES: Mapping of EXIF orientation numbers to the description
+        ExifTool reports for each one.
+    FAKE_MAKE: Camera make to embed in "basic" and "full" payloads.
+    FAKE_MODEL: Camera model to embed in "basic" and "full" payloads.
+    FAKE_LATITUDE: GPS latitude (degrees) to embed in "full" payloads.
+    FAKE_LONGITUDE: GPS longitude (degrees) to embed in "full" payloads.
+    FAKE_ADDRESS: Geo address to use for Attachments with a "full" payload.
+"""
+
+import io
+from collections import namedtuple
+from PIL import ExifTags, Image, ImageDraw
+
+SyntheticSpec = namedtuple('SyntheticSpec', ['color', 'size', 'orientation', 'exif_payload'])
+
+EXIF_PAYLOADS = ('none', 'basic', 'full')
+ORIENTATION_NAMES = {
+    1: 'Horizontal (normal)',
+    2: 'Mirror horizontal',
+    3: 'Rotate 180',
+    4: 'Mirror vertical',
+    5: 'Mirror horizontal and rotate 270 CW',
+    6: 'Rotate 90 CW',
+    7: 'Mirror horizontal and rotate 90 CW',
+    8: 'Rotate 270 CW'}
+FAKE_MAKE = 'Windowbox'
+FAKE_MODEL = 'Synthetic'
+FAKE_LATITUDE = 36.0
+FAKE_LONGITUDE = -78.9
+FAKE_ADDRESS = 'Command Line, USA'
+
+
+def parse_size(value):
+    """
+    Convert a "WIDTHxHEIGHT" string into a (width, height) tuple.
+
+    Args:
+        value: String like "2000x1500".
+
+    Returns:
+        Tuple of two positive integers.
+
+    Raises:
+        ValueError: The string was not in the expected format.
+    """
+    try:
+        width, height = (int(v) for v in value.lower().split('x'))
+    except ValueError:
+        raise ValueError(f'Size {value!r} is not in WIDTHxHEIGHT format')
+
+    if width < 1 or height < 1:
+        raise ValueError(f'Size {value!r} must be at least 1x1')
+
+    return width, height
+
+
+def make_spec(*, rng, sizes, orientations, exif_payload):
+    """
+    Pick a random color, size, and orientation for one synthetic Post.
+
+    Args:
+        rng: random.Random instance (or the `random` module) to draw from.
+        sizes: Sequence of (width, height) tuples to choose between.
+        orientations: Sequence of EXIF orientation numbers to choose between.
+        exif_payload: One of the names in EXIF_PAYLOADS.
+
+    Returns:
+        SyntheticSpec instance.
+    """
+    return SyntheticSpec(
+        color=(rng.randrange(256), rng.randrange(256), rng.randrange(256)),
+        size=rng.choice(sizes),
+        orientation=rng.choice(orientations),
+        exif_payload=exif_payload)
+
+
+def caption_for(spec):
+    """
+    Return the caption text for a synthetic Post: its color as a hex triplet.
+
+    Args:
+        spec: SyntheticSpec instance.
+
+    Returns:
+        String like "#1A2B3C".
+    """
+    return '#{:0>2X}{:0>2X}{:0>2X}'.format(*spec.color)
+
+
+def dms(degrees):
+    """
+    Convert a signed decimal degree value to an unsigned EXIF rational triplet.
+
+    Args:
+        degrees: Float angle; the sign is discarded.
+
+    Returns:
+        Tuple of (degrees, minutes, seconds) floats.
+    """
+    degrees = abs(degrees)
+    minutes = (degrees % 1) * 60
+
+    return float(int(degrees)), float(int(minutes)), round((minutes % 1) * 60, 2)
+
+
+def render_exif(spec):
+    """
+    Build the binary EXIF block that render_image() embeds for `spec`.
+
+    Args:
+        spec: SyntheticSpec instance.
+
+    Returns:
+        Bytes suitable for the `exif` option of Image.save(), or None if the
+        spec's payload does not include any EXIF.
+    """
+    if spec.exif_payload == 'none':
+        return None
+
+    exif = Image.Exif()
+    exif[ExifTags.Base.Make] = FAKE_MAKE
+    exif[ExifTags.Base.Model] = FAKE_MODEL
+    exif[ExifTags.Base.Orientation] = spec.orientation
+
+    if spec.exif_payload == 'full':
+        exif[ExifTags.IFD.Exif] = {
+            ExifTags.Base.ExposureTime: 1 / 60,
+            ExifTags.Base.FNumber: 2.8,
+            ExifTags.Base.ISOSpeedRatings: 100}
+        exif[ExifTags.IFD.GPSInfo] = {
+            ExifTags.GPS.GPSLatitudeRef: 'N' if FAKE_LATITUDE >= 0 else 'S',
+            ExifTags.GPS.GPSLatitude: dms(FAKE_LATITUDE),
+            ExifTags.GPS.GPSLongitudeRef: 'E' if FAKE_LONGITUDE >= 0 else 'W',
+            ExifTags.GPS.GPSLongitude: dms(FAKE_LONGITUDE)}
+
+    return exif.tobytes()
+
+
+def render_image(spec):
+    """
+    Draw the image for `spec` and encode it as a JPEG.
+
+    The image is a solid field of the spec's color with a centered circle in
+    the complementary color, which makes bad crops easy to spot by eye.
+
+    Args:
+        spec: SyntheticSpec instance.
+
+    Returns:
+        Bytes containing the complete JPEG file.
+    """
+    width, height = spec.size
+    red, green, blue = spec.color
+    side = min(width, height)
+    left, top = (width - side) // 2, (height - side) // 2
+
+    image = Image.new('RGB', spec.size, spec.color)
+    draw = ImageDraw.Draw(image)
+    draw.ellipse((left, top, left + side - 1, top + side - 1), fill=(blue, green, red))
+
+    options = {'quality': 75}
+    exif = render_exif(spec)
+    if exif is not None:
+        options['exif'] = exif
+
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', **options)
+
+    return buffer.getvalue()
+
+
+def exif_field(fields, attribute, description, value, raw_value=None):
+    """
+    Add one tag to a flattened EXIF dict in the shape ExifToolClient returns.
+
+    Args:
+        fields: Dict to update in place.
+        attribute: Full "Group:Item" attribute name.
+        description: Human-readable name of the tag.
+        value: Printable value of the tag.
+        raw_value: Numeric value of the tag, if it differs from `value`.
+    """
+    fields[f'{attribute}.desc'] = description
+    fields[f'{attribute}.val'] = value
+    if raw_value is not None:
+        fields[f'{attribute}.num'] = raw_value
+
+
+def exif_data(spec):
+    """
+    Return the flattened EXIF dict that ExifToolClient would read for `spec`.
+
+    Args:
+        spec: SyntheticSpec instance.
+
+    Returns:
+        Dict mapping flattened attribute names to values.
+    """
+    width, height = spec.size
+    fields = {}
+
+    exif_field(fields, 'File:FileType', 'File Type', 'JPEG')
+    exif_field(fields, 'File:ImageWidth', 'Image Width', width)
+    exif_field(fields, 'File:ImageHeight', 'Image Height', height)
+
+    if spec.exif_payload == 'none':
+        return fields
+
+    exif_field(fields, 'EXIF:Make', 'Make', FAKE_MAKE)
+    exif_field(fields, 'EXIF:Model', 'Camera Model Name', FAKE_MODEL)
+    exif_field(
+        fields, 'EXIF:Orientation', 'Orientation', ORIENTATION_NAMES[spec.orientation],
+        spec.orientation)
+
+    if spec.exif_payload == 'full':
+        exif_field(fields, 'EXIF:ExposureTime', 'Exposure Time', '1/60', 1 / 60)
+        exif_field(fields, 'EXIF:FNumber', 'F Number', '2.8', 2.8)
+        exif_field(fields, 'EXIF:ISO', 'ISO', 100)
+        exif_field(
+            fields, 'Composite:GPSLatitude', 'GPS Latitude', f'{FAKE_LATITUDE} deg',
+            FAKE_LATITUDE)
+        exif_field(
+            fields, 'Composite:GPSLongitude', 'GPS Longitude', f'{FAKE_LONGITUDE} deg',
+            FAKE_LONGITUDE)
+
+    return fields
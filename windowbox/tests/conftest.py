@@ -10,10 +10,13 @@ Attributes:
 import pytest
 from datetime import datetime, timezone
 from windowbox import app as test_app
+from windowbox.blueprints.api.cache import ResponseCache
 from windowbox.database import db as test_db
 from windowbox.models.attachment import Attachment
 from windowbox.models.post import Post
 from windowbox.models.sender import Sender
+from windowbox.clients.s3 import S3Client
+from windowbox.standins import GeocodeStandIn, ObjectStoreStandIn
 
 TEST_DB_SUFFIX = '/test.sqlite'
 
@@ -30,7 +33,12 @@ def app():
 def client(app):
     """
     Return a Flask test client configured for the Windowbox application.
+
+    The API response cache is emptied first, since content versions (and so
+    ETags) repeat between tests that build the same fixtures.
     """
+    app.api_response_cache = ResponseCache(max_bytes=app.config['API_RESPONSE_CACHE_BYTES'])
+
     with app.test_client() as client:
         yield client
 
@@ -58,6 +66,33 @@ def db(app):
         test_db.drop_all()
 
 
+@pytest.fixture
+def geocode_server():
+    """
+    Return a running stand-in for the Google Maps geocoding API.
+    """
+    with GeocodeStandIn() as server:
+        yield server
+
+
+@pytest.fixture
+def object_store(tmp_path):
+    """
+    Return a running stand-in for an S3-compatible object store.
+    """
+    with ObjectStoreStandIn(directory=tmp_path / 'object-store', access_key='AK', secret_key='SK') as server:
+        yield server
+
+
+@pytest.fixture
+def s3_client(object_store):
+    """
+    Return an S3Client for the "bucket" bucket of the object store stand-in.
+    """
+    return S3Client(
+        endpoint_url=object_store.base_url, bucket='bucket', access_key='AK', secret_key='SK', part_size=10)
+
+
 @pytest.fixture
 def attachment_instance(post_instance):
     """
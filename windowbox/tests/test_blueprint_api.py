@@ -2,6 +2,13 @@
 Integration tests for the API blueprint (and its schemas).
 """
 
+from datetime import datetime, timezone
+from flask import url_for
+from unittest.mock import patch
+from windowbox.blueprints.api.cache import ResponseCache
+from windowbox.blueprints.api.schemas import url_templates
+from windowbox.models.attachment import Attachment
+
 
 def assert_json_200(res):
     """
@@ -80,6 +87,36 @@ def test_api_get_many_posts(client, post_instances):
     assert_json_422(res)
 
 
+def test_api_get_archive(client, post_instances):
+    """
+    Test "archive overview" endpoint.
+    """
+    res = client.get('/api/archive')
+
+    assert_json_200(res)
+    assert len(res.json['months']) == 12
+    assert res.json['months'][0]['year'] == 2018
+    assert res.json['months'][0]['month'] == 12
+    assert res.json['months'][0]['post_count'] == 1
+    assert res.json['months'][0]['posts_url'].endswith('/api/archive/2018/12')
+
+
+def test_api_get_archive_month(client, post_instances):
+    """
+    Test "Posts in one month" endpoint.
+    """
+    res = client.get('/api/archive/2018/4')
+
+    assert_json_200(res)
+    assert len(res.json['posts']) == 1
+    assert res.json['posts'][0]['id'] == 4
+    assert res.json['more_url'] is None
+
+    res = client.get('/api/archive/2018/13')
+
+    assert_json_422(res)
+
+
 def test_api_get_post(client, post_instances):
     """
     Test "get one Post" endpoint.
@@ -122,3 +159,107 @@ def test_attachment_get_attachment(client, post_instances):
     res = client.get('/api/attachments/666666')
 
     assert_json_404(res)
+
+
+def test_api_conditional_many_posts(app, client, db, post_instances):
+    """
+    Should answer a matching If-None-Match with 304, and serve repeats from cache.
+    """
+    res = client.get('/api/posts?limit=10')
+
+    assert_json_200(res)
+    assert res.cache_control.no_cache
+    etag = res.get_etag()[0]
+
+    with patch('windowbox.controllers.post.PostController.get_many') as mock_get_many:
+        res = client.get('/api/posts?limit=10', headers={'If-None-Match': f'"{etag}"'})
+
+        assert res.status_code == 304
+        assert res.get_etag()[0] == etag
+        assert res.data == b''
+
+        cached = client.get('/api/posts?limit=10')
+
+        assert_json_200(cached)
+        assert cached.get_etag()[0] == etag
+        assert len(cached.json['posts']) == 10
+
+        mock_get_many.assert_not_called()
+
+    res = client.get('/api/archive/2018/4', headers={'If-None-Match': f'"{etag}"'})
+
+    assert_json_200(res)
+    assert len(app.api_response_cache) == 2
+
+    post_instances[3].attachments[0].updated_utc = datetime(2099, 1, 1, tzinfo=timezone.utc)
+    db.session.flush()
+
+    res = client.get('/api/posts?limit=10', headers={'If-None-Match': f'"{etag}"'})
+
+    assert_json_200(res)
+    assert res.get_etag()[0] != etag
+
+
+def test_api_conditional_post_and_attachment(client, post_instances):
+    """
+    Should validate single Posts and Attachments, but not missing ones.
+    """
+    for url in ('/api/posts/2', '/api/attachments/1'):
+        res = client.get(url)
+        assert_json_200(res)
+
+        res = client.get(url, headers={'If-None-Match': res.headers['ETag']})
+        assert res.status_code == 304
+
+    for url in ('/api/posts/666666', '/api/attachments/666666'):
+        res = client.get(url)
+        assert_json_404(res)
+        assert 'ETag' not in res.headers
+
+
+def test_api_response_cache():
+    """
+    Should evict the least recently used bodies to stay within its size.
+    """
+    cache = ResponseCache(max_bytes=10)
+
+    cache.put('a', b'1234')
+    cache.put('b', b'1234')
+    assert cache.get('a') == b'1234'
+
+    cache.put('c', b'1234')
+    assert cache.get('b') is None
+    assert (len(cache), cache.size) == (2, 8)
+
+    cache.put('a', b'12')
+    cache.put('d', b'12345678901')
+    assert cache.get('a') == b'12'
+    assert cache.get('d') is None
+    assert (len(cache), cache.size) == (2, 6)
+
+    cache = ResponseCache(max_bytes=0)
+    cache.put('a', b'1')
+    assert len(cache) == 0
+
+
+def test_api_url_templates(app, post_instances):
+    """
+    Should build exactly the URLs that url_for() would, once per request.
+    """
+    attachment = post_instances[1].attachments[0]
+
+    with app.test_request_context(base_url='https://example.com/root/'):
+        templates = url_templates()
+
+        assert url_templates() is templates
+        assert templates.post(42) == url_for('api.get_post', post_id=42, _external=True)
+        assert templates.attachment(42) == url_for('api.get_attachment', attachment_id=42, _external=True)
+
+        for mime_type in Attachment.KNOWN_EXTENSIONS:
+            attachment.mime_type = mime_type
+            for name in Attachment.CANNED_DIMENSIONS_MAP:
+                assert templates.derivative(attachment, name) == attachment.derivative_url(name, _external=True)
+
+    with app.test_request_context(base_url='http://other.example.com/'):
+        assert url_templates() is not templates
+        assert url_templates().post(1) == 'http://other.example.com/api/posts/1'
@@ -2,6 +2,14 @@
 Integration tests for the site blueprint.
 """
 
+from datetime import datetime, timezone
+from unittest.mock import patch
+from windowbox.controllers.post import PostController
+from windowbox.models.derivative import Derivative
+from windowbox.models.pack import PackStore
+from windowbox.models.post import Post
+from windowbox.storage import ObjectStoreBackend
+
 
 def assert_html_200(res):
     """
@@ -82,6 +90,48 @@ def test_site_get_index(client, post_instances):
     assert_html_422(res)
 
 
+def test_site_get_archive(client, post_instances):
+    """
+    Test archive overview page.
+    """
+    res = client.get('/archive')
+
+    assert_html_200(res)
+    assert b'<h2>2018</h2>' in res.data
+    assert b'/archive/2018/1"' in res.data
+    assert b'/archive/2018/12"' in res.data
+
+
+def test_site_get_archive_month(app, client, post_instances):
+    """
+    Test archive month page, including pagination within the month.
+    """
+    res = client.get('/archive/2018/4')
+
+    assert_html_200(res)
+    assert b'Posts from April 2018' in res.data
+    assert b'Post Fixture 4' in res.data
+    assert b'Post Fixture 5' not in res.data
+    assert b'class="next-page"' not in res.data
+
+    with patch.object(PostController, 'SITE_DEFAULT_LIMIT', 1):
+        post = Post(sender=post_instances[0].sender, caption='Post Fixture 4b',
+                    created_utc=datetime(2018, 4, 15, tzinfo=timezone.utc))
+        app.extensions['sqlalchemy'].session.add(post)
+
+        res = client.get('/archive/2018/4')
+        assert b'Post Fixture 4b' in res.data
+        assert b'/archive/2018/4?until=13' in res.data
+
+        res = client.get('/archive/2018/4?until=13')
+        assert b'Post Fixture 4<' in res.data
+        assert b'class="next-page"' not in res.data
+
+    res = client.get('/archive/2018/13')
+
+    assert_html_422(res)
+
+
 def test_site_get_post(client, post_instances):
     """
     Test single Post pages.
@@ -137,6 +187,46 @@ def test_site_get_attachment_derivative(client, post_instances):
     assert_html_404(res)
 
 
+def test_site_get_attachment_derivative_packed(client, post_instances, tmp_path):
+    """
+    Should send packed Derivatives directly, even when offloading the rest.
+    """
+    pack_store = PackStore(base_path=tmp_path, max_entry_bytes=64 * 1024, max_pack_bytes=1024 * 1024)
+
+    with patch.dict(client.application.config, USE_X_ACCEL_REDIRECT=True), \
+            patch.object(client.application, 'derivatives_path', tmp_path), \
+            patch.object(client.application, 'derivative_pack_store', pack_store):
+        first = client.get('/attachment/2/300x300.png')
+        again = client.get('/attachment/2/300x300.png', headers={'If-None-Match': first.headers['ETag']})
+
+    assert first.status_code == 200
+    assert first.content_type == 'image/png'
+    assert first.data.startswith(b'\x89PNG')
+    assert first.headers.get('x-accel-redirect') is None
+    assert again.status_code == 304
+
+
+def test_site_get_attachment_derivative_object_store(client, post_instances, s3_client):
+    """
+    Should stream Derivatives from an object store, or redirect to its public URL.
+    """
+    backend = ObjectStoreBackend(client=s3_client, prefix='derivatives/')
+
+    with patch.dict(client.application.config, USE_X_ACCEL_REDIRECT=True), \
+            patch.object(Derivative, 'storage_backend', backend):
+        streamed = client.get('/attachment/3/300x300.png')
+
+        backend.public_url = 'https://cdn.example.com'
+        redirected = client.get('/attachment/3/300x300.png')
+
+    assert streamed.status_code == 200
+    assert streamed.content_type == 'image/png'
+    assert streamed.data.startswith(b'\x89PNG')
+    assert streamed.headers.get('x-accel-redirect') is None
+    assert redirected.status_code == 302
+    assert redirected.location.startswith('https://cdn.example.com/derivatives/')
+
+
 def test_site_get_feed_atom(client, post_instances):
     """
     Test XML Atom feed.
@@ -3,8 +3,13 @@ Tests for the ExifTool client.
 """
 
 import pytest
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import patch
-from windowbox.clients.exiftool import ExifToolClient
+from windowbox.clients.exiftool import (
+    EXCLUDE_TAGS, READ_ARGS, ExifToolClient, ExifToolProcess, StayOpenExifToolClient,
+    make_client, make_read_args)
 
 
 @pytest.fixture
@@ -55,6 +60,49 @@ def test_read_file_discard(exiftool):
         assert exiftool.read_file('/path/to/test/image.jpg') == {'OneGoodKey': 'yup'}
 
 
+def test_read_file_exclude():
+    """
+    Should ask exiftool to skip unwanted tags, and not to extract binary data.
+    """
+    exiftool = ExifToolClient(exiftool_bin='/path/to/test/bin', tag_filter='exclude')
+
+    with patch('subprocess.check_output', return_value=b'[{"foo": "bar"}]') as mock_subprocess:
+        assert exiftool.read_file('/path/to/test/image.jpg') == {'foo': 'bar'}
+
+    args = mock_subprocess.call_args.args[0]
+    assert '-binary' not in args
+    assert args[:len(READ_ARGS) + 1] == ['/path/to/test/bin', *READ_ARGS]
+    assert [a for a in args if a.startswith('--')] == [f'--{t}' for t in EXCLUDE_TAGS]
+    assert args[-1] == '/path/to/test/image.jpg'
+
+
+def test_read_file_whitelist():
+    """
+    Should ask exiftool for exactly the whitelisted tags.
+    """
+    exiftool = ExifToolClient(
+        exiftool_bin='/path/to/test/bin', tag_filter='whitelist',
+        tags=['EXIF:Orientation', 'Composite:GPSLatitude'])
+
+    with patch('subprocess.check_output', return_value=b'[{"SourceFile": "x"}]') as mock_subprocess:
+        assert exiftool.read_file('/path/to/test/image.jpg') == {}
+
+    mock_subprocess.assert_called_once_with([
+        '/path/to/test/bin', *READ_ARGS, '-EXIF:Orientation', '-Composite:GPSLatitude',
+        '/path/to/test/image.jpg'])
+
+
+def test_make_read_args_invalid():
+    """
+    Should reject unknown tag filters and empty whitelists.
+    """
+    with pytest.raises(ValueError):
+        make_read_args(tag_filter='nope')
+
+    with pytest.raises(ValueError):
+        make_read_args(tag_filter='whitelist', tags=[])
+
+
 def test_read_file_flatten(exiftool):
     """
     Should flatten any nested objects using a separator.
@@ -100,3 +148,150 @@ def test_read_file_flatten(exiftool):
             'nested1.nested2.bar': 'nested two bar',
             'nested1.nested2.nested3.foo': 'nested three foo',
             'nested1.nested2.nested3.bar': 'nested three bar'}
+
+
+FAKE_STAY_OPEN_SCRIPT = '''#!{python}
+import json, os, sys, time
+
+args = []
+for line in sys.stdin:
+    line = line.rstrip('\\n')
+
+    if line == 'False' and args[-1:] == ['-stay_open']:
+        sys.exit(0)
+    elif not line.startswith('-execute'):
+        args.append(line)
+        continue
+
+    name = args[-1]
+    if name.endswith('crash') or (name.endswith('crash-once') and not os.path.exists(name)):
+        open(name, 'w').close()
+        sys.exit(1)
+    elif name.endswith('slow'):
+        time.sleep(10)
+    elif not name.endswith('missing'):
+        print(json.dumps([{{'SourceFile': name, 'Pid': os.getpid(), 'Args': len(args)}}]))
+
+    print('{{ready' + line[len('-execute'):] + '}}', flush=True)
+    args = []
+'''
+
+
+@pytest.fixture
+def stay_open(tmp_path):
+    """
+    Return a stay-open ExifTool client backed by a fake exiftool script.
+    """
+    script = tmp_path / 'exiftool'
+    script.write_text(FAKE_STAY_OPEN_SCRIPT.format(python=sys.executable))
+    script.chmod(0o755)
+
+    client = StayOpenExifToolClient(exiftool_bin=str(script), processes=2, timeout=2)
+    yield client
+    client.close()
+
+
+def test_make_client():
+    """
+    Should return a one-shot client only when no processes are requested.
+    """
+    oneshot = make_client(exiftool_bin='/bin/x', processes=0, timeout=1)
+    assert type(oneshot) is ExifToolClient
+    oneshot.close()
+
+    persistent = make_client(
+        exiftool_bin='/bin/x', processes=3, timeout=4, tag_filter='whitelist', tags=['EXIF:ISO'])
+    assert isinstance(persistent, StayOpenExifToolClient)
+    assert persistent.exiftool_bin == '/bin/x'
+    assert persistent.processes == 3
+    assert persistent.timeout == 4
+    assert persistent.read_args == [*READ_ARGS, '-EXIF:ISO']
+
+
+def test_stay_open_read_file(stay_open, tmp_path):
+    """
+    Should reuse one process for consecutive reads, and restart after close.
+    """
+    first = stay_open.read_file(tmp_path / 'one.jpg')
+    second = stay_open.read_file(tmp_path / 'two.jpg')
+
+    assert first['Args'] == len(stay_open.read_args) + 1
+    assert first['Pid'] == second['Pid']
+
+    stay_open.close()
+    assert stay_open.read_file(tmp_path / 'three.jpg')['Pid'] != first['Pid']
+
+
+def test_stay_open_crash(stay_open, tmp_path):
+    """
+    Should replace a crashed process and retry, but only once.
+    """
+    assert 'Pid' in stay_open.read_file(tmp_path / 'a.crash-once')
+
+    with pytest.raises(subprocess.CalledProcessError):
+        stay_open.read_file(tmp_path / 'b.crash')
+
+
+def test_stay_open_missing(stay_open, tmp_path):
+    """
+    Should raise if exiftool had nothing to say about the file.
+    """
+    with pytest.raises(subprocess.CalledProcessError):
+        stay_open.read_file(tmp_path / 'c.missing')
+
+
+def test_stay_open_timeout(stay_open, tmp_path):
+    """
+    Should kill a process that takes too long, and use a new one next time.
+    """
+    stay_open.timeout = 0.2
+    with pytest.raises(subprocess.TimeoutExpired):
+        stay_open.read_file(tmp_path / 'd.slow')
+
+    # The replacement process has to start up from scratch, so give it room.
+    stay_open.timeout = 2
+    assert 'Pid' in stay_open.read_file(tmp_path / 'e.jpg')
+
+
+def test_stay_open_threads(stay_open, tmp_path):
+    """
+    Should share no more than the configured number of processes across threads.
+    """
+    with ThreadPoolExecutor(max_workers=6) as executor:
+        results = list(executor.map(stay_open.read_file, [tmp_path / f'{n}.jpg' for n in range(30)]))
+
+    assert len(results) == 30
+    assert 1 <= len({r['Pid'] for r in results}) <= 2
+
+
+def test_stay_open_fork(stay_open, tmp_path):
+    """
+    Should not use or close processes that were started by another PID.
+    """
+    parent_pid = stay_open.read_file(tmp_path / 'f.jpg')['Pid']
+
+    with patch('os.getpid', return_value=-1):
+        assert stay_open.read_file(tmp_path / 'g.jpg')['Pid'] != parent_pid
+
+    process = ExifToolProcess(exiftool_bin=stay_open.exiftool_bin)
+    with patch('os.getpid', return_value=-1):
+        assert not process.is_usable
+        process.close()
+    assert process.popen.poll() is None
+
+    process.close()
+    assert process.popen.poll() == 0
+
+
+def test_process_broken_pipe(stay_open):
+    """
+    Should report a crash if the process is gone before a command is sent.
+    """
+    process = ExifToolProcess(exiftool_bin=stay_open.exiftool_bin)
+    process.popen.kill()
+    process.popen.wait()
+
+    with pytest.raises(ExifToolProcess.Crashed):
+        process.execute(['x'], timeout=1)
+
+    process.close()
@@ -0,0 +1,157 @@
+"""
+Tests for the offline gazetteer geocoder.
+"""
+
+import numpy
+import pytest
+from unittest.mock import Mock
+from windowbox.clients.gazetteer import (
+    FallbackGeocoder, GazetteerClient, GazetteerError, KDTree, make_geocoder, read_names, to_xyz)
+
+CITIES = [
+    # geonameid, name, asciiname, alternatenames, latitude, longitude, class, code, country, cc2, admin1
+    ('4464368', 'Durham', 'Durham', '', '35.99403', '-78.89862', 'P', 'PPLA2', 'US', '', 'NC'),
+    ('4487042', 'Raleigh', 'Raleigh', '', '35.7721', '-78.63861', 'P', 'PPLA', 'US', '', 'NC'),
+    ('2193733', 'Auckland', 'Auckland', '', '-36.84853', '174.76349', 'P', 'PPLA', 'NZ', '', 'E7'),
+    ('4032402', 'Apia', 'Apia', '', '-13.83333', '-171.76666', 'P', 'PPLC', 'WS', '', '24'),
+    ('1880252', 'Singapore', 'Singapore', '', '1.28967', '103.85007', 'P', 'PPLC', 'SG', '', '00')]
+
+
+@pytest.fixture
+def gazetteer_path(tmp_path):
+    """
+    Return the path to a tiny GeoNames-style cities file, with region names.
+    """
+    path = tmp_path / 'cities15000.txt'
+    path.write_text(''.join('\t'.join(row) + '\n' for row in CITIES))
+    (tmp_path / 'admin1CodesASCII.txt').write_text(
+        'US.NC\tNorth Carolina\tNorth Carolina\t4482348\n'
+        'NZ.E7\tAuckland\tAuckland\t2193734\n')
+
+    return path
+
+
+def test_to_xyz():
+    """
+    Should place coordinates on the unit sphere.
+    """
+    assert numpy.allclose(to_xyz(0, 0), [1, 0, 0])
+    assert numpy.allclose(to_xyz(90, 123), [0, 0, 1])
+    assert numpy.allclose(to_xyz(numpy.array([0, 0]), numpy.array([90, 180])), [[0, 1, 0], [-1, 0, 0]])
+
+
+def test_read_names(tmp_path):
+    """
+    Should skip comments, and tolerate a missing file.
+    """
+    path = tmp_path / 'countryInfo.txt'
+    path.write_text('#ISO\tISO3\tISO-Numeric\tfips\tCountry\n' 'US\tUSA\t840\tUS\tUnited States\n')
+
+    assert read_names(path, key_column=0, name_column=4) == {'US': 'United States'}
+    assert read_names(tmp_path / 'nope.txt', key_column=0, name_column=4) == {}
+
+
+def test_kdtree_nearest():
+    """
+    Should find the same neighbors as a brute-force search.
+    """
+    rng = numpy.random.default_rng(1)
+    points = rng.normal(size=(2000, 3))
+    tree = KDTree(points)
+
+    for query in rng.normal(size=(200, 3)):
+        distances = ((points - query) ** 2).sum(axis=1)
+        index, distance = tree.nearest(query)
+
+        assert index == distances.argmin()
+        assert distance == pytest.approx(distances.min())
+
+
+def test_format_address():
+    """
+    Should drop empty and repeated parts.
+    """
+    assert GazetteerClient.format_address('Durham', 'North Carolina', 'US') == 'Durham, North Carolina, US'
+    assert GazetteerClient.format_address('Singapore', '00', 'Singapore') == 'Singapore, 00'
+    assert GazetteerClient.format_address('Nowhere', '', '') == 'Nowhere'
+
+
+def test_latlng_to_address(gazetteer_path):
+    """
+    Should name the nearest place, including across the antimeridian.
+    """
+    (gazetteer_path.parent / 'countryInfo.txt').write_text(
+        'US\tUSA\t840\tUS\tUnited States\nWS\tWSM\t882\tWS\tSamoa\n')
+    client = GazetteerClient(path=str(gazetteer_path), max_distance=None)
+
+    assert client.latlng_to_address(latitude=36, longitude=-78.9) == 'Durham, North Carolina, United States'
+    assert client.latlng_to_address(latitude=35.8, longitude=-78.6) == 'Raleigh, North Carolina, United States'
+    assert client.latlng_to_address(latitude=-36.8, longitude=174.8) == 'Auckland, NZ'
+    assert client.latlng_to_address(latitude=-13.8, longitude=179.9) == 'Apia, 24, Samoa'
+
+
+def test_latlng_to_address_max_distance(gazetteer_path):
+    """
+    Should not name places that are too far away.
+    """
+    client = GazetteerClient(path=gazetteer_path, max_distance=50)
+
+    assert client.latlng_to_address(latitude=36.2, longitude=-78.9) == 'Durham, North Carolina, US'
+    assert client.latlng_to_address(latitude=30, longitude=-60) is None
+
+
+def test_load_once(gazetteer_path):
+    """
+    Should only read the gazetteer the first time it's needed.
+    """
+    client = GazetteerClient(path=gazetteer_path)
+    client.load()
+    tree = client.tree
+    client.load()
+
+    assert client.tree is tree
+    assert len(client.addresses) == len(CITIES)
+
+
+@pytest.mark.parametrize('content,match', [
+    (None, 'could not read'),
+    ('1\tBad\tBad\t\tnorth\twest\tP\tPPL\tUS\t\tNC\n', 'could not read'),
+    ('1\tShort\n', 'could not read'),
+    ('', 'contains no places')])
+def test_load_errors(tmp_path, content, match):
+    """
+    Should raise on missing, malformed, or empty gazetteers.
+    """
+    path = tmp_path / 'cities.txt'
+    if content is not None:
+        path.write_text(content)
+
+    with pytest.raises(GazetteerError, match=match):
+        GazetteerClient(path=path).latlng_to_address(latitude=0, longitude=0)
+
+
+def test_fallback_geocoder():
+    """
+    Should use the first geocoder that doesn't raise.
+    """
+    broken, empty, working = Mock(), Mock(), Mock()
+    broken.latlng_to_address.side_effect = RuntimeError('broken')
+    empty.latlng_to_address.return_value = None
+    working.latlng_to_address.return_value = 'Here'
+
+    assert FallbackGeocoder([broken, working]).latlng_to_address(latitude=1, longitude=2) == 'Here'
+    assert FallbackGeocoder([empty, working]).latlng_to_address(latitude=1, longitude=2) is None
+    working.latlng_to_address.assert_called_once_with(latitude=1, longitude=2)
+
+    with pytest.raises(RuntimeError):
+        FallbackGeocoder([broken, broken]).latlng_to_address(latitude=1, longitude=2)
+
+
+def test_make_geocoder():
+    """
+    Should only wrap the geocoders when there is more than one.
+    """
+    first, second = Mock(), Mock()
+
+    assert make_geocoder([first]) is first
+    assert make_geocoder([first, second]).geocoders == [first, second]
@@ -3,32 +3,60 @@ Tests for the Google Maps API client.
 """
 
 import pytest
-from unittest.mock import Mock, patch
-from windowbox.clients.gmapi import GoogleMapsAPIClient, GMAPIClientError
+import requests
+from unittest.mock import patch
+from windowbox.clients.gmapi import GoogleMapsAPIClient, GMAPIClientError, GMAPIRetryableError
+from windowbox.standins import GEOCODE_ADDRESS, GEOCODE_PATH, GeocodeStandIn
 
 
 @pytest.fixture
-def gmapi():
+def gmapi(geocode_server):
     """
-    Return a Google Maps API client.
+    Return a Google Maps API client pointed at the stand-in server.
     """
-    return GoogleMapsAPIClient(api_key='secrets4google', timeout=15)
+    return GoogleMapsAPIClient(
+        api_key='secrets4google', timeout=15, base_url=geocode_server.base_url + '/', backoff=0)
 
 
-def test_constructor(gmapi):
+def test_constructor():
     """
     Should accept and store all publicly-defined attributes.
     """
+    gmapi = GoogleMapsAPIClient(api_key='secrets4google', timeout=15)
+
     assert gmapi.api_key == 'secrets4google'
     assert gmapi.timeout == 15
+    assert gmapi.base_url == 'https://maps.googleapis.com'
+    assert gmapi.retries == 3
 
 
-def test_latlng_to_address(gmapi):
+def test_session(gmapi):
+    """
+    Should reuse one Session per process.
+    """
+    session = gmapi.session
+
+    assert gmapi.session is session
+
+    gmapi._pid = -1
+    assert gmapi.session is not session
+
+
+def test_backoff_delay():
+    """
+    Should wait a random time up to a limit that doubles each retry.
+    """
+    gmapi = GoogleMapsAPIClient(api_key='', backoff=1, max_backoff=3)
+
+    with patch('random.uniform', side_effect=lambda a, b: b):
+        assert [gmapi.backoff_delay(n) for n in (1, 2, 3)] == [1, 2, 3]
+
+
+def test_latlng_to_address(gmapi, geocode_server):
     """
     Should send latitude/longitude pairs to the API and parse the response.
     """
-    response = Mock()
-    response.json.return_value = {
+    geocode_server.responses.append((200, {
         'status': 'OK',
         'results': [
             {
@@ -52,46 +80,103 @@ def test_latlng_to_address(gmapi):
                 'geometry': {'location_type': 'APPROXIMATE'}
             }
         ]
-    }
+    }))
+
+    assert gmapi.latlng_to_address(latitude=36, longitude=-78.9) == 'Bingo, NC, USA'
+    assert gmapi.latlng_to_address(latitude=36, longitude=-78.9) == GEOCODE_ADDRESS
+
+    assert geocode_server.requests == [
+        (GEOCODE_PATH, {'key': ['secrets4google'], 'latlng': ['36,-78.9']})] * 2
+
+
+def test_latlng_to_address_keepalive(gmapi, geocode_server):
+    """
+    Should reuse the same connection for consecutive lookups.
+    """
+    for _ in range(3):
+        gmapi.latlng_to_address(latitude=36, longitude=-78.9)
 
-    with patch('requests.get', return_value=response) as mock_get:
-        address = gmapi.latlng_to_address(latitude=36, longitude=-78.9)
-        mock_get.assert_called_once_with(
-            'https://maps.googleapis.com/maps/api/geocode/json',
-            params={'key': 'secrets4google', 'latlng': '36,-78.9'},
-            timeout=15)
-        assert address == 'Bingo, NC, USA'
+    assert len(geocode_server.requests) == 3
+    assert geocode_server.connections == 1
 
 
-def test_latlng_to_address_zero_results(gmapi):
+def test_latlng_to_address_zero_results(gmapi, geocode_server):
     """
     Should gracefully handle zero-results lookups.
     """
-    response = Mock()
-    response.json.return_value = {'status': 'ZERO_RESULTS'}
+    geocode_server.responses.append((200, {'status': 'ZERO_RESULTS'}))
 
-    with patch('requests.get', return_value=response):
-        assert gmapi.latlng_to_address(latitude=36, longitude=-78.9) is None
+    assert gmapi.latlng_to_address(latitude=36, longitude=-78.9) is None
 
 
-def test_latlng_to_address_status(gmapi):
+def test_latlng_to_address_status(gmapi, geocode_server):
     """
     Should detect and raise on bad status.
     """
-    response = Mock()
-    response.json.return_value = {'status': 'WHOA_NELLY'}
+    geocode_server.responses.append((200, {'status': 'WHOA_NELLY'}))
+
+    with pytest.raises(GMAPIClientError, match='got unexpected status: WHOA_NELLY'):
+        gmapi.latlng_to_address(latitude=36, longitude=-78.9)
+
+
+def test_latlng_to_address_client_error(gmapi, geocode_server):
+    """
+    Should not retry requests that the server rejects outright.
+    """
+    geocode_server.responses.append((403, {}))
+
+    with pytest.raises(requests.HTTPError):
+        gmapi.latlng_to_address(latitude=36, longitude=-78.9)
+
+    assert len(geocode_server.requests) == 1
+
+
+def test_latlng_to_address_retry(gmapi, geocode_server):
+    """
+    Should retry server errors and rate limiting until a lookup succeeds.
+    """
+    geocode_server.responses.extend([
+        (500, {}),
+        (200, {'status': 'OVER_QUERY_LIMIT'}),
+        (503, {})])
+
+    with patch.object(gmapi, 'backoff_delay', return_value=0) as mock_delay:
+        assert gmapi.latlng_to_address(latitude=36, longitude=-78.9) == GEOCODE_ADDRESS
+
+    assert [c.args for c in mock_delay.call_args_list] == [(1,), (2,), (3,)]
+    assert len(geocode_server.requests) == 4
+
+
+def test_latlng_to_address_retry_exhausted(gmapi, geocode_server):
+    """
+    Should give up once every retry has failed.
+    """
+    gmapi.retries = 1
+    geocode_server.responses.extend([(502, {})] * 3)
+
+    with pytest.raises(GMAPIRetryableError, match='got server error: HTTP 502'):
+        gmapi.latlng_to_address(latitude=36, longitude=-78.9)
+
+    assert len(geocode_server.requests) == 2
+
+
+def test_latlng_to_address_connection_error():
+    """
+    Should retry, then give up on, connections that can't be made.
+    """
+    server = GeocodeStandIn()
+    server.httpd.server_close()
+    gmapi = GoogleMapsAPIClient(api_key='', base_url=server.base_url, retries=1, backoff=0)
 
-    with patch('requests.get', return_value=response):
-        with pytest.raises(GMAPIClientError, match='got unexpected status: WHOA_NELLY'):
-            gmapi.latlng_to_address(latitude=36, longitude=-78.9)
+    with pytest.raises(GMAPIRetryableError, match='request failed'):
+        gmapi.latlng_to_address(latitude=36, longitude=-78.9)
 
 
-def test_latlng_to_address_resolution(gmapi):
+def test_latlng_to_address_resolution(gmapi, geocode_server):
     """
     If it can't find an APPROXIMATE result, don't succeed.
     """
-    response = Mock()
-    response.json.return_value = {
+    geocode_server.responses.append((200, {
         'status': 'OK',
         'results': [
             {
@@ -107,8 +192,7 @@ def test_latlng_to_address_resolution(gmapi):
                 'geometry': {'location_type': 'GEOMETRIC_CENTER'}
             }
         ]
-    }
+    }))
 
-    with patch('requests.get', return_value=response):
-        with pytest.raises(GMAPIClientError, match='could not find an "approximate" location type'):
-            gmapi.latlng_to_address(latitude=36, longitude=-78.9)
+    with pytest.raises(GMAPIClientError, match='could not find an "approximate" location type'):
+        gmapi.latlng_to_address(latitude=36, longitude=-78.9)
@@ -2,12 +2,22 @@
 Tests for the IMAP4 fetch client.
 """
 
+import base64
+import email
+import email.policy
+import io
 import pytest
+import socket
+import threading
+from collections import deque
+from concurrent.futures import Future
 from copy import deepcopy
 from datetime import datetime, timezone
 from unittest.mock import Mock, call, patch
 from windowbox.clients.imap import (
-    IMAP_SSLClient, IMAPMessage, IMAPClientError, NoMessages)
+    ExpungeBatch, IMAP_SSLClient, IMAPMessage, IMAPClientError, NoMessages, idle, read_uid_validity,
+    write_part)
+from windowbox.metrics import RunMetrics
 
 HEADERS = [
     (
@@ -154,6 +164,10 @@ def test_imapclient_constructor(imap_client):
     assert imap_client.port == 993
     assert imap_client.user == 'windowbox@example.org'
     assert imap_client.password == 'hunter2'
+    assert imap_client.expunge_every == 50
+    assert imap_client.batch_size == 20
+    assert imap_client.batch_bytes == 32 * 1024 * 1024
+    assert imap_client.prefetch == 1
 
     # Once more, with explicit port override
     imap_client = IMAP_SSLClient(
@@ -183,22 +197,74 @@ def test_imapclient_date_uid_map(imap_client):
         [*imap_client.date_uid_map(HEADERS_JUNK)]
 
 
-def test_imapclient_yield_messages(imap_client):
+def test_imapclient_message_date(imap_client):
     """
-    Verify happy path of IMAP mailbox scraping.
+    Should prefer the Date header, and fall back to INTERNALDATE.
     """
-    mock_ic = Mock()
+    folded = (b'1 (UID 1 BODY[HEADER.FIELDS (DATE)] {50}', b'DATE: Sat, 28 Sep 2019\r\n 17:42:39 -0400\r\n\r\n')
+    naive = (b'1 (UID 1 BODY[HEADER.FIELDS (DATE)] {40}', b'Date: Sat, 28 Sep 2019 21:42:39 -0000\r\n\r\n')
+    internal = (
+        b'1 (UID 1 INTERNALDATE " 1-Oct-2019 12:00:00 +0000" BODY[HEADER.FIELDS (DATE)] {20}',
+        b'Date: whenever\r\n\r\n')
+
+    assert imap_client.message_date(folded) == datetime(2019, 9, 28, 21, 42, 39, tzinfo=timezone.utc)
+    assert imap_client.message_date(naive) == datetime(2019, 9, 28, 21, 42, 39, tzinfo=timezone.utc)
+    assert imap_client.message_date(internal) == datetime(2019, 10, 1, 12, 0, 0, tzinfo=timezone.utc)
+    assert imap_client.message_date((b'1 (UID 1 BODY[HEADER.FIELDS (DATE)] {2}', b'\r\n')) is None
+
+
+def test_imapclient_message_set(imap_client):
+    """
+    Should collapse consecutive UIDs into ranges.
+    """
+    assert imap_client.message_set([3, 1, 2]) == '1:3'
+    assert imap_client.message_set([12, 7, 1, 10, 9, 11, 2, 3, 7]) == '1:3,7,9:12'
+    assert imap_client.message_set([5]) == '5'
+
+
+def fake_uid(responses):
+    """
+    Return a side effect for a mock ic.uid() that answers by command/UID set.
+
+    Any STORE or EXPUNGE command is answered with success.
+    """
+    def uid(command, message_set, *args):
+        if command in ('STORE', 'EXPUNGE'):
+            return ('OK', [b''])
+        return responses[(command, message_set)]
+
+    return uid
+
+
+def fake_ic(*capabilities):
+    """
+    Return a mock IMAP4 connection that logs in and selects successfully.
+
+    The connection only reports `capabilities` once CAPABILITY is re-sent
+    after login, the way Gmail behaves.
+    """
+    mock_ic = Mock(capabilities=('IMAP4REV1',))
     mock_ic.login.return_value = ('OK', [b'test@example.com authenticated (Success)'])
+    mock_ic.capability.return_value = ('OK', [b' '.join([b'IMAP4rev1', *capabilities])])
     mock_ic.select.return_value = ('OK', [b'3'])
-    mock_ic.uid.side_effect = [
-        # Return value for ic.uid('SEARCH', 'ALL')
-        ('OK', [b'1 2 3']),
-        # ...for uid('FETCH', uids '(BODY.PEEK[HEADER])')
-        ('OK', HEADERS),
-        # ...for three iterations of ic.uid('FETCH', uid '(RFC822)')
-        ('OK', FULL_MESSAGES[0:2]),
-        ('OK', FULL_MESSAGES[2:4]),
-        ('OK', FULL_MESSAGES[4:6])]
+    mock_ic.response.return_value = ('UIDVALIDITY', [b'1234'])
+
+    return mock_ic
+
+
+def test_imapclient_yield_messages(imap_client):
+    """
+    Verify happy path of IMAP mailbox scraping.
+    """
+    imap_client.batch_size = 2
+
+    mock_ic = fake_ic()
+    mock_ic.uid.side_effect = fake_uid({
+        ('SEARCH', 'ALL'): ('OK', [b'1 2 3']),
+        ('FETCH', '1:3'): ('OK', HEADERS),
+        # Servers answer in UID order, regardless of the order requested
+        ('FETCH', b'3,1'): ('OK', FULL_MESSAGES[0:2] + FULL_MESSAGES[4:6]),
+        ('FETCH', b'2'): ('OK', FULL_MESSAGES[2:4])})
 
     with patch('imaplib.IMAP4_SSL') as mock_imap:
         mock_imap.return_value.__enter__.return_value = mock_ic
@@ -215,18 +281,432 @@ def test_imapclient_yield_messages(imap_client):
     mock_ic.select.assert_called_with(mailbox='foobar')
     mock_ic.uid.assert_has_calls([
         call('SEARCH', 'ALL'),
-        call('FETCH', '1:3', '(BODY.PEEK[HEADER])'),
-        call('FETCH', b'3', '(RFC822)'),
-        call('FETCH', b'1', '(RFC822)'),
+        call('FETCH', '1:3', '(RFC822.SIZE INTERNALDATE BODY.PEEK[HEADER.FIELDS (DATE)])'),
+        call('FETCH', b'3,1', '(RFC822)'),
         call('FETCH', b'2', '(RFC822)')])
 
 
+def test_imapclient_yield_messages_metrics(imap_client):
+    """
+    Should time each IMAP command and message parse, and count message bytes.
+    """
+    imap_client.batch_size = 2
+
+    mock_ic = fake_ic()
+    mock_ic.uid.side_effect = fake_uid({
+        ('SEARCH', 'ALL'): ('OK', [b'1 2 3']),
+        ('FETCH', '1:3'): ('OK', HEADERS),
+        ('FETCH', b'3,1'): ('OK', FULL_MESSAGES[0:2] + FULL_MESSAGES[4:6]),
+        ('FETCH', b'2'): ('OK', FULL_MESSAGES[2:4])})
+    mock_ic.expunge.return_value = ('OK', [b''])
+    metrics = RunMetrics()
+
+    with patch('imaplib.IMAP4_SSL') as mock_imap:
+        mock_imap.return_value.__enter__.return_value = mock_ic
+
+        for message in imap_client.yield_messages(metrics=metrics):
+            message.delete()
+
+    report = metrics.report()
+    assert {stage: s['calls'] for stage, s in report['stages'].items()} == {
+        'imap_body': 2, 'imap_connect': 1, 'imap_delete': 3, 'imap_expunge': 1, 'imap_headers': 1,
+        'imap_login': 1, 'imap_search': 1, 'imap_select': 1, 'mime_parse': 3}
+    assert report['counters'] == {'body_bytes': sum(len(m[1]) for m in FULL_MESSAGES if isinstance(m, tuple))}
+
+
+def test_imapclient_yield_messages_sort(imap_client):
+    """
+    Should let the server sort by date when it can, and only fetch sizes.
+    """
+    mock_ic = fake_ic(b'SORT')
+    mock_ic.uid.side_effect = fake_uid({
+        ('SORT', '(DATE)'): ('OK', [b'2 3 1']),
+        ('FETCH', '1:3'): ('OK', [b'1 (UID 1 RFC822.SIZE 10)', b'2 (UID 2 RFC822.SIZE 20)', b'3 (UID 3)']),
+        ('FETCH', b'2,3,1'): ('OK', FULL_MESSAGES)})
+
+    with patch('imaplib.IMAP4_SSL') as mock_imap:
+        mock_imap.return_value.__enter__.return_value = mock_ic
+
+        assert [m.uid for m in imap_client.yield_messages()] == [b'2', b'3', b'1']
+
+    mock_ic.uid.assert_has_calls([
+        call('SORT', '(DATE)', 'UTF-8', 'ALL'),
+        call('FETCH', '1:3', '(RFC822.SIZE)'),
+        call('FETCH', b'2,3,1', '(RFC822)')])
+
+    mock_ic.uid.side_effect = [('BAD', [b'Bad sort'])]
+    with patch('imaplib.IMAP4_SSL') as mock_imap:
+        mock_imap.return_value.__enter__.return_value = mock_ic
+
+        with pytest.raises(IMAPClientError, match='failed to execute SORT'):
+            [*imap_client.yield_messages()]
+
+
+def test_imapclient_yield_messages_missing(imap_client):
+    """
+    Should skip messages that disappeared between the header and full fetches.
+    """
+    mock_ic = fake_ic()
+    mock_ic.uid.side_effect = fake_uid({
+        ('SEARCH', 'ALL'): ('OK', [b'1 2 3']),
+        ('FETCH', '1:3'): ('OK', HEADERS),
+        ('FETCH', b'3,1,2'): ('OK', FULL_MESSAGES[0:2] + [(b'junk', b'')] + FULL_MESSAGES[4:6]),
+        ('FETCH', b'2'): ('OK', [None])})
+
+    with patch('imaplib.IMAP4_SSL') as mock_imap:
+        mock_imap.return_value.__enter__.return_value = mock_ic
+
+        assert [m.uid for m in imap_client.yield_messages()] == [b'3', b'1']
+
+    mock_ic.uid.assert_any_call('FETCH', b'2', '(RFC822)')
+
+
+def test_imapclient_message_data_by_uid(imap_client):
+    """
+    Should find the UID whether it comes before or after the message literal.
+    """
+    data = [
+        FULL_MESSAGES[0],
+        b')',
+        (b'2 (RFC822 {100}', b'Content for message UID 2'),
+        b' UID 2)',
+        (b'3 (RFC822 {100}', b'No UID anywhere'),
+        b')']
+
+    assert imap_client.message_data_by_uid(data) == {
+        b'1': [FULL_MESSAGES[0]],
+        b'2': [(b'2 (RFC822 {100}', b'Content for message UID 2')]}
+
+
+def test_imapclient_fetch_batch_refetch(imap_client):
+    """
+    Should fetch a UID alone if the batch response didn't account for it.
+    """
+    mock_ic = Mock()
+    mock_ic.uid.side_effect = fake_uid({
+        ('FETCH', b'1,2'): ('OK', FULL_MESSAGES[0:2] + [(b'2 (RFC822 {100}', b'?'), b')']),
+        ('FETCH', b'2'): ('OK', FULL_MESSAGES[2:4])})
+
+    assert imap_client.fetch_batch(mock_ic, [b'1', b'2']) == [
+        (b'1', [FULL_MESSAGES[0]]), (b'2', [FULL_MESSAGES[2]])]
+
+    mock_ic.uid.side_effect = [('OK', FULL_MESSAGES[0:2]), ('BAD', [b'Bad fetch'])]
+
+    with pytest.raises(IMAPClientError, match=r'failed to execute FETCH UIDs 2 \(full\)'):
+        imap_client.fetch_batch(mock_ic, [b'1', b'2'])
+
+
+class ImmediateExecutor:
+    """
+    Stand-in for ThreadPoolExecutor that runs each task as it is submitted.
+    """
+
+    def __init__(self, **kwargs):
+        pass
+
+    def submit(self, fn, *args):
+        future = Future()
+        future.set_result(fn(*args))
+        return future
+
+    def shutdown(self, wait):
+        pass
+
+
+@pytest.mark.parametrize('prefetch,fetched_ahead', [(0, 1), (1, 2), (2, 3)])
+def test_imapclient_yield_messages_prefetch(imap_client, prefetch, fetched_ahead):
+    """
+    Should hold no more than `prefetch` batches beyond the one in use.
+    """
+    imap_client.batch_size = 1
+    imap_client.prefetch = prefetch
+
+    mock_ic = fake_ic()
+    mock_ic.uid.side_effect = fake_uid({
+        ('SEARCH', 'ALL'): ('OK', [b'1 2 3']),
+        ('FETCH', '1:3'): ('OK', HEADERS),
+        ('FETCH', b'3'): ('OK', FULL_MESSAGES[4:6]),
+        ('FETCH', b'1'): ('OK', FULL_MESSAGES[0:2]),
+        ('FETCH', b'2'): ('OK', FULL_MESSAGES[2:4])})
+
+    def full_fetches():
+        return sum(1 for c in mock_ic.uid.call_args_list if c.args[-1] == '(RFC822)')
+
+    with patch('imaplib.IMAP4_SSL') as mock_imap, \
+            patch('windowbox.clients.imap.ThreadPoolExecutor', ImmediateExecutor):
+        mock_imap.return_value.__enter__.return_value = mock_ic
+
+        messages = imap_client.yield_messages()
+        next(messages)
+        assert full_fetches() == fetched_ahead
+
+        assert len([*messages]) == 2
+        assert full_fetches() == 3
+
+
+def test_imapclient_yield_messages_stop(imap_client):
+    """
+    Should stop fetching and clean up if the caller stops iterating early.
+    """
+    imap_client.batch_size = 1
+    imap_client.prefetch = 2
+
+    mock_ic = fake_ic(b'UIDPLUS')
+    mock_ic.uid.side_effect = fake_uid({
+        ('SEARCH', 'ALL'): ('OK', [b'1 2 3']),
+        ('FETCH', '1:3'): ('OK', HEADERS),
+        ('FETCH', b'3'): ('OK', FULL_MESSAGES[4:6]),
+        ('FETCH', b'1'): ('OK', FULL_MESSAGES[0:2]),
+        ('FETCH', b'2'): ('OK', FULL_MESSAGES[2:4])})
+
+    with patch('imaplib.IMAP4_SSL') as mock_imap:
+        mock_imap.return_value.__enter__.return_value = mock_ic
+
+        messages = imap_client.yield_messages()
+        first = next(messages)
+        first.delete()
+        messages.close()
+
+    assert first.uid == b'3'
+    mock_ic.uid.assert_any_call('EXPUNGE', b'3')
+
+
+def test_imapclient_yield_messages_delete(imap_client):
+    """
+    Should expunge deleted messages in batches, and once more at the end.
+    """
+    imap_client.expunge_every = 2
+    imap_client.batch_size = 1
+
+    mock_ic = fake_ic(b'UIDPLUS')
+    mock_ic.uid.side_effect = fake_uid({
+        ('SEARCH', 'ALL'): ('OK', [b'1 2 3']),
+        ('FETCH', '1:3'): ('OK', HEADERS),
+        ('FETCH', b'3'): ('OK', FULL_MESSAGES[4:6]),
+        ('FETCH', b'1'): ('OK', FULL_MESSAGES[0:2]),
+        ('FETCH', b'2'): ('OK', FULL_MESSAGES[2:4])})
+
+    with patch('imaplib.IMAP4_SSL') as mock_imap:
+        mock_imap.return_value.__enter__.return_value = mock_ic
+
+        for message in imap_client.yield_messages():
+            message.delete()
+
+    # UIDPLUS was only advertised after login
+    mock_ic.capability.assert_called_once_with()
+    mock_ic.expunge.assert_not_called()
+    expunges = [c for c in mock_ic.uid.call_args_list if c.args[0] == 'EXPUNGE']
+    assert expunges == [call('EXPUNGE', b'3,1'), call('EXPUNGE', b'2')]
+    for uid in (b'1', b'2', b'3'):
+        mock_ic.uid.assert_any_call('STORE', uid, '+FLAGS', '\\Deleted')
+
+
+def test_imapclient_yield_messages_min_uid(imap_client):
+    """
+    Should only search for and return messages from `min_uid` up.
+    """
+    mock_ic = Mock(capabilities=())
+    mock_ic.uid.side_effect = fake_uid({
+        # "2:*" matches the highest UID even when it's lower, so 1 sneaks in
+        ('SEARCH', 'UID 2:*'): ('OK', [b'1'])})
+
+    with patch('imaplib.IMAP4_SSL') as mock_imap:
+        with pytest.raises(NoMessages):
+            [*imap_client.yield_messages(connection=mock_ic, min_uid=2)]
+
+    mock_imap.assert_not_called()
+
+
+def test_imapclient_yield_messages_retry_uids(imap_client):
+    """
+    Should also search for, and return, lower UIDs that are due for a retry.
+    """
+    mock_ic = fake_ic()
+    mock_ic.uid.side_effect = fake_uid({
+        ('SEARCH', 'UID 1,3:*'): ('OK', [b'1 3']),
+        ('FETCH', '1,3'): ('OK', HEADERS[0:2] + HEADERS[4:6]),
+        ('FETCH', b'3,1'): ('OK', FULL_MESSAGES[4:6] + FULL_MESSAGES[0:2])})
+
+    messages = imap_client.yield_messages(connection=mock_ic, min_uid=3, retry_uids=[1])
+
+    assert [m.uid for m in messages] == [b'3', b'1']
+
+
+class FakeIdleConnection:
+    """
+    Just enough of an imaplib connection to exercise idle().
+    """
+
+    def __init__(self, lines):
+        self.lines = deque(lines)
+        self.sent = []
+        self.raw_sock, self.peer = socket.socketpair()
+        self.sock = Mock(fileno=self.raw_sock.fileno, pending=Mock(return_value=0))
+
+    def _new_tag(self):
+        return b'TAG1'
+
+    def send(self, data):
+        self.sent.append(data)
+
+    def _get_line(self):
+        return self.lines.popleft()
+
+
+def test_idle_new_mail():
+    """
+    Should wake up and report new mail when the server sends EXISTS.
+    """
+    ic = FakeIdleConnection([b'+ idling', b'* 4 EXISTS', b'TAG1 OK IDLE terminated'])
+    ic.peer.send(b'x')
+
+    assert idle(ic, timeout=5) is True
+    assert ic.sent == [b'TAG1 IDLE\r\n', b'DONE\r\n']
+
+
+def test_idle_timeout():
+    """
+    Should give up quietly at the timeout, or sooner if asked to stop.
+    """
+    ic = FakeIdleConnection([b'+ idling', b'* 1 RECENT', b'TAG1 OK IDLE terminated'])
+    assert idle(ic, timeout=0.01) is False
+    assert ic.sent == [b'TAG1 IDLE\r\n', b'DONE\r\n']
+
+    stop = threading.Event()
+    stop.set()
+    ic = FakeIdleConnection([b'+ idling', b'* 5 EXISTS', b'TAG1 OK IDLE terminated'])
+    assert idle(ic, timeout=60, stop=stop) is True
+
+
+def test_idle_errors():
+    """
+    Should raise if the server refuses or fails the IDLE command.
+    """
+    with pytest.raises(IMAPClientError, match='server refused IDLE'):
+        idle(FakeIdleConnection([b'TAG1 BAD unknown command']), timeout=0.01)
+
+    with pytest.raises(IMAPClientError, match='IDLE failed'):
+        idle(FakeIdleConnection([b'+ idling', b'TAG1 NO too tired']), timeout=0.01)
+
+
+def test_imapclient_connect(imap_client):
+    """
+    Should see capabilities (like IDLE) that are only advertised after login.
+    """
+    mock_ic = fake_ic(b'IDLE')
+    metrics = RunMetrics()
+
+    with patch('imaplib.IMAP4_SSL') as mock_imap:
+        mock_imap.return_value.__enter__.return_value = mock_ic
+
+        with imap_client.connect(mailbox='foobar', metrics=metrics) as ic:
+            assert 'IDLE' in ic.capabilities
+            assert ic.mailbox == 'windowbox@example.org@example.org/foobar'
+            assert ic.uid_validity == 1234
+
+    mock_ic.select.assert_called_once_with(mailbox='foobar')
+    mock_ic.response.assert_called_once_with('UIDVALIDITY')
+    assert set(metrics.report()['stages']) == {'imap_connect', 'imap_login', 'imap_select'}
+
+
+@pytest.mark.parametrize('response,expected', [([b'42'], 42), ([None], None), ([b'junk'], None)])
+def test_read_uid_validity(response, expected):
+    """
+    Should parse UIDVALIDITY, or give up on it if it's missing or mangled.
+    """
+    mock_ic = Mock()
+    mock_ic.response.return_value = ('UIDVALIDITY', response)
+
+    assert read_uid_validity(mock_ic) == expected
+
+
+def test_imapclient_wait_for_mail(imap_client):
+    """
+    Should IDLE if the server supports it, and poll with NOOP otherwise.
+    """
+    mock_ic = Mock(capabilities=('IMAP4REV1', 'IDLE'), lock=threading.Lock())
+    stop = threading.Event()
+
+    with patch('windowbox.clients.imap.idle') as mock_idle:
+        imap_client.wait_for_mail(mock_ic, timeout=30, stop=stop)
+    mock_idle.assert_called_once_with(mock_ic.connection, timeout=30, stop=stop)
+
+    mock_ic.capabilities = ('IMAP4REV1',)
+    mock_ic.noop.return_value = ('OK', [b''])
+    with patch('time.sleep') as mock_sleep:
+        imap_client.wait_for_mail(mock_ic, timeout=30, poll_interval=7)
+    mock_sleep.assert_called_once_with(7)
+    mock_ic.noop.assert_called_once_with()
+
+    stop.wait = Mock()
+    mock_ic.noop.return_value = ('BAD', [b''])
+    with pytest.raises(IMAPClientError, match='failed to execute NOOP'):
+        imap_client.wait_for_mail(mock_ic, timeout=30, poll_interval=7, stop=stop)
+    stop.wait.assert_called_once_with(7)
+
+
+def test_imapclient_uid_size_map(imap_client):
+    """
+    Should extract message sizes, treating missing ones as zero.
+    """
+    data = [
+        (b'1 (UID 1 RFC822.SIZE 1234 BODY[HEADER] {100}', b''),
+        b')',
+        (b'2 (UID 2 BODY[HEADER] {100}', b''),
+        b')',
+        b'3 (UID 3 RFC822.SIZE 99)',
+        b' UID 4)',
+        None,
+        b')',
+        (b'no uid here', b''),
+        b')']
+
+    assert [*imap_client.uid_size_map(data)] == [(b'1', 1234), (b'2', 0), (b'3', 99)]
+
+
+def test_imapclient_plan_batches(imap_client):
+    """
+    Should split UIDs by count and by size without changing their order.
+    """
+    uids = [b'5', b'1', b'4', b'2', b'3']
+    sizes = {b'5': 10, b'1': 10, b'4': 100, b'2': 10}
+
+    assert imap_client.plan_batches(uids=uids, sizes=sizes, batch_size=2, batch_bytes=1000) == [
+        [b'5', b'1'], [b'4', b'2'], [b'3']]
+    assert imap_client.plan_batches(uids=uids, sizes=sizes, batch_size=10, batch_bytes=50) == [
+        [b'5', b'1'], [b'4'], [b'2', b'3']]
+    assert imap_client.plan_batches(uids=[], sizes={}, batch_size=10, batch_bytes=50) == []
+
+
+def test_expunge_batch():
+    """
+    Should fall back to a plain EXPUNGE on servers without UIDPLUS.
+    """
+    mock_ic = Mock(capabilities=('IMAP4REV1',))
+    mock_ic.expunge.return_value = ('OK', [b''])
+    batch = ExpungeBatch(imap_connection=mock_ic, size=10)
+
+    batch.expunge()
+    mock_ic.expunge.assert_not_called()
+
+    batch.add(b'7')
+    batch.add(b'8')
+    batch.expunge()
+    mock_ic.expunge.assert_called_once_with()
+    mock_ic.uid.assert_not_called()
+    assert batch.pending == []
+
+    mock_ic.expunge.return_value = ('BAD', [b''])
+    batch.add(b'9')
+    with pytest.raises(IMAPClientError, match='failed to EXPUNGE'):
+        batch.expunge()
+
+
 def test_imapclient_yield_messages_empty(imap_client):
     """
     Should raise relatively early if there are no messages in the mailbox.
     """
-    mock_ic = Mock()
-    mock_ic.login.return_value = ('OK', [b'test@example.com authenticated (Success)'])
+    mock_ic = fake_ic()
     mock_ic.select.return_value = ('OK', [b'0'])
     mock_ic.uid.return_value = ('OK', [b''])
 
@@ -241,9 +721,7 @@ def test_imapclient_yield_messages_errors(imap_client):
     """
     Should raise if errors are encountered at any point in the IMAP session.
     """
-    mock_ic = Mock()
-    mock_ic.login.return_value = ('OK', [b'test@example.com authenticated (Success)'])
-    mock_ic.select.return_value = ('OK', [b'3'])
+    mock_ic = fake_ic()
     mock_ic.uid.side_effect = [
         # Return value for ic.uid('SEARCH', 'ALL')
         ('OK', [b'1 2 3']),
@@ -255,7 +733,7 @@ def test_imapclient_yield_messages_errors(imap_client):
     with patch('imaplib.IMAP4_SSL') as mock_imap:
         mock_imap.return_value.__enter__.return_value = mock_ic
 
-        with pytest.raises(IMAPClientError, match=r'failed to execute FETCH UID 3 \(full\)'):
+        with pytest.raises(IMAPClientError, match=r'failed to execute FETCH UIDs 3,1,2 \(full\)'):
             [*imap_client.yield_messages()]
 
         mock_ic.uid.side_effect = [
@@ -277,6 +755,11 @@ def test_imapclient_yield_messages_errors(imap_client):
         with pytest.raises(IMAPClientError, match='failed to SELECT mailbox INBOX'):
             [*imap_client.yield_messages()]
 
+        mock_ic.capability.return_value = ('BAD', [b'Bad capability'])
+
+        with pytest.raises(IMAPClientError, match='failed to execute CAPABILITY'):
+            [*imap_client.yield_messages()]
+
         mock_ic.login.return_value = ('BAD', [b'Bad login'])
 
         with pytest.raises(IMAPClientError, match='failed to LOGIN as windowbox@example.org'):
@@ -357,3 +840,69 @@ def test_imapmessage_yield_parts(imap_message):
     assert len([*imap_message.yield_parts('text/html')]) == 1
     assert len([*imap_message.yield_parts('image/jpeg')]) == 2
     assert len([*imap_message.yield_parts('application/pdf')]) == 2
+
+
+def test_imapmessage_lazy_decoding(imap_message):
+    """
+    Should not decode any part until its type is asked for.
+    """
+    with patch('windowbox.clients.imap.part_content') as mock_content:
+        mock_content.return_value = 'text'
+        imap_message.text_plain
+
+    assert mock_content.call_count == 2
+
+
+@pytest.mark.parametrize('chunk_chars', [4, 7, 256 * 1024])
+def test_write_part_base64(chunk_chars):
+    """
+    Should decode base64 in slices with the same result as decoding it whole.
+    """
+    data = bytes(range(256)) * 40
+    msg = email.message_from_bytes(
+        b'Content-Type: image/jpeg\r\nContent-Transfer-Encoding: base64\r\n\r\n'
+        + base64.encodebytes(data).replace(b'\n', b'\r\n'),
+        policy=email.policy.SMTP)
+
+    fp = io.BytesIO()
+    with patch('windowbox.clients.imap.BASE64_CHUNK_CHARS', chunk_chars):
+        write_part(msg, fp)
+
+    assert fp.getvalue() == data == msg.get_content()
+
+
+def test_write_part_other():
+    """
+    Should decode other encodings in one go, and tolerate missing padding.
+    """
+    msg = email.message_from_bytes(
+        b'Content-Type: image/png\r\nContent-Transfer-Encoding: base64\r\n\r\nAAEC\r\nAw\r\n',
+        policy=email.policy.SMTP)
+    fp = io.BytesIO()
+    write_part(msg, fp)
+    assert fp.getvalue() == b'\x00\x01\x02\x03'
+
+    msg = email.message_from_bytes(
+        b'Content-Type: image/png\r\nContent-Transfer-Encoding: quoted-printable\r\n\r\na=3Db',
+        policy=email.policy.SMTP)
+    fp = io.BytesIO()
+    write_part(msg, fp)
+    assert fp.getvalue() == b'a=b'
+
+
+def test_imapmessage_write_parts(imap_message, tmp_path):
+    """
+    Should write each part of a type to its own file, and clean up on errors.
+    """
+    paths = [*imap_message.write_parts('image/jpeg', directory=tmp_path)]
+
+    assert len(paths) == 2
+    assert all(p.parent == tmp_path and p.name.startswith('.incoming-') for p in paths)
+    assert paths[0].read_bytes() == next(imap_message.yield_parts('image/jpeg'))
+    assert [*imap_message.write_parts('image/gif', directory=tmp_path)] == []
+
+    with patch('windowbox.clients.imap.write_part', side_effect=ValueError('bad data')):
+        with pytest.raises(ValueError):
+            [*imap_message.write_parts('application/pdf', directory=tmp_path)]
+
+    assert sorted(tmp_path.iterdir()) == sorted(paths)
@@ -0,0 +1,133 @@
+"""
+Tests for the S3-compatible object store client.
+"""
+
+import os
+import pytest
+import requests
+from unittest.mock import patch
+from windowbox.clients.s3 import S3Client, S3ClientError, S3NotFoundError, canonical_query, xml_text
+
+
+def test_canonical_query():
+    """
+    Should sort and encode the parameters, keeping empty values.
+    """
+    assert canonical_query({'uploadId': 'a b', 'partNumber': '2'}) == 'partNumber=2&uploadId=a%20b'
+    assert canonical_query({'uploads': ''}) == 'uploads='
+    assert canonical_query({}) == ''
+
+
+def test_xml_text():
+    """
+    Should find elements with or without a namespace.
+    """
+    assert xml_text(b'<Error><Code>NoSuchKey</Code></Error>', 'Code') == 'NoSuchKey'
+    assert xml_text(b'<A xmlns="urn:x"><B><UploadId>u1</UploadId></B></A>', 'UploadId') == 'u1'
+    assert xml_text(b'<A/>', 'Code') is None
+
+
+def test_session_per_process(s3_client):
+    """
+    Should reuse one Session, but not across a fork.
+    """
+    session = s3_client.session
+    assert s3_client.session is session
+
+    with patch('os.getpid', return_value=os.getpid() + 1):
+        assert s3_client.session is not session
+
+
+def test_put_get_head_delete(object_store, s3_client):
+    """
+    Should store, read, inspect and delete objects with signed requests.
+    """
+    s3_client.put_object('a/b c.jpg', b'SNAUSAGES')
+
+    assert (object_store.directory / 'bucket' / 'a' / 'b c.jpg').read_bytes() == b'SNAUSAGES'
+    assert s3_client.head_object('a/b c.jpg')['Content-Length'] == '9'
+
+    response = s3_client.get_object('a/b c.jpg')
+    with response.raw as stream:
+        assert stream.read() == b'SNAUSAGES'
+
+    s3_client.delete_object('a/b c.jpg')
+    s3_client.delete_object('a/b c.jpg')
+
+    assert s3_client.head_object('a/b c.jpg') is None
+    with pytest.raises(S3NotFoundError):
+        s3_client.get_object('a/b c.jpg')
+
+
+def test_request_errors(object_store, s3_client):
+    """
+    Should raise on rejected requests and unreachable servers.
+    """
+    s3_client.secret_key = 'wrong'
+    with pytest.raises(S3ClientError, match='HTTP 403 SignatureDoesNotMatch'):
+        s3_client.put_object('key', b'')
+
+    object_store.secret_key = None
+    with pytest.raises(S3ClientError, match='HTTP 400 InvalidRequest'):
+        s3_client.put_object('../key', b'')
+
+    with patch('requests.Session.request', side_effect=requests.ConnectionError('refused')):
+        with pytest.raises(S3ClientError, match='refused'):
+            s3_client.head_object('key')
+
+
+def test_upload_file(tmp_path, object_store, s3_client):
+    """
+    Should upload small files in one piece, and large ones in parts.
+    """
+    small, large = tmp_path / 'small', tmp_path / 'large'
+    small.write_bytes(b'0123456789')
+    large.write_bytes(b'0123456789' * 3 + b'!')
+
+    s3_client.upload_file('small', small)
+    s3_client.upload_file('large', large)
+
+    stored = object_store.directory / 'bucket'
+    assert (stored / 'small').read_bytes() == small.read_bytes()
+    assert (stored / 'large').read_bytes() == large.read_bytes()
+    assert [method for method, path, _ in object_store.requests if path.endswith('/large')] == [
+        'POST', 'PUT', 'PUT', 'PUT', 'PUT', 'POST']
+    assert not any((object_store.directory / '.uploads').iterdir())
+
+
+def test_upload_multipart_aborts(tmp_path, object_store, s3_client):
+    """
+    Should abort the upload if a part or the completion fails.
+    """
+    path = tmp_path / 'large'
+    path.write_bytes(b'x' * 25)
+
+    real_request = S3Client.request
+
+    def bad_etag(self, method, key, **kwargs):
+        response = real_request(self, method, key, **kwargs)
+        if 'partNumber' in kwargs.get('query', {}):
+            response.headers['ETag'] = '"nope"'
+        return response
+
+    with patch.object(S3Client, 'request', bad_etag):
+        with pytest.raises(S3ClientError, match='InvalidPart'):
+            s3_client.upload_multipart('large', path)
+
+    assert object_store.requests[-1][0] == 'DELETE'
+    assert not any((object_store.directory / '.uploads').iterdir())
+    assert not (object_store.directory / 'bucket' / 'large').exists()
+
+    def fail_abort(self, method, key, **kwargs):
+        if method == 'DELETE':
+            raise S3ClientError('abort failed')
+        if 'partNumber' in kwargs.get('query', {}):
+            raise S3ClientError('part failed')
+        return real_request(self, method, key, **kwargs)
+
+    with patch.object(S3Client, 'request', fail_abort):
+        with pytest.raises(S3ClientError, match='part failed'):
+            s3_client.upload_multipart('large', path)
+
+    with pytest.raises(S3NotFoundError):
+        s3_client.request('DELETE', 'large', query={'uploadId': 'missing'})
@@ -2,27 +2,247 @@
 Tests for the console scripts.
 """
 
+import hashlib
+import json
+import mailbox
 import pytest
-from unittest.mock import Mock, patch
+import signal
+import threading
+from collections import deque
+from email.message import EmailMessage
+from unittest.mock import ANY, MagicMock, Mock, call, patch
 from windowbox import app
-from windowbox.fetch import main as main_fetch, run_fetch
+from windowbox.fetch import main as main_fetch, run_checkpointed_fetch, run_daemon, run_fetch
+from windowbox.importer import main as main_import, read_checkpoint, run_import
 from windowbox.clients.gmapi import GMAPIClientError
-from windowbox.clients.imap import NoMessages
+from windowbox.clients.imap import IMAPClientError, NoMessages
+from windowbox.clients.s3 import S3ClientError
 from windowbox.controllers.post import PostController
+from windowbox.metrics import RunMetrics
+from windowbox.models.attachment import Attachment
+from windowbox.models.checkpoint import FetchCheckpoint
+from windowbox.models.post import Post
+from windowbox.storage import ObjectStoreBackend
+
+
+def fake_files(parts):
+    """
+    Return a side effect for message_to_files() that writes `parts` to files.
+    """
+    def message_to_files(message, *, directory):
+        directory.mkdir(parents=True, exist_ok=True)
+        for n, (mime_type, data) in enumerate(parts):
+            path = directory / f'.incoming-{id(message)}-{n}'
+            path.write_bytes(data)
+            yield mime_type, path
+
+    return message_to_files
 
 
 def test_main_fetch():
     """
     Verify the main function for the fetch script dispatches as expected.
     """
-    with patch('windowbox.fetch.run_fetch') as mock_run_fetch:
-        assert main_fetch() == 0
+    with patch('windowbox.fetch.run_checkpointed_fetch') as mock_run_fetch, \
+            patch('windowbox.fetch.sweep_temp_files') as mock_sweep:
+        assert main_fetch([]) == 0
+
+    min_age = app.config['STORAGE_SWEEP_MIN_AGE']
+    assert mock_sweep.call_args_list == [
+        call(app.attachments_path, min_age=min_age), call(app.derivatives_path, min_age=min_age)]
 
     mock_run_fetch.assert_called_with(
         attachments_path=app.attachments_path,
+        content_addressed=app.config['STORAGE_CONTENT_ADDRESSED'],
         exiftool_client=app.exiftool_client,
         gmapi_client=app.gmapi_client,
-        imap_client=app.imap_client)
+        imap_client=app.imap_client,
+        ingest_workers=app.config['INGEST_WORKERS'],
+        max_attempts=app.config['IMAP_FETCH_MAX_ATTEMPTS'],
+        metrics_textfile=app.config['INGEST_METRICS_TEXTFILE'])
+
+
+def test_main_fetch_daemon():
+    """
+    Should run the daemon until SIGTERM sets its stop event.
+    """
+    with patch('windowbox.fetch.run_daemon') as mock_run_daemon:
+        with patch('signal.signal') as mock_signal:
+            assert main_fetch(['--daemon']) == 0
+
+    kwargs = mock_run_daemon.call_args.kwargs
+    assert kwargs['imap_client'] is app.imap_client
+    assert kwargs['idle_timeout'] == app.config['IMAP_IDLE_TIMEOUT']
+    assert kwargs['poll_interval'] == app.config['IMAP_POLL_INTERVAL']
+    assert kwargs['max_backoff'] == app.config['IMAP_RECONNECT_MAX_BACKOFF']
+    assert kwargs['ingest_workers'] == app.config['INGEST_WORKERS']
+    assert kwargs['max_attempts'] == app.config['IMAP_FETCH_MAX_ATTEMPTS']
+    assert kwargs['metrics_textfile'] == app.config['INGEST_METRICS_TEXTFILE']
+    assert kwargs['content_addressed'] == app.config['STORAGE_CONTENT_ADDRESSED']
+
+    signum, handler = mock_signal.call_args.args
+    assert signum == signal.SIGTERM
+    assert not kwargs['stop'].is_set()
+    handler(signum, None)
+    assert kwargs['stop'].is_set()
+
+
+def test_run_daemon(db):
+    """
+    Should reconnect after failures, and only search for newer UIDs after that.
+    """
+    stop = threading.Event()
+    stop.wait = Mock()
+
+    mock_imap = Mock()
+    mock_imap.connect.return_value = MagicMock()
+    mock_imap.connect.return_value.__enter__.return_value = Mock(mailbox='INBOX', uid_validity=1)
+    mock_imap.yield_messages.side_effect = [[], [Mock(uid=b'7')], NoMessages]
+    outcomes = deque([IMAPClientError('connection dropped'), None, stop.set])
+
+    def wait_for_mail(*args, **kwargs):
+        outcome = outcomes.popleft()
+        if isinstance(outcome, Exception):
+            raise outcome
+        if outcome is not None:
+            outcome()
+
+    mock_imap.wait_for_mail.side_effect = wait_for_mail
+
+    # A daemon that never stops would hang the suite; fail it instead. The
+    # pytest failure is a BaseException, so run_daemon can't swallow it.
+    def timed_out(signum, frame):
+        pytest.fail('run_daemon did not stop')
+
+    previous = signal.signal(signal.SIGALRM, timed_out)
+    signal.alarm(10)
+    try:
+        with patch('windowbox.fetch.ingest_message') as mock_ingest:
+            run_daemon(
+                attachments_path=None, exiftool_client=None, gmapi_client=None,
+                imap_client=mock_imap, stop=stop, idle_timeout=10, poll_interval=5,
+                max_backoff=60)
+    finally:
+        signal.alarm(0)
+        signal.signal(signal.SIGALRM, previous)
+
+    assert not outcomes
+
+    assert mock_imap.connect.call_count == 2
+    assert [c.kwargs['min_uid'] for c in mock_imap.yield_messages.call_args_list] == [1, 1, 8]
+    assert mock_ingest.call_count == 1
+    assert db.session.get(FetchCheckpoint, 'INBOX').last_uid == 7
+    stop.wait.assert_called_once_with(1)
+    mock_imap.wait_for_mail.assert_called_with(
+        mock_imap.connect.return_value.__enter__.return_value, timeout=10, poll_interval=5,
+        stop=stop)
+
+
+def test_run_checkpointed_fetch(db):
+    """
+    Should pick up where the mailbox's checkpoint left off.
+    """
+    checkpoint = FetchCheckpoint(mailbox='INBOX', uid_validity=1, last_uid=4)
+    checkpoint.record_failure(2, ValueError('bad'))
+    db.session.add(checkpoint)
+    db.session.commit()
+
+    mock_imap = MagicMock()
+    mock_imap.connect.return_value.__enter__.return_value = Mock(mailbox='INBOX', uid_validity=1)
+    mock_imap.yield_messages.side_effect = NoMessages
+
+    assert run_checkpointed_fetch(
+        attachments_path=None, exiftool_client=None, gmapi_client=None, imap_client=mock_imap) == 5
+
+    mock_imap.yield_messages.assert_called_once_with(
+        connection=mock_imap.connect.return_value.__enter__.return_value, min_uid=5, retry_uids=[2],
+        metrics=ANY)
+    assert mock_imap.connect.call_args.kwargs['metrics'] is mock_imap.yield_messages.call_args.kwargs['metrics']
+
+    # Message 2 didn't turn up, so it must have been deleted
+    assert not db.session.get(FetchCheckpoint, 'INBOX').quarantine
+
+
+def test_run_fetch_quarantine(db):
+    """
+    Should quarantine messages that fail, retry them, and give up eventually.
+    """
+    checkpoint = FetchCheckpoint.load(mailbox='INBOX', uid_validity=1)
+    mock_imap = Mock()
+    mock_imap.yield_messages.side_effect = lambda **kwargs: [Mock(uid=b'1'), Mock(uid=b'2'), Mock(uid=b'3')]
+    poison = {b'2'}
+
+    def ingest_message(message, **kwargs):
+        if message.uid in poison:
+            raise ValueError('poison')
+
+    def fetch():
+        with patch('windowbox.fetch.ingest_message', side_effect=ingest_message) as mock_ingest:
+            run_fetch(
+                attachments_path=None, exiftool_client=None, gmapi_client=None,
+                imap_client=mock_imap, checkpoint=checkpoint, max_attempts=2)
+
+        return [c.args[0].uid for c in mock_ingest.call_args_list]
+
+    assert fetch() == [b'1', b'2', b'3']
+    assert checkpoint.last_uid == 3
+    assert checkpoint.quarantine[2].attempts == 1
+    assert checkpoint.quarantine[2].last_error == 'ValueError: poison'
+
+    fetch()
+    assert mock_imap.yield_messages.call_args.kwargs == {
+        'connection': None, 'min_uid': 4, 'retry_uids': [2], 'metrics': ANY}
+    assert checkpoint.quarantine[2].attempts == 2
+
+    fetch()
+    assert mock_imap.yield_messages.call_args.kwargs['retry_uids'] == []
+
+    poison.clear()
+    fetch()
+    assert not checkpoint.quarantine
+
+
+def test_run_fetch_quarantine_transient(db):
+    """
+    Should not blame messages for failures that are not their fault.
+    """
+    checkpoint = FetchCheckpoint.load(mailbox='INBOX', uid_validity=1)
+    mock_imap = Mock()
+    mock_imap.yield_messages.return_value = [Mock(uid=b'1')]
+
+    with patch('windowbox.fetch.ingest_message', side_effect=IMAPClientError('dropped')):
+        with pytest.raises(IMAPClientError):
+            run_fetch(
+                attachments_path=None, exiftool_client=None, gmapi_client=None,
+                imap_client=mock_imap, checkpoint=checkpoint)
+
+    assert checkpoint.last_uid == 0
+    assert not checkpoint.quarantine
+
+
+def test_run_fetch_quarantine_object_store(db, tmp_path, post_instance, s3_client):
+    """
+    Should not blame messages when the object store can't take their files.
+    """
+    checkpoint = FetchCheckpoint.load(mailbox='INBOX', uid_validity=1)
+    mock_imap = Mock()
+    mock_imap.yield_messages.return_value = [Mock(uid=b'1')]
+    s3_client.secret_key = 'wrong'
+
+    with patch.object(Attachment, 'storage_backend', ObjectStoreBackend(client=s3_client)):
+        with patch(
+                'windowbox.controllers.post.PostController.message_to_post',
+                return_value=post_instance):
+            with patch(
+                    'windowbox.controllers.attachment.AttachmentController.message_to_files',
+                    side_effect=fake_files([('image/jpeg', b'jpeg-data')])):
+                with pytest.raises(S3ClientError, match='HTTP 403'):
+                    run_fetch(
+                        attachments_path=tmp_path, exiftool_client=Mock(**{'read_file.return_value': {}}),
+                        gmapi_client=None, imap_client=mock_imap, checkpoint=checkpoint)
+
+    assert checkpoint.last_uid == 0
+    assert not checkpoint.quarantine
 
 
 def test_run_fetch_empty():
@@ -64,6 +284,27 @@ def test_run_fetch_unknown_sender():
     msg3.delete.assert_called()
 
 
+def test_run_fetch_duplicate():
+    """
+    Should delete messages that were already posted without posting them again.
+    """
+    msg1 = Mock(uid=b'1', message_id='<1@example.com>')
+
+    mock_imap = Mock()
+    mock_imap.yield_messages.return_value = [msg1]
+
+    with patch(
+            'windowbox.controllers.post.PostController.message_to_post',
+            side_effect=PostController.DuplicateMessage):
+        run_fetch(
+            attachments_path=None,
+            exiftool_client=None,
+            gmapi_client=None,
+            imap_client=mock_imap)
+
+    msg1.delete.assert_called()
+
+
 def test_run_fetch(db, tmp_path, post_instance):
     """
     Should fetch all messages.
@@ -86,19 +327,132 @@ def test_run_fetch(db, tmp_path, post_instance):
             'windowbox.controllers.post.PostController.message_to_post',
             return_value=post_instance):
         with patch(
-                'windowbox.controllers.attachment.AttachmentController.message_to_data',
-                return_value=[('image/jpeg', b'pretend-this-is-image-data')]):
-            run_fetch(
+                'windowbox.controllers.attachment.AttachmentController.message_to_files',
+                side_effect=fake_files([('image/jpeg', b'pretend-this-is-image-data')])):
+            next_uid = run_fetch(
                 attachments_path=tmp_path,
                 exiftool_client=mock_exiftool,
                 gmapi_client=Mock(),
                 imap_client=mock_imap)
 
+    assert next_uid == 4
+
     msg1.delete.assert_called()
     msg2.delete.assert_called()
     msg3.delete.assert_called()
 
 
+def test_run_fetch_content_addressed(db, tmp_path, post_instance):
+    """
+    Should store identical attachments once, by their digest.
+    """
+    mock_imap = Mock()
+    mock_imap.yield_messages.return_value = [Mock(uid=b'1')]
+    mock_exiftool = Mock()
+    mock_exiftool.read_file.return_value = {}
+    metrics = RunMetrics()
+
+    with patch(
+            'windowbox.controllers.post.PostController.message_to_post',
+            return_value=post_instance):
+        with patch(
+                'windowbox.controllers.attachment.AttachmentController.message_to_files',
+                side_effect=fake_files([('image/jpeg', b'same-data')] * 2)):
+            run_fetch(
+                attachments_path=tmp_path, exiftool_client=mock_exiftool, gmapi_client=Mock(),
+                imap_client=mock_imap, content_addressed=True, metrics=metrics)
+
+    first, second = post_instance.attachments
+    assert first.sha256 == second.sha256 == hashlib.sha256(b'same-data').hexdigest()
+    assert first.storage_path() == second.storage_path()
+    assert first.storage_path().read_bytes() == b'same-data'
+    assert [p for p in tmp_path.rglob('*') if p.is_file()] == [first.storage_path()]
+    assert metrics.report()['stages']['storage_hash']['calls'] == 2
+
+
+def test_run_fetch_concurrent(db, tmp_path, post_instance):
+    """
+    Should process a message's attachments together and keep each one's data.
+    """
+    mock_imap = Mock()
+    mock_imap.yield_messages.return_value = [Mock(uid=b'1')]
+
+    def read_file(path):
+        return {
+            'EXIF:Orientation.num': 6 if path.read_bytes() == b'jpeg-data' else 1,
+            'Composite:GPSLatitude.num': 12,
+            'Composite:GPSLongitude.num': 34}
+
+    mock_exiftool = Mock()
+    mock_exiftool.read_file.side_effect = read_file
+
+    mock_gmapi = Mock()
+    mock_gmapi.latlng_to_address.return_value = 'pytestburg'
+    metrics = RunMetrics()
+
+    with patch(
+            'windowbox.controllers.post.PostController.message_to_post',
+            return_value=post_instance):
+        with patch(
+                'windowbox.controllers.attachment.AttachmentController.message_to_files',
+                side_effect=fake_files([('image/jpeg', b'jpeg-data'), ('image/png', b'png-data')])):
+            run_fetch(
+                attachments_path=tmp_path,
+                exiftool_client=mock_exiftool,
+                gmapi_client=mock_gmapi,
+                imap_client=mock_imap,
+                ingest_workers=2,
+                metrics=metrics,
+                metrics_textfile=tmp_path / 'fetch.prom')
+
+    jpeg, png = sorted(post_instance.attachments, key=lambda a: a.mime_type)
+    assert jpeg.storage_path().read_bytes() == b'jpeg-data'
+    assert png.storage_path().read_bytes() == b'png-data'
+    assert (jpeg.orientation, png.orientation) == (6, 1)
+    assert jpeg.geo_address == png.geo_address == 'pytestburg'
+    assert float(png.geo_latitude) == 12
+
+    report = metrics.report()
+    assert report['counters'] == {'attachment_bytes': 17, 'attachments': 2, 'messages': 1, 'posts': 1}
+    assert {stage: s['calls'] for stage, s in report['stages'].items()} == {
+        'db_commit': 1, 'db_flush': 1, 'exiftool': 2, 'geocode': 2, 'post_lookup': 1,
+        'storage_move': 2, 'storage_write': 2}
+    assert 'windowbox_fetch_items{name="posts"} 1' in (tmp_path / 'fetch.prom').read_text()
+
+
+@pytest.mark.parametrize('ingest_workers', [1, 2])
+def test_run_gmapi_failure_cleanup(db, tmp_path, post_instance, ingest_workers):
+    """
+    Should delete every attachment file of the message if any step fails.
+    """
+    mock_imap = Mock()
+    mock_imap.yield_messages.return_value = [Mock(uid=b'1')]
+
+    mock_exiftool = Mock()
+    mock_exiftool.read_file.side_effect = [
+        {},
+        {'Composite:GPSLatitude.num': 12, 'Composite:GPSLongitude.num': 34}]
+
+    mock_gmapi = Mock()
+    mock_gmapi.latlng_to_address.side_effect = GMAPIClientError('testing API failure')
+
+    with patch(
+            'windowbox.controllers.post.PostController.message_to_post',
+            return_value=post_instance):
+        with patch(
+                'windowbox.controllers.attachment.AttachmentController.message_to_files',
+                side_effect=fake_files([('image/jpeg', b'one'), ('image/jpeg', b'two')])):
+            with pytest.raises(GMAPIClientError):
+                run_fetch(
+                    attachments_path=tmp_path,
+                    exiftool_client=mock_exiftool,
+                    gmapi_client=mock_gmapi,
+                    imap_client=mock_imap,
+                    ingest_workers=ingest_workers)
+
+    assert not [p for p in tmp_path.rglob('*') if p.is_file()]
+
+
 def test_run_gmapi_failure(db, tmp_path, post_instance):
     """
     Should delete the generated attachment if the gmapi lookup fails.
@@ -118,11 +472,199 @@ def test_run_gmapi_failure(db, tmp_path, post_instance):
             'windowbox.controllers.post.PostController.message_to_post',
             return_value=post_instance):
         with patch(
-                'windowbox.controllers.attachment.AttachmentController.message_to_data',
-                return_value=[('image/jpeg', b'pretend-this-is-image-data')]):
+                'windowbox.controllers.attachment.AttachmentController.message_to_files',
+                side_effect=fake_files([('image/jpeg', b'pretend-this-is-image-data')])):
             with pytest.raises(GMAPIClientError):
                 run_fetch(
                     attachments_path=tmp_path,
                     exiftool_client=mock_exiftool,
                     gmapi_client=mock_gmapi,
                     imap_client=mock_imap)
+
+
+def archived_message(*, sender, message_id, attachment=None, date='Sat, 28 Sep 2019 17:42:39 -0400'):
+    """
+    Return an email message like the ones found in an exported archive.
+    """
+    msg = EmailMessage()
+    msg['From'] = sender
+    msg['Message-ID'] = message_id
+    if date is not None:
+        msg['Date'] = date
+    msg.set_content('Imported caption')
+    if attachment is not None:
+        msg.add_attachment(attachment, maintype='image', subtype='png', filename='pixel.png')
+
+    return msg
+
+
+@pytest.fixture
+def archive_messages(png_pixel, sender_instance):
+    """
+    Return a list of messages covering each outcome of an import.
+    """
+    return [
+        archived_message(
+            sender=sender_instance.email_address, message_id='<1@example.com>',
+            attachment=png_pixel),
+        archived_message(
+            sender='stranger@example.com', message_id='<2@example.com>', attachment=png_pixel),
+        archived_message(sender=sender_instance.email_address, message_id='<1@example.com>'),
+        archived_message(sender=sender_instance.email_address, message_id='<3@x>', date=None)]
+
+
+def test_main_import(tmp_path):
+    """
+    Verify the main function for the import script dispatches as expected.
+    """
+    source = tmp_path / 'archive.mbox'
+    checkpoint = tmp_path / 'archive.mbox.windowbox-import.json'
+    checkpoint.write_text('{}')
+
+    with patch('windowbox.importer.run_import') as mock_run_import, \
+            patch('windowbox.importer.sweep_temp_files') as mock_sweep:
+        assert main_import([str(source)]) == 0
+        assert main_import([str(source), '--dry-run', '--format', 'maildir', '--workers', '0']) == 0
+
+    first, second = mock_run_import.call_args_list
+    assert mock_sweep.call_count == 4
+    assert first.kwargs['checkpoint'] == checkpoint
+    assert first.kwargs['workers'] == app.config['IMPORT_WORKERS']
+    assert first.kwargs['batch_size'] == app.config['IMPORT_BATCH_SIZE']
+    assert first.kwargs['dry_run'] is False
+    assert first.kwargs['content_addressed'] == app.config['STORAGE_CONTENT_ADDRESSED']
+    assert second.kwargs['checkpoint'] is None
+    assert (second.kwargs['fmt'], second.kwargs['workers']) == ('maildir', 0)
+
+    with patch('windowbox.importer.run_import'):
+        main_import([str(source), '--restart'])
+    assert not checkpoint.exists()
+
+
+def test_run_import(db, tmp_path, sender_instance, archive_messages):
+    """
+    Should import good messages, skip the rest, and resume from its checkpoint.
+    """
+    db.session.add(sender_instance)
+    db.session.commit()
+
+    source = tmp_path / 'archive.mbox'
+    box = mailbox.mbox(source)
+    for msg in archive_messages:
+        box.add(msg)
+    box.close()
+
+    attachments_path = tmp_path / 'attachments'
+    checkpoint = tmp_path / 'checkpoint.json'
+    mock_exiftool = Mock()
+    mock_exiftool.read_file.return_value = {'EXIF:Orientation.num': 6}
+    kwargs = {
+        'source': source, 'attachments_path': attachments_path, 'exiftool_client': mock_exiftool,
+        'gmapi_client': Mock(), 'workers': 0, 'batch_size': 3, 'checkpoint': checkpoint}
+
+    counts = run_import(**kwargs)
+
+    assert counts == {'imported': 1, 'unknown_sender': 1, 'duplicate': 1, 'failed': 1}
+    [post] = Post.query.all()
+    assert post.message_id == '<1@example.com>'
+    assert post.caption == 'Imported caption'
+    [attachment] = post.attachments
+    attachment.base_path = attachments_path
+    assert attachment.mime_type == 'image/png'
+    assert attachment.orientation == 6
+    assert attachment.has_storage_data
+    assert not [*attachments_path.glob('.incoming-*')]
+    assert read_checkpoint(checkpoint, source=source) == 3
+
+    assert run_import(**kwargs) == {}
+    assert read_checkpoint(checkpoint, source=tmp_path / 'other.mbox') is None
+
+
+def test_run_import_content_addressed(db, tmp_path, sender_instance, png_pixel):
+    """
+    Should not store the data of a repeated attachment a second time.
+    """
+    db.session.add(sender_instance)
+    db.session.commit()
+
+    source = tmp_path / 'archive.mbox'
+    box = mailbox.mbox(source)
+    for n in range(2):
+        box.add(archived_message(
+            sender=sender_instance.email_address, message_id=f'<{n}@example.com>', attachment=png_pixel))
+    box.close()
+
+    attachments_path = tmp_path / 'attachments'
+    mock_exiftool = Mock()
+    mock_exiftool.read_file.return_value = {}
+
+    counts = run_import(
+        source=source, attachments_path=attachments_path, exiftool_client=mock_exiftool,
+        gmapi_client=Mock(), workers=0, batch_size=1, content_addressed=True)
+
+    assert counts == {'imported': 2}
+    first, second = [post.attachments[0] for post in Post.query.order_by(Post.id)]
+    first.base_path = second.base_path = attachments_path
+    assert first.sha256 == second.sha256 == hashlib.sha256(png_pixel).hexdigest()
+    assert [p for p in attachments_path.rglob('*') if p.is_file()] == [first.storage_path()]
+
+
+def test_run_import_dry_run(db, tmp_path, sender_instance, archive_messages):
+    """
+    Should go through a Maildir with worker processes, but leave nothing behind.
+    """
+    db.session.add(sender_instance)
+    db.session.commit()
+
+    source = tmp_path / 'Maildir'
+    box = mailbox.Maildir(source)
+    for msg in archive_messages[:2]:
+        box.add(msg)
+
+    attachments_path = tmp_path / 'attachments'
+    mock_exiftool = Mock()
+    mock_exiftool.read_file.return_value = {}
+
+    counts = run_import(
+        source=source, attachments_path=attachments_path, exiftool_client=mock_exiftool,
+        gmapi_client=Mock(), workers=1, batch_size=10, dry_run=True)
+
+    assert counts == {'imported': 1, 'unknown_sender': 1}
+    assert Post.query.count() == 0
+    assert not [p for p in attachments_path.rglob('*') if p.is_file()]
+
+
+def test_run_import_failure(db, tmp_path, sender_instance, archive_messages):
+    """
+    Should clean up files when decoding or committing fails.
+    """
+    db.session.add(sender_instance)
+    db.session.commit()
+
+    source = tmp_path / 'archive.mbox'
+    box = mailbox.mbox(source)
+    box.add(archive_messages[0])
+    box.close()
+
+    attachments_path = tmp_path / 'attachments'
+    checkpoint = tmp_path / 'checkpoint.json'
+    mock_exiftool = Mock()
+    mock_exiftool.read_file.side_effect = ValueError('exiftool broke')
+    kwargs = {
+        'source': source, 'attachments_path': attachments_path, 'exiftool_client': mock_exiftool,
+        'gmapi_client': Mock(), 'workers': 0, 'batch_size': 10, 'checkpoint': checkpoint}
+
+    assert run_import(**kwargs) == {'failed': 1}
+    assert not [p for p in attachments_path.rglob('*') if p.is_file()]
+    assert json.loads(checkpoint.read_text())['last_key'] == 0
+
+    checkpoint.unlink()
+    mock_exiftool.read_file.side_effect = None
+    mock_exiftool.read_file.return_value = {}
+
+    with patch('windowbox.importer.finish_batch', side_effect=RuntimeError('commit broke')):
+        with pytest.raises(RuntimeError):
+            run_import(**kwargs)
+
+    assert Post.query.count() == 0
+    assert not [p for p in attachments_path.rglob('*') if p.is_file()]
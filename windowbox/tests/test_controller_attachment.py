@@ -3,7 +3,9 @@ Tests for the Attachment controller.
 """
 
 import pytest
-from unittest.mock import patch
+import sqlalchemy.orm.exc
+from flask_sqlalchemy.query import Query
+from unittest.mock import Mock, patch
 from windowbox.controllers.attachment import AttachmentController
 from windowbox.models.attachment import Dimensions
 
@@ -35,6 +37,21 @@ def test_attachment_message_to_data():
         ('image/png', b'png3')]
 
 
+def test_attachment_message_to_files(tmp_path):
+    """
+    Should only ask the message to write parts of known types.
+    """
+    message = Mock(part_types={'image/png', 'text/html', 'image/jpeg'})
+    message.write_parts.side_effect = lambda mime_type, directory: iter(
+        [directory / f'{mime_type.replace("/", "-")}-1'])
+    directory = tmp_path / 'new'
+
+    assert [*AttachmentController.message_to_files(message, directory=directory)] == [
+        ('image/jpeg', directory / 'image-jpeg-1'),
+        ('image/png', directory / 'image-png-1')]
+    assert directory.is_dir()
+
+
 def test_attachment_get_by_id(db, attachment_instance):
     """
     Should be able to get a single attachment instance.
@@ -50,6 +67,17 @@ def test_attachment_get_by_id(db, attachment_instance):
         AttachmentController.get_by_id(666666)
 
 
+def test_attachment_get_version(db, attachment_instance):
+    """
+    Should return the updated stamp of an Attachment without loading it.
+    """
+    db.session.add(attachment_instance)
+    db.session.flush()
+
+    assert AttachmentController.get_version(attachment_instance.id) == attachment_instance.updated_utc
+    assert AttachmentController.get_version(666666) is None
+
+
 def test_attachment_decode_dimensions():
     """
     Whale on the dimensions decoder regex.
@@ -130,3 +158,32 @@ def test_attachment_make_or_get_derivative(db, attachment_instance):
             assert dv.base_path is not None
             mock_esd.assert_called()
             mock_esd.reset_mock()
+
+
+def test_attachment_make_or_get_derivative_race(db, attachment_instance):
+    """
+    Should use the existing Derivative if a concurrent request created it first.
+    """
+    db.session.add(attachment_instance)
+    winner = attachment_instance.new_derivative(width=100, height=75, allow_crop=True)
+    db.session.add(winner)
+    db.session.commit()
+
+    # Make the initial lookup miss, as if the winner committed just after it
+    real_one = Query.one
+    calls = []
+
+    def one_but_miss_first(self):
+        calls.append(self)
+        if len(calls) == 1:
+            raise sqlalchemy.orm.exc.NoResultFound
+        return real_one(self)
+
+    with patch('windowbox.models.derivative.Derivative.ensure_storage_data'):
+        with patch.object(Query, 'one', one_but_miss_first):
+            dv = AttachmentController.make_or_get_derivative(
+                attachment=attachment_instance,
+                dim_tuple=Dimensions(100, 75, True))
+
+    assert dv.id == winner.id
+    assert len(calls) == 2
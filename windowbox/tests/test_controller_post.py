@@ -3,6 +3,7 @@ Tests for the Post controller.
 """
 
 import pytest
+from datetime import datetime, timezone
 from unittest.mock import Mock
 from windowbox.controllers.post import PostController
 
@@ -15,6 +16,7 @@ def test_post_message_to_post(datetime_now, db, emoji, sender_instance):
     message.from_address = 'known.sender@example.com'
     message.date = datetime_now
     message.x_mailer = 'pytest'
+    message.message_id = ' <abc123@example.com> '
     message.text_plain = f'Today is a good day for making {emoji} Posts.'
 
     # Need to create a Sender for the create to succeed
@@ -27,6 +29,18 @@ def test_post_message_to_post(datetime_now, db, emoji, sender_instance):
     assert post.created_utc == datetime_now
     assert post.user_agent == 'pytest'
     assert post.caption == f'Today is a good day for making {emoji} Posts.'
+    assert post.message_id == '<abc123@example.com>'
+
+    # Same Message-ID should not succeed twice
+    db.session.add(post)
+    db.session.flush()
+
+    with pytest.raises(PostController.DuplicateMessage):
+        PostController.message_to_post(message)
+
+    # ...but messages without one are never duplicates
+    message.message_id = None
+    assert PostController.message_to_post(message).message_id is None
 
     # Unknown sender should not succeed
     message.from_address = 'unknown.sender@example.com'
@@ -182,8 +196,87 @@ def test_post_get_lastmod_datetime_empty(datetime_now, db):
     assert (dt - datetime_now).total_seconds() < 1
 
 
+def test_post_get_content_version(db, post_instances):
+    """
+    Should change when a Post is added or any Attachment is updated.
+    """
+    version = PostController.get_content_version()
+
+    assert version[0] == 12
+    assert version[1] == max(a.updated_utc for p in post_instances for a in p.attachments)
+
+    post_instances[1].attachments[0].updated_utc = datetime(2099, 1, 1, tzinfo=timezone.utc)
+    db.session.flush()
+
+    assert PostController.get_content_version() == (12, datetime(2099, 1, 1, tzinfo=timezone.utc))
+
+
+def test_post_get_content_version_empty(db):
+    """
+    Should still return a version when there are no Posts.
+    """
+    assert PostController.get_content_version() == (None, None)
+
+
+def test_post_get_post_version(db, post_instances):
+    """
+    Should cover the Post, its Attachments, and the newest Post ID.
+    """
+    attachment = post_instances[1].attachments[0]
+
+    assert PostController.get_post_version(1) == (1, 12, None)
+    assert PostController.get_post_version(2) == (2, 12, attachment.updated_utc)
+    assert PostController.get_post_version(666666) is None
+
+    attachment.updated_utc = datetime(2099, 1, 1, tzinfo=timezone.utc)
+    db.session.flush()
+
+    assert PostController.get_post_version(2) == (2, 12, datetime(2099, 1, 1, tzinfo=timezone.utc))
+    assert PostController.get_post_version(4)[2] < attachment.updated_utc
+
+
 def test_post_yield_all(post_instances):
     """
     Should be able to yield all the Posts in descending order.
     """
     assert [*PostController.yield_all()] == [*reversed(post_instances)]
+
+
+def test_post_month_bounds():
+    """
+    Should compute the start and end of a month, and reject bad values.
+    """
+    assert PostController.month_bounds(year=2018, month=4) == (
+        datetime(2018, 4, 1, tzinfo=timezone.utc), datetime(2018, 5, 1, tzinfo=timezone.utc))
+    assert PostController.month_bounds(year=2018, month=12) == (
+        datetime(2018, 12, 1, tzinfo=timezone.utc), datetime(2019, 1, 1, tzinfo=timezone.utc))
+
+    for year, month in ((2018, 0), (2018, 13), (0, 1), (9999, 1)):
+        with pytest.raises(PostController.InvalidArgument):
+            PostController.month_bounds(year=year, month=month)
+
+
+def test_post_get_many_month(post_instances):
+    """
+    Should be able to restrict get_many() to a single month.
+    """
+    posts, has_more, _ = PostController.get_many(year=2018, month=4)
+    assert posts == [post_instances[3]]
+    assert not has_more
+
+    posts, has_more, _ = PostController.get_many(year=2017, month=4)
+    assert posts == []
+    assert not has_more
+
+    with pytest.raises(PostController.InvalidArgument):
+        PostController.get_many(year=2018, month=13)
+
+
+def test_post_get_archive_months(post_instances):
+    """
+    Should return every month with Posts in it, newest first.
+    """
+    months = PostController.get_archive_months()
+
+    assert [(m.year, m.month) for m in months] == [(2018, m) for m in range(12, 0, -1)]
+    assert all(m.post_count == 1 for m in months)
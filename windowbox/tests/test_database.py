@@ -1,8 +1,15 @@
 """
-Tests for the custom database types.
+Tests for the database connection helpers and custom types.
 """
 
 from datetime import datetime, timedelta, timezone
+import pytest
+from sqlalchemy import create_engine, insert, select
+from unittest.mock import patch
+from windowbox.database import (
+    REPLICA_KEY, apply_sqlite_pragmas, reset_routing, route_request, use_primary, use_replica)
+from windowbox.models.post import Post
+from windowbox.models.sender import Sender
 
 
 def test_utc_datetime_constructor(db):
@@ -49,3 +56,132 @@ def test_utc_datetime_load(db):
 
     # All incoming datetimes should become aware UTC with the same value
     assert utc.process_result_value(now_utc_naive, None) == now_utc_aware
+
+
+def test_apply_sqlite_pragmas(tmp_path):
+    """
+    Every new connection should receive the configured pragmas.
+    """
+    engine = create_engine(f'sqlite:///{tmp_path / "pragma.sqlite"}')
+    apply_sqlite_pragmas(engine, {'journal_mode': 'WAL', 'busy_timeout': 1234})
+
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql('PRAGMA journal_mode').scalar() == 'wal'
+        assert conn.exec_driver_sql('PRAGMA busy_timeout').scalar() == 1234
+
+    # Read-only connections should skip journal_mode but still get the rest
+    engine = create_engine(f'sqlite:///file:{tmp_path / "pragma.sqlite"}?mode=ro&uri=true')
+    apply_sqlite_pragmas(engine, {'journal_mode': 'DELETE', 'busy_timeout': 4321})
+
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql('PRAGMA journal_mode').scalar() == 'wal'
+        assert conn.exec_driver_sql('PRAGMA busy_timeout').scalar() == 4321
+
+
+def test_configure_engines(app, db):
+    """
+    The app's SQLite engines should come up with the tuning profile applied.
+    """
+    with db.engine.connect() as conn:
+        assert conn.exec_driver_sql('PRAGMA journal_mode').scalar() == 'wal'
+        assert conn.exec_driver_sql('PRAGMA synchronous').scalar() == 1  # NORMAL
+
+
+@pytest.fixture
+def replica_db(app, db):
+    """
+    Create the schema on the test replica and route reads there.
+
+    The replica is a separate SQLite file that nothing replicates into, so any
+    data a test finds there must have been read from the replica engine.
+    """
+    replica_engine = db.engines['replica']
+    db.metadata.create_all(bind=replica_engine)
+
+    with patch.dict(app.config, {'DATABASE_READ_BINDS': ['replica']}):
+        yield replica_engine
+
+    reset_routing()
+    db.session.rollback()
+    db.metadata.drop_all(bind=replica_engine)
+
+
+def test_routing_session(app, db, replica_db):
+    """
+    Reads should use the replica only until something is written.
+    """
+    primary = db.engines[None]
+    statement = select(Sender)
+
+    # No replica chosen yet: everything goes to the primary
+    assert db.session.get_bind(clause=statement) is primary
+
+    use_replica()
+    assert db.session.get_bind(clause=statement) is replica_db
+
+    # Writes go to the primary and pin all later reads there too
+    assert db.session.get_bind(clause=insert(Sender)) is primary
+    assert db.session.get_bind(clause=statement) is primary
+
+    # Resetting forgets both the replica choice and the pin
+    reset_routing()
+    assert db.session.get_bind(clause=statement) is primary
+    use_replica()
+    assert db.session.get_bind(clause=statement) is replica_db
+
+    use_primary()
+    assert db.session.get_bind(clause=statement) is primary
+
+
+def test_routing_session_flush(app, db, replica_db, sender_instance):
+    """
+    A flush should pin the session, so a request can read its own writes.
+    """
+    use_replica()
+
+    # Nothing has been replicated, so the replica doesn't have this Sender
+    db.session.add(sender_instance)
+    db.session.commit()
+    reset_routing()
+    use_replica()
+    assert Sender.query.count() == 0
+
+    db.session.add(Sender(email_address='another@example.com', display_name='Another'))
+    db.session.flush()
+    assert Sender.query.count() == 2
+
+
+def test_routing_no_replicas(app, db):
+    """
+    Without any configured replicas, use_replica() should do nothing.
+    """
+    use_replica()
+    assert db.session.info.get(REPLICA_KEY) is None
+
+
+def test_route_request(app, db, replica_db):
+    """
+    Only safe HTTP methods should be allowed to read from a replica.
+    """
+    for method, expect in (('GET', 'replica'), ('HEAD', 'replica'), ('POST', None)):
+        with app.test_request_context(method=method):
+            route_request()
+            assert db.session.info.get(REPLICA_KEY) == expect
+            reset_routing()
+
+
+def test_route_request_views(app, client, db, replica_db, post_instances):
+    """
+    GET views should read from the replica and forget about it afterwards.
+    """
+    db.session.commit()
+
+    res = client.get('/api/posts')
+    assert res.json['posts'] == []
+
+    res = client.get('/archive/2018/4')
+    assert b'Post Fixture 4' not in res.data
+
+    # Routing must not leak out of the request
+    assert db.session.info.get(REPLICA_KEY) is None
+    assert Post.query.count() == 12
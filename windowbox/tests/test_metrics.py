@@ -0,0 +1,96 @@
+"""
+Tests for the ingest run metrics.
+"""
+
+import json
+import pytest
+from unittest.mock import patch
+from windowbox.metrics import NULL_METRICS, RunMetrics
+
+
+def test_run_metrics_report():
+    """
+    Should total up stage timings and counters, including from failed stages.
+    """
+    metrics = RunMetrics()
+
+    with patch('time.perf_counter', side_effect=[10, 10.5, 20, 20.25]):
+        with metrics.timed('exiftool'):
+            pass
+        with pytest.raises(ValueError):
+            with metrics.timed('exiftool'):
+                raise ValueError
+    metrics.count('messages')
+    metrics.count('attachment_bytes', 1234)
+    metrics.count('messages')
+
+    report = metrics.report()
+
+    assert report['stages'] == {'exiftool': {'calls': 2, 'seconds': 0.75}}
+    assert report['counters'] == {'attachment_bytes': 1234, 'messages': 2}
+    assert report['elapsed_seconds'] >= 0
+    assert json.loads(metrics.to_json()).keys() == report.keys()
+    assert json.loads(metrics.to_json())['stages'] == report['stages']
+
+
+def test_run_metrics_timed_iter():
+    """
+    Should time each item as it's produced, but not the caller's work.
+    """
+    metrics = RunMetrics()
+
+    assert [*metrics.timed_iter('storage_write', 'abc')] == ['a', 'b', 'c']
+    assert metrics.report()['stages']['storage_write']['calls'] == 3
+
+
+def test_run_metrics_prometheus(tmp_path):
+    """
+    Should write every figure as a gauge, replacing the file atomically.
+    """
+    metrics = RunMetrics()
+    metrics.add_time('imap_search', 1.5)
+    metrics.count('posts', 3)
+    path = tmp_path / 'fetch.prom'
+    path.write_text('stale')
+
+    metrics.write_textfile(path)
+    text = path.read_text()
+
+    assert '# TYPE windowbox_fetch_stage_seconds gauge\n' in text
+    assert 'windowbox_fetch_stage_seconds{stage="imap_search"} 1.5\n' in text
+    assert 'windowbox_fetch_stage_calls{stage="imap_search"} 1\n' in text
+    assert 'windowbox_fetch_items{name="posts"} 3\n' in text
+    assert f'windowbox_fetch_last_run_timestamp_seconds {metrics.started_unix}\n' in text
+    assert [p.name for p in tmp_path.iterdir()] == ['fetch.prom']
+
+
+def test_run_metrics_emit(tmp_path, caplog):
+    """
+    Should log the JSON report, and only warn if the textfile can't be written.
+    """
+    metrics = RunMetrics()
+    metrics.count('messages')
+
+    with patch.object(metrics, 'to_prometheus', side_effect=OSError('disk full')):
+        metrics.emit(textfile=tmp_path / 'fetch.prom')
+
+    assert '"messages": 1' in caplog.text
+    assert 'Could not write metrics' in caplog.text
+    assert not [*tmp_path.iterdir()]
+
+    metrics.emit(textfile='')
+    metrics.emit(textfile=tmp_path / 'fetch.prom')
+    assert (tmp_path / 'fetch.prom').exists()
+
+
+def test_null_metrics():
+    """
+    Should record nothing at all.
+    """
+    with NULL_METRICS.timed('anything'):
+        NULL_METRICS.count('messages')
+        NULL_METRICS.add_time('anything', 5)
+
+    assert [*NULL_METRICS.timed_iter('anything', [1, 2])] == [1, 2]
+    assert NULL_METRICS.report()['stages'] == {}
+    assert NULL_METRICS.report()['counters'] == {}
@@ -0,0 +1,99 @@
+"""
+Tests for the ArchiveMonth model.
+"""
+
+import importlib
+from datetime import datetime, timedelta, timezone
+from unittest.mock import Mock
+from windowbox.database import UPSERT_DIALECTS
+from windowbox.models.archive import ArchiveMonth
+from windowbox.models.post import Post
+
+
+def month_counts():
+    """
+    Return all archive counts as a {(year, month): count} dict.
+    """
+    return {(m.year, m.month): m.post_count for m in ArchiveMonth.query}
+
+
+def test_archive_month_name():
+    """
+    Should know the name of its month.
+    """
+    assert ArchiveMonth(year=2004, month=1).month_name == 'January'
+    assert ArchiveMonth(year=2004, month=12).month_name == 'December'
+
+
+def test_archive_month_insert_delete(db, sender_instance):
+    """
+    Counts should follow Posts as they are inserted and deleted.
+    """
+    eastern = timezone(timedelta(hours=-5))
+    posts = [
+        Post(sender=sender_instance, caption='a', created_utc=datetime(2004, 3, 1, tzinfo=timezone.utc)),
+        Post(sender=sender_instance, caption='b', created_utc=datetime(2004, 3, 31, tzinfo=timezone.utc)),
+        # Still March in New York, but April in UTC
+        Post(sender=sender_instance, caption='c', created_utc=datetime(2004, 3, 31, 22, tzinfo=eastern))]
+    db.session.add_all(posts)
+    db.session.flush()
+
+    assert month_counts() == {(2004, 3): 2, (2004, 4): 1}
+
+    db.session.delete(posts[0])
+    db.session.flush()
+
+    assert month_counts() == {(2004, 3): 1, (2004, 4): 1}
+
+
+def test_archive_month_default_date(db, datetime_now, sender_instance):
+    """
+    Posts without an explicit date should be counted in the current month.
+    """
+    db.session.add(Post(sender=sender_instance, caption='now'))
+    db.session.flush()
+
+    assert month_counts() == {(datetime_now.year, datetime_now.month): 1}
+
+
+def test_archive_month_rebuild(db, post_instances):
+    """
+    Should be able to recompute every count from the Post table.
+    """
+    ArchiveMonth.query.delete()
+    db.session.add(ArchiveMonth(year=1999, month=1, post_count=42))
+    db.session.flush()
+
+    ArchiveMonth.rebuild()
+
+    assert month_counts() == {(2018, m): 1 for m in range(1, 13)}
+
+
+def test_archive_month_adjust_upsert():
+    """
+    Should build an atomic upsert for each dialect that has one.
+    """
+    created = datetime(2004, 3, 1, tzinfo=timezone.utc)
+
+    for name in UPSERT_DIALECTS:
+        connection = Mock()
+        connection.dialect.name = name
+        ArchiveMonth.adjust(connection=connection, created_utc=created, delta=1)
+
+        [stmt], _ = connection.execute.call_args
+        dialect = importlib.import_module(f'sqlalchemy.dialects.{name}').dialect()
+        sql = str(stmt.compile(dialect=dialect))
+        assert 'ON DUPLICATE KEY UPDATE' in sql or 'ON CONFLICT' in sql
+
+
+def test_archive_month_adjust_fallback():
+    """
+    Should fall back to update-then-insert on dialects without an upsert.
+    """
+    connection = Mock()
+    connection.dialect.name = 'oracle'
+    connection.execute.return_value.rowcount = 0
+    ArchiveMonth.adjust(
+        connection=connection, created_utc=datetime(2004, 3, 1, tzinfo=timezone.utc), delta=1)
+
+    assert connection.execute.call_count == 2
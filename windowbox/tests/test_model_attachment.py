@@ -2,8 +2,11 @@
 Tests for the Attachment model.
 """
 
+import hashlib
+from datetime import datetime, timezone
 from unittest.mock import Mock, patch
-from windowbox.models.attachment import Attachment, EXIF_Field
+from windowbox.models.attachment import Attachment, EXIF_CATEGORIES, EXIF_Field
+from windowbox.models.pack import PackEntry, PackStore
 
 
 def test_attachment_storage(db, post_instance):
@@ -45,6 +48,19 @@ def test_attachment_storage(db, post_instance):
     assert out_attachment.exif == exif
 
 
+def test_attachment_exif_whitelist():
+    """
+    Should list every displayable and required EXIF attribute exactly once.
+    """
+    whitelist = Attachment.exif_whitelist()
+
+    assert len(whitelist) == len(set(whitelist))
+    assert {'EXIF:Orientation', 'Composite:GPSLatitude', 'Composite:GPSLongitude'} <= set(whitelist)
+    assert all(
+        candidate in whitelist for category_data in EXIF_CATEGORIES.values()
+        for field_candidates in category_data for candidate in field_candidates)
+
+
 def test_attachment_new_derivative(attachment_instance):
     """
     Should be able to make a new Derivative bound to this Attachment.
@@ -88,6 +104,30 @@ def test_attachment_populate_exif(db, tmp_path, attachment_instance):
     assert attachment_instance.orientation == 2
 
 
+def test_attachment_updated_utc(db, attachment_instance):
+    """
+    Should move the updated stamp forward when the row or its EXIF changes.
+    """
+    old = datetime(2018, 1, 1, tzinfo=timezone.utc)
+    attachment_instance.updated_utc = old
+    db.session.add(attachment_instance)
+    db.session.flush()
+
+    assert attachment_instance.updated_utc == old
+
+    attachment_instance.geo_address = 'pytestburg'
+    db.session.flush()
+
+    assert attachment_instance.updated_utc > old
+
+    attachment_instance.updated_utc = old
+    db.session.flush()
+    attachment_instance.set_exif({'EXIF:Make.val': 'pytest'})
+    db.session.flush()
+
+    assert attachment_instance.updated_utc > old
+
+
 def test_attachment_populate_geo(attachment_instance):
     """
     Should be able to load the geographic data from EXIF lat/long.
@@ -219,3 +259,104 @@ def test_attachment_yield_exif(attachment_instance):
         'EXIF:NoodlePoodle.val': 'verily'}
     assert [*attachment_instance.yield_exif('image')] == [
         EXIF_Field('EXIF:ExifImageHeight', 'Exif Image Height', '3024', '3024')]
+
+
+def test_attachment_storage_is_shared(db, post_instance):
+    """
+    Should only consider Attachments with the same digest to share a file.
+    """
+    first, copy, other = [
+        post_instance.new_attachment(mime_type='image/jpeg', sha256=sha256)
+        for sha256 in ('a' * 64, 'a' * 64, 'b' * 64)]
+    db.session.add_all([first, copy, other])
+    db.session.flush()
+
+    assert first.content_key == 'a' * 64
+    assert first.storage_is_shared()
+    assert not other.storage_is_shared()
+
+
+def test_attachment_deduplicate_storage(db, tmp_path, post_instance):
+    """
+    Should move ID-addressed files to content paths, merging identical copies.
+    """
+    attachments_path = tmp_path / 'attachments'
+    derivatives_path = tmp_path / 'derivatives'
+    attachments = [post_instance.new_attachment(mime_type='image/jpeg') for _ in range(4)]
+    db.session.add_all(attachments)
+    db.session.flush()
+
+    for attachment, data in zip(attachments, (b'SAME', b'SAME', b'DIFFERENT', None)):
+        attachment.base_path = attachments_path
+        if data is not None:
+            attachment.set_storage_data(data)
+    old_paths = [attachment.storage_path() for attachment in attachments]
+
+    derivative = attachments[0].new_derivative(width=10, height=10, allow_crop=False)
+    db.session.add(derivative)
+    db.session.flush()
+    derivative.base_path = derivatives_path
+    derivative.set_storage_data(b'SMALL')
+    old_derivative_path = derivative.storage_path()
+
+    pack_store = PackStore(base_path=derivatives_path, max_entry_bytes=1024, max_pack_bytes=1024)
+    packed = [attachment.new_derivative(width=20, height=20, allow_crop=False) for attachment in attachments[:3]]
+    db.session.add_all(packed)
+    db.session.flush()
+    for packed_derivative, data in zip(packed, (b'PACKED', b'PACKED', b'OTHER')):
+        pack_store.put(packed_derivative.storage_name, data)
+    db.session.commit()
+
+    counts = Attachment.deduplicate_storage(
+        attachments_path=attachments_path, derivatives_path=derivatives_path, workers=2, batch_size=2)
+
+    assert counts == {'moved': 2, 'merged': 1, 'missing': 1}
+    first, copy, other, missing = attachments
+    assert first.sha256 == copy.sha256 == hashlib.sha256(b'SAME').hexdigest()
+    assert other.sha256 == hashlib.sha256(b'DIFFERENT').hexdigest()
+    assert missing.sha256 is None
+    assert first.storage_path() == copy.storage_path()
+    assert first.storage_path().read_bytes() == b'SAME'
+    assert other.storage_path().read_bytes() == b'DIFFERENT'
+    assert not any(path.exists() for path in old_paths)
+
+    assert derivative.storage_path() != old_derivative_path
+    assert derivative.storage_path().read_bytes() == b'SMALL'
+    assert not old_derivative_path.exists()
+
+    assert packed[0].storage_name == packed[1].storage_name != packed[2].storage_name
+    assert [entry.name for entry in PackEntry.query.order_by(PackEntry.offset)] == [
+        packed[0].storage_name, packed[2].storage_name]
+    assert pack_store.get(packed[0].storage_name) == b'PACKED'
+    assert pack_store.get(packed[2].storage_name) == b'OTHER'
+
+    assert Attachment.deduplicate_storage(
+        attachments_path=attachments_path, derivatives_path=derivatives_path) == {'missing': 1}
+
+
+def test_attachment_migrate_storage_layout(db, tmp_path, post_instance):
+    """
+    Should move ID-addressed files into the new layout, and can be re-run.
+    """
+    attachments = [post_instance.new_attachment(mime_type='image/jpeg') for _ in range(3)]
+    attachments.append(post_instance.new_attachment(mime_type='image/jpeg', sha256='a' * 64))
+    db.session.add_all(attachments)
+    db.session.commit()
+
+    moved, already, missing, content_addressed = attachments
+    for attachment in attachments:
+        attachment.base_path = tmp_path
+    for attachment in (moved, already, content_addressed):
+        attachment.storage_path(layout=1, create_parents=True).write_bytes(b'DATA')
+    already.storage_path(layout=2, create_parents=True).write_bytes(b'DATA')
+
+    counts = Attachment.migrate_storage_layout(base_path=tmp_path, source=1, target=2, workers=2, batch_size=2)
+
+    assert counts == {'moved': 1, 'already': 1, 'missing': 1}
+    for attachment in (moved, already):
+        assert attachment.storage_path(layout=2).read_bytes() == b'DATA'
+        assert not attachment.storage_path(layout=1).exists()
+    assert content_addressed.storage_path().read_bytes() == b'DATA'
+
+    assert Attachment.migrate_storage_layout(base_path=tmp_path, source=1, target=2) == {
+        'already': 2, 'missing': 1}
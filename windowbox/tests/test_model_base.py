@@ -2,10 +2,11 @@
 Tests for the base model mixins.
 """
 
-import io
+import hashlib
 import pytest
 from unittest.mock import Mock, patch
-from windowbox.models import FilesystemMixin
+from windowbox.models import FilesystemMixin, configure_storage, hash_file, hashed_shards
+from windowbox.storage import ObjectStoreBackend
 
 
 @pytest.fixture
@@ -14,6 +15,9 @@ def fs_tester(tmp_path):
     Return a tester stub with a valid (and ephemeral) base path and ID.
     """
     class FS_Tester(FilesystemMixin):
+        storage_layout = 1
+        fallback_layout = None
+
         def __init__(self, base_path, id, mime_type):
             self.base_path = base_path
             self.id = id
@@ -26,28 +30,19 @@ def test_fs_mixin_has_storage_data(tmp_path, fs_tester):
     """
     Should be able to discern if storage data is present on disk.
     """
-    storage_path = tmp_path / 'storage.data'
-
-    with patch('windowbox.models.FilesystemMixin.storage_path', return_value=storage_path):
-        try:
-            storage_path.unlink()
-        except FileNotFoundError:
-            pass
-        assert not fs_tester.has_storage_data
+    assert not fs_tester.has_storage_data
 
-        storage_path.touch()
-        assert fs_tester.has_storage_data
+    fs_tester.storage_path(create_parents=True).touch()
+    assert fs_tester.has_storage_data
 
 
 def test_fs_mixin_storage_data_size_bytes(tmp_path, fs_tester):
     """
     Should be able to measure the size of the storage data.
     """
-    storage_path = tmp_path / 'storage.data'
-    storage_path.write_bytes(b'\x00' * 50)
+    fs_tester.storage_path(create_parents=True).write_bytes(b'\x00' * 50)
 
-    with patch('windowbox.models.FilesystemMixin.storage_path', return_value=storage_path):
-        assert fs_tester.storage_data_size_bytes == 50
+    assert fs_tester.storage_data_size_bytes == 50
 
 
 def test_fs_mixin_storage_path_requirements(fs_tester):
@@ -60,6 +55,8 @@ def test_fs_mixin_storage_path_requirements(fs_tester):
     fs_tester.base_path = None
     with pytest.raises(RuntimeError, match='base_path should not be None'):
         fs_tester.storage_path()
+    with pytest.raises(RuntimeError, match='base_path should not be None'):
+        fs_tester.has_storage_data
     fs_tester.base_path = old_base_path
 
     # It should require id
@@ -109,6 +106,175 @@ def test_fs_mixin_storage_path_directory(fs_tester):
     assert str(fs_tester.storage_path()).startswith(f'{prefix}/4/5/')
 
 
+def test_fs_mixin_storage_path_content_key(fs_tester):
+    """
+    Should build the path from the content key instead of the ID, if there is one.
+    """
+    key = 'abcdef' + '0' * 58
+    fs_tester.id = None
+    fs_tester.content_key = key
+
+    assert fs_tester.storage_path(create_parents=True) == (
+        fs_tester.base_path / 'sha256' / 'ab' / 'cd' / f'{key}.jpg')
+    assert (fs_tester.base_path / 'sha256' / 'ab' / 'cd').is_dir()
+
+
+def test_fs_mixin_delete_storage_data(fs_tester):
+    """
+    Should remove the file, unless another instance shares it.
+    """
+    fs_tester.set_storage_data(b'SNAUSAGES')
+    fs_tester.delete_storage_data()
+    fs_tester.delete_storage_data()
+    assert not fs_tester.has_storage_data
+
+    fs_tester.content_key = '0' * 64
+    assert not fs_tester.storage_is_shared()
+    fs_tester.storage_is_shared = Mock(return_value=True)
+    fs_tester.set_storage_data(b'SNAUSAGES')
+    fs_tester.delete_storage_data()
+    assert fs_tester.has_storage_data
+
+    fs_tester.storage_is_shared.return_value = False
+    fs_tester.delete_storage_data()
+    assert not fs_tester.has_storage_data
+
+
+def test_hash_file(tmp_path):
+    """
+    Should hash files larger than one chunk.
+    """
+    data = b'SNAUSAGES' * 300000
+    path = tmp_path / 'big.dat'
+    path.write_bytes(data)
+
+    assert hash_file(path) == hashlib.sha256(data).hexdigest()
+
+
+def test_fs_mixin_storage_path_hashed(fs_tester):
+    """
+    Should spread consecutive IDs evenly over the hashed layout's directories.
+    """
+    fs_tester.storage_layout = 2
+    prefixes = set()
+
+    for i in range(1000, 1100):
+        fs_tester.id = i
+        path = fs_tester.storage_path()
+        assert path.relative_to(fs_tester.base_path).parts == (*hashed_shards(str(i)), f'{i}.jpg')
+        prefixes.add(path.parent)
+
+    assert len(prefixes) > 95
+    assert hashed_shards('1234') == hashed_shards('1234')
+    assert all(len(d) == 2 for d in hashed_shards('1234'))
+
+
+def test_fs_mixin_storage_path_fallback(fs_tester):
+    """
+    Should read files from the fallback layout until they are in the new one.
+    """
+    fs_tester.storage_layout = 2
+    fs_tester.fallback_layout = 1
+    old_path = fs_tester.storage_path(layout=1)
+    new_path = fs_tester.storage_path(layout=2)
+
+    assert fs_tester.storage_path() == new_path
+    assert not fs_tester.has_storage_data
+
+    old_path.parent.mkdir(parents=True)
+    old_path.write_bytes(b'OLD')
+    assert fs_tester.storage_path() == old_path
+    assert fs_tester.storage_path(create_parents=True) == new_path
+
+    fs_tester.set_storage_data(b'NEW')
+    assert fs_tester.storage_path() == new_path
+    assert old_path.read_bytes() == b'OLD'
+
+
+def test_fs_mixin_storage_key_fallback(fs_tester):
+    """
+    Should find keys in the fallback layout through the backend.
+    """
+    fs_tester.storage_layout = 2
+    fs_tester.fallback_layout = 1
+
+    assert fs_tester.storage_key() == fs_tester.layout_key(2)
+
+    fs_tester.storage_path(layout=1, create_parents=True).write_bytes(b'OLD')
+    assert fs_tester.storage_key() == '1/2/1234.jpg'
+    assert fs_tester.storage_key(layout=2) == fs_tester.layout_key(2)
+
+    fs_tester.content_key = 'abcd'
+    assert fs_tester.storage_key() == 'sha256/ab/cd/abcd.jpg'
+
+
+def test_fs_mixin_storage_backend(tmp_path, fs_tester, object_store, s3_client, png_pixel):
+    """
+    Should keep storage data in the class's backend instead of base_path.
+    """
+    fs_tester.storage_backend = ObjectStoreBackend(client=s3_client)
+    fs_tester.base_path = None
+    stored = object_store.directory / 'bucket' / '1' / '2' / '1234.jpg'
+
+    fs_tester.set_storage_data(png_pixel)
+
+    assert stored.read_bytes() == png_pixel
+    assert fs_tester.has_storage_data
+    assert fs_tester.storage_data_size_bytes == len(png_pixel)
+    assert fs_tester.get_storage_data_as_image().size == (1, 1)
+    with fs_tester.open_storage_data() as fp:
+        assert fp.read() == png_pixel
+    with fs_tester.storage_local_file() as path:
+        assert path.read_bytes() == png_pixel
+
+    fs_tester.content_key = 'abcd'
+    source = tmp_path / '.incoming-1'
+    for expected in (True, False):
+        source.write_bytes(b'SHARED')
+        assert fs_tester.move_into_storage(source) is expected
+        assert not source.exists()
+    assert (object_store.directory / 'bucket' / 'sha256' / 'ab' / 'cd' / 'abcd.jpg').read_bytes() == b'SHARED'
+
+    fs_tester.content_key = None
+    fs_tester.delete_storage_data()
+    assert not stored.exists()
+
+
+def test_fs_mixin_id_addressed_query(fs_tester):
+    """
+    Should consider every instance to be ID-addressed by default.
+    """
+    type(fs_tester).query = Mock()
+
+    assert fs_tester.id_addressed_query() is fs_tester.query
+
+
+def test_configure_storage():
+    """
+    Should set the layouts of every model class, and refuse unknown ones.
+    """
+    layout, fallback_layout = FilesystemMixin.storage_layout, FilesystemMixin.fallback_layout
+    fsync = FilesystemMixin.fsync_policy
+
+    try:
+        configure_storage(layout=2, fallback_layout=2)
+        assert (FilesystemMixin.storage_layout, FilesystemMixin.fallback_layout) == (2, None)
+
+        configure_storage(layout=1, fallback_layout=2)
+        assert (FilesystemMixin.storage_layout, FilesystemMixin.fallback_layout) == (1, 2)
+
+        with pytest.raises(ValueError, match='Unknown storage layout: 3'):
+            configure_storage(layout=1, fallback_layout=3)
+
+        configure_storage(layout=1, fsync='full')
+        assert FilesystemMixin.fsync_policy == 'full'
+
+        with pytest.raises(ValueError, match='Unknown fsync policy: sometimes'):
+            configure_storage(layout=1, fsync='sometimes')
+    finally:
+        configure_storage(layout=layout, fallback_layout=fallback_layout, fsync=fsync)
+
+
 def test_fs_mixin_set_storage_data(fs_tester):
     """
     Should be able to save a bunch of bytes.
@@ -123,12 +289,14 @@ def test_fs_mixin_set_storage_data_from_image(fs_tester):
     Should be able to save data from a PIL Image.
     """
     fake_image = Mock()
+    fake_image.save.side_effect = lambda fp, **kwargs: fp.write(b'IMAGE')
 
     fs_tester.mime_type = 'image/jpeg'
     fs_tester.set_storage_data_from_image(fake_image)
 
     args, kwargs = fake_image.save.call_args
-    assert str(kwargs['fp']).endswith('/1234.jpg')
+    assert (fs_tester.base_path / '1' / '2' / '1234.jpg').read_bytes() == b'IMAGE'
+    assert kwargs['format'] == 'JPEG'
     assert kwargs['optimize'] is True
     assert kwargs['quality'] == 75
     assert kwargs['progressive'] is True
@@ -138,17 +306,66 @@ def test_fs_mixin_set_storage_data_from_image(fs_tester):
     fs_tester.set_storage_data_from_image(fake_image)
 
     args, kwargs = fake_image.save.call_args
-    assert str(kwargs['fp']).endswith('/1234.png')
+    assert (fs_tester.base_path / '1' / '2' / '1234.png').read_bytes() == b'IMAGE'
+    assert kwargs['format'] == 'PNG'
     assert kwargs['optimize'] is True
 
 
+def test_fs_mixin_set_storage_data_atomic(fs_tester):
+    """
+    Should leave the old data alone, and no temporary file, if a write fails.
+    """
+    fs_tester.set_storage_data(b'OLD')
+    broken_image = Mock()
+    broken_image.save.side_effect = lambda fp, **kwargs: [fp.write(b'HALF'), 1 / 0]
+
+    with pytest.raises(ZeroDivisionError):
+        fs_tester.set_storage_data_from_image(broken_image)
+
+    path = fs_tester.storage_path()
+    assert path.read_bytes() == b'OLD'
+    assert [p.name for p in path.parent.iterdir()] == [path.name]
+    assert path.stat().st_mode & 0o777 == 0o644
+
+
+@pytest.mark.parametrize('policy,synced', [('none', 0), ('file', 1), ('full', 2)])
+def test_fs_mixin_fsync_policy(fs_tester, policy, synced):
+    """
+    Should flush the file, and then its directory, as the policy says.
+    """
+    fs_tester.fsync_policy = policy
+
+    with patch('os.fsync') as mock_fsync:
+        fs_tester.set_storage_data(b'SNAUSAGES')
+
+    assert mock_fsync.call_count == synced
+
+
+def test_fs_mixin_move_into_storage(tmp_path, fs_tester):
+    """
+    Should move files into place, unless identical content is already there.
+    """
+    source = tmp_path / '.incoming-1'
+    source.write_bytes(b'FIRST')
+    assert fs_tester.move_into_storage(source)
+    assert fs_tester.storage_path().read_bytes() == b'FIRST'
+
+    source.write_bytes(b'AGAIN')
+    assert fs_tester.move_into_storage(source)
+    assert fs_tester.storage_path().read_bytes() == b'AGAIN'
+
+    fs_tester.content_key = '0' * 64
+    fs_tester.set_storage_data(b'SHARED')
+    source.write_bytes(b'SHARED')
+    assert not fs_tester.move_into_storage(source)
+    assert not source.exists()
+
+
 def test_fs_mixin_get_storage_data_as_image(fs_tester, png_pixel):
     """
     Should be able to read the storage data and return a PIL Image.
     """
-    png_fh = io.BytesIO(png_pixel)
-
-    fs_tester.storage_path = Mock(return_value=png_fh)
+    fs_tester.set_storage_data(png_pixel)
 
     image = fs_tester.get_storage_data_as_image()
     assert image.size == (1, 1)
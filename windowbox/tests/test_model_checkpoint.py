@@ -0,0 +1,72 @@
+"""
+Tests for the FetchCheckpoint and QuarantinedMessage models.
+"""
+
+from windowbox.models.checkpoint import FetchCheckpoint, QuarantinedMessage
+
+
+def test_fetch_checkpoint_load(db):
+    """
+    Should create a checkpoint once, then keep returning it.
+    """
+    checkpoint = FetchCheckpoint.load(mailbox='me@example.com/INBOX', uid_validity=7)
+
+    assert checkpoint.last_uid == 0
+    assert checkpoint.next_uid == 1
+
+    checkpoint.advance(41)
+    checkpoint.advance(12)
+    db.session.commit()
+
+    checkpoint = FetchCheckpoint.load(mailbox='me@example.com/INBOX', uid_validity=7)
+
+    assert checkpoint.next_uid == 42
+    assert FetchCheckpoint.query.count() == 1
+
+
+def test_fetch_checkpoint_load_reset(db):
+    """
+    Should start over when UIDVALIDITY changes or can't be known.
+    """
+    checkpoint = FetchCheckpoint.load(mailbox='INBOX', uid_validity=7)
+    checkpoint.advance(10)
+    checkpoint.record_failure(5, ValueError('bad'))
+    db.session.commit()
+
+    checkpoint = FetchCheckpoint.load(mailbox='INBOX', uid_validity=8)
+
+    assert checkpoint.uid_validity == 8
+    assert checkpoint.last_uid == 0
+    assert QuarantinedMessage.query.count() == 0
+
+    checkpoint.advance(10)
+    db.session.commit()
+
+    assert FetchCheckpoint.load(mailbox='INBOX', uid_validity=None).last_uid == 0
+    assert FetchCheckpoint.load(mailbox='INBOX', uid_validity=None).last_uid == 0
+
+
+def test_fetch_checkpoint_quarantine(db):
+    """
+    Should count failures, stop retrying at the limit, and release on success.
+    """
+    checkpoint = FetchCheckpoint.load(mailbox='INBOX', uid_validity=1)
+
+    assert checkpoint.record_failure(3, ValueError('bad')) == 1
+    assert checkpoint.record_failure(3, ValueError('worse' * 500)) == 2
+    assert checkpoint.record_failure(5, KeyError('nope')) == 1
+    db.session.commit()
+
+    quarantined = db.session.get(QuarantinedMessage, ('INBOX', 3))
+    assert quarantined.attempts == 2
+    assert quarantined.last_error.startswith('ValueError: worseworse')
+    assert len(quarantined.last_error) == QuarantinedMessage.ERROR_LENGTH
+
+    assert checkpoint.retry_uids(max_attempts=3) == [3, 5]
+    assert checkpoint.retry_uids(max_attempts=2) == [5]
+
+    checkpoint.record_success(3)
+    checkpoint.record_success(4)
+    db.session.commit()
+
+    assert [q.uid for q in QuarantinedMessage.query] == [5]
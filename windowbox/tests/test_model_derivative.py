@@ -8,6 +8,7 @@ import sqlalchemy.exc
 from PIL import Image
 from unittest.mock import Mock, PropertyMock, patch
 from windowbox.models.derivative import Derivative
+from windowbox.models.pack import PackStore
 
 
 @pytest.fixture
@@ -87,6 +88,51 @@ def test_derivative_attachment_id_dimensions_unique(db, attachment_instance):
         db.session.flush()
 
 
+def test_derivative_content_key(db, post_instance):
+    """
+    Should share storage between identical Derivatives of identical Attachments.
+    """
+    attachments = [
+        post_instance.new_attachment(mime_type='image/jpeg', sha256=sha256, orientation=1)
+        for sha256 in ('a' * 64, 'a' * 64, 'b' * 64, None)]
+    derivatives = [a.new_derivative(width=100, height=75, allow_crop=False) for a in attachments]
+    db.session.add_all(derivatives)
+    db.session.flush()
+
+    first, copy, other, legacy = derivatives
+    assert first.content_key == copy.content_key
+    assert first.content_key not in (other.content_key, None)
+    assert legacy.content_key is None
+
+    assert first.storage_is_shared()
+    assert not other.storage_is_shared()
+
+    bigger = attachments[1].new_derivative(width=200, height=150, allow_crop=False)
+    db.session.add(bigger)
+    db.session.flush()
+    assert bigger.content_key != copy.content_key
+    assert not bigger.storage_is_shared()
+
+
+def test_derivative_migrate_storage_layout(db, tmp_path, post_instance):
+    """
+    Should only move the Derivatives of ID-addressed Attachments.
+    """
+    legacy = post_instance.new_attachment(mime_type='image/jpeg')
+    shared = post_instance.new_attachment(mime_type='image/jpeg', sha256='a' * 64)
+    derivatives = [a.new_derivative(width=10, height=10, allow_crop=False) for a in (legacy, shared)]
+    db.session.add_all(derivatives)
+    db.session.commit()
+
+    for derivative in derivatives:
+        derivative.base_path = tmp_path
+        derivative.storage_path(layout=1, create_parents=True).write_bytes(b'DATA')
+
+    assert Derivative.migrate_storage_layout(base_path=tmp_path, source=1, target=2) == {'moved': 1}
+    assert derivatives[0].storage_path(layout=2).read_bytes() == b'DATA'
+    assert derivatives[1].storage_path().read_bytes() == b'DATA'
+
+
 def test_derivative_ensure_storage_data(attachment_instance_with_data):
     """
     Should create storage data if it is needed, and no-op otherwise.
@@ -118,6 +164,96 @@ def test_derivative_ensure_storage_data(attachment_instance_with_data):
         assert out_pix[99, 75] == (0, 0, 0)
 
 
+def test_derivative_packed_storage(db, tmp_path, attachment_instance_with_data):
+    """
+    Should put small Derivatives in the pack store and large ones in files.
+    """
+    attachment_instance_with_data.mime_type = 'image/png'
+    db.session.add(attachment_instance_with_data)
+    small = attachment_instance_with_data.new_derivative(width=10, height=10, allow_crop=True)
+    large = attachment_instance_with_data.new_derivative(width=None, height=None, allow_crop=False)
+    db.session.add_all([small, large])
+    db.session.commit()
+
+    pack_store = PackStore(base_path=tmp_path, max_entry_bytes=1024, max_pack_bytes=1024)
+    for derivative, max_entry_bytes in ((small, 1024), (large, 0)):
+        pack_store.max_entry_bytes = max_entry_bytes
+        derivative.base_path = tmp_path
+        derivative.pack_store = pack_store
+        assert not derivative.has_storage_data
+        assert derivative.get_packed_data() is None
+        derivative.ensure_storage_data()
+        assert derivative.has_storage_data
+
+    assert not small.storage_path().exists()
+    assert small.storage_data_size_bytes == small.pack_entry.length
+    assert Image.open(io.BytesIO(small.get_packed_data())).size == (10, 10)
+    assert large.pack_entry is None
+    assert large.storage_data_size_bytes == large.storage_path().stat().st_size
+
+    with patch.object(Derivative, 'to_image') as mock_to_image:
+        small.ensure_storage_data()
+    mock_to_image.assert_not_called()
+
+    small.delete_storage_data()
+    large.delete_storage_data()
+    db.session.commit()
+    assert not small.has_storage_data
+    assert not large.has_storage_data
+
+    small.pack_store = None
+    assert small.get_packed_data() is None
+
+
+def test_derivative_packed_storage_unreadable(db, tmp_path, attachment_instance_with_data):
+    """
+    Should render a packed Derivative again if its pack is missing or truncated.
+    """
+    attachment_instance_with_data.mime_type = 'image/png'
+    db.session.add(attachment_instance_with_data)
+    derivative = attachment_instance_with_data.new_derivative(width=10, height=10, allow_crop=True)
+    db.session.add(derivative)
+    db.session.commit()
+
+    pack_store = PackStore(base_path=tmp_path, max_entry_bytes=1024, max_pack_bytes=1024)
+    derivative.base_path = tmp_path
+    derivative.pack_store = pack_store
+    derivative.ensure_storage_data()
+    data = derivative.get_packed_data()
+
+    pack_store.path(1).write_bytes(b'short')
+    assert derivative.get_packed_data() == data
+    assert derivative.pack_entry.offset == 5
+
+    pack_store.path(1).unlink()
+    assert derivative.get_packed_data() == data
+    assert derivative.pack_entry.offset == 0
+
+
+def test_derivative_packed_storage_shared(db, tmp_path, post_instance):
+    """
+    Should keep a packed entry while another Derivative shares it.
+    """
+    attachments = [post_instance.new_attachment(mime_type='image/png', sha256='a' * 64) for _ in range(2)]
+    derivatives = [a.new_derivative(width=10, height=10, allow_crop=False) for a in attachments]
+    db.session.add_all(derivatives)
+    db.session.commit()
+
+    pack_store = PackStore(base_path=tmp_path, max_entry_bytes=200, max_pack_bytes=1024)
+    pack_store.put(derivatives[0].storage_name, b'PNG')
+    for derivative in derivatives:
+        derivative.pack_store = pack_store
+
+    derivatives[0].delete_storage_data()
+    assert derivatives[1].get_packed_data() == b'PNG'
+
+    db.session.delete(derivatives[0])
+    db.session.flush()
+    derivatives[1].delete_storage_data()
+    db.session.flush()
+    assert derivatives[1].pack_entry is None
+
+
 def test_derivative_to_image_transpose(attachment_instance_with_data):
     """
     Should rotate/flip images as required.
@@ -0,0 +1,125 @@
+"""
+Tests for the GeocodeCache model and CachedGeocoder.
+"""
+
+import pytest
+from datetime import datetime, timedelta, timezone
+from unittest.mock import Mock
+from windowbox.clients.gmapi import GMAPIClientError
+from windowbox.models.geocode import CachedGeocoder, GeocodeCache
+
+
+@pytest.fixture
+def geocoder(app, db):
+    """
+    Return a CachedGeocoder wrapping a mock client that always finds "Here".
+    """
+    client = Mock()
+    client.latlng_to_address.return_value = 'Here'
+
+    return CachedGeocoder(client=client, app=app, grid=0.001, ttl=60)
+
+
+def test_geocode_cache_cell_for():
+    """
+    Should round to the nearest cell and name the grid size.
+    """
+    assert GeocodeCache.cell_for(latitude=36.00001, longitude=-78.90049, grid=0.001) == '0.001:36000:-78900'
+    assert GeocodeCache.cell_for(latitude=36.0006, longitude=-78.9, grid=0.001) == '0.001:36001:-78900'
+    assert GeocodeCache.cell_for(latitude=36.0006, longitude=-78.9, grid=0.01) == '0.01:3600:-7890'
+
+
+def test_cached_geocoder_hit_miss(db, geocoder):
+    """
+    Should only ask the client once per cell, and count hits and misses.
+    """
+    assert geocoder.latlng_to_address(latitude=36.0, longitude=-78.9) == 'Here'
+    assert geocoder.latlng_to_address(latitude=36.0002, longitude=-78.9001) == 'Here'
+    assert geocoder.latlng_to_address(latitude=36.0, longitude=-78.9) == 'Here'
+
+    geocoder.client.latlng_to_address.assert_called_once_with(latitude=36.0, longitude=-78.9)
+
+    row = GeocodeCache.query.one()
+    assert row.cell == '0.001:36000:-78900'
+    assert row.hit_count == 2
+    assert row.miss_count == 1
+
+
+def test_cached_geocoder_none(db, geocoder):
+    """
+    Should cache places that have no address at all.
+    """
+    geocoder.client.latlng_to_address.return_value = None
+
+    assert geocoder.latlng_to_address(latitude=0, longitude=-150) is None
+    assert geocoder.latlng_to_address(latitude=0, longitude=-150) is None
+
+    assert geocoder.client.latlng_to_address.call_count == 1
+
+
+@pytest.mark.parametrize('ttl,calls', [(60, 2), (0, 1)])
+def test_cached_geocoder_ttl(db, geocoder, ttl, calls):
+    """
+    Should look up expired cells again, unless the TTL is disabled.
+    """
+    geocoder.ttl = ttl
+    db.session.add(GeocodeCache(
+        cell='0.001:36000:-78900', address='Old',
+        updated_utc=datetime.now(timezone.utc) - timedelta(seconds=61)))
+    db.session.commit()
+
+    geocoder.latlng_to_address(latitude=36.0, longitude=-78.9)
+    geocoder.latlng_to_address(latitude=36.0, longitude=-78.9)
+
+    row = GeocodeCache.query.one()
+    assert row.address == ('Here' if ttl else 'Old')
+    assert row.miss_count == calls - 1
+    assert geocoder.client.latlng_to_address.call_count == calls - 1
+
+
+def test_cached_geocoder_failure(db, geocoder):
+    """
+    Should not cache failed lookups.
+    """
+    geocoder.client.latlng_to_address.side_effect = GMAPIClientError('testing API failure')
+
+    with pytest.raises(GMAPIClientError):
+        geocoder.latlng_to_address(latitude=36.0, longitude=-78.9)
+
+    assert GeocodeCache.query.count() == 0
+
+
+def test_cached_geocoder_engine_fork(geocoder):
+    """
+    Should drop the pooled connections inherited from a parent process.
+    """
+    geocoder._engine = engine = Mock()
+
+    assert geocoder.engine is engine
+    engine.dispose.assert_called_once_with(close=False)
+
+    assert geocoder.engine is engine
+    assert engine.dispose.call_count == 1
+
+
+def test_geocode_cache_backfill(db, attachment_instance, post_instance):
+    """
+    Should seed one cell per distinct place, preferring the newest address.
+    """
+    older = post_instance.new_attachment(mime_type='image/jpeg')
+    older.geo_latitude, older.geo_longitude, older.geo_address = 36.0, -78.9, 'Older'
+    attachment_instance.geo_latitude = 36.0001
+    attachment_instance.geo_longitude = -78.9
+    attachment_instance.geo_address = 'Newer'
+    elsewhere = post_instance.new_attachment(mime_type='image/jpeg')
+    elsewhere.geo_latitude, elsewhere.geo_longitude = 40.0, -75.0
+    db.session.add_all([older, attachment_instance, elsewhere])
+    db.session.add(GeocodeCache(
+        cell='0.001:0:0', address='Null Island', updated_utc=datetime.now(timezone.utc)))
+    db.session.commit()
+
+    assert GeocodeCache.backfill(grid=0.001) == 1
+    assert GeocodeCache.backfill(grid=0.001) == 0
+
+    cached = {row.cell: row.address for row in GeocodeCache.query}
+    assert cached == {'0.001:0:0': 'Null Island', '0.001:36000:-78900': 'Newer'}
@@ -0,0 +1,187 @@
+"""
+Tests for the pack-file store.
+"""
+
+import os
+import pytest
+import time
+from unittest.mock import patch
+from windowbox.models.pack import PackEntry, PackError, PackStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    """
+    Return a PackStore whose packs hold at most 10 bytes.
+    """
+    return PackStore(base_path=tmp_path, max_entry_bytes=8, max_pack_bytes=10)
+
+
+def test_append(store):
+    """
+    Should append to the current pack, starting a new one when it fills up.
+    """
+    assert store.append(b'abcd') == (1, 0)
+    assert store.append(b'efgh') == (1, 4)
+    assert store.append(b'ijkl') == (2, 0)
+    assert store.append(b'0123456789ABC') == (3, 0)
+    assert store.append(b'm') == (4, 0)
+
+    assert store.packs() == [1, 2, 3, 4]
+    assert store.path(1).read_bytes() == b'abcdefgh'
+    assert store.path(3).read_bytes() == b'0123456789ABC'
+
+
+@pytest.mark.parametrize('fsync, files, directories', [('none', 0, 0), ('file', 3, 0), ('full', 3, 2)])
+def test_append_fsync(tmp_path, fsync, files, directories):
+    """
+    Should flush appends, and new packs' directory entries, as asked.
+    """
+    store = PackStore(base_path=tmp_path, max_entry_bytes=8, max_pack_bytes=10, fsync=fsync)
+
+    with patch('os.fsync') as mock_fsync, patch('windowbox.models.pack.fsync_path') as mock_fsync_path:
+        for data in (b'abcd', b'efgh', b'ijkl'):
+            store.append(data)
+
+    assert mock_fsync.call_count == files
+    assert mock_fsync_path.call_count == directories
+
+
+def test_append_other_process(store, tmp_path):
+    """
+    Should follow other processes to newer packs, and recover from removed ones.
+    """
+    other = PackStore(base_path=tmp_path, max_entry_bytes=8, max_pack_bytes=10)
+
+    assert store.append(b'abcdefgh') == (1, 0)
+    assert other.append(b'ijkl') == (2, 0)
+    assert store.append(b'm') == (2, 4)
+
+    store.current = 1
+    store.path(1).unlink()
+    assert store.append(b'n') == (2, 5)
+
+
+def test_accepts(store):
+    """
+    Should only accept data up to the entry size limit.
+    """
+    assert store.accepts(8)
+    assert not store.accepts(9)
+
+
+def test_put_get(db, store):
+    """
+    Should store and read back data by name.
+    """
+    store.put('a.jpg', b'apple')
+    store.put('b.jpg', b'banana')
+
+    assert store.get('a.jpg') == b'apple'
+    assert store.get('b.jpg') == b'banana'
+    assert store.get('c.jpg') is None
+    assert store.entry('b.jpg').length == 6
+
+
+def test_put_race(db, store):
+    """
+    Should keep the first entry when two processes store the same name.
+    """
+    store.put('a.jpg', b'apple')
+
+    with patch('windowbox.models.pack.db.session.merge', side_effect=lambda entry: db.session.add(entry)):
+        store.put('a.jpg', b'avocado')
+
+    assert store.get('a.jpg') == b'apple'
+
+
+def test_read_truncated(db, store):
+    """
+    Should refuse to return less data than the entry describes.
+    """
+    store.put('a.jpg', b'apple')
+    store.path(1).write_bytes(b'app')
+
+    with pytest.raises(PackError, match='truncated'):
+        store.get('a.jpg')
+
+
+def test_get_moved(db, store):
+    """
+    Should look an entry up again if its pack is removed while reading it.
+    """
+    store.put('a.jpg', b'apple')
+    entry = store.entry('a.jpg')
+
+    with patch.object(store, 'read', side_effect=[FileNotFoundError, b'apple']) as mock_read:
+        assert store.get('a.jpg') == b'apple'
+
+    assert mock_read.call_count == 2
+    assert mock_read.call_args.args == (entry,)
+
+
+def test_discard(db, store):
+    """
+    Should forget an entry, leaving its data behind.
+    """
+    store.put('a.jpg', b'apple')
+    store.discard('a.jpg')
+
+    assert store.get('a.jpg') is None
+    assert store.path(1).read_bytes() == b'apple'
+
+
+def test_compact(db, store):
+    """
+    Should rewrite sealed packs that are mostly unused, and leave the rest.
+    """
+    store.put('dead1', b'xxxxxx')
+    store.put('live1', b'abc')
+    store.put('live2', b'defghi')
+    store.put('dead2', b'yyy')
+    store.put('live3', b'jk')
+    for name in ('dead1', 'dead2'):
+        db.session.delete(store.entry(name))
+    db.session.commit()
+    assert store.packs() == [1, 2, 3]
+
+    assert store.compact() == {}
+
+    counts = store.compact(min_age=0)
+
+    assert counts == {'packs': 1, 'entries': 1, 'bytes': 6}
+    assert store.packs() == [2, 3]
+    assert store.entry('live1').pack == 3
+    assert [store.get(name) for name in ('live1', 'live2', 'live3')] == [b'abc', b'defghi', b'jk']
+    assert PackEntry.query.count() == 3
+
+    assert store.compact(min_age=0) == {}
+
+
+def test_compact_late_entry(db, store):
+    """
+    Should move entries committed while a pack is being compacted.
+    """
+    store.put('dead', b'xxxx')
+    pack, offset = store.append(b'late')
+    store.put('live', b'abc')
+    db.session.delete(store.entry('dead'))
+    db.session.commit()
+    old = time.time() - 7200
+    os.utime(store.path(1), (old, old))
+
+    real_entries_in = store.entries_in
+
+    def entries_in(number):
+        entries = real_entries_in(number)
+        if number == 1 and not entries and store.entry('late') is None:
+            db.session.add(PackEntry(name='late', pack=pack, offset=offset, length=4))
+            db.session.commit()
+        return entries
+
+    with patch.object(store, 'entries_in', side_effect=entries_in):
+        counts = store.compact()
+
+    assert counts == {'packs': 1, 'entries': 1, 'bytes': 8}
+    assert store.packs() == [2]
+    assert store.get('late') == b'late'
@@ -0,0 +1,47 @@
+"""
+Tests for the local service stand-ins.
+"""
+
+import requests
+import time
+from windowbox.standins import GEOCODE_PATH, GeocodeStandIn
+
+
+def test_geocode_standin():
+    """
+    Should replay canned responses in order, then answer with its address.
+    """
+    with GeocodeStandIn(responses=[(503, {})], address='Somewhere') as server:
+        url = server.base_url + GEOCODE_PATH
+
+        assert requests.get(url).status_code == 503
+        assert requests.get(url).json()['results'][-1]['formatted_address'] == 'Somewhere'
+        assert requests.get(server.base_url + '/nope').status_code == 404
+        assert requests.post(url).status_code == 405
+
+    assert [path for path, _ in server.requests] == [GEOCODE_PATH, GEOCODE_PATH, '/nope']
+    assert server.connections == 4
+
+
+def test_object_store_standin_unsigned(object_store, s3_client):
+    """
+    Should refuse requests that are not signed with its access key.
+    """
+    url = f'{object_store.base_url}/bucket/key'
+
+    assert requests.put(url, data=b'DATA').status_code == 403
+    assert requests.put(url, data=b'DATA', headers={
+        'Authorization': 'AWS4-HMAC-SHA256 Credential=XX/20260101/us-east-1/s3/aws4_request, '
+                         'SignedHeaders=host, Signature=00'}).status_code == 403
+    assert s3_client.head_object('key') is None
+
+
+def test_geocode_standin_latency():
+    """
+    Should wait before answering each request.
+    """
+    with GeocodeStandIn(latency=0.2) as server:
+        started = time.monotonic()
+        requests.get(server.base_url + GEOCODE_PATH)
+
+        assert time.monotonic() - started >= 0.2
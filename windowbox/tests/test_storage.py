@@ -0,0 +1,274 @@
+"""
+Tests for the storage backends.
+"""
+
+import errno
+import os
+import pytest
+from unittest.mock import patch
+from windowbox import storage
+from windowbox.storage import (
+    STORAGE_FILE_MODE, CachedBackend, LocalBackend, ObjectStoreBackend, StorageBackend, make_backend,
+    sweep_temp_files)
+
+
+@pytest.fixture
+def object_backend(s3_client):
+    """
+    Return an ObjectStoreBackend on the object store stand-in.
+    """
+    return ObjectStoreBackend(client=s3_client, prefix='things/')
+
+
+@pytest.fixture
+def cached_backend(tmp_path, object_backend):
+    """
+    Return a CachedBackend in front of the object store stand-in.
+    """
+    return CachedBackend(origin=object_backend, cache=LocalBackend(tmp_path / 'cache'))
+
+
+def test_storage_backend_interface():
+    """
+    Should refuse to build a backend that doesn't implement everything.
+    """
+    class Incomplete(StorageBackend):
+        def put(self, key, source):
+            pass
+
+    with pytest.raises(TypeError, match='abstract'):
+        Incomplete()
+
+
+def test_local_backend(tmp_path):
+    """
+    Should keep each key in a file beneath the base path.
+    """
+    backend = LocalBackend(tmp_path, fsync='none')
+    source = tmp_path / '.incoming-1'
+    source.write_bytes(b'FIRST')
+    source.chmod(0o600)
+
+    backend.put('a/b/1.jpg', source)
+
+    assert not source.exists()
+    assert backend.exists('a/b/1.jpg')
+    assert backend.size('a/b/1.jpg') == 5
+    assert backend.path('a/b/1.jpg').stat().st_mode & 0o777 == STORAGE_FILE_MODE
+    assert backend.serve_hint('a/b/1.jpg') == tmp_path / 'a' / 'b' / '1.jpg'
+
+    with backend.writer('a/b/1.jpg') as fp:
+        fp.write(b'SECOND')
+    assert backend.path('a/b/1.jpg').stat().st_mode & 0o777 == STORAGE_FILE_MODE
+    with backend.open('a/b/1.jpg') as fp:
+        assert fp.read() == b'SECOND'
+    with backend.local_file('a/b/1.jpg') as path:
+        assert path == tmp_path / 'a' / 'b' / '1.jpg'
+
+    backend.delete('a/b/1.jpg')
+    backend.delete('a/b/1.jpg')
+
+    assert not backend.exists('a/b/1.jpg')
+    with pytest.raises(FileNotFoundError):
+        backend.open('a/b/1.jpg')
+
+
+def test_local_backend_cross_device(tmp_path):
+    """
+    Should copy a source that can't be renamed across filesystems.
+    """
+    backend = LocalBackend(tmp_path / 'store', fsync='none')
+    source = tmp_path / '.incoming-1'
+    source.write_bytes(b'FIRST')
+    real_install_file = storage.install_file
+
+    def install_file(source, path, *, fsync):
+        if source.name == '.incoming-1':
+            raise OSError(errno.EXDEV, 'Invalid cross-device link')
+        real_install_file(source, path, fsync=fsync)
+
+    with patch('windowbox.storage.install_file', side_effect=install_file):
+        backend.put('a/1.jpg', source)
+
+    assert not source.exists()
+    assert backend.path('a/1.jpg').read_bytes() == b'FIRST'
+    assert backend.path('a/1.jpg').stat().st_mode & 0o777 == STORAGE_FILE_MODE
+    assert [p.name for p in backend.path('a').iterdir()] == ['1.jpg']
+
+    source.write_bytes(b'SECOND')
+    with patch('windowbox.storage.install_file', side_effect=OSError(errno.EACCES, 'Permission denied')):
+        with pytest.raises(PermissionError):
+            backend.put('a/1.jpg', source)
+
+    assert source.exists()
+    assert backend.path('a/1.jpg').read_bytes() == b'FIRST'
+
+
+def test_object_store_backend(tmp_path, object_store, object_backend):
+    """
+    Should keep each key in a prefixed object, and stream it back.
+    """
+    source = tmp_path / '.incoming-1'
+    source.write_bytes(b'SNAUSAGES')
+
+    object_backend.put('a/1.jpg', source)
+
+    assert not source.exists()
+    assert (object_store.directory / 'bucket' / 'things' / 'a' / '1.jpg').read_bytes() == b'SNAUSAGES'
+    assert object_backend.exists('a/1.jpg')
+    assert object_backend.size('a/1.jpg') == 9
+    assert object_backend.serve_hint('a/1.jpg') is None
+
+    with object_backend.writer('a/2.jpg') as fp:
+        fp.write(b'0123456789' * 2)
+    with object_backend.open('a/2.jpg') as fp:
+        assert fp.read() == b'0123456789' * 2
+    with object_backend.local_file('a/2.jpg') as path:
+        assert path.read_bytes() == b'0123456789' * 2
+        assert path.suffix == '.jpg'
+    assert not path.exists()
+
+    object_backend.delete('a/1.jpg')
+
+    assert not object_backend.exists('a/1.jpg')
+    with pytest.raises(FileNotFoundError):
+        object_backend.size('a/1.jpg')
+    with pytest.raises(FileNotFoundError):
+        object_backend.open('a/1.jpg')
+
+
+def test_object_store_backend_writer_failure(tmp_path, object_backend):
+    """
+    Should store nothing, and leave no temporary file, if a write fails.
+    """
+    with patch('tempfile.tempdir', str(tmp_path)):
+        with pytest.raises(ZeroDivisionError):
+            with object_backend.writer('a/1.jpg') as fp:
+                fp.write(b'HALF')
+                1 / 0
+
+    assert not object_backend.exists('a/1.jpg')
+    assert not [p for p in tmp_path.iterdir() if p.name.startswith('.tmp-')]
+
+
+def test_object_store_backend_public_url(s3_client):
+    """
+    Should point browsers at the public copy of each object.
+    """
+    backend = ObjectStoreBackend(client=s3_client, prefix='things/', public_url='https://cdn.example.com/')
+
+    assert backend.serve_hint('a/1 2.jpg') == 'https://cdn.example.com/things/a/1%202.jpg'
+
+
+def test_cached_backend(tmp_path, object_store, cached_backend):
+    """
+    Should write through to the origin, and read through the cache.
+    """
+    cache, origin = cached_backend.cache, cached_backend.origin
+    source = tmp_path / '.incoming-1'
+    source.write_bytes(b'SNAUSAGES')
+
+    cached_backend.put('a/1.jpg', source)
+
+    assert cache.exists('a/1.jpg')
+    assert origin.exists('a/1.jpg')
+    assert cached_backend.size('a/1.jpg') == 9
+
+    cache.delete('a/1.jpg')
+    assert cached_backend.exists('a/1.jpg')
+    assert cached_backend.size('a/1.jpg') == 9
+
+    with cached_backend.open('a/1.jpg') as fp:
+        assert fp.read() == b'SNAUSAGES'
+    assert cache.exists('a/1.jpg')
+
+    requests_before = len(object_store.requests)
+    assert cached_backend.serve_hint('a/1.jpg') == cache.path('a/1.jpg')
+    with cached_backend.local_file('a/1.jpg') as path:
+        assert path == cache.path('a/1.jpg')
+    assert len(object_store.requests) == requests_before
+
+    cached_backend.delete('a/1.jpg')
+
+    assert not cached_backend.exists('a/1.jpg')
+    with pytest.raises(FileNotFoundError):
+        cached_backend.open('a/1.jpg')
+    assert not any(p.is_file() for p in cache.base_path.rglob('*'))
+
+
+def test_cached_backend_cross_device(tmp_path, cached_backend):
+    """
+    Should keep a copy in the cache even when the source is on another disk.
+    """
+    source = tmp_path / '.incoming-1'
+    source.write_bytes(b'SNAUSAGES')
+    real_replace = os.replace
+
+    def replace(src, dst):
+        if str(src) == str(source):
+            raise OSError(errno.EXDEV, 'Invalid cross-device link')
+        real_replace(src, dst)
+
+    with patch('os.replace', side_effect=replace):
+        cached_backend.put('a/1.jpg', source)
+
+    assert not source.exists()
+    assert cached_backend.cache.path('a/1.jpg').read_bytes() == b'SNAUSAGES'
+    assert cached_backend.origin.size('a/1.jpg') == 9
+
+
+def test_cached_backend_trim(cached_backend):
+    """
+    Should remove the least recently accessed files first.
+    """
+    cache = cached_backend.cache
+    for n in range(4):
+        with cache.writer(f'{n}.jpg') as fp:
+            fp.write(b'x' * 10)
+        os.utime(cache.path(f'{n}.jpg'), (1000 - n, 1000 - n))
+    cache.path('.tmp-abc').write_bytes(b'x' * 100)
+
+    counts = cached_backend.trim(25)
+
+    assert counts == {'files': 2, 'bytes': 20}
+    assert sorted(p.name for p in cache.base_path.iterdir()) == ['.tmp-abc', '0.jpg', '1.jpg']
+    assert cached_backend.trim(25) == {}
+
+
+def test_make_backend(tmp_path, s3_client):
+    """
+    Should build the named backend.
+    """
+    assert make_backend(name='local') is None
+
+    backend = make_backend(name='s3', client=s3_client, prefix='p/', public_url='http://x')
+    assert isinstance(backend, ObjectStoreBackend)
+    assert (backend.client, backend.prefix, backend.public_url) == (s3_client, 'p/', 'http://x')
+
+    backend = make_backend(name='cached', client=s3_client, cache_path=tmp_path, fsync='full')
+    assert isinstance(backend, CachedBackend)
+    assert (backend.cache.base_path, backend.cache.fsync) == (tmp_path, 'full')
+
+    with pytest.raises(ValueError, match='Unknown storage backend: ftp'):
+        make_backend(name='ftp')
+
+
+def test_sweep_temp_files(tmp_path):
+    """
+    Should remove old temporary files anywhere beneath the base path.
+    """
+    shard = tmp_path / 'ab' / 'cd'
+    shard.mkdir(parents=True)
+    old = [tmp_path / '.incoming-abc', shard / '.tmp-xyz']
+    new = [shard / '.tmp-new']
+    keep = [shard / '1234.jpg']
+    for path in old + new + keep:
+        path.write_bytes(b'DATA')
+    for path in old + keep:
+        os.utime(path, (0, 0))
+
+    with patch('pathlib.Path.unlink', autospec=True, side_effect=[None, FileNotFoundError]):
+        assert sweep_temp_files(tmp_path, min_age=60) == 1
+
+    assert sweep_temp_files(tmp_path, min_age=60) == 2
+    assert sorted(p for p in tmp_path.rglob('*') if p.is_file()) == sorted(new + keep)
@@ -0,0 +1,104 @@
+"""
+Tests for the synthetic data generator.
+"""
+
+import io
+import pytest
+import random
+from PIL import ExifTags, Image
+from windowbox.synthetic import (
+    SyntheticSpec, caption_for, dms, exif_data, make_spec, parse_size, render_image)
+
+
+def test_parse_size():
+    """
+    Should parse WIDTHxHEIGHT strings and reject anything else.
+    """
+    assert parse_size('2000x1500') == (2000, 1500)
+    assert parse_size('10X20') == (10, 20)
+
+    for bad in ('2000', '2000x', 'axb', '1x2x3', '0x10'):
+        with pytest.raises(ValueError):
+            parse_size(bad)
+
+
+def test_make_spec():
+    """
+    Should only choose from the provided sizes and orientations.
+    """
+    rng = random.Random(1)
+
+    for _ in range(20):
+        spec = make_spec(rng=rng, sizes=[(4, 3), (3, 4)], orientations=[6, 8], exif_payload='basic')
+        assert spec.size in [(4, 3), (3, 4)]
+        assert spec.orientation in [6, 8]
+        assert spec.exif_payload == 'basic'
+        assert all(0 <= c <= 255 for c in spec.color)
+
+
+def test_caption_for():
+    """
+    Should use the color's hex triplet as the caption.
+    """
+    spec = SyntheticSpec(color=(1, 171, 255), size=(4, 3), orientation=1, exif_payload='none')
+
+    assert caption_for(spec) == '#01ABFF'
+
+
+def test_dms():
+    """
+    Should convert signed degrees into unsigned degrees/minutes/seconds.
+    """
+    assert dms(36.0) == (36.0, 0.0, 0.0)
+    assert dms(-78.9) == (78.0, 54.0, 0.0)
+
+
+def test_render_image_none():
+    """
+    Should render a JPEG of the requested size with no EXIF data.
+    """
+    spec = SyntheticSpec(color=(10, 20, 30), size=(40, 30), orientation=6, exif_payload='none')
+    image = Image.open(io.BytesIO(render_image(spec)))
+
+    assert image.format == 'JPEG'
+    assert image.size == (40, 30)
+    assert len(image.getexif()) == 0
+
+
+def test_render_image_full():
+    """
+    Should embed the orientation, camera, exposure, and GPS tags.
+    """
+    spec = SyntheticSpec(color=(10, 20, 30), size=(30, 40), orientation=8, exif_payload='full')
+    exif = Image.open(io.BytesIO(render_image(spec))).getexif()
+
+    assert exif[ExifTags.Base.Orientation] == 8
+    assert exif[ExifTags.Base.Make] == 'Windowbox'
+    assert exif.get_ifd(ExifTags.IFD.Exif)[ExifTags.Base.FNumber] == 2.8
+
+    gps = exif.get_ifd(ExifTags.IFD.GPSInfo)
+    assert gps[ExifTags.GPS.GPSLatitudeRef] == 'N'
+    assert gps[ExifTags.GPS.GPSLongitudeRef] == 'W'
+    assert gps[ExifTags.GPS.GPSLongitude] == (78.0, 54.0, 0.0)
+
+
+def test_exif_data():
+    """
+    Should describe each payload in the same flattened form ExifTool uses.
+    """
+    spec = SyntheticSpec(color=(10, 20, 30), size=(40, 30), orientation=6, exif_payload='none')
+    none = exif_data(spec)
+    basic = exif_data(spec._replace(exif_payload='basic'))
+    full = exif_data(spec._replace(exif_payload='full'))
+
+    assert none['File:ImageWidth.val'] == 40
+    assert none['File:ImageHeight.val'] == 30
+    assert 'EXIF:Orientation.num' not in none
+
+    assert basic['EXIF:Orientation.num'] == 6
+    assert basic['EXIF:Orientation.val'] == 'Rotate 90 CW'
+    assert 'Composite:GPSLatitude.num' not in basic
+
+    assert full['Composite:GPSLatitude.num'] == 36.0
+    assert full['Composite:GPSLongitude.num'] == -78.9
+    assert set(none) < set(basic) < set(full)
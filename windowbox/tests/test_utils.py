@@ -4,6 +4,9 @@ Tests for the app utilities.
 
 import windowbox.utils
 from datetime import datetime, timezone
+from decimal import Decimal
+from flask.json.provider import DefaultJSONProvider
+from unittest.mock import patch
 
 
 def test_datetime_to_rfc2822():
@@ -60,3 +63,23 @@ def test_minify_xml():
     assert windowbox.utils.minify_xml(xml, encoding='utf-8') == \
         b"<?xml version='1.0' encoding='utf-8'?>\n" \
         b"<top><el><data>first</data></el><el><data>second</data></el></top>"
+
+
+def test_fast_json_provider(app):
+    """
+    Should encode compact JSON the same way as Flask's default provider.
+    """
+    default = DefaultJSONProvider(app)
+    fast = windowbox.utils.FastJSONProvider(app)
+    obj = {
+        'z': [1, 2.5, None, True], 'a': {'b': 'c'}, 'n': {1: 'one'},
+        'when': datetime(2019, 10, 27, tzinfo=timezone.utc), 'amount': Decimal('1.50')}
+
+    assert fast.dumps(obj) == default.dumps(obj, separators=(',', ':'))
+    assert fast.dumps(obj, separators=(',', ':')) == fast.dumps(obj)
+    assert fast.dumps(obj, indent=2) == default.dumps(obj, indent=2)
+    assert fast.dumps({'caption': '\u2603'}) == '{"caption":"\u2603"}'
+    assert fast.loads(fast.dumps({'caption': '\u2603'})) == {'caption': '\u2603'}
+
+    with patch('windowbox.utils.orjson', None):
+        assert fast.dumps({'caption': '\u2603'}) == '{"caption": "\\u2603"}'
@@ -3,9 +3,15 @@ Useful utilities and other odds-and-ends.
 """
 
 import email.utils
+from flask.json.provider import DefaultJSONProvider
 from htmlmin import minify
 from lxml import etree
 
+try:
+    import orjson
+except ImportError:  # pragma: nocover
+    orjson = None
+
 
 def datetime_to_rfc2822(dt):
     """
@@ -50,3 +56,36 @@ def minify_xml(content, *, encoding):
         remove_blank_text=True, strip_cdata=False))
 
     return etree.tostring(root, encoding=encoding, xml_declaration=True)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider that encodes compact output with orjson, if installed.
+
+    Keys are sorted the same way, and anything orjson would format differently
+    than Flask does (like dates) goes through the same `default` function, so
+    the only visible difference is that non-ASCII characters are written as
+    UTF-8 instead of being escaped. Pretty-printed output (as in debug mode)
+    and calls with any other arguments still go through the standard library.
+    """
+
+    def dumps(self, obj, **kwargs):
+        """
+        Serialize `obj` as a JSON string.
+
+        Args:
+            obj: The data to serialize.
+            kwargs: Arguments for json.dumps(). orjson is only used if these
+                are absent or only ask for compact separators.
+
+        Returns:
+            String of JSON.
+        """
+        if orjson is None or kwargs not in ({}, {'separators': (',', ':')}):
+            return super().dumps(obj, **kwargs)
+
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATACLASS | orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+
+        return orjson.dumps(obj, default=self.default, option=option).decode()